@@ -118,7 +118,20 @@ class GuiServerMixin(object):
             juju_version=juju_version, debug=config['juju-gui-debug'],
             port=config.get('port'), jem_location=config['jem-location'],
             interactive_login=config['interactive-login'],
-            gzip=config['gzip-compression'])
+            gzip=config['gzip-compression'],
+            websocket_compression=config[
+                'builtin-server-websocket-compression'],
+            api_reconnect=config['builtin-server-api-reconnect'],
+            processes=config['builtin-server-processes'],
+            proxy_max_clients=config['builtin-server-proxy-max-clients'],
+            proxy_keep_alive=config['builtin-server-proxy-keep-alive'],
+            proxy_connect_timeout=config[
+                'builtin-server-proxy-connect-timeout'],
+            proxy_request_timeout=config[
+                'builtin-server-proxy-request-timeout'],
+            proxy_queue_timeout=config['builtin-server-proxy-queue-timeout'],
+            proxy_breaker_failures=config[
+                'builtin-server-proxy-breaker-failures'])
 
     def stop(self, backend):
         utils.stop_builtin_server()
@@ -56,6 +56,7 @@ __all__ = [
     'cmd_log',
     'find_missing_packages',
     'get_api_address',
+    'get_api_addresses',
     'get_launchpad_release',
     'get_port',
     'get_release_file_path',
@@ -101,10 +102,20 @@ results_log = None
 def get_api_address(unit_dir=None):
     """Return the Juju API address.
 
+    This is the first of the addresses returned by get_api_addresses.
+    """
+    return get_api_addresses(unit_dir)[0]
+
+
+def get_api_addresses(unit_dir=None):
+    """Return the list of all the Juju API addresses.
+
+    In highly available environments the Juju API is served by multiple
+    controllers.
     """
     api_addresses = os.getenv('JUJU_API_ADDRESSES')
     if api_addresses is not None:
-        return api_addresses.split()[0]
+        return api_addresses.split()
     # The JUJU_API_ADDRESSES environment variable is not included in the hooks
     # context in older releases of juju-core.  Retrieve it from the machiner
     # agent file instead.
@@ -120,8 +131,7 @@ def get_api_address(unit_dir=None):
     else:
         raise IOError('Juju agent configuration file not found.')
     contents = yaml.load(open(agent_conf))
-    return contents['apiinfo']['addrs'][0]
-    return api_addresses.split()[0]
+    return contents['apiinfo']['addrs']
 
 
 def _get_by_attr(collection, attr, value):
@@ -301,10 +311,15 @@ def write_builtin_server_startup(
         ssl_cert_path, serve_tests=False, sandbox=False,
         builtin_server_logging='info', insecure=False, charmworld_url='',
         env_password=None, env_uuid=None, juju_version=None, debug=False,
-        port=None, jem_location=None, interactive_login=False, gzip=True):
+        port=None, jem_location=None, interactive_login=False, gzip=True,
+        websocket_compression=False, api_reconnect=0, processes=1,
+        proxy_max_clients=20, proxy_keep_alive=True, proxy_connect_timeout=20,
+        proxy_request_timeout=20, proxy_queue_timeout=10,
+        proxy_breaker_failures=0):
     """Generate the builtin server Upstart file."""
     log('Generating the builtin server Upstart file.')
     context = {
+        'api_reconnect': api_reconnect,
         'builtin_server_logging': builtin_server_logging,
         'charmworld_url': charmworld_url,
         'env_password': env_password,
@@ -319,14 +334,23 @@ def write_builtin_server_startup(
         'juju_version': juju_version,
         'no_proxy': os.environ.get('no_proxy', os.environ.get('NO_PROXY')),
         'port': port,
+        'processes': processes,
+        'proxy_breaker_failures': proxy_breaker_failures,
+        'proxy_connect_timeout': proxy_connect_timeout,
+        'proxy_keep_alive': proxy_keep_alive,
+        'proxy_max_clients': proxy_max_clients,
+        'proxy_queue_timeout': proxy_queue_timeout,
+        'proxy_request_timeout': proxy_request_timeout,
         'sandbox': sandbox,
         'serve_tests': serve_tests,
         'ssl_cert_path': ssl_cert_path,
+        'websocket_compression': websocket_compression,
     }
     if not sandbox:
-        api_url = 'wss://{}'.format(get_api_address())
+        api_addresses = get_api_addresses()
         context.update({
-            'api_url': api_url,
+            'api_addresses': ','.join(api_addresses),
+            'api_url': 'wss://{}'.format(api_addresses[0]),
             'api_version': 'go',
         })
     if serve_tests:
@@ -339,7 +363,11 @@ def start_builtin_server(
         ssl_cert_path, serve_tests, sandbox, builtin_server_logging,
         insecure, charmworld_url, env_password=None, env_uuid=None,
         juju_version=None, debug=False, port=None, jem_location=None,
-        interactive_login=False, gzip=True):
+        interactive_login=False, gzip=True, websocket_compression=False,
+        api_reconnect=0, processes=1, proxy_max_clients=20,
+        proxy_keep_alive=True, proxy_connect_timeout=20,
+        proxy_request_timeout=20, proxy_queue_timeout=10,
+        proxy_breaker_failures=0):
     """Start the builtin server."""
     if (port is not None) and not port_in_range(port):
         # Do not use the user provided port if it is not valid.
@@ -350,7 +378,15 @@ def start_builtin_server(
         charmworld_url=charmworld_url, env_password=env_password,
         env_uuid=env_uuid, juju_version=juju_version,
         debug=debug, port=port, jem_location=jem_location,
-        interactive_login=interactive_login, gzip=gzip)
+        interactive_login=interactive_login, gzip=gzip,
+        websocket_compression=websocket_compression,
+        api_reconnect=api_reconnect, processes=processes,
+        proxy_max_clients=proxy_max_clients,
+        proxy_keep_alive=proxy_keep_alive,
+        proxy_connect_timeout=proxy_connect_timeout,
+        proxy_request_timeout=proxy_request_timeout,
+        proxy_queue_timeout=proxy_queue_timeout,
+        proxy_breaker_failures=proxy_breaker_failures)
     log('Starting the builtin server.')
     with su('root'):
         service_control(GUISERVER, RESTART)
@@ -0,0 +1,366 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server shared AllWatcher state.
+
+The AllWatcher deltas received from the Juju API are applied to an in-memory
+model of the environment. Browser sessions starting to watch an environment
+which is already being watched receive a compact snapshot of its current state
+straight away, followed by the live deltas.
+
+    - EnvironmentState: the entities in a Juju environment, along with a
+      bounded log of the most recent deltas. The number of entities is capped
+      as well: a state growing beyond the cap is closed. Subscribers (usually
+      multiplexed browser sessions) request changes by calling next().
+    - StateCache: the registry of environment states, keyed by environment
+      UUID and owner, the opaque number of the upstream connection feeding
+      the state. States nobody is subscribed to are evicted after a grace
+      period, and the least recently used states are evicted when too many
+      environments are cached.
+"""
+
+import collections
+import datetime
+import itertools
+import logging
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.watchers import WatcherError
+
+
+# The default maximum number of deltas stored in the log of each environment.
+DEFAULT_MAX_DELTAS = 10000
+# The default number of seconds environment states are kept after the last
+# subscriber leaves.
+DEFAULT_TTL = 60
+# The default maximum number of cached environment states.
+DEFAULT_MAX_ENVIRONMENTS = 100
+# The default maximum number of entities stored for each environment.
+DEFAULT_MAX_ENTITIES = 100000
+# The keys used by the Juju API to identify entities in the AllWatcher deltas.
+ENTITY_ID_KEYS = ('Name', 'Id', 'Key', 'Tag', 'UUID')
+
+_environments = metrics.gauge(
+    'allwatcher_environments', 'The cached environment states.')
+_evictions = metrics.counter(
+    'allwatcher_evictions',
+    'The environment states evicted to make room for new ones.')
+_snapshot_entities = metrics.summary(
+    'allwatcher_snapshot_entities',
+    'The number of entities in the snapshots sent to subscribers.')
+_oversized = metrics.counter(
+    'allwatcher_oversized',
+    'The environment states closed for exceeding the maximum number of '
+    'entities.')
+_resyncs = metrics.counter(
+    'allwatcher_resyncs',
+    'The subscribers resynchronized with a snapshot after falling behind '
+    'the deltas log.')
+
+
+def _entity_key(kind, entity):
+    """Return the key identifying the given entity, or None if not found."""
+    for key in ENTITY_ID_KEYS:
+        if key in entity:
+            return kind, entity[key]
+    return None
+
+
+class EnvironmentState(object):
+    """The current state of a Juju environment, as seen by the AllWatcher.
+
+    Each subscriber (any hashable object) first receives a snapshot of the
+    entities in the environment, and then the deltas it has not yet seen.
+    Only the most recent max_deltas deltas are retained: a subscriber falling
+    further behind is resynchronized with a snapshot, preceded by the removal
+    of the entities it may have seen and which no longer exist. When the last
+    subscriber leaves, the state is closed after ttl seconds, unless a new
+    subscriber joins. The on_close callback is called passing this state when
+    the state is closed.
+
+    At most max_entities entities are stored: if the environment grows beyond
+    that, the state is closed and its subscribers receive an error, so that
+    memory usage is bounded for each environment, not only by the number of
+    cached environments.
+    """
+
+    def __init__(self, watcher_id, max_deltas, ttl, io_loop, on_close,
+                 max_entities=DEFAULT_MAX_ENTITIES):
+        self.closed = False
+        # True after the first deltas have been applied.
+        self.ready = False
+        self.watcher_id = watcher_id
+        self._max_entities = max_entities
+        self._ttl = ttl
+        self._io_loop = io_loop
+        self._on_close = on_close
+        self._error = None
+        self._timeout = None
+        # The entities attribute maps (kind, id) tuples to entities.
+        self._entities = collections.OrderedDict()
+        self._deltas = collections.deque(maxlen=max_deltas)
+        # The removed attribute maps the keys of the removed entities to
+        # (sequence, delta) tuples, oldest first. Removals are only retained
+        # while subscribers may not have seen them.
+        self._removed = collections.OrderedDict()
+        # The total number of deltas applied so far.
+        self._sequence = 0
+        # The positions attribute maps subscribers to the number of deltas
+        # they have seen, or None if they have not yet received the snapshot.
+        self._positions = {}
+        # The futures attribute maps subscribers to pending Futures.
+        self._futures = {}
+
+    @property
+    def entities(self):
+        """Return the number of entities in the environment."""
+        return len(self._entities)
+
+    @property
+    def subscribers(self):
+        """Return the number of subscribers."""
+        return len(self._positions)
+
+    def subscribe(self, subscriber):
+        """Subscribe to changes: the snapshot will be sent first."""
+        if self.closed:
+            raise WatcherError(self._error)
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._positions[subscriber] = None
+
+    def unsubscribe(self, subscriber):
+        """Remove the given subscriber.
+
+        Schedule the state to be closed if no subscribers are left.
+        """
+        self._positions.pop(subscriber, None)
+        future = self._futures.pop(subscriber, None)
+        if future is not None:
+            future.set_exception(WatcherError('AllWatcher stopped'))
+        if self.closed or self._positions:
+            return
+        if self._ttl:
+            self._timeout = self._io_loop.add_timeout(
+                datetime.timedelta(seconds=self._ttl), self.close)
+        else:
+            self.close()
+
+    def next(self, subscriber):
+        """Request the changes the given subscriber has not yet seen.
+
+        Return a Future whose result is a (deltas, snapshot) tuple, where
+        snapshot is True if the deltas describe the whole environment.
+        """
+        if subscriber not in self._positions:
+            raise WatcherError('AllWatcher not started')
+        if subscriber in self._futures:
+            raise WatcherError('AllWatcher already waiting for changes')
+        future = Future()
+        if self.closed:
+            future.set_exception(WatcherError(self._error))
+        elif not self._resolve(subscriber, future):
+            self._futures[subscriber] = future
+        return future
+
+    def _resolve(self, subscriber, future):
+        """Send the subscriber its unseen changes using the given Future.
+
+        Return False if there are no changes to send.
+        """
+        position = self._positions[subscriber]
+        if position is None:
+            if not self.ready:
+                return False
+            deltas = self.snapshot()
+            _snapshot_entities.observe(len(deltas))
+            result = deltas, True
+        else:
+            unseen = self._sequence - position
+            if not unseen:
+                return False
+            if unseen > len(self._deltas):
+                # The deltas are no longer available: resynchronize.
+                _resyncs.inc()
+                deltas = [
+                    delta for sequence, delta in self._removed.values()
+                    if sequence > position]
+                deltas.extend(self.snapshot())
+            else:
+                start = len(self._deltas) - unseen
+                deltas = list(itertools.islice(self._deltas, start, None))
+            result = deltas, False
+        self._positions[subscriber] = self._sequence
+        future.set_result(result)
+        return True
+
+    def snapshot(self):
+        """Return the deltas describing all the entities in the environment."""
+        return [
+            [kind, 'change', entity]
+            for (kind, _), entity in self._entities.items()]
+
+    def apply(self, deltas):
+        """Apply the given AllWatcher deltas and notify the subscribers."""
+        removed = self._removed
+        for delta in deltas:
+            self._sequence += 1
+            kind, operation, entity = delta
+            key = _entity_key(kind, entity)
+            if key is None:
+                logging.warning(
+                    'allwatcher: unknown entity: {!r}'.format(delta))
+            elif operation == 'remove':
+                self._entities.pop(key, None)
+                removed.pop(key, None)
+                removed[key] = self._sequence, delta
+            else:
+                self._entities[key] = entity
+                removed.pop(key, None)
+            self._deltas.append(delta)
+        if len(self._entities) > self._max_entities:
+            logging.warning(
+                'allwatcher: too many entities in the environment: '
+                '{}'.format(len(self._entities)))
+            _oversized.inc()
+            self.close('AllWatcher state too large')
+            return
+        self.ready = True
+        futures, self._futures = self._futures, {}
+        for subscriber, future in futures.items():
+            if not self._resolve(subscriber, future):
+                self._futures[subscriber] = future
+        self._forget_removed()
+
+    def _forget_removed(self):
+        """Forget the removals already seen by all the subscribers."""
+        positions = [
+            position for position in self._positions.values()
+            if position is not None]
+        seen = min(positions) if positions else self._sequence
+        removed = self._removed
+        while removed:
+            key, (sequence, _) = next(removed.iteritems())
+            if sequence > seen:
+                break
+            del removed[key]
+
+    def close(self, error='AllWatcher stopped'):
+        """Close the state, failing all pending requests for changes."""
+        if self.closed:
+            return
+        self.closed = True
+        self._error = error
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._entities.clear()
+        self._deltas.clear()
+        self._removed.clear()
+        futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(WatcherError(error))
+        self._on_close(self)
+
+
+class StateCache(object):
+    """The environment states currently cached.
+
+    States are keyed by (environment UUID, owner) tuples, the owner being an
+    opaque number identifying the upstream connection feeding the state: the
+    same environment watched by different users or connections has a state
+    for each of them. Owners are never reported as user names, as the status
+    is publicly exposed.
+
+    Note that the cache is instantiated once when the application is
+    bootstrapped and shared by all the upstream Juju API connections.
+
+    At most max_environments states are cached. When a new state is created,
+    the least recently used states are evicted to make room for it: states
+    nobody is subscribed to are evicted first. The subscribers of an evicted
+    state receive an error, and can start watching the environment again.
+    Each state stores at most max_entities entities.
+    """
+
+    def __init__(self, max_deltas=DEFAULT_MAX_DELTAS, ttl=DEFAULT_TTL,
+                 max_environments=DEFAULT_MAX_ENVIRONMENTS,
+                 max_entities=DEFAULT_MAX_ENTITIES, io_loop=None):
+        self._max_deltas = max_deltas
+        self._max_entities = max_entities
+        self._ttl = ttl
+        self._max_environments = max_environments
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._ids = itertools.count(1)
+        # Map keys to states, the least recently used state first.
+        self._states = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the open state for the given environment, or None."""
+        state = self._states.pop(key, None)
+        if state is not None:
+            # Move the state to the end, as the most recently used.
+            self._states[key] = state
+        return state
+
+    def create(self, key, on_close):
+        """Create and return a new state for the given environment.
+
+        The on_close callback is called passing the state when it is closed.
+        """
+        self._evict()
+
+        def close(state):
+            if self._states.get(key) is state:
+                del self._states[key]
+                _environments.dec()
+            on_close(state)
+        state = EnvironmentState(
+            str(next(self._ids)), self._max_deltas, self._ttl, self._io_loop,
+            close, max_entities=self._max_entities)
+        self._states[key] = state
+        _environments.inc()
+        return state
+
+    def _evict(self):
+        """Make room for a new state, evicting the least recently used ones.
+        """
+        states = self._states
+        while states and len(states) >= self._max_environments:
+            idle = [
+                state for state in states.values() if not state.subscribers]
+            state = idle[0] if idle else next(states.itervalues())
+            _evictions.inc()
+            # Closing the state also removes it from the cache.
+            state.close('AllWatcher state evicted')
+
+    def status(self):
+        """Return a list describing the cached environment states.
+
+        Upstream connections are identified by their opaque owner number.
+        """
+        return [{
+            'environment': environment,
+            'upstream': owner,
+            'entities': state.entities,
+            'ready': state.ready,
+            'subscribers': state.subscribers,
+        } for (environment, owner), state in self._states.items()]
@@ -0,0 +1,203 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server Juju API responses cache.
+
+The GUI repeatedly requests data which rarely changes, like charm or
+environment info, and each browser tab does it separately. The responses to
+an allowlist of read-only "Type.Request" methods can be cached, so that
+subsequent identical requests are answered by the GUI server without
+contacting the Juju API. Entries are keyed by Juju API URL, user, method and
+normalized parameters: cached responses are never shared between users.
+
+Entries expire after a configurable amount of time. Each method can also be
+related to AllWatcher delta kinds (e.g. "service"): when a browser receives
+a delta of a related kind, the entries for that method and environment are
+invalidated. Delta kinds are found by scanning the raw messages, so that
+the AllWatcher messages are still relayed without being decoded. Methods are
+described by strings like the following:
+
+    Client.CharmInfo,Client.ServiceGet:service,Client.Status:service+unit
+
+    - parse_methods: parse the description of the cached methods;
+    - ResponseCache: the cache, shared by all the browser connections.
+"""
+
+import collections
+import json
+import re
+import time
+
+from guiserver import metrics
+
+
+# The default number of seconds responses are cached.
+DEFAULT_TTL = 60
+# The default maximum number of cached responses.
+DEFAULT_MAX_ENTRIES = 1000
+
+_request_id_pattern = re.compile(r'"RequestId"\s*:\s*(\d+)')
+# Find the kinds of the AllWatcher deltas, encoded as ["kind", "change", {}].
+_delta_kinds = re.compile(
+    r'\[\s*"([^"\\]+)"\s*,\s*"(?:change|remove)"\s*,').findall
+
+_hits = metrics.counter(
+    'api_cache_hits',
+    'The Juju API requests answered from the cache, each one saving an '
+    'upstream round trip.')
+_misses = metrics.counter(
+    'api_cache_misses',
+    'The cacheable Juju API requests sent to the Juju API.')
+_invalidations = metrics.counter(
+    'api_cache_invalidations',
+    'The cached Juju API responses invalidated by AllWatcher deltas.')
+_entries = metrics.gauge(
+    'api_cache_entries', 'The cached Juju API responses.')
+
+
+def parse_methods(value):
+    """Parse the given comma separated description of the cached methods.
+
+    Return a dict mapping "Type.Request" methods to frozensets of related
+    AllWatcher delta kinds. Raise a ValueError if the value is not valid.
+    """
+    methods = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        method, _, kinds = item.partition(':')
+        request_type, _, request = method.partition('.')
+        if not (request_type and request):
+            raise ValueError('invalid method: {}'.format(method))
+        methods[method] = frozenset(kind for kind in kinds.split('+') if kind)
+    return methods
+
+
+def get_request_id(message):
+    """Return the request id included in the given raw JSON message.
+
+    Return None if the message does not include a request id.
+    """
+    match = _request_id_pattern.search(message)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class ResponseCache(object):
+    """Cache the responses to read-only Juju API requests.
+
+    Note that the cache is instantiated once when the application is
+    bootstrapped and used as a singleton by all WebSocket requests.
+    """
+
+    def __init__(
+            self, methods, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """Initialize the cache.
+
+        The methods argument is a dict as returned by parse_methods.
+        Responses are cached for ttl seconds. When max_entries responses are
+        cached, the least recently used one is discarded.
+        """
+        self._methods = methods
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._kinds = frozenset().union(*methods.values())
+        # The markers used to identify the browser messages which must be
+        # decoded, i.e. the quoted names of the cached requests.
+        self.markers = tuple(sorted(set(
+            '"{}"'.format(method.partition('.')[2]) for method in methods)))
+        # The entries attribute maps keys to (response, expiration) tuples,
+        # the least recently used entry first.
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, apiurl, username, data):
+        """Return the cache key for the given request data.
+
+        Return None if the request cannot be cached.
+        """
+        method = '{}.{}'.format(data.get('Type'), data.get('Request'))
+        if method not in self._methods or 'RequestId' not in data:
+            return None
+        params = json.dumps(data.get('Params', {}), sort_keys=True)
+        return (
+            apiurl, username, method, data.get('Id'), data.get('Version'),
+            params)
+
+    def get(self, key, request_id):
+        """Return the cached response for the given key, or None.
+
+        The returned response includes the given request id.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[1] <= time.time():
+            _entries.set(len(self._entries))
+            entry = None
+        if entry is None:
+            _misses.inc()
+            return None
+        # Move the entry to the end, as the most recently used.
+        self._entries[key] = entry
+        _hits.inc()
+        return dict(entry[0], RequestId=request_id)
+
+    def put(self, key, data):
+        """Cache the given response data, unless it reports an error."""
+        if 'Error' in data:
+            return
+        response = dict(data)
+        response.pop('RequestId', None)
+        self._entries.pop(key, None)
+        while len(self._entries) >= self._max_entries:
+            self._entries.popitem(last=False)
+        self._entries[key] = (response, time.time() + self._ttl)
+        _entries.set(len(self._entries))
+
+    def invalidate(self, apiurl, message):
+        """Invalidate the entries related to the deltas in the given message.
+
+        The raw message has been received from the Juju API at the given URL.
+        This is a cheap scan of the message string, which is not decoded:
+        false positives just cause entries to be invalidated early.
+        """
+        if not self._kinds or '"Deltas"' not in message:
+            return
+        kinds = self._kinds.intersection(_delta_kinds(message))
+        if not kinds:
+            return
+        methods = self._methods
+        stale = [
+            key for key in self._entries
+            if key[0] == apiurl and not kinds.isdisjoint(methods[key[2]])]
+        for key in stale:
+            del self._entries[key]
+        _invalidations.inc(len(stale))
+        _entries.set(len(self._entries))
+
+    def status(self):
+        """Return a dict describing the cache usage."""
+        hits, misses = _hits.value, _misses.value
+        requests = hits + misses
+        return {
+            'entries': len(self._entries),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / requests if requests else None,
+            'invalidations': _invalidations.value,
+        }
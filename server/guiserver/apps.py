@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Juju GUI server applications."""
+import os
 import time
 
 from pyramid.config import Configurator
@@ -23,8 +24,23 @@ from tornado.options import options
 from tornado.wsgi import WSGIContainer
 
 from guiserver import (
+    allwatcher,
+    apicache,
     auth,
+    batching,
+    breaker,
+    charmcache,
+    coalesce,
+    compression,
+    failover,
     handlers,
+    httppool,
+    icons,
+    latency,
+    multiplex,
+    pool,
+    resume,
+    shared,
     utils,
 )
 from guiserver.bundles.base import Deployer
@@ -35,39 +51,156 @@ from jujugui import make_application
 WEBSOCKET_URL_TEMPLATE = '/api/$server/$port/$uuid'
 
 
+def get_deflate_options():
+    """Return the WebSocket compression options."""
+    return compression.DeflateOptions(
+        level=options.wsdeflatelevel,
+        max_window_bits=options.wsdeflatewindow,
+        min_size=options.wsdeflateminsize)
+
+
 def server():
     """Return the main server application.
 
     The server app is responsible for serving the WebSocket connection, the
     Juju GUI static files and the main index file for dynamic URLs.
     """
+    # Set up the state shared with the other server processes, if any.
+    token_store = changeset_store = deployer_lock = None
+    if options.shareddir:
+        database = os.path.join(options.shareddir, 'shared.db')
+        token_store = shared.SharedStore(database, table='tokens')
+        changeset_store = shared.SharedStore(database, table='changesets')
+        deployer_lock = os.path.join(options.shareddir, 'deployer.lock')
     # Set up the bundle deployer.
     deployer = Deployer(options.apiurl, options.apiversion,
-                        options.charmworldurl)
+                        options.charmworldurl, lock_path=deployer_lock)
     # Set up handlers.
     server_handlers = []
+    multiplexer = None
+    connection_pool = None
+    controllers = None
+    response_cache = None
+    charm_cache = None
+    single_flight = None
+    http_pool = None
+    api_latency = latency.ApiLatency()
     if options.sandbox:
         # Sandbox mode.
         server_handlers.append(
             (r'^/ws(?:/.*)?$', handlers.SandboxHandler, {}))
     else:
         # Real environment.
-        tokens = auth.AuthenticationTokenHandler()
+        tokens = auth.AuthenticationTokenHandler(store=token_store)
+        auth_backend = auth.get_backend(options.apiversion)
+        connect = None
+        if options.apiaddresses:
+            controllers = failover.Controllers(
+                options.apiaddresses.split(','),
+                connect_timeout=options.apiconnecttimeout)
+            connect = controllers.connect
+        if options.multiplex:
+            states = allwatcher.StateCache(
+                max_deltas=options.allwatcherbacklog,
+                ttl=options.allwatcherttl,
+                max_environments=options.allwatchermaxenvironments,
+                max_entities=options.allwatchermaxentities)
+            multiplexer = multiplex.Multiplexer(
+                auth_backend, states=states, connect=connect)
+        elif options.upstreampool:
+            connection_pool = pool.ConnectionPool(
+                size=options.upstreampool, max_idle=options.upstreampoolidle,
+                connect=connect)
+        compression_options = None
+        if options.wsdeflate:
+            compression_options = get_deflate_options()
+        parking = None
+        if options.resumewindow:
+            parking = resume.SessionParking(
+                window=options.resumewindow,
+                max_sessions=options.resumesessions,
+                max_bytes=options.resumebytes)
+        if options.apicache:
+            response_cache = apicache.ResponseCache(
+                apicache.parse_methods(options.apicache),
+                ttl=options.apicachettl, max_entries=options.apicachesize)
+        if options.charmcachedir:
+            charm_cache = charmcache.CharmFileCache(
+                options.charmcachedir, max_size=options.charmcachesize,
+                ttl=options.charmcachettl)
+        if options.proxycoalescewait:
+            single_flight = coalesce.SingleFlight(
+                timeout=options.proxycoalescewait / 1000.0)
+        juju_core_url = utils.ws_to_http(options.apiurl)
+        circuit_breaker = None
+        if options.proxybreakerfailures:
+            # Server certificates are not validated: see
+            # handlers.JujuProxyHandler.initialize.
+            circuit_breaker = breaker.CircuitBreaker(
+                'juju-core', juju_core_url, validate_cert=False,
+                max_failures=options.proxybreakerfailures,
+                max_latency=options.proxybreakerlatency / 1000.0,
+                reset_timeout=options.proxybreakerreset)
+        http_pool = httppool.HTTPPool(
+            'juju-core', max_clients=options.proxymaxclients,
+            keep_alive=options.proxykeepalive,
+            connect_timeout=options.proxyconnecttimeout,
+            request_timeout=options.proxyrequesttimeout,
+            queue_timeout=options.proxyqueuetimeout, breaker=circuit_breaker)
+        batching_options = None
+        if options.wsbatch:
+            batching_options = batching.BatchOptions(
+                max_size=options.wsbatchsize, delay=options.wsbatchdelay)
         websocket_handler_options = {
             # The Juju API backend url.
             'apiurl': options.apiurl,
             # The backend to use for user authentication.
-            'auth_backend': auth.get_backend(options.apiversion),
+            'auth_backend': auth_backend,
             # The Juju deployer to use for importing bundles.
             'deployer': deployer,
             # The tokens collection for authentication token requests.
             'tokens': tokens,
             # The WebSocket URL template.
             'ws_url_template': WEBSOCKET_URL_TEMPLATE,
+            # The shared upstream connections multiplexer, or None.
+            'multiplexer': multiplexer,
+            # The pre-warmed upstream connections pool, or None.
+            'pool': connection_pool,
+            # The Juju API controllers used for failover, or None.
+            'controllers': controllers,
+            # The number of times a browser session is reconnected to the Juju
+            # API when the connection is unexpectedly closed.
+            'reconnect_attempts': options.apireconnect,
+            # The browser WebSocket compression options, or None.
+            'compression': compression_options,
+            # The browser WebSocket batching options, or None.
+            'batching': batching_options,
+            # The Juju API calls latency aggregator.
+            'latency': api_latency,
+            # The change set tokens store shared between processes, or None.
+            'changesets': changeset_store,
+            # The registry of the sessions waiting to be resumed, or None.
+            'parking': parking,
+            # The cache of the read-only Juju API responses, or None.
+            'response_cache': response_cache,
         }
         juju_proxy_handler_options = {
-            'target_url': utils.ws_to_http(options.apiurl),
-            'charmworld_url': options.charmworldurl,
+            'target_url': juju_core_url,
+            # The response bytes buffered for slow clients before pausing.
+            'max_buffer': options.proxybuffer,
+            # The disk cache of charm files, or None.
+            'charm_cache': charm_cache,
+            # The registry of the charms lacking an icon.
+            'missing_icons': icons.MissingIcons(
+                ttl=options.missingiconttl,
+                max_entries=options.missingiconsize),
+            # The registry of the fetches shared by identical requests, or
+            # None.
+            'single_flight': single_flight,
+            # The pool of connections to juju-core.
+            'http_pool': http_pool,
+            # Whether to compress the text-like responses.
+            'compress': options.gzip,
         }
         server_handlers.extend([
             # Handle WebSocket connections.
@@ -88,6 +221,12 @@ def server():
         'apiurl': options.apiurl,
         'apiversion': options.apiversion,
         'deployer': deployer,
+        'multiplexer': multiplexer,
+        'pool': connection_pool,
+        'controllers': controllers,
+        'response_cache': response_cache,
+        'charm_cache': charm_cache,
+        'http_pool': http_pool,
         'sandbox': options.sandbox,
         'start_time': int(time.time()),
     }
@@ -114,6 +253,11 @@ def server():
     server_handlers.extend([
         # Handle GUI server info.
         (r'^/gui-server-info', handlers.InfoHandler, info_handler_options),
+        # Handle Juju API latency info.
+        (r'^/gui-server-latency', handlers.LatencyHandler,
+         {'latency': api_latency}),
+        # Handle metrics in the Prometheus format.
+        (r'^/metrics$', handlers.MetricsHandler, {'latency': api_latency}),
         (r".*", web.FallbackHandler, dict(fallback=wsgi_app))
     ])
     return web.Application(server_handlers, debug=options.debug)
@@ -48,7 +48,14 @@ import datetime
 import logging
 import uuid
 
-from tornado.ioloop import IOLoop
+from guiserver import (
+    metrics,
+    shared,
+)
+
+
+_tokens = metrics.gauge(
+    'auth_tokens', 'The authentication tokens waiting to be used.')
 
 
 class User(object):
@@ -286,12 +293,18 @@ class AuthenticationTokenHandler(object):
         }
     """
 
-    def __init__(self, max_life=datetime.timedelta(minutes=2), io_loop=None):
+    def __init__(self, max_life=datetime.timedelta(minutes=2), store=None):
+        """Initialize the tokens handler.
+
+        Tokens are saved in the given store, which is responsible for
+        expiring them (see guiserver.shared). Use a shared.SharedStore to
+        allow tokens to be used in all the server processes sharing the
+        store. If not provided, tokens are kept in memory.
+        """
         self._max_life = max_life
-        if io_loop is None:
-            io_loop = IOLoop.current()
-        self._io_loop = io_loop
-        self._data = {}
+        if store is None:
+            store = shared.MemoryStore()
+        self._store = store
 
     def token_requested(self, data):
         """Does data represent a token creation request?  True or False."""
@@ -311,29 +324,23 @@ class AuthenticationTokenHandler(object):
                 Response={}))
             return
         token = uuid.uuid4().hex
-
-        def expire_token():
-            self._data.pop(token, None)
-            logging.info('auth: expired token {}'.format(token))
-        handle = self._io_loop.add_timeout(self._max_life, expire_token)
         now = datetime.datetime.utcnow()
-        # Stashing these is a security risk.  We currently deem this risk to
-        # be acceptably small.  Even keeping an authenticated websocket in
-        # memory seems to be of a similar risk profile, and we cannot operate
-        # without that.
-        self._data[token] = dict(
-            username=user.username,
-            password=user.password,
-            handle=handle
-            )
-        write_message({
+        response = {
             'RequestId': data['RequestId'],
             'Response': {
                 'Token': token,
                 'Created': now.isoformat() + 'Z',
                 'Expires': (now + self._max_life).isoformat() + 'Z'
             }
-        })
+        }
+        # Stashing these is a security risk.  We currently deem this risk to
+        # be acceptably small.  Even keeping an authenticated websocket in
+        # memory seems to be of a similar risk profile, and we cannot operate
+        # without that.
+        credentials = dict(username=user.username, password=user.password)
+        self._store.put(token, credentials, self._max_life.total_seconds())
+        _tokens.set(len(self._store))
+        write_message(response)
 
     def authentication_requested(self, data):
         """Does data represent a token authentication request? True or False.
@@ -349,10 +356,10 @@ class AuthenticationTokenHandler(object):
     def process_authentication_request(self, data, write_message):
         """Get the credentials for the token, or send an error."""
         token = data['Params']['Token']
-        credentials = self._data.pop(token, None)
+        credentials = self._store.pop(token)
+        _tokens.set(len(self._store))
         if credentials is not None:
             logging.info('auth: using token {}'.format(token))
-            self._io_loop.remove_timeout(credentials['handle'])
             return credentials['username'], credentials['password']
         else:
             write_message({
@@ -0,0 +1,110 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server WebSocket frame batching.
+
+Browsers selecting the SUBPROTOCOL WebSocket sub-protocol receive the Juju
+API messages in batches: each WebSocket frame is a JSON array including all
+the messages received from the Juju API within the same IO loop iteration, or
+within the configured delay. This reduces the number of writes, and therefore
+of system calls and TLS records, when the Juju API sends many small frames.
+
+    - BatchOptions: the batching settings, provided by the server options.
+    - FrameBatcher: collect the messages to be sent to a browser, and send
+      them in batches.
+"""
+
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+
+
+# The WebSocket sub-protocol requested by browsers supporting batches.
+SUBPROTOCOL = 'juju-gui-batch'
+
+_batch_messages = metrics.summary(
+    'ws_batch_messages',
+    'The number of messages included in each batched WebSocket frame.')
+
+
+class BatchOptions(object):
+    """The WebSocket batching settings.
+
+    The max_size is the maximum number of messages included in a frame, and
+    the delay is the number of milliseconds messages are collected before a
+    frame is sent. If the delay is 0, the messages handled within the same
+    IO loop iteration are sent together: note that Tornado parses the
+    WebSocket frames received in a single read across several iterations, so
+    a small delay is usually required for messages to be coalesced.
+    """
+
+    __slots__ = ('max_size', 'delay')
+
+    def __init__(self, max_size=100, delay=5):
+        self.max_size = max_size
+        self.delay = delay
+
+
+class FrameBatcher(object):
+    """Collect messages and send them in batched frames.
+
+    The write callable receives the frames, i.e. JSON arrays of the collected
+    messages, which are assumed to be JSON encoded strings.
+    """
+
+    def __init__(self, write, options, io_loop=None):
+        self._write = write
+        self._max_size = options.max_size
+        self._delay = options.delay / 1000.0
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._messages = []
+        # The handle of the scheduled flush, or None if not scheduled.
+        self._scheduled = None
+
+    def add(self, message):
+        """Add a message to the current batch.
+
+        The batch is sent if full, or scheduled to be sent otherwise.
+        """
+        self._messages.append(message)
+        if len(self._messages) >= self._max_size:
+            return self.flush()
+        if self._scheduled is None:
+            if self._delay:
+                self._scheduled = self._io_loop.add_timeout(
+                    self._io_loop.time() + self._delay, self.flush)
+            else:
+                self._scheduled = True
+                self._io_loop.add_callback(self.flush)
+
+    def flush(self):
+        """Send the collected messages, if any."""
+        self.cancel()
+        messages, self._messages = self._messages, []
+        if messages:
+            _batch_messages.observe(len(messages))
+            self._write(u'[' + u','.join(messages) + u']')
+
+    def cancel(self):
+        """Cancel the scheduled flush, if any.
+
+        The collected messages are preserved.
+        """
+        scheduled, self._scheduled = self._scheduled, None
+        if scheduled not in (None, True):
+            self._io_loop.remove_timeout(scheduled)
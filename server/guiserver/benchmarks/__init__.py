@@ -0,0 +1,27 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server benchmarks.
+
+This package includes command line tools used to measure the performance of
+the GUI server on the local machine, without requiring a Juju environment.
+Each module can be run as a script, e.g.:
+
+    python -m guiserver.benchmarks.proxy --help
+
+Results are printed to stdout as a JSON object, so that they can be stored and
+compared across GUI server revisions.
+"""
@@ -0,0 +1,198 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the system calls required to deliver Juju API deltas.
+
+A local WebSocket server is used as the Juju API upstream: each time it
+receives a request it replies with a burst of small AllWatcher like frames, as
+juju-core does during big deployments. The GUI server WebSocket handler is
+run in a separate process in front of it, with batching enabled:
+
+    benchmark client -> WebSocketHandler -> burst server
+
+The benchmark is run twice, first by a legacy client receiving a frame for
+each message, and then by a client requesting the batching sub-protocol. For
+each run, the number of socket send system calls performed by the proxy
+process for each message delivered to the client is reported, along with the
+number of frames received by the client. Send calls are counted by
+instrumenting the Tornado IOStream in the proxy process, e.g.:
+
+    python -m guiserver.benchmarks.batching --bursts 200 --burst-size 50
+"""
+
+import argparse
+import json
+import multiprocessing
+
+from tornado import (
+    gen,
+    httpclient,
+    iostream,
+    netutil,
+    web,
+    websocket,
+)
+from tornado.ioloop import IOLoop
+
+from guiserver import batching
+from guiserver.benchmarks.proxy import (
+    make_proxy_app,
+    serve,
+    start_process,
+)
+
+
+class BurstHandler(websocket.WebSocketHandler):
+    """A WebSocket server replying to each message with a burst of frames."""
+
+    def initialize(self, burst_size, size):
+        self.burst_size = burst_size
+        self.padding = 'x' * size
+
+    def on_message(self, message):
+        """Send a burst of AllWatcher deltas."""
+        request_id = json.loads(message)['RequestId']
+        for index in range(self.burst_size):
+            delta = ['unit', 'change', {
+                'Name': 'django/{}'.format(index),
+                'Status': self.padding,
+            }]
+            self.write_message(json.dumps({
+                'RequestId': request_id,
+                'Response': {'Deltas': [delta]},
+            }))
+
+
+def make_burst_app(burst_size, size):
+    """Return a Tornado application sending bursts of WebSocket frames."""
+    options = {'burst_size': burst_size, 'size': size}
+    return web.Application([(r'/burst', BurstHandler, options)])
+
+
+def make_batching_proxy_app(apiurl, max_size, delay):
+    """Return a proxy application supporting batched frames."""
+    options = batching.BatchOptions(max_size=max_size, delay=delay)
+    return make_proxy_app(apiurl, options)
+
+
+def serve_counting_sends(sockets, sends, make_app, *args):
+    """Serve the application like proxy.serve, counting socket sends.
+
+    Each call to IOStream.write_to_fd performs a send system call: the calls
+    are counted in the given multiprocessing.Value.
+    """
+    write_to_fd = iostream.IOStream.write_to_fd
+
+    def counting_write_to_fd(stream, data):
+        with sends.get_lock():
+            sends.value += 1
+        return write_to_fd(stream, data)
+
+    iostream.IOStream.write_to_fd = counting_write_to_fd
+    serve(sockets, make_app, *args)
+
+
+@gen.coroutine
+def run_client(url, bursts, burst_size, batched):
+    """Request the given number of bursts through the proxy at url.
+
+    Return the number of frames received by the client.
+    """
+    request = httpclient.HTTPRequest(url)
+    if batched:
+        request.headers['Sec-WebSocket-Protocol'] = batching.SUBPROTOCOL
+    conn = yield websocket.websocket_connect(request)
+    frames = 0
+    for request_id in range(bursts):
+        conn.write_message(json.dumps({'RequestId': request_id}))
+        received = 0
+        while received < burst_size:
+            message = yield conn.read_message()
+            if message is None:
+                raise IOError('connection closed by the proxy')
+            frames += 1
+            if batched:
+                received += len(json.loads(message))
+            else:
+                received += 1
+    conn.close()
+    raise gen.Return(frames)
+
+
+def measure(url, sends, bursts, burst_size, batched):
+    """Run the client and return the results as a dict.
+
+    The sends argument is the counter of the proxy socket send calls.
+    """
+    sends_start = sends.value
+    frames = IOLoop.instance().run_sync(
+        lambda: run_client(url, bursts, burst_size, batched), timeout=3600)
+    calls = sends.value - sends_start
+    messages = bursts * burst_size
+    return {
+        'frames': frames,
+        'messages': messages,
+        'messages_per_frame': round(messages / float(frames), 2),
+        'proxy_send_calls': calls,
+        'send_calls_per_message': round(calls / float(messages), 3),
+    }
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--bursts', type=int, default=200,
+        help='the number of bursts to request (default: %(default)s)')
+    parser.add_argument(
+        '--burst-size', type=int, default=50,
+        help='the number of frames in each burst (default: %(default)s)')
+    parser.add_argument(
+        '--size', type=int, default=64,
+        help='the approximate size of each frame (default: %(default)s)')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='the maximum number of messages in a batch '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--batch-delay', type=int, default=5,
+        help='the batch flush delay in milliseconds (default: %(default)s)')
+    args = parser.parse_args()
+    burst_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    proxy_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    apiurl = 'ws://127.0.0.1:{}/burst'.format(
+        burst_sockets[0].getsockname()[1])
+    url = 'ws://127.0.0.1:{}/ws'.format(proxy_sockets[0].getsockname()[1])
+    start_process(
+        serve, burst_sockets, make_burst_app, args.burst_size, args.size)
+    sends = multiprocessing.Value('L', 0)
+    start_process(
+        serve_counting_sends, proxy_sockets, sends, make_batching_proxy_app,
+        apiurl, args.batch_size, args.batch_delay)
+    results = {
+        'bursts': args.bursts,
+        'burst_size': args.burst_size,
+        'size': args.size,
+        'batch_size': args.batch_size,
+        'batch_delay': args.batch_delay,
+        'legacy': measure(url, sends, args.bursts, args.burst_size, False),
+        'batched': measure(url, sends, args.bursts, args.burst_size, True),
+    }
+    print(json.dumps(results, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
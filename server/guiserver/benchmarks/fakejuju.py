@@ -0,0 +1,646 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Run a fake Juju API server for benchmarking and profiling.
+
+The fake server speaks enough of the Juju API WebSocket protocol to be used
+as the upstream of the GUI server without a real Juju environment: the
+Admin.Login, Client.WatchAll, AllWatcher.Next/Stop and a few read-only and
+write Client calls are implemented. The environment is synthetic: its size
+and the rate at which units change their status are configurable, and it is
+generated from a seed, so that runs are reproducible.
+
+Start the fake server and point the GUI server at it, e.g.:
+
+    python -m guiserver.benchmarks.fakejuju --port 17070 --services 50 \\
+        --units 500 --rate 20
+    python runserver.py --apiurl wss://127.0.0.1:17070 --insecure ...
+
+A JSON object describing the fake environment, including the Juju API URL,
+is printed to stdout when the server is ready. Log in as "user-admin" with
+the password "password" unless different credentials are provided.
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import uuid
+
+import tornado
+from tornado import (
+    gen,
+    httpserver,
+    netutil,
+    web,
+    websocket,
+)
+from tornado.concurrent import Future
+from tornado.ioloop import (
+    IOLoop,
+    PeriodicCallback,
+)
+
+
+DEFAULT_USERNAME = 'user-admin'
+DEFAULT_PASSWORD = 'password'
+# The series used by the synthetic machines and charms.
+SERIES = 'trusty'
+# The interval in milliseconds at which deltas are generated.
+TICK_INTERVAL = 100
+# The unit statuses cycled by the generated deltas.
+UNIT_STATUSES = ('started', 'pending', 'installed', 'started')
+# The facades advertised in the login response.
+FACADES = (
+    {'Name': 'AllWatcher', 'Versions': [0]},
+    {'Name': 'Client', 'Versions': [0]},
+    {'Name': 'Pinger', 'Versions': [0]},
+)
+
+
+class ApiError(Exception):
+    """A Juju API error, reported to the client as an error response."""
+
+    def __init__(self, message, code=''):
+        super(ApiError, self).__init__(message)
+        self.code = code
+
+
+class Environment(object):
+    """A synthetic Juju environment.
+
+    The environment includes the given number of services and units, each
+    unit living in its own machine. Pairs of services are related, and each
+    service is annotated with its position in the GUI canvas.
+    """
+
+    def __init__(self, services=10, units=100, seed=None, name='fake'):
+        self.name = name
+        self._random = random.Random(seed)
+        self.uuid = str(uuid.UUID(int=self._random.getrandbits(128)))
+        # The entities attribute maps (kind, id) tuples to entities.
+        self._entities = collections.OrderedDict()
+        self._watchers = set()
+        self._units = []
+        self._generate(services, units)
+
+    def _add(self, kind, key, entity):
+        """Add the given entity to the environment."""
+        self._entities[kind, key] = entity
+
+    def _generate(self, services, units):
+        """Populate the environment."""
+        names = ['service-{}'.format(num) for num in range(services)]
+        for num, name in enumerate(names):
+            self._add('service', name, {
+                'Name': name,
+                'CharmURL': 'cs:{}/app-{}-1'.format(SERIES, num),
+                'Exposed': False,
+                'Life': 'alive',
+                'MinUnits': 0,
+                'OwnerTag': 'user-admin',
+                'Constraints': {},
+                'Config': {'debug': False},
+                'Status': {'Current': 'active', 'Message': ''},
+                'Subordinate': False,
+            })
+            self._add('annotation', 'service-' + name, {
+                'Tag': 'service-' + name,
+                'Annotations': {
+                    'gui-x': str(num % 10 * 300),
+                    'gui-y': str(num // 10 * 300),
+                },
+            })
+        for num in range(0, services - 1, 2):
+            key = '{}:db {}:db'.format(names[num], names[num + 1])
+            self._add('relation', key, {
+                'Key': key,
+                'Id': num // 2,
+                'Endpoints': [
+                    {'ServiceName': names[num],
+                     'Relation': {'Name': 'db', 'Interface': 'app',
+                                  'Role': 'requirer', 'Scope': 'global'}},
+                    {'ServiceName': names[num + 1],
+                     'Relation': {'Name': 'db', 'Interface': 'app',
+                                  'Role': 'provider', 'Scope': 'global'}},
+                ],
+            })
+        unit_numbers = collections.Counter()
+        for num in range(units if services else 0):
+            machine_id = str(num)
+            address = '10.0.{}.{}'.format(num // 250, num % 250 + 2)
+            self._add('machine', machine_id, {
+                'Id': machine_id,
+                'InstanceId': 'i-{:08x}'.format(num),
+                'Status': 'started',
+                'StatusInfo': '',
+                'Life': 'alive',
+                'Series': SERIES,
+                'SupportedContainers': ['lxc'],
+                'SupportedContainersKnown': True,
+                'HardwareCharacteristics': {'Arch': 'amd64', 'Mem': 2048},
+                'Jobs': ['JobHostUnits'],
+                'Addresses': [{'Value': address, 'Type': 'ipv4',
+                               'Scope': 'local-cloud'}],
+                'HasVote': False,
+                'WantsVote': False,
+            })
+            service = names[num % services]
+            name = '{}/{}'.format(service, unit_numbers[service])
+            unit_numbers[service] += 1
+            self._add('unit', name, {
+                'Name': name,
+                'Service': service,
+                'Series': SERIES,
+                'CharmURL': self.get('service', service)['CharmURL'],
+                'PublicAddress': address,
+                'PrivateAddress': address,
+                'MachineId': machine_id,
+                'Ports': [],
+                'Status': 'started',
+                'StatusInfo': '',
+                'StatusData': {},
+                'Subordinate': False,
+            })
+            self._units.append(name)
+
+    def get(self, kind, key):
+        """Return the entity of the given kind and key.
+
+        Raise an ApiError if the entity is not found.
+        """
+        try:
+            return self._entities[kind, key]
+        except KeyError:
+            raise ApiError('{} "{}" not found'.format(kind, key), 'not found')
+
+    def count(self, kind):
+        """Return the number of entities of the given kind."""
+        return sum(1 for key in self._entities if key[0] == kind)
+
+    def snapshot(self):
+        """Return the deltas describing the whole environment."""
+        return [
+            [kind, 'change', entity]
+            for (kind, _), entity in self._entities.items()]
+
+    def add_watcher(self, watcher):
+        """Send the future changes of the environment to the given watcher."""
+        self._watchers.add(watcher)
+
+    def remove_watcher(self, watcher):
+        """Stop sending changes to the given watcher."""
+        self._watchers.discard(watcher)
+
+    def change(self, kind, key, **fields):
+        """Update the given entity and return the resulting delta."""
+        entity = dict(self.get(kind, key), **fields)
+        self._entities[kind, key] = entity
+        return [kind, 'change', entity]
+
+    def random_changes(self, count):
+        """Return count deltas changing the status of random units."""
+        deltas = []
+        for _ in range(count if self._units else 0):
+            name = self._random.choice(self._units)
+            status = self.get('unit', name)['Status']
+            index = UNIT_STATUSES.index(status) + 1
+            deltas.append(self.change(
+                'unit', name, Status=UNIT_STATUSES[index % 3]))
+        return deltas
+
+    def broadcast(self, deltas):
+        """Send the given deltas to all the watchers."""
+        if deltas:
+            for watcher in self._watchers:
+                watcher.push(deltas)
+
+    def full_status(self):
+        """Return the environment status, as returned by Client.FullStatus.
+        """
+        machines, services = {}, {}
+        for (kind, key), entity in self._entities.items():
+            if kind == 'machine':
+                machines[key] = {
+                    'Id': key,
+                    'AgentState': entity['Status'],
+                    'InstanceId': entity['InstanceId'],
+                    'DNSName': entity['Addresses'][0]['Value'],
+                    'Series': entity['Series'],
+                    'Containers': {},
+                }
+            elif kind == 'service':
+                services[key] = {
+                    'Charm': entity['CharmURL'],
+                    'Exposed': entity['Exposed'],
+                    'Life': '',
+                    'Relations': {},
+                    'Units': {},
+                }
+            elif kind == 'unit':
+                services[entity['Service']]['Units'][key] = {
+                    'AgentState': entity['Status'],
+                    'Machine': entity['MachineId'],
+                    'PublicAddress': entity['PublicAddress'],
+                }
+        return {
+            'EnvironmentName': self.name,
+            'Machines': machines,
+            'Services': services,
+        }
+
+
+class AllWatcher(object):
+    """An AllWatcher, sending a snapshot and then the environment changes."""
+
+    def __init__(self, environment):
+        self._environment = environment
+        self._pending = environment.snapshot()
+        self._future = None
+        environment.add_watcher(self)
+
+    def push(self, deltas):
+        """Add the given deltas to the ones waiting to be sent."""
+        self._pending.extend(deltas)
+        if self._future is not None:
+            self._resolve()
+
+    def _resolve(self):
+        """Send the pending deltas to the waiting Next call."""
+        future, self._future = self._future, None
+        deltas, self._pending = self._pending, []
+        future.set_result(deltas)
+
+    def next(self):
+        """Return a Future whose result is the list of pending deltas.
+
+        The Future is resolved as soon as there are deltas to be sent.
+        """
+        if self._future is not None:
+            raise ApiError('watcher has a pending Next call')
+        future = self._future = Future()
+        if self._pending:
+            self._resolve()
+        return future
+
+    def stop(self):
+        """Stop the watcher, failing the pending Next call if any."""
+        self._environment.remove_watcher(self)
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.set_exception(ApiError('watcher was stopped'))
+
+
+class DeltaGenerator(object):
+    """Change the environment at the given rate of deltas per second."""
+
+    def __init__(self, environment, rate, io_loop=None):
+        self._environment = environment
+        self._rate = rate
+        self._credit = 0.0
+        self._callback = PeriodicCallback(
+            self._tick, TICK_INTERVAL, io_loop=io_loop)
+
+    def start(self):
+        """Start generating deltas."""
+        if self._rate > 0:
+            self._callback.start()
+
+    def stop(self):
+        """Stop generating deltas."""
+        self._callback.stop()
+
+    def _tick(self):
+        """Generate the deltas due since the last tick, as a single batch."""
+        self._credit += self._rate * TICK_INTERVAL / 1000.0
+        count = int(self._credit)
+        self._credit -= count
+        environment = self._environment
+        environment.broadcast(environment.random_changes(count))
+
+
+class FakeJujuHandler(websocket.WebSocketHandler):
+    """A WebSocket handler serving the Juju API on a synthetic environment.
+    """
+
+    def initialize(
+            self, environment, username=DEFAULT_USERNAME,
+            password=DEFAULT_PASSWORD, latency=0):
+        """Initialize the handler.
+
+        The latency argument is the number of seconds each call is delayed,
+        simulating a remote Juju API server.
+        """
+        self._environment = environment
+        self._credentials = (username, password)
+        self._latency = latency
+        self._logged_in = False
+        self._watchers = {}
+        self._watcher_ids = itertools.count(1)
+        self._calls = {
+            ('Admin', 'Login'): self.login,
+            ('Pinger', 'Ping'): lambda params: {},
+            ('Client', 'WatchAll'): self.watch_all,
+            ('AllWatcher', 'Next'): self.watcher_next,
+            ('AllWatcher', 'Stop'): self.watcher_stop,
+            ('Client', 'FullStatus'): self.full_status,
+            ('Client', 'EnvironmentInfo'): self.environment_info,
+            ('Client', 'EnvironmentGet'): self.environment_get,
+            ('Client', 'CharmInfo'): self.charm_info,
+            ('Client', 'ServiceGet'): self.service_get,
+            ('Client', 'ServiceExpose'): self.service_expose,
+            ('Client', 'ServiceUnexpose'): self.service_unexpose,
+        }
+
+    def select_subprotocol(self, subprotocols):
+        """Accept any sub-protocol requested by the client."""
+        return subprotocols[0]
+
+    def on_message(self, message):
+        """Handle a Juju API request."""
+        try:
+            data = json.loads(message)
+        except ValueError:
+            logging.error('fakejuju: invalid message: {}'.format(message))
+            return
+        # Unexpected errors are logged by the IO loop.
+        IOLoop.current().add_future(
+            self._handle(data), lambda future: future.result())
+
+    @gen.coroutine
+    def _handle(self, data):
+        """Call the method requested by data and send the response."""
+        response = {'RequestId': data.get('RequestId')}
+        if self._latency:
+            yield gen.Task(
+                IOLoop.current().add_timeout,
+                datetime.timedelta(seconds=self._latency))
+        try:
+            call = self._calls.get((data.get('Type'), data.get('Request')))
+            if call is None:
+                raise ApiError(
+                    'no such request - method {}.{} is not implemented'.format(
+                        data.get('Type'), data.get('Request')),
+                    'not implemented')
+            if not (self._logged_in or call == self.login):
+                raise ApiError('not logged in', 'unauthorized access')
+            params = dict(data.get('Params') or {}, Id=data.get('Id'))
+            result = call(params)
+            if isinstance(result, Future):
+                result = yield result
+            response['Response'] = result
+        except ApiError as err:
+            response.update(Error=str(err), ErrorCode=err.code, Response={})
+        if self.ws_connection is not None:
+            self.write_message(json.dumps(response))
+
+    def on_close(self):
+        """Stop the watchers when the client disconnects."""
+        for watcher in self._watchers.values():
+            watcher.stop()
+        self._watchers.clear()
+
+    def login(self, params):
+        """Handle Admin.Login calls."""
+        if self._logged_in:
+            raise ApiError('already logged in')
+        credentials = (params.get('AuthTag'), params.get('Password'))
+        if credentials != self._credentials:
+            raise ApiError(
+                'invalid entity name or password', 'unauthorized access')
+        self._logged_in = True
+        return {
+            'EnvironTag': 'environment-' + self._environment.uuid,
+            'Facades': list(FACADES),
+            'Servers': [],
+        }
+
+    def watch_all(self, params):
+        """Handle Client.WatchAll calls."""
+        watcher_id = str(next(self._watcher_ids))
+        self._watchers[watcher_id] = AllWatcher(self._environment)
+        return {'AllWatcherId': watcher_id}
+
+    def _get_watcher(self, params):
+        """Return the AllWatcher identified in params."""
+        try:
+            return self._watchers[params['Id']]
+        except KeyError:
+            raise ApiError('unknown watcher id', 'not found')
+
+    @gen.coroutine
+    def watcher_next(self, params):
+        """Handle AllWatcher.Next calls."""
+        deltas = yield self._get_watcher(params).next()
+        raise gen.Return({'Deltas': deltas})
+
+    def watcher_stop(self, params):
+        """Handle AllWatcher.Stop calls."""
+        self._get_watcher(params).stop()
+        del self._watchers[params['Id']]
+        return {}
+
+    def full_status(self, params):
+        """Handle Client.FullStatus calls."""
+        return self._environment.full_status()
+
+    def environment_info(self, params):
+        """Handle Client.EnvironmentInfo calls."""
+        return {
+            'DefaultSeries': SERIES,
+            'ProviderType': 'local',
+            'Name': self._environment.name,
+            'UUID': self._environment.uuid,
+        }
+
+    def environment_get(self, params):
+        """Handle Client.EnvironmentGet calls."""
+        return {'Config': {
+            'name': self._environment.name,
+            'type': 'local',
+            'default-series': SERIES,
+            'uuid': self._environment.uuid,
+        }}
+
+    def charm_info(self, params):
+        """Handle Client.CharmInfo calls."""
+        url = params.get('CharmURL', '')
+        name = url.rpartition('/')[2].rpartition('-')[0]
+        if not (url.startswith('cs:') and name):
+            raise ApiError('charm url "{}" not found'.format(url), 'not found')
+        return {
+            'URL': url,
+            'Revision': 1,
+            'Meta': {
+                'Name': name,
+                'Summary': 'A synthetic charm.',
+                'Description': 'A charm generated by the fake Juju API.',
+                'Provides': {'db': {'Interface': 'app'}},
+                'Requires': {'db': {'Interface': 'app'}},
+            },
+            'Config': {'Options': {
+                'debug': {'Type': 'boolean', 'Default': False,
+                          'Description': 'Enable debugging.'},
+            }},
+        }
+
+    def service_get(self, params):
+        """Handle Client.ServiceGet calls."""
+        service = self._environment.get('service', params.get('ServiceName'))
+        return {
+            'Service': service['Name'],
+            'Charm': service['CharmURL'].rpartition('/')[2],
+            'Config': service['Config'],
+            'Constraints': service['Constraints'],
+        }
+
+    def _set_exposed(self, params, exposed):
+        """Expose or unexpose the service named in params."""
+        environment = self._environment
+        delta = environment.change(
+            'service', params.get('ServiceName'), Exposed=exposed)
+        environment.broadcast([delta])
+        return {}
+
+    def service_expose(self, params):
+        """Handle Client.ServiceExpose calls."""
+        return self._set_exposed(params, True)
+
+    def service_unexpose(self, params):
+        """Handle Client.ServiceUnexpose calls."""
+        return self._set_exposed(params, False)
+
+
+def make_app(environment, rate=0, username=DEFAULT_USERNAME,
+             password=DEFAULT_PASSWORD, latency=0):
+    """Return a Tornado application serving the fake Juju API.
+
+    Deltas are generated at the given rate per second once the IO loop is
+    started. The Juju API is served on all paths.
+    """
+    DeltaGenerator(environment, rate).start()
+    options = {
+        'environment': environment,
+        'username': username,
+        'password': password,
+        'latency': latency,
+    }
+    return web.Application([(r'/.*', FakeJujuHandler, options)])
+
+
+def get_ssl_options(certfile=None, keyfile=None):
+    """Return the SSL options used to serve secure WebSockets.
+
+    If the certificate and key files are not provided, the self-signed
+    certificate distributed with Tornado is used.
+    """
+    if certfile is None or keyfile is None:
+        path = os.path.join(os.path.dirname(tornado.__file__), 'test')
+        certfile = os.path.join(path, 'test.crt')
+        keyfile = os.path.join(path, 'test.key')
+    return {'certfile': certfile, 'keyfile': keyfile}
+
+
+def serve(sockets, ssl_options, environment_options, app_options):
+    """Serve the fake Juju API on the given sockets.
+
+    The environment and the application are created in the current process,
+    passing them the given options (see Environment and make_app). This
+    function never returns: it is intended to be run in a separate process.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    app = make_app(Environment(**environment_options), **app_options)
+    server = httpserver.HTTPServer(app, ssl_options=ssl_options)
+    server.add_sockets(sockets)
+    IOLoop.instance().start()
+
+
+def main():
+    """Start the fake Juju API server."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--address', default='127.0.0.1',
+        help='the address to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--port', type=int, default=17070,
+        help='the port to listen on, 0 for a random one '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--services', type=int, default=10,
+        help='the number of services (default: %(default)s)')
+    parser.add_argument(
+        '--units', type=int, default=100,
+        help='the total number of units (default: %(default)s)')
+    parser.add_argument(
+        '--rate', type=float, default=10,
+        help='the number of AllWatcher deltas generated per second '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='the milliseconds each Juju API call is delayed '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the seed used to generate the environment '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--user', default=DEFAULT_USERNAME,
+        help='the user name (default: %(default)s)')
+    parser.add_argument(
+        '--password', default=DEFAULT_PASSWORD,
+        help='the password (default: %(default)s)')
+    parser.add_argument(
+        '--insecure', action='store_true',
+        help='serve plain WebSockets rather than secure ones')
+    parser.add_argument(
+        '--certfile', help='the SSL certificate (default: a test one)')
+    parser.add_argument(
+        '--keyfile', help='the SSL certificate key (default: a test one)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    environment = Environment(args.services, args.units, seed=args.seed)
+    app = make_app(
+        environment, rate=args.rate, username=args.user,
+        password=args.password, latency=args.latency / 1000.0)
+    ssl_options = None
+    scheme = 'ws'
+    if not args.insecure:
+        ssl_options = get_ssl_options(args.certfile, args.keyfile)
+        scheme = 'wss'
+    sockets = netutil.bind_sockets(args.port, args.address)
+    server = httpserver.HTTPServer(app, ssl_options=ssl_options)
+    server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    info = {
+        'apiurl': '{}://{}:{}'.format(scheme, args.address, port),
+        'uuid': environment.uuid,
+        'services': environment.count('service'),
+        'units': environment.count('unit'),
+        'machines': environment.count('machine'),
+        'relations': environment.count('relation'),
+        'rate': args.rate,
+    }
+    print(json.dumps(info, sort_keys=True))
+    sys.stdout.flush()
+    IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,588 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure how many concurrent GUI sessions a GUI server can serve.
+
+Simulated GUI sessions are opened against a GUI server started with
+runserver.py. Each session logs in, keeps an AllWatcher pending and sends a
+mix of Juju API calls, ChangeSet and Deployer requests, each kind at its own
+rate: requests are separated by exponentially distributed pauses, and each
+one waits for the previous response (i.e. a closed loop). The sessions are
+spread over multiple client processes so that the clients are not the
+bottleneck.
+
+By default a fake Juju API (see guiserver.benchmarks.fakejuju) and a GUI
+server are started locally, and the GUI server resource usage is measured,
+e.g.:
+
+    python -m guiserver.benchmarks.load --sessions 200 --duration 60 \\
+        --server-args="--apicache=Client.CharmInfo"
+
+Alternatively, pass the WebSocket URL of a running GUI server (and its pid
+to measure its resource usage), e.g.:
+
+    python -m guiserver.benchmarks.load --url wss://gui.example.com/ws \\
+        --user user-admin --password secret
+
+The report is printed to stdout as a JSON object. Latencies are expressed in
+milliseconds. Deployer requests only ask for the deployments status, so that
+no bundle is actually deployed.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import Queue
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+from tornado import (
+    gen,
+    httpclient,
+    netutil,
+    websocket,
+)
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import guiserver
+from guiserver.benchmarks import fakejuju
+from guiserver.benchmarks.proxy import (
+    get_cpu_time,
+    start_process,
+)
+
+
+# The Juju API calls sent by default by each session.
+DEFAULT_CALLS = (
+    'Client.FullStatus,Client.ServiceGet,Client.CharmInfo,'
+    'Client.EnvironmentInfo,Pinger.Ping')
+# The bundle used by ChangeSet requests.
+BUNDLE = """
+services:
+  mysql:
+    charm: cs:trusty/mysql-38
+    num_units: 1
+  wordpress:
+    charm: cs:trusty/wordpress-2
+    num_units: 2
+    expose: true
+relations:
+  - [mysql, wordpress]
+"""
+# The number of seconds allowed for the servers to start.
+STARTUP_TIMEOUT = 30
+
+
+def percentile(values, fraction):
+    """Return the given percentile of the sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(durations):
+    """Return a dict summarizing the given durations in milliseconds."""
+    durations = sorted(duration * 1000 for duration in durations)
+    if not durations:
+        return {'count': 0}
+    return {
+        'count': len(durations),
+        'mean': round(sum(durations) / len(durations), 2),
+        'p50': round(percentile(durations, 0.5), 2),
+        'p95': round(percentile(durations, 0.95), 2),
+        'p99': round(percentile(durations, 0.99), 2),
+        'max': round(durations[-1], 2),
+    }
+
+
+class Stats(object):
+    """The measurements collected by a client process."""
+
+    def __init__(self):
+        self.connect = []
+        self.failed_sessions = 0
+        # Map "Type.Request" methods to lists of round trip durations.
+        self.round_trips = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.deltas = 0
+        self.messages = 0
+
+    def to_dict(self):
+        """Return the measurements as a picklable dict."""
+        return {
+            'connect': self.connect,
+            'failed_sessions': self.failed_sessions,
+            'round_trips': dict(self.round_trips),
+            'errors': dict(self.errors),
+            'deltas': self.deltas,
+            'messages': self.messages,
+        }
+
+
+class Session(object):
+    """A simulated GUI session, matching responses to requests by id."""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+        self._request_ids = itertools.count(1)
+        # Map request ids to (future, start time) tuples.
+        self._pending = {}
+        self.closed = False
+        self._read_loop()
+
+    @gen.coroutine
+    def _read_loop(self):
+        """Dispatch the responses until the connection is closed."""
+        while True:
+            message = yield self._conn.read_message()
+            if message is None:
+                break
+            self._stats.messages += 1
+            data = json.loads(message)
+            pending = self._pending.pop(data.get('RequestId'), None)
+            if pending is not None:
+                future, start = pending
+                future.set_result((data, time.time() - start))
+        self.closed = True
+        for future, _ in self._pending.values():
+            future.set_result((None, None))
+        self._pending.clear()
+
+    def call(self, request_type, request, params=None, **kwargs):
+        """Send a request and return a Future of (response, round trip).
+
+        The response is None if the connection is closed.
+        """
+        future = Future()
+        if self.closed:
+            future.set_result((None, None))
+            return future
+        request_id = next(self._request_ids)
+        data = dict(
+            RequestId=request_id, Type=request_type, Request=request,
+            Params=params or {}, **kwargs)
+        self._pending[request_id] = (future, time.time())
+        self._conn.write_message(json.dumps(data))
+        return future
+
+    @gen.coroutine
+    def timed_call(self, request_type, request, params=None):
+        """Send a request, recording its round trip and errors.
+
+        Return the response, or None if the connection is closed.
+        """
+        data, elapsed = yield self.call(request_type, request, params)
+        if data is not None:
+            method = '{}.{}'.format(request_type, request)
+            self._stats.round_trips[method].append(elapsed)
+            response = data.get('Response')
+            if 'Error' in data or (
+                    isinstance(response, dict) and response.get('Error')):
+                self._stats.errors[method] += 1
+        raise gen.Return(data)
+
+    def close(self):
+        """Close the connection."""
+        self._conn.close()
+
+
+@gen.coroutine
+def pause(rng, rate, deadline):
+    """Wait for an exponentially distributed time with the given rate.
+
+    Return False if the deadline is reached in the meanwhile.
+    """
+    delay = rng.expovariate(rate)
+    remaining = deadline - time.time()
+    yield gen.Task(
+        IOLoop.current().add_timeout,
+        time.time() + min(delay, max(remaining, 0)))
+    raise gen.Return(delay < remaining)
+
+
+@gen.coroutine
+def watch_loop(session, stats, watcher_id):
+    """Keep an AllWatcher.Next request pending, counting the deltas."""
+    while True:
+        data, _ = yield session.call('AllWatcher', 'Next', Id=watcher_id)
+        if data is None or 'Error' in data:
+            break
+        stats.deltas += len(data['Response'].get('Deltas') or ())
+
+
+@gen.coroutine
+def call_loop(session, rng, rate, deadline, make_request):
+    """Send the requests returned by make_request() at the given rate."""
+    if rate <= 0:
+        return
+    while not session.closed:
+        keep_going = yield pause(rng, rate, deadline)
+        if not keep_going:
+            break
+        yield session.timed_call(*make_request())
+
+
+@gen.coroutine
+def run_session(url, args, rng, deadline, stats):
+    """Run a simulated GUI session until the deadline."""
+    request = httpclient.HTTPRequest(
+        url, validate_cert=False, connect_timeout=STARTUP_TIMEOUT,
+        request_timeout=STARTUP_TIMEOUT)
+    start = time.time()
+    try:
+        conn = yield websocket.websocket_connect(request)
+    except Exception:
+        stats.failed_sessions += 1
+        return
+    stats.connect.append(time.time() - start)
+    session = Session(conn, stats)
+    data = yield session.timed_call(
+        'Admin', 'Login', {'AuthTag': args.user, 'Password': args.password})
+    if data is None or 'Error' in data:
+        stats.failed_sessions += 1
+        session.close()
+        return
+    data = yield session.timed_call('Client', 'WatchAll')
+    if data is None or 'Error' in data:
+        stats.failed_sessions += 1
+        session.close()
+        return
+    watch_loop(session, stats, data['Response']['AllWatcherId'])
+    calls = [call.split('.', 1) for call in args.calls.split(',') if call]
+
+    def make_call():
+        request_type, request = rng.choice(calls)
+        params = {}
+        if request == 'ServiceGet':
+            params['ServiceName'] = 'service-{}'.format(
+                rng.randrange(max(args.services, 1)))
+        elif request == 'CharmInfo':
+            params['CharmURL'] = 'cs:{}/app-{}-1'.format(
+                fakejuju.SERIES, rng.randrange(max(args.services, 1)))
+        return request_type, request, params
+
+    yield [
+        call_loop(session, rng, args.rate, deadline, make_call),
+        call_loop(
+            session, rng, args.changeset_rate, deadline,
+            lambda: ('ChangeSet', 'GetChanges', {'YAML': BUNDLE})),
+        call_loop(
+            session, rng, args.deployer_rate, deadline,
+            lambda: ('Deployer', 'Status', {})),
+    ]
+    session.close()
+
+
+def run_client(url, args, sessions, seed, results):
+    """Run the given number of sessions and put the stats in results.
+
+    Sessions are started evenly during the ramp up period. This function is
+    intended to be run in a separate process.
+    """
+    rng = random.Random(seed)
+    stats = Stats()
+    deadline = time.time() + args.ramp_up + args.duration
+
+    @gen.coroutine
+    def run():
+        loops = []
+        for num in range(sessions):
+            if args.ramp_up and num:
+                yield gen.Task(
+                    IOLoop.current().add_timeout,
+                    time.time() + args.ramp_up / float(sessions))
+            loops.append(run_session(
+                url, args, random.Random(rng.random()), deadline, stats))
+        yield loops
+
+    IOLoop.instance().run_sync(
+        run, timeout=args.ramp_up + args.duration + STARTUP_TIMEOUT * 2)
+    results.put(stats.to_dict())
+
+
+def get_process_tree(pid):
+    """Return the ids of the given process and of all its descendants."""
+    children = collections.defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            continue
+        parent = int(stat.rsplit(')', 1)[1].split()[1])
+        children[parent].append(int(name))
+    pids, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        pids.append(current)
+        queue.extend(children[current])
+    return pids
+
+
+def get_rss(pid):
+    """Return the resident memory in bytes used by the process with pid."""
+    with open('/proc/{}/status'.format(pid)) as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class ResourceMonitor(object):
+    """Sample the CPU time and memory used by a process and its children."""
+
+    def __init__(self, pid):
+        self._pid = pid
+        self._cpu_start = self._cpu()
+        self._start = time.time()
+        self.peak_rss = 0
+
+    def _usage(self, func):
+        """Return the sum of func(pid) for all the processes in the tree."""
+        total = 0
+        for pid in get_process_tree(self._pid):
+            try:
+                total += func(pid)
+            except IOError:
+                # The process exited in the meanwhile.
+                pass
+        return total
+
+    def _cpu(self):
+        return self._usage(get_cpu_time)
+
+    def sample(self):
+        """Sample the memory usage, and return the current RSS in bytes."""
+        rss = self._usage(get_rss)
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def report(self):
+        """Return a dict describing the resources used since the start."""
+        rss = self.sample()
+        cpu = self._cpu() - self._cpu_start
+        elapsed = time.time() - self._start
+        return {
+            'processes': len(get_process_tree(self._pid)),
+            'cpu_seconds': round(cpu, 3),
+            'cpu_percent': round(100 * cpu / elapsed, 1),
+            'rss_mb': round(rss / 1048576.0, 1),
+            'peak_rss_mb': round(self.peak_rss / 1048576.0, 1),
+        }
+
+
+def wait_for_port(port, process):
+    """Wait for the local server process to listen on the given port.
+
+    Exit if the process terminates or does not start listening in time.
+    """
+    deadline = time.time() + STARTUP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if process.poll() is not None:
+                sys.exit('error: the GUI server exited')
+            if time.time() > deadline:
+                process.terminate()
+                sys.exit('error: the GUI server did not start')
+            time.sleep(0.1)
+
+
+def start_servers(args):
+    """Start a fake Juju API and a GUI server in front of it.
+
+    Return the GUI server WebSocket URL and process.
+    """
+    juju_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    juju_port = juju_sockets[0].getsockname()[1]
+    environment_options = {
+        'services': args.services, 'units': args.units, 'seed': args.seed}
+    app_options = {
+        'rate': args.delta_rate, 'username': args.user,
+        'password': args.password}
+    start_process(
+        fakejuju.serve, juju_sockets, fakejuju.get_ssl_options(),
+        environment_options, app_options)
+    # Find a free port for the GUI server.
+    gui_socket = socket.socket()
+    gui_socket.bind(('127.0.0.1', 0))
+    gui_port = gui_socket.getsockname()[1]
+    gui_socket.close()
+    runserver = os.path.join(
+        os.path.dirname(os.path.dirname(guiserver.__file__)), 'runserver.py')
+    command = [
+        sys.executable, runserver,
+        '--apiurl=wss://127.0.0.1:{}'.format(juju_port),
+        '--insecure', '--port={}'.format(gui_port), '--logging=warning',
+    ] + shlex.split(args.server_args)
+    process = subprocess.Popen(command)
+    wait_for_port(gui_port, process)
+    return 'ws://127.0.0.1:{}/ws'.format(gui_port), process
+
+
+def merge(results):
+    """Merge the stats dicts produced by the client processes."""
+    merged = Stats()
+    for result in results:
+        merged.connect.extend(result['connect'])
+        merged.failed_sessions += result['failed_sessions']
+        for method, durations in result['round_trips'].items():
+            merged.round_trips[method].extend(durations)
+        merged.errors.update(result['errors'])
+        merged.deltas += result['deltas']
+        merged.messages += result['messages']
+    return merged
+
+
+def main():
+    """Run the load test and print the report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--url', help='the WebSocket URL of a running GUI server (default: '
+                      'start a GUI server and a fake Juju API)')
+    parser.add_argument(
+        '--pid', type=int,
+        help='the id of the GUI server process to measure when using --url')
+    parser.add_argument(
+        '--sessions', type=int, default=50,
+        help='the number of concurrent GUI sessions (default: %(default)s)')
+    parser.add_argument(
+        '--clients', type=int, default=2,
+        help='the number of client processes (default: %(default)s)')
+    parser.add_argument(
+        '--duration', type=float, default=30,
+        help='the seconds of full load (default: %(default)s)')
+    parser.add_argument(
+        '--ramp-up', type=float, default=5,
+        help='the seconds spent opening the sessions (default: %(default)s)')
+    parser.add_argument(
+        '--rate', type=float, default=1,
+        help='the Juju API calls per second sent by each session '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--calls', default=DEFAULT_CALLS,
+        help='the comma separated Juju API calls to choose from '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--changeset-rate', type=float, default=0.1,
+        help='the ChangeSet requests per second sent by each session '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--deployer-rate', type=float, default=0.1,
+        help='the Deployer requests per second sent by each session '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--user', default=fakejuju.DEFAULT_USERNAME,
+        help='the user name (default: %(default)s)')
+    parser.add_argument(
+        '--password', default=fakejuju.DEFAULT_PASSWORD,
+        help='the password (default: %(default)s)')
+    parser.add_argument(
+        '--services', type=int, default=10,
+        help='the services in the fake environment (default: %(default)s)')
+    parser.add_argument(
+        '--units', type=int, default=100,
+        help='the units in the fake environment (default: %(default)s)')
+    parser.add_argument(
+        '--delta-rate', type=float, default=10,
+        help='the AllWatcher deltas per second generated by the fake Juju '
+             'API (default: %(default)s)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the random seed (default: %(default)s)')
+    parser.add_argument(
+        '--server-args', default='',
+        help='additional arguments passed to the GUI server, e.g. '
+             '"--processes=2"')
+    args = parser.parse_args()
+    process = None
+    pid = args.pid
+    if args.url is None:
+        url, process = start_servers(args)
+        pid = process.pid
+    else:
+        url = args.url
+    monitor = ResourceMonitor(pid) if pid else None
+    results = multiprocessing.Queue()
+    clients = []
+    for num in range(args.clients):
+        sessions = args.sessions // args.clients
+        if num < args.sessions % args.clients:
+            sessions += 1
+        clients.append(start_process(
+            run_client, url, args, sessions, args.seed + num, results))
+    start = time.time()
+    collected = []
+    while len(collected) < len(clients):
+        try:
+            collected.append(results.get(timeout=1))
+        except Queue.Empty:
+            pass
+        if monitor is not None:
+            monitor.sample()
+    elapsed = time.time() - start
+    server = monitor.report() if monitor is not None else None
+    for client in clients:
+        client.join()
+    if process is not None:
+        process.terminate()
+        process.wait()
+    stats = merge(collected)
+    requests = sum(len(values) for values in stats.round_trips.values())
+    all_round_trips = list(itertools.chain(*stats.round_trips.values()))
+    methods = {}
+    for method, durations in stats.round_trips.items():
+        methods[method] = summarize(durations)
+        methods[method]['errors'] = stats.errors[method]
+    print(json.dumps({
+        'version': guiserver.get_version(),
+        'url': url,
+        'sessions': args.sessions,
+        'failed_sessions': stats.failed_sessions,
+        'clients': args.clients,
+        'duration': args.duration,
+        'elapsed': round(elapsed, 3),
+        'ramp_up': args.ramp_up,
+        'rates': {
+            'calls': args.rate,
+            'changesets': args.changeset_rate,
+            'deployer': args.deployer_rate,
+            'deltas': args.delta_rate if args.url is None else None,
+        },
+        'connect': summarize(stats.connect),
+        'round_trip': summarize(all_round_trips),
+        'methods': methods,
+        'throughput': {
+            'requests_per_sec': round(requests / elapsed, 1),
+            'messages_per_sec': round(stats.messages / elapsed, 1),
+            'deltas_per_sec': round(stats.deltas / elapsed, 1),
+        },
+        'server': server,
+    }, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure how the GUI server throughput scales with its worker processes.
+
+Local echo WebSocket servers are used as the Juju API upstream, and the GUI
+server WebSocket handler is run in front of them by a number of worker
+processes sharing the same listening socket, as with the --processes option:
+
+    benchmark clients -> workers (WebSocketHandler) -> echo servers
+
+The load is generated by multiple client processes. For each number of
+workers, two rates are measured:
+    - connections per second: each client connection sends a single request,
+      waits for the response and then disconnects;
+    - messages per second: requests are sent in windows over long lived
+      connections.
+The scaling of each rate is the rate divided by the single worker rate times
+the number of workers: 1.0 means perfectly linear scaling. The results are
+only meaningful if the machine has enough cores for the workers, the clients
+and the echo servers, e.g. on an 8-core machine:
+
+    python -m guiserver.benchmarks.processes --workers 1,2,4 --clients 3
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+
+from tornado import (
+    gen,
+    netutil,
+    websocket,
+)
+from tornado.ioloop import IOLoop
+
+from guiserver.benchmarks.proxy import (
+    make_echo_app,
+    make_frame,
+    make_proxy_app,
+    serve,
+    start_process,
+)
+
+
+@gen.coroutine
+def connect_loop(url, deadline, size, counter):
+    """Open connections sending a single request until deadline."""
+    while time.time() < deadline:
+        conn = yield websocket.websocket_connect(url)
+        conn.write_message(make_frame(0, size))
+        message = yield conn.read_message()
+        if message is None:
+            raise IOError('connection closed by the proxy')
+        conn.close()
+        counter[0] += 1
+
+
+@gen.coroutine
+def message_loop(url, deadline, size, window, counter):
+    """Send requests over a single connection until deadline."""
+    conn = yield websocket.websocket_connect(url)
+    request_id = 0
+    while time.time() < deadline:
+        for _ in range(window):
+            request_id += 1
+            conn.write_message(make_frame(request_id, size))
+        for _ in range(window):
+            message = yield conn.read_message()
+            if message is None:
+                raise IOError('connection closed by the proxy')
+        counter[0] += window
+    conn.close()
+
+
+def run_client(url, mode, concurrency, duration, size, window, results):
+    """Generate load on the proxy at url and put the operations in results.
+
+    The mode is either "connections" or "messages". This function is
+    intended to be run in a separate process.
+    """
+    counter = [0]
+    deadline = time.time() + duration
+
+    @gen.coroutine
+    def run():
+        if mode == 'connections':
+            loops = [
+                connect_loop(url, deadline, size, counter)
+                for _ in range(concurrency)]
+        else:
+            loops = [
+                message_loop(url, deadline, size, window, counter)
+                for _ in range(concurrency)]
+        yield loops
+
+    IOLoop.instance().run_sync(run, timeout=duration + 60)
+    results.put(counter[0])
+
+
+def measure(url, mode, args):
+    """Run the client processes in the given mode and return the rate."""
+    results = multiprocessing.Queue()
+    clients = [
+        start_process(
+            run_client, url, mode, args.concurrency, args.duration,
+            args.size, args.window, results)
+        for _ in range(args.clients)]
+    operations = sum(results.get() for _ in clients)
+    for client in clients:
+        client.join()
+    return operations / float(args.duration)
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--workers', default='1,2,4',
+        help='comma separated numbers of workers (default: %(default)s)')
+    parser.add_argument(
+        '--clients', type=int, default=2,
+        help='the number of client processes (default: %(default)s)')
+    parser.add_argument(
+        '--concurrency', type=int, default=20,
+        help='the connections run by each client (default: %(default)s)')
+    parser.add_argument(
+        '--duration', type=float, default=5,
+        help='the seconds spent measuring each rate (default: %(default)s)')
+    parser.add_argument(
+        '--window', type=int, default=10,
+        help='the requests in flight for each connection when measuring '
+             'messages (default: %(default)s)')
+    parser.add_argument(
+        '--size', type=int, default=256,
+        help='the approximate size of each request (default: %(default)s)')
+    args = parser.parse_args()
+    workers = [int(value) for value in args.workers.split(',')]
+    echo_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    apiurl = 'ws://127.0.0.1:{}/echo'.format(
+        echo_sockets[0].getsockname()[1])
+    # Start enough echo servers so that they are not the bottleneck.
+    for _ in range(max(workers)):
+        start_process(serve, echo_sockets, make_echo_app)
+    results = []
+    for count in workers:
+        proxy_sockets = netutil.bind_sockets(0, '127.0.0.1')
+        url = 'ws://127.0.0.1:{}/ws'.format(
+            proxy_sockets[0].getsockname()[1])
+        processes = [
+            start_process(serve, proxy_sockets, make_proxy_app, apiurl)
+            for _ in range(count)]
+        # Give the workers time to start.
+        time.sleep(1)
+        results.append({
+            'workers': count,
+            'connections_per_sec': int(measure(url, 'connections', args)),
+            'messages_per_sec': int(measure(url, 'messages', args)),
+        })
+        for process in processes:
+            process.terminate()
+            process.join()
+        for sock in proxy_sockets:
+            sock.close()
+    base = results[0]
+    for result in results:
+        for key in ('connections', 'messages'):
+            rate = key + '_per_sec'
+            expected = base[rate] * result['workers'] / float(base['workers'])
+            result[key + '_scaling'] = (
+                round(result[rate] / expected, 2) if expected else None)
+    print(json.dumps({
+        'cpus': multiprocessing.cpu_count(),
+        'clients': args.clients,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'size': args.size,
+        'window': args.window,
+        'results': results,
+    }, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the WebSocket proxy throughput.
+
+A local echo WebSocket server is used as the Juju API upstream, and the GUI
+server WebSocket handler is run in a separate process in front of it:
+
+    benchmark client -> WebSocketHandler -> echo server
+
+The client sends Juju API like requests in windows of frames, and waits for
+all of them to be echoed back before sending the next window. The number of
+frames relayed per second and per CPU second consumed by the proxy process
+(i.e. frames/sec per core) are reported.
+
+Run the benchmark on two GUI server revisions to compare them, e.g.:
+
+    python -m guiserver.benchmarks.proxy --frames 50000 --size 512
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from tornado import (
+    gen,
+    httpserver,
+    netutil,
+    web,
+    websocket,
+)
+from tornado.ioloop import IOLoop
+
+from guiserver import (
+    auth,
+    handlers,
+)
+from guiserver.bundles.base import Deployer
+
+
+# Define the template used by the proxy to build the WebSocket URL.
+WEBSOCKET_URL_TEMPLATE = '/api/$server/$port/$uuid'
+
+
+class EchoHandler(websocket.WebSocketHandler):
+    """A WebSocket server echoing back messages."""
+
+    def on_message(self, message):
+        """Echo back the received message."""
+        self.write_message(message, isinstance(message, bytes))
+
+
+def serve(sockets, make_app, *args):
+    """Serve the application returned by make_app(*args) on the given sockets.
+
+    This function never returns: it is intended to be run in a separate
+    process. The application is created in the new process so that it uses
+    its own IO loop.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    server = httpserver.HTTPServer(make_app(*args))
+    server.add_sockets(sockets)
+    IOLoop.instance().start()
+
+
+def make_echo_app():
+    """Return a Tornado application echoing WebSocket messages."""
+    return web.Application([(r'/echo', EchoHandler)])
+
+
+def make_proxy_app(apiurl, batching=None):
+    """Return a Tornado application proxying WebSocket messages to apiurl.
+
+    If batching options are provided, clients can request batched frames.
+    """
+    options = {
+        'apiurl': apiurl,
+        'auth_backend': auth.get_backend('go'),
+        'deployer': Deployer(apiurl, 'go'),
+        'tokens': auth.AuthenticationTokenHandler(),
+        'ws_url_template': WEBSOCKET_URL_TEMPLATE,
+        'batching': batching,
+    }
+    return web.Application([(r'/ws', handlers.WebSocketHandler, options)])
+
+
+def start_process(target, *args):
+    """Start and return a daemon process running target(*args)."""
+    process = multiprocessing.Process(target=target, args=args)
+    process.daemon = True
+    process.start()
+    return process
+
+
+def get_cpu_time(pid):
+    """Return the user+system CPU seconds consumed by the process with pid.
+
+    The information is retrieved from the /proc file system.
+    """
+    with open('/proc/{}/stat'.format(pid)) as stat_file:
+        stat = stat_file.read()
+    # The process name can include spaces: split after its closing paren.
+    fields = stat.rsplit(')', 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def make_frame(request_id, size):
+    """Return a Juju API request frame padded to at least size bytes."""
+    data = {
+        'RequestId': request_id,
+        'Type': 'Client',
+        'Request': 'FullStatus',
+        'Params': {'Patterns': []},
+    }
+    frame = json.dumps(data)
+    padding = size - len(frame) - len(', "Padding": ""')
+    if padding > 0:
+        data['Padding'] = 'x' * padding
+        frame = json.dumps(data)
+    return frame
+
+
+@gen.coroutine
+def run_client(url, frames, window, size):
+    """Send frames through the proxy at url and wait for the responses.
+
+    Return the elapsed time in seconds.
+    """
+    conn = yield websocket.websocket_connect(url)
+    # Warm up the connection.
+    conn.write_message(make_frame(0, size))
+    yield conn.read_message()
+    sent = 0
+    start = time.time()
+    while sent < frames:
+        count = min(window, frames - sent)
+        for request_id in range(sent, sent + count):
+            conn.write_message(make_frame(request_id, size))
+        for _ in range(count):
+            message = yield conn.read_message()
+            if message is None:
+                raise IOError('connection closed by the proxy')
+        sent += count
+    elapsed = time.time() - start
+    conn.close()
+    raise gen.Return(elapsed)
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--frames', type=int, default=20000,
+        help='the number of frames to send (default: %(default)s)')
+    parser.add_argument(
+        '--window', type=int, default=100,
+        help='the number of frames in flight (default: %(default)s)')
+    parser.add_argument(
+        '--size', type=int, default=256,
+        help='the approximate size of each frame (default: %(default)s)')
+    args = parser.parse_args()
+    echo_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    proxy_sockets = netutil.bind_sockets(0, '127.0.0.1')
+    apiurl = 'ws://127.0.0.1:{}/echo'.format(
+        echo_sockets[0].getsockname()[1])
+    url = 'ws://127.0.0.1:{}/ws'.format(proxy_sockets[0].getsockname()[1])
+    start_process(serve, echo_sockets, make_echo_app)
+    proxy = start_process(serve, proxy_sockets, make_proxy_app, apiurl)
+    cpu_start = get_cpu_time(proxy.pid)
+    elapsed = IOLoop.instance().run_sync(
+        lambda: run_client(url, args.frames, args.window, args.size),
+        timeout=3600)
+    cpu = get_cpu_time(proxy.pid) - cpu_start
+    results = {
+        'frames': args.frames,
+        'size': args.size,
+        'window': args.window,
+        'elapsed': round(elapsed, 3),
+        'proxy_cpu': round(cpu, 3),
+        'frames_per_sec': int(args.frames / elapsed),
+        'frames_per_cpu_sec': int(args.frames / cpu) if cpu else None,
+    }
+    print(json.dumps(results, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
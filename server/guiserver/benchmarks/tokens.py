@@ -0,0 +1,128 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure the latency of the authentication token stores.
+
+Tokens are created and then used, as the GUI does when opening a new browser
+tab. For each store, the latency of storing a token (put) and of retrieving
+and removing it (pop) is reported in microseconds. A plain dict, as used
+before token stores were introduced, is included as a baseline, e.g.:
+
+    python -m guiserver.benchmarks.tokens --tokens 10000 --live 100
+
+The shared store database is created in /dev/shm if available, so that it is
+kept in memory as when running the GUI server with multiple processes.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from guiserver import shared
+
+
+# The memory backed file system where the shared store database is created.
+SHARED_STATE_ROOT = '/dev/shm'
+
+
+class DictStore(object):
+    """A store using a plain dict, without expiration."""
+
+    def __init__(self):
+        self._data = {}
+
+    def put(self, key, value, ttl):
+        self._data[key] = value
+
+    def pop(self, key):
+        return self._data.pop(key, None)
+
+
+def percentile(values, fraction):
+    """Return the given percentile of the sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(durations):
+    """Return a dict summarizing the given durations in microseconds."""
+    durations = sorted(duration * 1e6 for duration in durations)
+    return {
+        'mean': round(sum(durations) / len(durations), 2),
+        'p50': round(percentile(durations, 0.5), 2),
+        'p99': round(percentile(durations, 0.99), 2),
+    }
+
+
+def measure(store, tokens, live):
+    """Put and pop tokens in the given store, keeping live tokens stored.
+
+    Return the put and pop latency summaries.
+    """
+    credentials = {'username': 'user-admin', 'password': 'ADMIN-SECRET'}
+    keys = [uuid.uuid4().hex for _ in range(tokens + live)]
+    for key in keys[:live]:
+        store.put(key, credentials, 120)
+    puts, pops = [], []
+    for index in range(tokens):
+        key = keys[live + index]
+        start = time.time()
+        store.put(key, credentials, 120)
+        puts.append(time.time() - start)
+        start = time.time()
+        value = store.pop(keys[index])
+        pops.append(time.time() - start)
+        if value is None:
+            raise ValueError('token not found')
+    return {'put': summarize(puts), 'pop': summarize(pops)}
+
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--tokens', type=int, default=10000,
+        help='the number of tokens to create and use (default: %(default)s)')
+    parser.add_argument(
+        '--live', type=int, default=100,
+        help='the number of tokens waiting to be used (default: %(default)s)')
+    args = parser.parse_args()
+    root = SHARED_STATE_ROOT if os.path.isdir(SHARED_STATE_ROOT) else None
+    directory = tempfile.mkdtemp(prefix='guiserver-', dir=root)
+    try:
+        path = os.path.join(directory, 'shared.db')
+        stores = {
+            'dict': DictStore(),
+            'memory': shared.MemoryStore(),
+            'shared': shared.SharedStore(path, table='tokens'),
+        }
+        results = dict(
+            (name, measure(store, args.tokens, args.live))
+            for name, store in stores.items())
+    finally:
+        shutil.rmtree(directory)
+    print(json.dumps({
+        'tokens': args.tokens,
+        'live': args.live,
+        'directory': root or tempfile.gettempdir(),
+        'results': results,
+    }, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
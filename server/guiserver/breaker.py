@@ -0,0 +1,194 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server circuit breakers for the proxied servers.
+
+When an upstream HTTP server stalls, proxied requests would pile up until
+they time out, leaving the browser waiting for minutes. A circuit breaker
+tracks the outcome of the fetches to an upstream server (see
+guiserver.httppool): after a number of consecutive failures, or of responses
+slower than a threshold, the circuit opens and requests are rejected right
+away. While the circuit is open, the upstream server is probed in the
+background, and the circuit is closed again as soon as a probe succeeds.
+
+    - CircuitOpen: the circuit breaker of the upstream server is open;
+    - CircuitBreaker: track the health of an upstream server.
+"""
+
+import logging
+import math
+
+from tornado import (
+    gen,
+    httpclient,
+)
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.httppool import (
+    Unavailable,
+    is_failure,
+)
+
+
+# The default number of consecutive failures after which the circuit opens.
+DEFAULT_MAX_FAILURES = 5
+# The default number of seconds between probes while the circuit is open.
+DEFAULT_RESET_TIMEOUT = 30
+# The default number of seconds allowed for a probe to complete.
+DEFAULT_PROBE_TIMEOUT = 5
+# The circuit breaker states.
+CLOSED = 'closed'
+OPEN = 'open'
+
+_opened = metrics.counter(
+    'proxy_circuit_opened',
+    'The times a proxy circuit breaker opened.')
+_fast_failures = metrics.counter(
+    'proxy_circuit_rejected',
+    'The proxy requests rejected because the circuit breaker was open.')
+_slow_fetches = metrics.counter(
+    'proxy_slow_fetches',
+    'The proxy responses slower than the circuit breaker latency threshold.')
+_probes = metrics.counter(
+    'proxy_circuit_probes',
+    'The health probes sent to upstream servers while the circuit was open.')
+
+
+class CircuitOpen(Unavailable):
+    """The circuit breaker of the upstream server is open."""
+
+    def __init__(self, name, retry_after):
+        super(CircuitOpen, self).__init__(
+            '{} is not responding'.format(name), retry_after)
+
+
+class CircuitBreaker(object):
+    """Track the health of an upstream server.
+
+    Note that circuit breakers are instantiated once when the application is
+    bootstrapped and used as singletons by all the proxy requests.
+    """
+
+    def __init__(
+            self, name, probe_url, validate_cert=True,
+            max_failures=DEFAULT_MAX_FAILURES, max_latency=0,
+            reset_timeout=DEFAULT_RESET_TIMEOUT,
+            probe_timeout=DEFAULT_PROBE_TIMEOUT, io_loop=None):
+        """Initialize the circuit breaker.
+
+        The name identifies the upstream server, and the probe URL is fetched
+        to check its health while the circuit is open, optionally validating
+        the server certificate. The circuit opens after max_failures
+        consecutive failures. Responses taking more than max_latency seconds
+        to start are counted as failures, unless max_latency is 0. Probes
+        are sent every reset_timeout seconds, and time out after
+        probe_timeout seconds.
+        """
+        self.name = name
+        self.probe_url = probe_url
+        self.validate_cert = validate_cert
+        self.max_failures = max_failures
+        self.max_latency = max_latency
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.io_loop = io_loop or IOLoop.current()
+        self.state = CLOSED
+        # The number of consecutive failures.
+        self.failures = 0
+        # The time of the next probe while the circuit is open.
+        self._probe_at = None
+
+    def check(self):
+        """Raise a CircuitOpen error if the circuit is open."""
+        if self.state == OPEN:
+            _fast_failures.inc()
+            delay = self._probe_at - self.io_loop.time()
+            raise CircuitOpen(self.name, max(1, int(math.ceil(delay))))
+
+    def record(self, response, failed):
+        """Record the outcome of a fetch.
+
+        Receive the httpclient.HTTPResponse, or None if not available, and
+        whether the fetch failed.
+        """
+        if not failed and self.max_latency and response is not None:
+            # Use the time to the first response byte if available, so that
+            # the transfer of large responses does not count.
+            latency = response.time_info.get(
+                'starttransfer', response.request_time)
+            if latency > self.max_latency:
+                _slow_fetches.inc()
+                failed = True
+        if not failed:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.max_failures:
+            self._open()
+
+    @gen.coroutine
+    def probe(self):
+        """Check the health of the upstream server.
+
+        Return a future whose result is True if the server responds.
+        """
+        _probes.inc()
+        request = httpclient.HTTPRequest(
+            self.probe_url, validate_cert=self.validate_cert,
+            connect_timeout=self.probe_timeout,
+            request_timeout=self.probe_timeout)
+        try:
+            yield httpclient.AsyncHTTPClient(io_loop=self.io_loop).fetch(
+                request)
+        except httpclient.HTTPError as err:
+            raise gen.Return(not is_failure(err.code))
+        except Exception:
+            raise gen.Return(False)
+        raise gen.Return(True)
+
+    def status(self):
+        """Return a dict describing the circuit breaker state."""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+        }
+
+    def _open(self):
+        """Open the circuit and start probing the upstream server."""
+        logging.warning(
+            'circuit breaker: {} failed {} times: rejecting requests'.format(
+                self.name, self.failures))
+        _opened.inc()
+        self.state = OPEN
+        self._schedule_probe()
+
+    def _schedule_probe(self):
+        """Probe the upstream server after the reset timeout."""
+        self._probe_at = self.io_loop.time() + self.reset_timeout
+        self.io_loop.add_timeout(self._probe_at, self._probe)
+
+    @gen.coroutine
+    def _probe(self):
+        """Close the circuit if the upstream server is healthy."""
+        healthy = yield self.probe()
+        if not healthy:
+            self._schedule_probe()
+            return
+        logging.info(
+            'circuit breaker: {} is responding again'.format(self.name))
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_at = None
@@ -34,6 +34,10 @@ from tornado import gen
 from tornado.ioloop import IOLoop
 from tornado.util import ObjectDict
 
+from guiserver import (
+    metrics,
+    shared,
+)
 from guiserver.bundles import (
     utils,
     views,
@@ -50,6 +54,24 @@ process.EXTRA_QUEUED_CALLS = 0
 # Tests use the first API version in this list.
 SUPPORTED_API_VERSIONS = ['go']
 
+_queue_depth = metrics.gauge(
+    'deployer_queue', 'The bundle deployments queued or in progress.')
+_validation_time = metrics.histogram(
+    'deployer_validation_seconds', 'The time spent validating bundles.')
+_import_time = metrics.histogram(
+    'deployer_import_seconds',
+    'The time spent importing bundles, including the time spent queued.')
+
+
+def _call_locked(lock_path, func, *args):
+    """Call func(*args) holding the lock file at lock_path.
+
+    This is used so that the server processes sharing the lock import one
+    bundle at the time.
+    """
+    with shared.FileLock(lock_path):
+        return func(*args)
+
 
 class Deployer(object):
     """Handle the bundle deployment process.
@@ -66,12 +88,17 @@ class Deployer(object):
     singleton by all WebSocket requests.
     """
 
-    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None):
+    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None,
+                 lock_path=None):
         """Initialize the deployer.
 
         The apiurl argument is the URL of the juju-core WebSocket server.
         The apiversion argument is the Juju API version (e.g. "go").
+        The lock_path argument, if provided, is the path of a lock file shared
+        by the server processes (see guiserver.shared.FileLock): deployments
+        started by different processes are executed one at the time.
         """
+        self._lock_path = lock_path
         self._apiurl = apiurl
         self._apiversion = apiversion
         if charmworldurl is not None and not charmworldurl.endswith('/'):
@@ -92,6 +119,8 @@ class Deployer(object):
         self._queue = []
         # The futures attribute maps deployment identifiers to Futures.
         self._futures = {}
+        # Map deployment identifiers to the time they have been scheduled.
+        self._start_times = {}
 
         # Options used by the juju-deployer.
         self.importer_options = blocking.get_default_guiserver_options()
@@ -113,12 +142,15 @@ class Deployer(object):
         apiversion = self._apiversion
         if apiversion not in SUPPORTED_API_VERSIONS:
             raise gen.Return('unsupported API version: {}'.format(apiversion))
+        start = time.time()
         try:
             yield self._validate_executor.submit(
                 blocking.validate, self._apiurl, user.username, user.password,
                 bundle)
         except Exception as err:
             raise gen.Return(str(err))
+        finally:
+            _validation_time.observe(time.time() - start)
 
     def import_bundle(
             self, user, name, bundle, version, bundle_id, test_callback=None):
@@ -147,12 +179,17 @@ class Deployer(object):
         self._observer.notify_position(deployment_id, len(self._queue))
         # Add this deployment to the queue.
         self._queue.append(deployment_id)
+        _queue_depth.set(len(self._queue))
+        self._start_times[deployment_id] = time.time()
         # Add the import bundle job to the run executor, and set up a callback
         # to be called when the import process completes.
-        future = self._run_executor.submit(
+        job = (
             blocking.import_bundle,
             self._apiurl, user.username, user.password, name, bundle, version,
             self.importer_options)
+        if self._lock_path is not None:
+            job = (_call_locked, self._lock_path) + job
+        future = self._run_executor.submit(*job)
         add_future(self._io_loop, future, self._import_callback,
                    deployment_id, bundle_id)
         self._futures[deployment_id] = future
@@ -187,7 +224,11 @@ class Deployer(object):
             self._observer.notify_completed(deployment_id, error=error)
         # Remove the completed deployment job from the queue.
         self._queue.remove(deployment_id)
+        _queue_depth.set(len(self._queue))
         del self._futures[deployment_id]
+        start = self._start_times.pop(deployment_id, None)
+        if start is not None:
+            _import_time.observe(time.time() - start)
         # Notify the new position of all remaining deployments in the queue.
         for position, deploy_id in enumerate(self._queue):
             self._observer.notify_position(deploy_id, position)
@@ -319,10 +360,16 @@ class ChangeSetMiddleware(object):
             changeset.process_request(data)
     """
 
-    def __init__(self, user, write_response):
-        """Initialize the change set middleware."""
+    def __init__(self, user, write_response, store=None):
+        """Initialize the change set middleware.
+
+        If a store is provided (see guiserver.shared.SharedStore), change set
+        tokens are saved there, so that they can be used in all the server
+        processes sharing the store.
+        """
         self._user = user
         self._write_response = write_response
+        self._store = store
         self.routes = {
             'GetChanges': views.get_changes,
             'SetChanges': views.set_changes,
@@ -342,7 +389,7 @@ class ChangeSetMiddleware(object):
         request_id = data['RequestId']
         params = data.get('Params', {})
         view = self.routes[data['Request']]
-        request = ObjectDict(params=params, user=self._user)
+        request = ObjectDict(params=params, user=self._user, store=self._store)
         response = yield view(request)
         response['RequestId'] = request_id
         self._write_response(response)
@@ -22,9 +22,12 @@ docstring, mimics the request/response paradigm over a WebSocket. Views are
 simple functions that, given a request, return a response to be sent back to
 the API client. Each view receives the following arguments:
 
-    - request: a request object with two attributes:
+    - request: a request object with the following attributes:
       - request.params: a dict representing the parameters sent by the client;
       - request.user: the current user (an instance of guiserver.auth.User);
+      - request.store (change set requests only): the store where change set
+        tokens are saved (see guiserver.shared), or None to use the default
+        in-memory store;
     - deployer: a Deployer instance, ready to be used to schedule/start/observe
       bundle deployments.
 
@@ -69,9 +72,9 @@ from jujubundlelib import (
     validation,
 )
 from tornado import gen
-from tornado.ioloop import IOLoop
 import yaml
 
+from guiserver import shared
 from guiserver.bundles.utils import (
     prepare_bundle,
     require_authenticated_user,
@@ -252,8 +255,9 @@ def status(request, deployer):
     raise response({'LastChanges': last_changes})
 
 
-# Map bundle tokens to the corresponding set of changes and the expire handle.
-_bundle_changesets = {}
+# Map bundle tokens to the corresponding set of changes, unless a store is
+# provided in the request.
+_bundle_changesets = shared.MemoryStore()
 # Define the expiration timeout for a bundle token.
 _bundle_max_life = datetime.timedelta(minutes=2)
 
@@ -282,13 +286,14 @@ def get_changes(request):
     token = params.get('Token')
     if token is not None:
         # Retrieve the change set using the provided token.
-        data = _bundle_changesets.pop(token, None)
+        store = request.store
+        if store is None:
+            store = _bundle_changesets
+        data = store.pop(token)
         if data is None:
             error = 'unknown, fulfilled, or expired bundle token'
             raise response(error=error)
         logging.info('get change set: using token {}'.format(token))
-        io_loop = IOLoop.current()
-        io_loop.remove_timeout(data['handle'])
         raise response({'Changes': data['changes']})
 
     # Retrieve the change set using the provided bundle content.
@@ -325,18 +330,11 @@ def set_changes(request):
 
     # Create and store the bundle token.
     token = uuid.uuid4().hex
-
-    def expire_token():
-        _bundle_changesets.pop(token, None)
-        logging.info('set change set: expired token {}'.format(token))
-
-    io_loop = IOLoop.current()
-    handle = io_loop.add_timeout(_bundle_max_life, expire_token)
     now = datetime.datetime.utcnow()
-    _bundle_changesets[token] = {
-        'changes': changes,
-        'handle': handle,
-    }
+    store = request.store
+    if store is None:
+        store = _bundle_changesets
+    store.put(token, {'changes': changes}, _bundle_max_life.total_seconds())
     raise response({
         'Token': token,
         'Created': now.isoformat() + 'Z',
@@ -0,0 +1,364 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server disk cache for the charm files proxied from juju-core.
+
+The GUI requests charm files (e.g. icons and README files) through the
+juju-core HTTPS proxy, and a page showing many services requests many of
+them. Charm URLs include the charm revision, so that the content of these
+files does not change: responses are stored on disk and served from there.
+
+Bodies are stored in files named after the SHA-256 digest of their content,
+so that identical files (e.g. the same icon in different charm revisions)
+are stored once. Each entry is described by a JSON index file, keyed by the
+normalized upstream URL and the credentials of the client: juju-core requires
+authentication to retrieve charm files, and entries are only served to the
+clients presenting the same credentials. When the cache exceeds its maximum
+size, the least recently used entries are removed. After the configured
+amount of time, entries are revalidated using the ETag and Last-Modified
+upstream headers.
+
+    - make_key: return the cache key for an upstream URL and credentials;
+    - CharmFileCache: the cache, shared by all the juju-core proxy requests;
+    - CacheWriter: store a response body streamed from juju-core.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib
+import urlparse
+
+from guiserver import metrics
+
+
+# The default maximum size in bytes of the cached files.
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+# The default number of seconds after which entries are revalidated.
+DEFAULT_TTL = 3600
+# The upstream response headers stored with the entries.
+_STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+# The request headers carrying the client credentials.
+_CREDENTIALS_HEADERS = ('Authorization', 'Cookie')
+
+_hits = metrics.counter(
+    'charm_cache_hits',
+    'The charm file requests served from the disk cache.')
+_misses = metrics.counter(
+    'charm_cache_misses',
+    'The charm file requests forwarded to juju-core.')
+_revalidations = metrics.counter(
+    'charm_cache_revalidations',
+    'The cached charm files confirmed unchanged by juju-core.')
+_size = metrics.gauge(
+    'charm_cache_bytes', 'The size in bytes of the cached charm files.')
+
+
+def make_key(url, headers=None):
+    """Return the cache key for the given upstream URL and request headers.
+
+    The query arguments are sorted, so that equivalent URLs share the entry.
+    The credentials included in the headers, if any, are part of the key, so
+    that entries are only served to the clients which stored them. Only their
+    digest is included, as keys are stored on disk.
+    """
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    arguments = urlparse.parse_qsl(query, keep_blank_values=True)
+    query = urllib.urlencode(sorted(arguments))
+    key = urlparse.urlunsplit((scheme, netloc.lower(), path, query, ''))
+    if headers is None:
+        return key
+    credentials = [
+        '{}: {}'.format(name, headers[name])
+        for name in _CREDENTIALS_HEADERS if name in headers]
+    if not credentials:
+        return key
+    return '{} {}'.format(key, _digest('\n'.join(credentials)))
+
+
+def _digest(value):
+    """Return the SHA-256 hex digest of the given string."""
+    return hashlib.sha256(value).hexdigest()
+
+
+class CacheEntry(object):
+    """A cached charm file."""
+
+    __slots__ = ('key', 'digest', 'size', 'headers', 'stored')
+
+    def __init__(self, key, digest, size, headers, stored):
+        self.key = key
+        self.digest = digest
+        self.size = size
+        # A dict of the stored upstream response headers.
+        self.headers = headers
+        # The time the content was last confirmed by juju-core.
+        self.stored = stored
+
+    @property
+    def etag(self):
+        """Return the ETag sent to browsers for this entry."""
+        return self.headers.get('ETag') or '"{}"'.format(self.digest)
+
+    def validators(self):
+        """Return the headers used to revalidate this entry upstream."""
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_dict(self):
+        """Return a dict representing this entry, suitable for JSON."""
+        return {
+            'key': self.key,
+            'digest': self.digest,
+            'size': self.size,
+            'headers': self.headers,
+            'stored': self.stored,
+        }
+
+
+class CharmFileCache(object):
+    """A size bounded disk cache of charm files.
+
+    Note that the cache is instantiated once when the application is
+    bootstrapped and used as a singleton by all the proxy requests. Entries
+    stored by a previous run in the same directory are reused. If multiple
+    processes use the same directory, each one only evicts the entries it
+    knows about, and removed files are just treated as cache misses.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """Initialize the cache.
+
+        Files are stored in the given directory, which is created if
+        required. When the stored files exceed max_size bytes, the least
+        recently used ones are removed. Entries are revalidated after ttl
+        seconds, which is also the max-age advertised to browsers. Responses
+        are marked as private, as retrieving them requires authentication.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_control = 'private, max-age={}'.format(ttl)
+        self._blobs = os.path.join(directory, 'blobs')
+        self._index = os.path.join(directory, 'index')
+        for path in (self._blobs, self._index):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        # Map keys to entries, the least recently used entry first.
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        """Load the entries stored by previous runs."""
+        entries = []
+        for name in os.listdir(self._index):
+            path = os.path.join(self._index, name)
+            try:
+                with open(path) as index_file:
+                    data = json.load(index_file)
+                entry = CacheEntry(**data)
+                used = os.path.getmtime(path)
+            except (IOError, OSError, TypeError, ValueError) as err:
+                logging.warning(
+                    'charm cache: ignoring entry {}: {}'.format(name, err))
+                continue
+            if os.path.exists(self._blob_path(entry.digest)):
+                entries.append((used, entry))
+        for _, entry in sorted(entries, key=lambda item: item[0]):
+            self._insert(entry)
+        self._evict()
+
+    def _blob_path(self, digest):
+        return os.path.join(self._blobs, digest)
+
+    def _index_path(self, key):
+        return os.path.join(self._index, _digest(key) + '.json')
+
+    def _insert(self, entry):
+        """Add the given entry as the most recently used one."""
+        self._entries[entry.key] = entry
+        self._size += entry.size
+        _size.set(self._size)
+
+    def _write_index(self, entry):
+        """Store the index file describing the given entry."""
+        path = self._index_path(entry.key)
+        with tempfile.NamedTemporaryFile(
+                dir=self._index, delete=False) as index_file:
+            json.dump(entry.to_dict(), index_file)
+        os.rename(index_file.name, path)
+
+    def _remove(self, key):
+        """Remove the entry with the given key and its files."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        _size.set(self._size)
+        paths = [self._index_path(key)]
+        if not any(
+                other.digest == entry.digest
+                for other in self._entries.itervalues()):
+            paths.append(self._blob_path(entry.digest))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Remove the least recently used entries exceeding the size."""
+        while self._size > self.max_size:
+            key = next(iter(self._entries))
+            self._remove(key)
+
+    def get(self, key):
+        """Return the entry for the given key, or None.
+
+        Entries which must be revalidated are returned too: see is_fresh.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            _misses.inc()
+            return None
+        # Move the entry to the end, as the most recently used.
+        self._entries[key] = entry
+        return entry
+
+    def is_fresh(self, entry):
+        """Return True if the given entry must not be revalidated."""
+        return time.time() - entry.stored < self.ttl
+
+    def open(self, entry):
+        """Return the file storing the content of the given entry.
+
+        Return None, and remove the entry, if the file is missing, e.g. if it
+        has been removed by another process.
+        """
+        try:
+            content = open(self._blob_path(entry.digest), 'rb')
+        except IOError:
+            self._remove(entry.key)
+            _misses.inc()
+            return None
+        _hits.inc()
+        return content
+
+    def revalidated(self, entry):
+        """Record that juju-core confirmed the given entry is unchanged."""
+        entry.stored = time.time()
+        self._write_index(entry)
+        _revalidations.inc()
+
+    def writer(self, key):
+        """Return a CacheWriter storing the response for the given key."""
+        return CacheWriter(self, key)
+
+    def add(self, key, path, digest, size, headers):
+        """Add an entry whose content is in the given temporary file."""
+        self._remove(key)
+        blob = self._blob_path(digest)
+        if os.path.exists(blob):
+            os.remove(path)
+        else:
+            os.rename(path, blob)
+        entry = CacheEntry(key, digest, size, headers, time.time())
+        self._write_index(entry)
+        self._insert(entry)
+        self._evict()
+        return entry
+
+    def status(self):
+        """Return a dict describing the cache usage."""
+        hits, misses = _hits.value, _misses.value
+        requests = hits + misses
+        return {
+            'entries': len(self._entries),
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / requests if requests else None,
+            'revalidations': _revalidations.value,
+        }
+
+
+class CacheWriter(object):
+    """Store a charm file as it is streamed from juju-core.
+
+    Writers are used as sinks of guiserver.streaming.ResponseStream objects.
+    The content is written to a temporary file, which becomes a cache entry
+    when the response is complete. Responses larger than the cache are not
+    stored.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        # The headers added to the streamed response.
+        self.headers = {'Cache-Control': cache.cache_control}
+        # The cache entry, once the response has been stored.
+        self.entry = None
+        self._file = None
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def write(self, chunk):
+        """Write a chunk of the response body."""
+        self._size += len(chunk)
+        if self._size > self.cache.max_size:
+            # The response is too large to be cached.
+            self.abort()
+            return
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(
+                dir=self.cache._blobs, prefix='.', delete=False)
+        self._file.write(chunk)
+        self._hash.update(chunk)
+
+    def commit(self, code, headers):
+        """Store the completed response, if successful.
+
+        Receive the response status code and headers.
+        """
+        if code != 200 or self._file is None:
+            self.abort()
+            return None
+        self._file.close()
+        stored = dict(
+            (key, headers[key]) for key in _STORED_HEADERS if key in headers)
+        entry = self.entry = self.cache.add(
+            self.key, self._file.name, self._hash.hexdigest(), self._size,
+            stored)
+        self._file = None
+        return entry
+
+    def abort(self):
+        """Discard the response."""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
@@ -16,13 +16,32 @@
 
 """Juju GUI server websocket clients."""
 
+import tornado
 from tornado import (
     httpclient,
     websocket,
 )
 
+from guiserver import metrics
+from guiserver.compression import (
+    CLIENT_OFFER,
+    DeflateProtocol,
+    accept_response,
+)
+
+
+_connections = metrics.gauge(
+    'juju_connections', 'The open WebSocket connections to the Juju API.')
+# Tornado does not support WebSocket extensions: the permessage-deflate client
+# handshake below replaces the one of the Tornado release pinned in
+# server-requirements.pip. Compression is not offered with other releases.
+_DEFLATE_TORNADO_VERSION = (3, 2)
+_deflate_supported = tornado.version_info[:2] == _DEFLATE_TORNADO_VERSION
 
-def websocket_connect(io_loop, url, on_message_callback, headers=None):
+
+def websocket_connect(
+        io_loop, url, on_message_callback, headers=None, connect_timeout=20,
+        request_timeout=100):
     """WebSocket client connection factory.
 
     The client factory receives the following arguments:
@@ -31,14 +50,22 @@ def websocket_connect(io_loop, url, on_message_callback, headers=None):
         - on_message_callback: a callback that will be called each time
           a new message is received by the client;
         - headers (optional): a dict of additional headers to include in the
-          client handshake.
+          client handshake;
+        - connect_timeout (optional): the number of seconds allowed for
+          establishing the TCP connection;
+        - request_timeout (optional): the number of seconds allowed for
+          completing the whole handshake.
 
     Return a Future whose result is a WebSocketClientConnection.
     """
     request = httpclient.HTTPRequest(
-        url, validate_cert=False, request_timeout=100)
+        url, validate_cert=False, connect_timeout=connect_timeout,
+        request_timeout=request_timeout)
     if headers is not None:
         request.headers.update(headers)
+    if (WebSocketClientConnection.compression is not None and
+            _deflate_supported):
+        request.headers['Sec-WebSocket-Extensions'] = CLIENT_OFFER
     conn = WebSocketClientConnection(io_loop, request, on_message_callback)
     return conn.connect_future
 
@@ -48,8 +75,16 @@ class WebSocketClientConnection(websocket.WebSocketClientConnection):
 
     Use this connection as described in
     <http://www.tornadoweb.org/en/stable/websocket.html#client-side-support>.
+
+    If the compression class attribute is set to a DeflateOptions instance,
+    the permessage-deflate extension is offered to the server (see
+    guiserver.compression).
     """
 
+    compression = None
+    # Whether the WebSocket handshake has been completed.
+    _established = False
+
     def __init__(self, io_loop, request, on_message_callback):
         """Client initializer.
 
@@ -60,10 +95,52 @@ class WebSocketClientConnection(websocket.WebSocketClientConnection):
         super(WebSocketClientConnection, self).__init__(io_loop, request)
         self._on_message_callback = on_message_callback
 
+    def set_message_callback(self, on_message_callback):
+        """Replace the callback called each time a new message is received."""
+        self._on_message_callback = on_message_callback
+
     def on_message(self, message):
         """Hook called when a new message is received.
 
         The on_message_callback is called passing it the message.
         """
+        if message is None and self._established:
+            # The connection has been closed.
+            self._established = False
+            _connections.dec()
         super(WebSocketClientConnection, self).on_message(message)
         self._on_message_callback(message)
+
+    def _handle_1xx(self, code):
+        """Complete the handshake, enabling compression if accepted."""
+        deflate = None
+        extensions = self.headers.get('Sec-WebSocket-Extensions')
+        if self.compression is not None and _deflate_supported and extensions:
+            deflate = accept_response(extensions, self.compression)
+        if deflate is None:
+            super(WebSocketClientConnection, self)._handle_1xx(code)
+        else:
+            self._check_handshake(code)
+            self.protocol = DeflateProtocol(self, deflate, mask_outgoing=True)
+            self.protocol._receive_frame()
+            if self._timeout is not None:
+                self.io_loop.remove_timeout(self._timeout)
+                self._timeout = None
+            self.connect_future.set_result(self)
+        self._established = True
+        _connections.inc()
+
+    def _check_handshake(self, code):
+        """Raise a WebSocketError if the handshake response is not valid."""
+        headers = self.headers
+        accept = websocket.WebSocketProtocol13.compute_accept_value(self.key)
+        if code != 101:
+            raise websocket.WebSocketError(
+                'unexpected handshake response code: {}'.format(code))
+        if headers.get('Upgrade', '').lower() != 'websocket':
+            raise websocket.WebSocketError('invalid Upgrade header')
+        if headers.get('Connection', '').lower() != 'upgrade':
+            raise websocket.WebSocketError('invalid Connection header')
+        if headers.get('Sec-Websocket-Accept') != accept:
+            raise websocket.WebSocketError(
+                'invalid Sec-WebSocket-Accept header')
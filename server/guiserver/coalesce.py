@@ -0,0 +1,204 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server coalescing of identical concurrent proxy requests.
+
+When a bundle is opened, many parts of the GUI request the same juju-core
+resources at the same time. Identical GET requests made while a fetch is in
+progress wait for it and receive its response, instead of sending their own
+upstream request. Requests are identical if their URL and the headers which
+can change the response are the same.
+
+The response of the first request is streamed to its browser as usual, and
+it is recorded up to a maximum size so that it can be shared. If the
+response is larger, or if the fetch fails, or if waiters do not receive the
+response in time, waiters fetch the response themselves.
+
+    - request_key: return the key identifying equivalent requests;
+    - SingleFlight: the registry of the shared fetches in progress;
+    - Flight: a fetch shared by identical requests.
+"""
+
+import functools
+from io import BytesIO
+
+from tornado import httpclient
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+
+
+# The default number of seconds requests wait for an identical fetch.
+DEFAULT_TIMEOUT = 5
+# The default maximum size in bytes of a shared response body.
+DEFAULT_MAX_SIZE = 1024 * 1024
+# The request headers which can change the response.
+_KEY_HEADERS = (
+    'Accept', 'Accept-Encoding', 'Authorization', 'Cookie',
+    'If-Modified-Since', 'If-None-Match', 'Range')
+
+_saved = metrics.counter(
+    'proxy_fetches_saved',
+    'The proxy requests answered with the response of an identical request '
+    'in progress.')
+_fallbacks = metrics.counter(
+    'proxy_coalesce_fallbacks',
+    'The proxy requests which waited for an identical request, and then '
+    'fetched the response themselves.')
+
+
+def request_key(request):
+    """Return the key identifying requests equivalent to the given one.
+
+    The request is an httpclient.HTTPRequest.
+    """
+    headers = request.headers
+    return (request.method, request.url) + tuple(
+        headers.get(name) for name in _KEY_HEADERS)
+
+
+class Flight(object):
+    """A fetch shared by identical concurrent requests.
+
+    The flight is used as the sink of the response stream of the request
+    performing the fetch (see guiserver.streaming.ResponseStream), so that
+    the streamed response is recorded. The sink of that request, if any, is
+    wrapped.
+    """
+
+    def __init__(self, flights, key, request, sink=None):
+        self.key = key
+        self.request = request
+        self.sink = sink
+        # The headers added to the streamed response.
+        self.headers = {} if sink is None else sink.headers
+        self._flights = flights
+        self._waiters = []
+        self._chunks = []
+        self._size = 0
+        # The status code and headers of the completely recorded response.
+        self._code = self._response_headers = None
+
+    def wait(self):
+        """Return a future whose result is the shared response.
+
+        The result is None if the response cannot be shared, and the request
+        must be sent upstream by the waiter.
+        """
+        future = Future()
+        self._waiters.append(future)
+        flights = self._flights
+        flights.io_loop.add_timeout(
+            flights.io_loop.time() + flights.timeout,
+            functools.partial(self._timeout, future))
+        return future
+
+    def write(self, chunk):
+        """Record a chunk of the streamed response body."""
+        if self.sink is not None:
+            self.sink.write(chunk)
+        if self._chunks is None:
+            return
+        self._size += len(chunk)
+        if self._size > self._flights.max_size:
+            # The response is too large to be shared.
+            self._chunks = None
+            self._land(None)
+            return
+        self._chunks.append(chunk)
+
+    def commit(self, code, headers):
+        """The response has been completely streamed."""
+        if self.sink is not None:
+            self.sink.commit(code, headers)
+        self._code, self._response_headers = code, headers
+
+    def abort(self):
+        """The response has not been completely streamed."""
+        if self.sink is not None:
+            self.sink.abort()
+
+    def finish(self, response):
+        """The fetch is completed: share its response with the waiters.
+
+        Receive the response returned to the request performing the fetch,
+        or None if the response has been streamed or an error occurred.
+        """
+        if response is None and self._code is not None and self._chunks:
+            response = httpclient.HTTPResponse(
+                self.request, self._code, headers=self._response_headers,
+                buffer=BytesIO(b''.join(self._chunks)))
+        self._chunks = None
+        self._land(response)
+
+    def _land(self, response):
+        """Send the given response, or None, to the waiters."""
+        self._flights.remove(self)
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            if response is None:
+                _fallbacks.inc()
+            else:
+                _saved.inc()
+            future.set_result(response)
+
+    def _timeout(self, future):
+        """The given waiter has waited too long."""
+        if future in self._waiters:
+            self._waiters.remove(future)
+            _fallbacks.inc()
+            future.set_result(None)
+
+
+class SingleFlight(object):
+    """The registry of the fetches shared by identical requests.
+
+    Note that the registry is instantiated once when the application is
+    bootstrapped and used as a singleton by all the proxy requests.
+    """
+
+    def __init__(
+            self, timeout=DEFAULT_TIMEOUT, max_size=DEFAULT_MAX_SIZE,
+            io_loop=None):
+        """Initialize the registry.
+
+        Requests wait for the response of an identical request for at most
+        timeout seconds. Responses larger than max_size bytes are not shared.
+        """
+        self.timeout = timeout
+        self.max_size = max_size
+        self.io_loop = io_loop or IOLoop.current()
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def get(self, key):
+        """Return the flight in progress for the given key, or None."""
+        return self._flights.get(key)
+
+    def start(self, key, request, sink=None):
+        """Start and return a flight for the given key and request.
+
+        If provided, the sink of the request is wrapped by the flight.
+        """
+        flight = self._flights[key] = Flight(self, key, request, sink)
+        return flight
+
+    def remove(self, flight):
+        """Stop sharing the response of the given flight."""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
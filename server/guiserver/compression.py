@@ -0,0 +1,325 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server WebSocket compression.
+
+This module implements the permessage-deflate WebSocket extension (RFC 7692)
+on top of the Tornado WebSocket protocol implementation, which does not
+support extensions.
+
+    - DeflateOptions: the compression settings, provided by the server
+      options.
+    - negotiate() and accept_response(): the server and client sides of the
+      extension negotiation. Both return a PerMessageDeflate instance, used to
+      compress and decompress the messages of a single connection.
+    - DeflateProtocol: a WebSocket protocol compressing outgoing messages and
+      decompressing incoming ones, if the extension has been negotiated.
+
+Messages smaller than the configured threshold are sent uncompressed.
+"""
+
+import os
+import struct
+import time
+import zlib
+
+from tornado import (
+    escape,
+    websocket,
+)
+from tornado.iostream import StreamClosedError
+from tornado.util import _websocket_mask
+
+from guiserver import metrics
+
+
+# The extension name as used in the Sec-WebSocket-Extensions header.
+EXTENSION = 'permessage-deflate'
+# The extension offer sent by WebSocket clients.
+CLIENT_OFFER = 'permessage-deflate; client_max_window_bits'
+# The maximum size of a decompressed message.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# The bit flagging the first frame of a compressed message.
+RSV1 = 0x40
+# The trailer removed from compressed messages, see RFC 7692 section 7.2.1.
+_TRAILER = b'\x00\x00\xff\xff'
+
+_deflate_input = metrics.counter(
+    'ws_deflate_input_bytes',
+    'The size of the WebSocket messages before compression.')
+_deflate_output = metrics.counter(
+    'ws_deflate_output_bytes',
+    'The size of the WebSocket messages after compression.')
+_deflate_cpu = metrics.counter(
+    'ws_deflate_cpu_seconds',
+    'The CPU time spent compressing WebSocket messages.')
+_deflate_skipped = metrics.counter(
+    'ws_deflate_skipped',
+    'The WebSocket messages not compressed because below the threshold.')
+_inflate_input = metrics.counter(
+    'ws_inflate_input_bytes',
+    'The size of the compressed WebSocket messages received.')
+_inflate_output = metrics.counter(
+    'ws_inflate_output_bytes',
+    'The size of the received WebSocket messages after decompression.')
+_inflate_cpu = metrics.counter(
+    'ws_inflate_cpu_seconds',
+    'The CPU time spent decompressing WebSocket messages.')
+
+
+class DeflateOptions(object):
+    """The WebSocket compression settings.
+
+    The level is the zlib compression level (1-9), max_window_bits is the
+    base two logarithm of the maximum compression window size (9-15), and
+    min_size is the size in bytes below which messages are not compressed.
+    """
+
+    __slots__ = ('level', 'max_window_bits', 'min_size')
+
+    def __init__(self, level=6, max_window_bits=15, min_size=256):
+        self.level = level
+        self.max_window_bits = max_window_bits
+        self.min_size = min_size
+
+
+class PerMessageDeflate(object):
+    """Compress and decompress the messages of a WebSocket connection."""
+
+    def __init__(self, level, window_bits, no_context_takeover, min_size):
+        self._level = level
+        self._window_bits = window_bits
+        self._no_context_takeover = no_context_takeover
+        self._min_size = min_size
+        self._compressor = self._make_compressor()
+        # Incoming messages can be compressed using any window size.
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def _make_compressor(self):
+        """Return a new raw deflate compressor."""
+        return zlib.compressobj(
+            self._level, zlib.DEFLATED, -self._window_bits)
+
+    def compress(self, data):
+        """Return the compressed data, or None if data is too small."""
+        if len(data) < self._min_size:
+            _deflate_skipped.inc()
+            return None
+        start = time.clock()
+        if self._no_context_takeover:
+            self._compressor = self._make_compressor()
+        compressor = self._compressor
+        compressed = compressor.compress(data) + compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+        compressed = compressed[:-len(_TRAILER)]
+        _deflate_cpu.inc(time.clock() - start)
+        _deflate_input.inc(len(data))
+        _deflate_output.inc(len(compressed))
+        return compressed
+
+    def decompress(self, data):
+        """Return the decompressed data.
+
+        Raise a ValueError if the decompressed message is too big, or a
+        zlib.error if the data is not valid.
+        """
+        start = time.clock()
+        decompressed = self._decompressor.decompress(
+            data + _TRAILER, MAX_MESSAGE_SIZE)
+        if self._decompressor.unconsumed_tail:
+            raise ValueError('decompressed message too big')
+        _inflate_cpu.inc(time.clock() - start)
+        _inflate_input.inc(len(data))
+        _inflate_output.inc(len(decompressed))
+        return decompressed
+
+
+def parse_extensions(header):
+    """Parse the given Sec-WebSocket-Extensions header value.
+
+    Return a list of (name, params) tuples, where params is a dict mapping
+    parameter names to values (None for parameters without a value).
+    """
+    extensions = []
+    for extension in header.split(','):
+        parts = [part.strip() for part in extension.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            params[key.strip()] = value.strip().strip('"') or None
+        extensions.append((parts[0], params))
+    return extensions
+
+
+def _window_bits(value, default):
+    """Return the window bits in the given parameter value.
+
+    Raise a ValueError if the value is not valid or not supported.
+    """
+    if value is None:
+        return default
+    bits = int(value)
+    # Window sizes of 2^8 bytes are not supported by zlib raw streams.
+    if not 9 <= bits <= 15:
+        raise ValueError('unsupported window bits: {}'.format(value))
+    return bits
+
+
+def negotiate(header, options):
+    """Accept the first acceptable permessage-deflate offer in header.
+
+    The header argument is the Sec-WebSocket-Extensions header sent by the
+    client. Return a (response, deflate) tuple, where response is the value of
+    the Sec-WebSocket-Extensions response header and deflate is a
+    PerMessageDeflate instance, or None if no offers are acceptable.
+    """
+    known = (
+        'client_max_window_bits', 'client_no_context_takeover',
+        'server_max_window_bits', 'server_no_context_takeover')
+    for name, params in parse_extensions(header):
+        if name != EXTENSION or set(params).difference(known):
+            continue
+        try:
+            window_bits = min(
+                options.max_window_bits,
+                _window_bits(params.get('server_max_window_bits'), 15))
+        except ValueError:
+            continue
+        response = [EXTENSION]
+        no_context_takeover = 'server_no_context_takeover' in params
+        if no_context_takeover:
+            response.append('server_no_context_takeover')
+        if window_bits < 15:
+            response.append('server_max_window_bits={}'.format(window_bits))
+        deflate = PerMessageDeflate(
+            options.level, window_bits, no_context_takeover, options.min_size)
+        return '; '.join(response), deflate
+    return None
+
+
+def accept_response(header, options):
+    """Return a PerMessageDeflate for the given server extensions response.
+
+    The header argument is the Sec-WebSocket-Extensions header sent by the
+    server in response to CLIENT_OFFER. Return None if the server did not
+    accept the offer. Raise a ValueError if the response is not valid.
+    """
+    for name, params in parse_extensions(header):
+        if name != EXTENSION:
+            continue
+        window_bits = min(
+            options.max_window_bits,
+            _window_bits(params.get('client_max_window_bits'), 15))
+        no_context_takeover = 'client_no_context_takeover' in params
+        return PerMessageDeflate(
+            options.level, window_bits, no_context_takeover, options.min_size)
+    return None
+
+
+class DeflateProtocol(websocket.WebSocketProtocol13):
+    """A WebSocket protocol supporting the permessage-deflate extension.
+
+    The deflate argument is the PerMessageDeflate instance used to compress
+    and decompress messages. When used on the server side, the extensions
+    argument is the value of the Sec-WebSocket-Extensions response header.
+    """
+
+    def __init__(self, handler, deflate, mask_outgoing=False,
+                 extensions=None):
+        websocket.WebSocketProtocol13.__init__(
+            self, handler, mask_outgoing=mask_outgoing)
+        self.deflate = deflate
+        self._extensions = extensions
+        # True if the message being received is compressed.
+        self._compressed = False
+
+    def _accept_connection(self):
+        """Complete the server handshake including the extensions header."""
+        subprotocol_header = ''
+        subprotocols = self.request.headers.get('Sec-WebSocket-Protocol', '')
+        subprotocols = [s.strip() for s in subprotocols.split(',')]
+        if subprotocols:
+            selected = self.handler.select_subprotocol(subprotocols)
+            if selected:
+                assert selected in subprotocols
+                subprotocol_header = (
+                    'Sec-WebSocket-Protocol: {}\r\n'.format(selected))
+        self.stream.write(escape.utf8(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {}\r\n'
+            'Sec-WebSocket-Extensions: {}\r\n'
+            '{}'
+            '\r\n'.format(
+                self._challenge_response(), self._extensions,
+                subprotocol_header)))
+        self.async_callback(self.handler.open)(
+            *self.handler.open_args, **self.handler.open_kwargs)
+        self._receive_frame()
+
+    def write_message(self, message, binary=False):
+        """Send the given message, compressing it if big enough."""
+        opcode = 0x2 if binary else 0x1
+        message = escape.utf8(message)
+        flags = 0
+        compressed = self.deflate.compress(message)
+        if compressed is not None:
+            message, flags = compressed, RSV1
+        try:
+            self._write_frame(True, opcode, message, flags=flags)
+        except StreamClosedError:
+            self._abort()
+
+    def _write_frame(self, fin, opcode, data, flags=0):
+        """Write a frame, setting the given reserved bits flags."""
+        finbit = 0x80 if fin else 0
+        frame = struct.pack('B', finbit | flags | opcode)
+        length = len(data)
+        mask_bit = 0x80 if self.mask_outgoing else 0
+        if length < 126:
+            frame += struct.pack('B', length | mask_bit)
+        elif length <= 0xFFFF:
+            frame += struct.pack('!BH', 126 | mask_bit, length)
+        else:
+            frame += struct.pack('!BQ', 127 | mask_bit, length)
+        if self.mask_outgoing:
+            mask = os.urandom(4)
+            data = mask + _websocket_mask(mask, data)
+        self.stream.write(frame + data)
+
+    def _on_frame_start(self, data):
+        """Handle the compression flag on the first frame of messages."""
+        header = ord(data[0])
+        if header & RSV1:
+            if (header & 0xf) not in (0x1, 0x2):
+                # Only the first frame of data messages can be compressed.
+                return self._abort()
+            self._compressed = True
+            data = chr(header & ~RSV1) + data[1:]
+        websocket.WebSocketProtocol13._on_frame_start(self, data)
+
+    def _handle_message(self, opcode, data):
+        """Decompress data messages if required."""
+        if self._compressed and opcode in (0x1, 0x2):
+            self._compressed = False
+            try:
+                data = self.deflate.decompress(data)
+            except (ValueError, zlib.error):
+                return self._abort()
+        websocket.WebSocketProtocol13._handle_message(self, opcode, data)
@@ -0,0 +1,256 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server Juju API controllers failover.
+
+In highly available environments the Juju API is served by multiple
+controllers. When connecting to the Juju API, the GUI server races connection
+attempts across all the known controller addresses, happy-eyeballs style:
+the preferred controller is tried first, and the next one is tried if no
+connection is established within a short delay, or as soon as the previous
+attempt fails. The first connection established wins; the others are closed.
+
+Controllers are preferred based on their health (controllers recently failing
+are tried last) and on their connection round trip time, tracked as a moving
+average.
+"""
+
+import collections
+import datetime
+import logging
+import time
+import urlparse
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.clients import websocket_connect
+from guiserver.utils import add_future
+
+
+# The default number of seconds allowed to establish a connection, including
+# the TLS and WebSocket handshakes.
+DEFAULT_CONNECT_TIMEOUT = 5
+# The default number of seconds after which the next controller is tried if
+# the previous attempt is still pending.
+DEFAULT_STAGGER = 0.25
+# The default number of seconds a failing controller is tried last.
+DEFAULT_BACKOFF = 30
+# The weight of the last connection round trip time in the moving average.
+RTT_WEIGHT = 0.3
+
+_failures = metrics.counter(
+    'controller_connect_failures',
+    'The failed attempts to connect to a Juju API controller.')
+_failovers = metrics.counter(
+    'controller_failovers',
+    'The connections established to a controller other than the preferred.')
+
+
+def _ignore_message(message):
+    """Discard messages received by connections losing the race."""
+
+
+class Controller(object):
+    """The connection statistics of a Juju API controller address."""
+
+    __slots__ = ('address', 'rtt', 'failures', 'failed_at')
+
+    def __init__(self, address):
+        self.address = address
+        # The moving average of the connection round trip time in seconds,
+        # or None if no connections have been established yet.
+        self.rtt = None
+        # The number of consecutive failures.
+        self.failures = 0
+        self.failed_at = None
+
+    def __repr__(self):
+        return '<Controller {}>'.format(self.address)
+
+    def healthy(self, now, backoff):
+        """Return True if the controller did not recently fail."""
+        return (self.failed_at is None) or (now - self.failed_at > backoff)
+
+    def succeeded(self, rtt):
+        """Record a successful connection with the given round trip time."""
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += RTT_WEIGHT * (rtt - self.rtt)
+        self.failures = 0
+        self.failed_at = None
+
+    def failed(self, now):
+        """Record a failed connection attempt."""
+        self.failures += 1
+        self.failed_at = now
+
+
+class Controllers(object):
+    """Connect to the Juju API racing attempts across controller addresses.
+
+    Note that this object is instantiated once when the application is
+    bootstrapped and used as a singleton by all WebSocket requests.
+    """
+
+    def __init__(self, addresses, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 stagger=DEFAULT_STAGGER, backoff=DEFAULT_BACKOFF,
+                 io_loop=None):
+        """Initialize the controllers.
+
+        The addresses argument is a sequence of "host:port" strings, the
+        preferred address first.
+        """
+        self._controllers = collections.OrderedDict(
+            (address, Controller(address)) for address in addresses)
+        self._connect_timeout = connect_timeout
+        self._stagger = datetime.timedelta(seconds=stagger)
+        self._backoff = backoff
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+
+    def candidates(self, url):
+        """Return a list of (controller, url) tuples to try connecting to.
+
+        The list is ordered by preference. The URLs are obtained replacing
+        the network location of the given URL with the controller addresses.
+        If the given URL does not refer to a known controller, a list
+        containing only (None, url) is returned.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.netloc not in self._controllers:
+            return [(None, url)]
+        return [
+            (controller, urlparse.urlunsplit(
+                parts._replace(netloc=controller.address)))
+            for controller in self._sorted(time.time())]
+
+    def _sorted(self, now):
+        """Return the list of controllers, preferred first.
+
+        Healthy controllers are preferred, then the ones with the lowest round
+        trip time, then the ones listed first.
+        """
+        positions = dict(
+            (address, position)
+            for position, address in enumerate(self._controllers))
+
+        def sort_key(controller):
+            return (
+                not controller.healthy(now, self._backoff),
+                controller.rtt is None,
+                controller.rtt,
+                positions[controller.address],
+            )
+        return sorted(self._controllers.values(), key=sort_key)
+
+    def connect(self, url, on_message_callback, headers=None):
+        """Return a Future whose result is a connection to the Juju API.
+
+        Receive the same arguments as guiserver.clients.websocket_connect,
+        except for the IO loop.
+        """
+        race = _Race(
+            self._io_loop, self.candidates(url), on_message_callback, headers,
+            self._connect_timeout, self._stagger)
+        return race.future
+
+    def status(self):
+        """Return a list describing the controllers, preferred first."""
+        now = time.time()
+        return [{
+            'address': controller.address,
+            'failures': controller.failures,
+            'healthy': controller.healthy(now, self._backoff),
+            'rtt': controller.rtt,
+        } for controller in self._sorted(now)]
+
+
+class _Race(object):
+    """Race connection attempts across the given candidates.
+
+    The candidates argument is a list of (controller, url) tuples as returned
+    by Controllers.candidates. The future attribute is a Future whose result
+    is the first connection established.
+    """
+
+    def __init__(self, io_loop, candidates, on_message_callback, headers,
+                 connect_timeout, stagger):
+        self.future = Future()
+        self._io_loop = io_loop
+        self._candidates = collections.deque(candidates)
+        self._preferred = candidates[0][0]
+        self._on_message_callback = on_message_callback
+        self._headers = headers
+        self._connect_timeout = connect_timeout
+        self._stagger = stagger
+        self._timeout = None
+        self._pending = 0
+        self._try_next()
+
+    def _try_next(self):
+        """Start connecting to the next candidate."""
+        self._timeout = None
+        controller, url = self._candidates.popleft()
+        self._pending += 1
+        future = websocket_connect(
+            self._io_loop, url, _ignore_message, headers=self._headers,
+            connect_timeout=self._connect_timeout,
+            request_timeout=self._connect_timeout)
+        add_future(
+            self._io_loop, future, self._on_connected, controller, url,
+            time.time())
+        if self._candidates:
+            self._timeout = self._io_loop.add_timeout(
+                self._stagger, self._try_next)
+
+    def _on_connected(self, controller, url, start_time, future):
+        """Handle the completion of a connection attempt."""
+        self._pending -= 1
+        try:
+            connection = future.result()
+        except Exception as err:
+            _failures.inc()
+            if controller is not None:
+                controller.failed(time.time())
+            logging.warning(
+                'failover: unable to connect to {}: {}'.format(url, err))
+            if self.future.done():
+                return
+            if self._candidates:
+                # Fail fast: try the next candidate straight away.
+                self._io_loop.remove_timeout(self._timeout)
+                return self._try_next()
+            if not self._pending:
+                self.future.set_exception(err)
+            return
+        if controller is not None:
+            controller.succeeded(time.time() - start_time)
+        if self.future.done():
+            # Another connection won the race.
+            return connection.close()
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._candidates.clear()
+        if controller is not self._preferred:
+            _failovers.inc()
+            logging.info('failover: connected to {}'.format(url))
+        connection.set_message_callback(self._on_message_callback)
+        self.future.set_result(connection)
@@ -0,0 +1,133 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server on-the-fly compression of proxied HTTP responses.
+
+juju-core serves JSON documents, charm icons and READMEs uncompressed. When
+the browser accepts it, text-like responses relayed by the proxy handlers are
+gzip compressed on the fly, including the ones streamed to the browser as
+they are received (see guiserver.streaming).
+
+    - is_compressible: report whether a content type is worth compressing;
+    - GzipTransform: a Tornado output transform compressing the response.
+"""
+
+import gzip
+from io import BytesIO
+
+from tornado import web
+
+from guiserver import metrics
+
+
+# The default size in bytes below which responses are sent uncompressed.
+DEFAULT_MIN_SIZE = 256
+# The compressible content types, in addition to the text ones.
+_CONTENT_TYPES = frozenset([
+    'application/javascript', 'application/json', 'application/x-yaml',
+    'application/xml', 'image/svg+xml'])
+# The status codes of the responses which are never compressed: partial
+# content ranges refer to the uncompressed body.
+_SKIPPED_CODES = frozenset([204, 206, 304])
+
+_input = metrics.counter(
+    'proxy_gzip_input_bytes',
+    'The size of the proxied responses before compression.')
+_output = metrics.counter(
+    'proxy_gzip_output_bytes',
+    'The size of the proxied responses after compression.')
+_saved = metrics.counter(
+    'proxy_gzip_saved_bytes',
+    'The bytes saved by compressing the proxied responses.')
+
+
+def is_compressible(content_type):
+    """Return True if the given content type is worth compressing."""
+    media_type = content_type.split(';')[0].strip().lower()
+    return media_type.startswith('text/') or media_type in _CONTENT_TYPES
+
+
+class GzipTransform(web.OutputTransform):
+    """Compress the response with gzip if the browser accepts it.
+
+    Unlike Tornado's GZipContentEncoding, streamed responses are compressed
+    even if their length is known in advance, and more content types are
+    compressed. Strong entity tags are made weak, as the compressed body is
+    not byte-for-byte identical to the upstream one.
+    """
+
+    def __init__(self, request, min_size=DEFAULT_MIN_SIZE):
+        self._gzipping = (
+            request.method != 'HEAD' and
+            'gzip' in request.headers.get('Accept-Encoding', ''))
+        self._min_size = min_size
+        self._buffer = self._file = None
+        self._input_size = self._output_size = 0
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        """Compress the first chunk and update the headers if required."""
+        content_type = headers.get('Content-Type', '')
+        if status_code in _SKIPPED_CODES or not is_compressible(content_type):
+            self._gzipping = False
+            return status_code, headers, chunk
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        # The size is unknown if the response is streamed without a length.
+        size = headers.get('Content-Length')
+        if size is not None:
+            size = int(size)
+        elif finishing:
+            size = len(chunk)
+        self._gzipping = (
+            self._gzipping and
+            'Content-Encoding' not in headers and
+            (size is None or size >= self._min_size))
+        if not self._gzipping:
+            return status_code, headers, chunk
+        headers['Content-Encoding'] = 'gzip'
+        etag = headers.get('Etag')
+        if etag is not None and not etag.startswith('W/'):
+            headers['Etag'] = 'W/' + etag
+        self._buffer = BytesIO()
+        self._file = gzip.GzipFile(mode='w', fileobj=self._buffer)
+        chunk = self.transform_chunk(chunk, finishing)
+        if finishing:
+            headers['Content-Length'] = str(len(chunk))
+        elif 'Content-Length' in headers:
+            # The compressed size is not known until the end.
+            del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        """Compress the given chunk, if required."""
+        if not self._gzipping:
+            return chunk
+        self._input_size += len(chunk)
+        self._file.write(chunk)
+        if finishing:
+            self._file.close()
+        else:
+            self._file.flush()
+        chunk = self._buffer.getvalue()
+        self._buffer.truncate(0)
+        self._buffer.seek(0)
+        self._output_size += len(chunk)
+        if finishing:
+            _input.inc(self._input_size)
+            _output.inc(self._output_size)
+            _saved.inc(max(0, self._input_size - self._output_size))
+        return chunk
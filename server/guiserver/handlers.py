@@ -17,47 +17,178 @@
 """Juju GUI server HTTP/HTTPS handlers."""
 
 from collections import deque
+import functools
+import itertools
 import logging
 import os
+import re
 import time
-import urlparse
 
 from tornado import (
     escape,
     gen,
     httpclient,
+    httputil,
     web,
     websocket,
 )
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
-from guiserver import get_version
+from guiserver import (
+    get_version,
+    metrics,
+)
+from guiserver.apicache import get_request_id
 from guiserver.auth import (
     AuthMiddleware,
     User,
 )
+from guiserver.batching import (
+    SUBPROTOCOL as BATCH_SUBPROTOCOL,
+    FrameBatcher,
+)
 from guiserver.bundles.base import (
     ChangeSetMiddleware,
     DeployMiddleware,
 )
+from guiserver.charmcache import make_key
 from guiserver.clients import websocket_connect
+from guiserver.coalesce import request_key
+from guiserver.compression import (
+    DeflateProtocol,
+    negotiate,
+)
+from guiserver.gzipping import GzipTransform
+from guiserver.httppool import Unavailable
+from guiserver.icons import (
+    DEFAULT_ICON_CACHE_CONTROL,
+    get_default_icon,
+)
+from guiserver.latency import RequestTimer
+from guiserver.ranges import (
+    MultipartRanges,
+    content_range,
+    requested_ranges,
+)
+from guiserver.resume import ParkedSession
+from guiserver.streaming import (
+    DEFAULT_MAX_BUFFER,
+    ResponseStream,
+    UploadStream,
+    relayed_headers,
+    uploads_status,
+)
 from guiserver.utils import (
     clone_request,
     get_headers,
     get_juju_api_url,
+    is_not_modified,
     join_url,
     json_decode_dict,
+    message_requires_decoding,
     request_summary,
     wrap_write_message,
 )
 
 
-# Define the path to the fallback charm icon hosted by charmworld.
-DEFAULT_CHARM_ICON_PATH = '/static/img/charm_160.svg'
+# The size of the chunks in which cached charm files are sent to browsers.
+CHARM_FILE_CHUNK_SIZE = 64 * 1024
+# Charm URLs including a revision identify immutable charm files.
+_charm_revision = re.compile(r'-\d+$')
+# Define the request types of the browser messages intercepted by the GUI
+# server. Messages not including any of these types are propagated to the Juju
+# API without being decoded.
+INTERCEPTED_REQUEST_TYPES = ('Admin', 'ChangeSet', 'Deployer', 'GUIToken')
+_INTERCEPTED_MARKERS = tuple(
+    '"{}"'.format(request_type) for request_type in INTERCEPTED_REQUEST_TYPES)
+# When sessions can be reconnected, AllWatcher requests are also intercepted,
+# so that the watcher can be restarted on the new connection.
+_RECONNECT_MARKERS = _INTERCEPTED_MARKERS + ('"AllWatcher"',)
+# When sessions can be parked, session and AllWatcher requests are also
+# intercepted, so that the resumed session can adopt or stop the AllWatcher
+# of the parked one.
+_PARKING_MARKERS = ('"GUISession"', '"AllWatcher"', '"WatchAll"')
+# The request identifiers used by requests sent by the GUI server on behalf of
+# the browser. They are chosen high enough not to collide with the browser
+# ones.
+_server_request_ids = itertools.count(2 ** 62)
+
+_juju_frames_raw = metrics.counter(
+    'juju_frames_raw',
+    'Frames relayed from the Juju API to the browser without decoding.')
+_juju_frames_decoded = metrics.counter(
+    'juju_frames_decoded',
+    'Frames decoded before being relayed from the Juju API to the browser.')
+_browser_connections = metrics.gauge(
+    'browser_websockets', 'The open browser WebSocket connections.')
+_browser_bytes_in = metrics.counter(
+    'browser_bytes_in',
+    'The size of the messages received from browsers, in characters.')
+_browser_bytes_out = metrics.counter(
+    'browser_bytes_out',
+    'The size of the messages sent to browsers, in characters.')
+_juju_queued_messages = metrics.gauge(
+    'juju_queued_messages',
+    'The browser messages waiting for the Juju API to be connected.')
+_proxy_fetches = metrics.gauge(
+    'proxy_fetches_in_flight', 'The HTTP proxy requests in progress.')
+_proxy_not_modified = metrics.counter(
+    'proxy_not_modified',
+    'The proxied responses replaced with 304 Not Modified, as the browser '
+    'copy is still valid.')
+_proxy_partial = metrics.counter(
+    'proxy_partial_responses',
+    'The byte ranges of charm files served from the disk cache.')
+_proxy_range_fallbacks = metrics.counter(
+    'proxy_range_fallbacks',
+    'The charm file ranges ignored by juju-core, and served from the disk '
+    'cache after storing the whole file.')
+_icon_hits = metrics.counter(
+    'charm_icon_hits', 'The charm icons retrieved from juju-core.')
+_icon_misses = metrics.counter(
+    'charm_icon_misses', 'The charm icons not found in juju-core.')
+_icon_fallbacks = metrics.counter(
+    'charm_icon_fallbacks',
+    'The default icons sent in place of missing charm icons.')
 
 
 class _WebSocketBaseHandler(websocket.WebSocketHandler):
-    """Base WebSocket handler defining shared methods."""
+    """Base WebSocket handler defining shared methods.
+
+    If the compression attribute is set to a DeflateOptions instance, the
+    permessage-deflate extension is negotiated with clients offering it (see
+    guiserver.compression). If the batching attribute is set to a
+    BatchOptions instance, clients requesting the batching sub-protocol
+    receive messages sent with write_batched() in batches (see
+    guiserver.batching).
+    """
+
+    compression = None
+    batching = None
+    # The FrameBatcher used if the batching sub-protocol has been selected.
+    _batcher = None
+
+    def _execute(self, transforms, *args, **kwargs):
+        """Accept the connection, negotiating compression if enabled.
+
+        Requests not offering the compression extension, or not valid
+        WebSocket handshakes, are handled by Tornado.
+        """
+        negotiated = None
+        headers = self.request.headers
+        if self.compression is not None and _is_upgrade(self.request):
+            negotiated = negotiate(
+                headers.get('Sec-WebSocket-Extensions', ''), self.compression)
+        if negotiated is None:
+            return super(_WebSocketBaseHandler, self)._execute(
+                transforms, *args, **kwargs)
+        self.open_args = args
+        self.open_kwargs = kwargs
+        extensions, deflate = negotiated
+        self.ws_connection = DeflateProtocol(
+            self, deflate, extensions=extensions)
+        self.ws_connection.accept_connection()
 
     def select_subprotocol(self, subprotocols):
         """Return the first sub-protocol sent by the client.
@@ -68,9 +199,68 @@ class _WebSocketBaseHandler(websocket.WebSocketHandler):
         Overriding this method is required due to a new behavior of development
         versions of the Chrome browser, which disconnects if if the
         sub-protocol does not match the one sent by the client.
+
+        If batching is enabled and requested by the client, select the
+        batching sub-protocol instead. If batching is disabled, the batching
+        sub-protocol is never selected.
         """
+        if BATCH_SUBPROTOCOL in subprotocols:
+            if self.batching is not None:
+                self._batcher = FrameBatcher(self._write, self.batching)
+                return BATCH_SUBPROTOCOL
+            subprotocols = [
+                subprotocol for subprotocol in subprotocols
+                if subprotocol != BATCH_SUBPROTOCOL] or [None]
         return subprotocols[0]
 
+    def write_batched(self, message):
+        """Send the given JSON encoded message to the client.
+
+        The message is delayed and sent in a batch if the client selected the
+        batching sub-protocol.
+        """
+        if self._batcher is None:
+            return self.write_message(message)
+        self._batcher.add(message)
+
+    def write_message(self, message, binary=False):
+        """Send the given message, preceded by the pending batch if any."""
+        if self._batcher is not None:
+            self._batcher.flush()
+        self._write(message, binary)
+
+    def _write(self, message, binary=False):
+        """Send the given message to the client."""
+        if isinstance(message, dict):
+            message = escape.json_encode(message)
+        _browser_bytes_out.inc(len(message))
+        super(_WebSocketBaseHandler, self).write_message(message, binary)
+
+    def close(self):
+        """Send the pending batch if any, and close the connection."""
+        if self._batcher is not None and self.ws_connection is not None:
+            self._batcher.flush()
+        super(_WebSocketBaseHandler, self).close()
+
+    def on_connection_close(self):
+        """Discard the pending batch, if any."""
+        if self._batcher is not None:
+            self._batcher.cancel()
+        super(_WebSocketBaseHandler, self).on_connection_close()
+
+
+def _is_upgrade(request):
+    """Return True if request is a valid version 13 WebSocket handshake."""
+    headers = request.headers
+    connection = [
+        value.strip().lower()
+        for value in headers.get('Connection', '').split(',')]
+    return (
+        request.method == 'GET' and
+        headers.get('Upgrade', '').lower() == 'websocket' and
+        'upgrade' in connection and
+        headers.get('Sec-WebSocket-Version') == '13')
+
 
 class WebSocketHandler(_WebSocketBaseHandler):
     """WebSocket handler supporting secure WebSockets.
@@ -83,7 +273,10 @@ class WebSocketHandler(_WebSocketBaseHandler):
 
       - connected: True if the current browser is connected, False otherwise;
       - juju_connected: True if the Juju API is connected, False otherwise;
-      - juju_connection: the WebSocket client connection to the Juju API.
+      - juju_connection: the WebSocket client connection to the Juju API, or
+        the session of a shared upstream connection if multiplexing is
+        enabled (see guiserver.multiplex);
+      - resumed: True if the session has been resumed, False otherwise.
 
     Callbacks:
 
@@ -97,16 +290,48 @@ class WebSocketHandler(_WebSocketBaseHandler):
       - close(): terminate the browser connection.
     """
 
+    def _request_summary(self):
+        """Return the request summary used in the access logs.
+
+        Override to redact the resume token (see guiserver.utils).
+        """
+        return request_summary(self.request)
+
     @gen.coroutine
     def initialize(
             self, apiurl, auth_backend, deployer, tokens, ws_url_template,
-            io_loop=None):
+            io_loop=None, multiplexer=None, pool=None, controllers=None,
+            reconnect_attempts=0, compression=None, batching=None,
+            latency=None, changesets=None, parking=None, response_cache=None):
         """Initialize the WebSocket server.
 
         Create a new WebSocket client and connect it to the Juju API.
         Set up the authentication system.
         Handle the queued messages.
+
+        If a multiplexer is provided, a shared upstream connection is joined
+        when the user logs in, instead of creating a new WebSocket client.
+        If a connection pool is provided, a pre-warmed connection is used if
+        available. If controllers are provided, connections are raced across
+        the Juju API controllers (see guiserver.failover). When the Juju API
+        unexpectedly closes the connection, the session is transparently
+        reconnected up to reconnect_attempts consecutive times. If compression
+        options are provided, browser messages are compressed when the
+        browser supports it. If batching options are provided, Juju API
+        messages are sent in batches to browsers requesting it. If an
+        ApiLatency instance is provided, the latency of the Juju API calls is
+        recorded. If a changesets store is provided, change set tokens are
+        shared with the other server processes (see guiserver.shared). If a
+        session parking is provided, authenticated sessions can be parked on
+        disconnection and resumed (see guiserver.resume). If a response cache
+        is provided, the responses to read-only Juju API requests are cached
+        (see guiserver.apicache).
         """
+        # Compression and batching must be set up before the WebSocket
+        # handshake is completed, so this must precede any asynchronous
+        # operation.
+        self.compression = compression
+        self.batching = batching
         if io_loop is None:
             io_loop = IOLoop.current()
         self._io_loop = io_loop
@@ -114,24 +339,100 @@ class WebSocketHandler(_WebSocketBaseHandler):
         logging.info(self._summary + 'client connected')
         self.connected = True
         self.juju_connected = False
-        self._juju_message_queue = queue = deque()
+        self._juju_message_queue = deque()
+        self._multiplexer = multiplexer
+        self._timer = None
+        if latency is not None:
+            self._timer = RequestTimer(latency)
+        # Set up the reconnection infrastructure.
+        if multiplexer is not None:
+            # Shared upstream connections are neither reconnected nor parked.
+            reconnect_attempts = 0
+            parking = None
+        self._reconnect_attempts = self._reconnects_left = reconnect_attempts
+        self._reconnecting = False
+        # The reconnect_requests attribute maps the ids of the requests sent
+        # while reconnecting to the callbacks handling their responses.
+        self._reconnect_requests = {}
+        # The last AllWatcher.Next request sent by the browser, and the id of
+        # the AllWatcher started when reconnecting. When sessions can be
+        # parked, also keep track of whether the request is pending.
+        self._watcher_request = None
+        self._watcher_id = None
+        self._watcher_pending = False
+        if reconnect_attempts:
+            self._markers = _RECONNECT_MARKERS
+        else:
+            self._markers = _INTERCEPTED_MARKERS
+        # Set up the session resumption infrastructure.
+        self._parking = parking
+        self.resumed = False
+        # The token under which the session is parked on disconnection, and
+        # the Juju response to the login request.
+        self._resume_token = None
+        self._login_response = None
+        # The credentials of the resumed session, the (browser, upstream) ids
+        # of the AllWatcher started by the parked page, the id of its pending
+        # AllWatcher.Next request, the browser request waiting for the
+        # response to it, and the AllWatcher deltas retained meanwhile.
+        self._resumed_credentials = None
+        self._resumed_watcher = None
+        self._parked_next_id = None
+        self._resumed_next = None
+        self._resumed_deltas = []
+        # The ids of the requests sent by the GUI server on behalf of the
+        # browser whose responses must be discarded.
+        self._discarded_requests = set()
+        if parking is not None:
+            self._markers += _PARKING_MARKERS
+        # Set up the Juju API responses cache. The cache_requests attribute
+        # maps the ids of the cacheable requests sent to the Juju API to
+        # their cache keys.
+        self._response_cache = response_cache
+        self._cache_requests = {}
+        if response_cache is not None:
+            self._markers += response_cache.markers
         # Set up the authentication infrastructure.
         self.tokens = tokens
         write_message = wrap_write_message(self)
         self.user = User()
+        self._auth_backend = auth_backend
         self.auth = AuthMiddleware(
             self.user, auth_backend, tokens, write_message)
         # Set up the bundle deployment and change set infrastructure.
         self.deployment = DeployMiddleware(self.user, deployer, write_message)
-        self.changeset = ChangeSetMiddleware(self.user, write_message)
+        self.changeset = ChangeSetMiddleware(
+            self.user, write_message, store=changesets)
         apiurl = get_juju_api_url(self.request.path, ws_url_template, apiurl)
         # Juju requires the Origin header to be included in the WebSocket
         # client handshake request. Propagate the client origin if present;
         # use the Juju API server as origin otherwise.
         headers = get_headers(self.request, apiurl)
+        self._apiurl = apiurl
+        self._juju_headers = headers
+        if multiplexer is not None:
+            # The shared upstream connection is joined when the user logs in:
+            # see self._join_upstream().
+            self._juju_connected_future = Future()
+            return
+        if pool is not None:
+            self._connect = pool.connect
+        elif controllers is not None:
+            self._connect = controllers.connect
+        else:
+            self._connect = functools.partial(websocket_connect, io_loop)
+        if parking is not None:
+            token = self.get_argument('resume', None)
+            session = None
+            if token is not None:
+                session = parking.resume(token)
+            if session is not None:
+                # Adopt the parked connection rather than connecting again.
+                self._resume(session)
+                return
         # Connect the WebSocket client to the Juju API server.
-        self._juju_connected_future = websocket_connect(
-            io_loop, apiurl, self.on_juju_message, headers=headers)
+        self._juju_connected_future = self._connect(
+            apiurl, self.on_juju_message, headers=headers)
         try:
             self.juju_connection = yield self._juju_connected_future
         except Exception as err:
@@ -142,12 +443,50 @@ class WebSocketHandler(_WebSocketBaseHandler):
         # At this point the Juju API is successfully connected.
         self.juju_connected = True
         logging.info(self._summary + 'Juju API connected')
-        # Send all the messages that have been enqueued before the connection
-        # to the Juju API server was established.
+        self._send_queued_messages()
+
+    def _resume(self, session):
+        """Resume the given parked session.
+
+        The resume token does not authenticate the browser: no requests are
+        relayed to Juju until the browser logs in again with the credentials
+        of the parked session. The AllWatcher deltas retained while the
+        session was parked are sent in response to the first AllWatcher.Next
+        request for the AllWatcher of the parked page. If the browser starts
+        a new AllWatcher instead, the one of the parked page is stopped.
+        """
+        connection = session.connection
+        connection.set_message_callback(self.on_juju_message)
+        self.juju_connection = connection
+        self._juju_connected_future = Future()
+        self._juju_connected_future.set_result(connection)
+        self._resumed_credentials = (session.username, session.password)
+        self._login_response = session.login_response
+        self._watcher_request = request = session.watcher_request
+        self._watcher_id = session.watcher_id
+        if request is not None:
+            self._resumed_watcher = (
+                request.get('Id'), session.watcher_id or request.get('Id'))
+            if session.watcher_pending:
+                self._parked_next_id = request.get('RequestId')
+            for message in session.messages:
+                self._retain_deltas(message)
+        self.resumed = True
+        self.juju_connected = True
+        logging.info(self._summary + 'Juju API session resumed')
+
+    def _send_queued_messages(self):
+        """Send the messages enqueued before the Juju API was connected."""
+        queue = self._juju_message_queue
         while self.connected and self.juju_connected and len(queue):
             message = queue.popleft()
-            encoded = message.encode('utf-8')
-            logging.debug(self._summary + 'queue -> juju: {}'.format(encoded))
+            if logging.root.isEnabledFor(logging.DEBUG):
+                encoded = message.encode('utf-8')
+                logging.debug(
+                    self._summary + 'queue -> juju: {}'.format(encoded))
+            _juju_queued_messages.dec()
+            if self._timer is not None:
+                self._timer.sent(message)
             self.juju_connection.write_message(message)
 
     def on_message(self, message):
@@ -158,9 +497,19 @@ class WebSocketHandler(_WebSocketBaseHandler):
         Otherwise the message is propagated to the Juju API server.
         Messages sent before the client connection to the Juju API server is
         established are queued for later delivery.
+        Messages that are not intercepted by the GUI server (see
+        INTERCEPTED_REQUEST_TYPES) are propagated without being decoded.
         """
-        data = json_decode_dict(message)
+        _browser_bytes_in.inc(len(message))
+        if self.resumed and not self.user.is_authenticated:
+            # Nothing is relayed on behalf of the parked session until the
+            # browser logs in again.
+            return self._process_resumed_request(message)
         encoded = None
+        if message_requires_decoding(message, self._markers):
+            data = json_decode_dict(message)
+        else:
+            data = None
         if data is not None:
             # Handle change set requests.
             if self.changeset.requested(data):
@@ -177,60 +526,461 @@ class WebSocketHandler(_WebSocketBaseHandler):
                 elif new_data != data:
                     encoded = escape.json_encode(new_data)
                     message = encoded.decode('utf8')
+                if (self._multiplexer is not None and
+                        self._auth_backend.request_is_login(new_data)):
+                    # Log in joining a shared upstream connection.
+                    return self._join_upstream(new_data)
             # Handle authentication token requests.
             if self.tokens.token_requested(data):
                 return self.tokens.process_token_request(
                     data, self.user, wrap_write_message(self))
+            if self._parking is not None:
+                # Handle session park requests.
+                if self._parking.park_requested(data):
+                    self._resume_token = self._parking.process_park_request(
+                        data, self.user, self.resumed,
+                        wrap_write_message(self))
+                    return
+                # The resumed session is already logged in.
+                if self.resumed and self._auth_backend.request_is_login(data):
+                    return self._process_resumed_login(data)
+                # Adopt or stop the AllWatcher of the parked page.
+                if (self._resumed_watcher is not None and
+                        self._process_resumed_watcher(data)):
+                    return
+            # Answer cacheable requests from the cache, if possible.
+            if (self._response_cache is not None and
+                    self.user.is_authenticated):
+                if self._process_cacheable_request(data):
+                    return
+            # Keep track of the AllWatcher if reconnections or session
+            # parking are enabled.
+            if ((self._reconnect_attempts or self._parking is not None) and
+                    data.get('Type') == 'AllWatcher'):
+                new_data = self._track_watcher(data)
+                if new_data is None:
+                    # The request will be sent when the session is restored.
+                    return
+                elif new_data is not data:
+                    encoded = escape.json_encode(new_data)
+                    message = encoded.decode('utf8')
         # Propagate messages to the Juju API server.
-        if encoded is None:
+        debug = logging.root.isEnabledFor(logging.DEBUG)
+        if debug and (encoded is None):
             encoded = message.encode('utf-8')
         if self.juju_connected:
-            logging.debug(self._summary + 'client -> juju: {}'.format(encoded))
+            if debug:
+                logging.debug(
+                    self._summary + 'client -> juju: {}'.format(encoded))
+            if self._timer is not None:
+                self._timer.sent(message)
             return self.juju_connection.write_message(message)
-        logging.debug(self._summary + 'client -> queue: {}'.format(encoded))
+        if debug:
+            logging.debug(
+                self._summary + 'client -> queue: {}'.format(encoded))
+        _juju_queued_messages.inc()
         self._juju_message_queue.append(message)
 
+    def _process_resumed_request(self, message):
+        """Handle the given message sent before logging in the resumed session.
+
+        Only login requests are accepted.
+        """
+        data = json_decode_dict(message)
+        if data is None:
+            logging.error(
+                self._summary + 'invalid request before resumed login')
+            return
+        if self._auth_backend.request_is_login(data):
+            return self._process_resumed_login(data)
+        self.write_message({
+            'RequestId': data.get('RequestId'),
+            'Error': 'the resumed session must log in again',
+            'ErrorCode': 'unauthorized access',
+            'Response': {},
+        })
+
+    def _process_resumed_login(self, data):
+        """Answer the given login request without contacting Juju.
+
+        The credentials must match the ones used to log in the resumed
+        session.
+        """
+        credentials = self._auth_backend.get_credentials(data)
+        if credentials == self._resumed_credentials:
+            user = self.user
+            user.username, user.password = credentials
+            user.is_authenticated = True
+            response = dict(self._login_response, RequestId=data['RequestId'])
+        else:
+            response = {
+                'RequestId': data['RequestId'],
+                'Error': 'the resumed session belongs to another user',
+                'ErrorCode': 'unauthorized access',
+                'Response': {},
+            }
+        self.write_message(response)
+
+    def _process_resumed_watcher(self, data):
+        """Handle the given request related to the parked page AllWatcher.
+
+        Next requests for that AllWatcher receive the deltas retained while
+        the session was parked, or the response to the pending request of the
+        parked page. Starting a new AllWatcher stops the parked one. Return
+        True if the request has been handled, False if it must be sent to the
+        Juju API.
+        """
+        request = (data.get('Type'), data.get('Request'))
+        if request == ('Client', 'WatchAll'):
+            self._stop_resumed_watcher()
+            return False
+        if request[0] != 'AllWatcher' or (
+                data.get('Id') != self._resumed_watcher[0]):
+            return False
+        if request[1] == 'Stop':
+            self._resumed_watcher = None
+            self._resumed_deltas = []
+            return False
+        if request[1] != 'Next':
+            return False
+        if self._resumed_deltas:
+            deltas, self._resumed_deltas = self._resumed_deltas, []
+            self.write_message({
+                'RequestId': data['RequestId'],
+                'Response': {'Deltas': deltas},
+            })
+            return True
+        if self._parked_next_id is not None:
+            # Wait for the response to the request of the parked page.
+            self._resumed_next = data
+            return True
+        return False
+
+    def _stop_resumed_watcher(self):
+        """Stop the AllWatcher started by the parked page."""
+        _, watcher_id = self._resumed_watcher
+        self._resumed_watcher = None
+        self._resumed_next = None
+        self._resumed_deltas = []
+        self._watcher_request = self._watcher_id = None
+        self._watcher_pending = False
+        request_id = next(_server_request_ids)
+        self._discarded_requests.add(request_id)
+        self.juju_connection.write_message(escape.json_encode({
+            'RequestId': request_id,
+            'Type': 'AllWatcher',
+            'Request': 'Stop',
+            'Id': watcher_id,
+            'Params': {},
+        }))
+
+    def _retain_deltas(self, message):
+        """Retain the deltas in the given parked page AllWatcher response."""
+        if self._response_cache is not None:
+            self._response_cache.invalidate(self._apiurl, message)
+        data = json_decode_dict(message)
+        if data is not None:
+            response = data.get('Response') or {}
+            self._resumed_deltas.extend(response.get('Deltas') or ())
+
+    def _on_parked_next(self, message):
+        """Handle the response to the parked page AllWatcher.Next request.
+
+        The response is sent to the browser request waiting for it, if any,
+        or retained. It is discarded if the AllWatcher has been stopped.
+        """
+        if self._resumed_watcher is None:
+            return
+        self._retain_deltas(message)
+        request, self._resumed_next = self._resumed_next, None
+        if request is not None and not self._process_resumed_watcher(request):
+            # The parked page request failed: send the browser one to Juju.
+            message = escape.json_encode(self._track_watcher(request))
+            self.juju_connection.write_message(message)
+
+    def _process_cacheable_request(self, data):
+        """Send the cached response to the given request, if available.
+
+        Return True if the response has been sent, False if the request must
+        be propagated to the Juju API.
+        """
+        cache = self._response_cache
+        key = cache.make_key(self._apiurl, self.user.username, data)
+        if key is None:
+            return False
+        response = cache.get(key, data['RequestId'])
+        if response is None:
+            self._cache_requests[data['RequestId']] = key
+            return False
+        self.write_message(response)
+        return True
+
+    def _cache_response(self, message):
+        """Update the responses cache with the given Juju API message.
+
+        Cache the responses to cacheable requests, and invalidate the
+        entries related to AllWatcher deltas. Return True if the message has
+        been decoded, which only happens for the responses to cache.
+        """
+        cache = self._response_cache
+        key = None
+        if self._cache_requests:
+            key = self._cache_requests.pop(get_request_id(message), None)
+        if key is None:
+            cache.invalidate(self._apiurl, message)
+            return False
+        data = json_decode_dict(message)
+        if data is not None:
+            cache.put(key, data)
+        return True
+
+    def _join_upstream(self, data):
+        """Join a shared upstream connection logging in with the given data.
+        """
+        future = self._multiplexer.connect(
+            self._apiurl, self._juju_headers, data, self.on_juju_message)
+        self._io_loop.add_future(future, self._on_upstream_joined)
+
+    def _on_upstream_joined(self, future):
+        """Called when the attempt to join a shared upstream completes.
+
+        Send all the queued messages if the login succeeded.
+        """
+        try:
+            connection = future.result()
+        except Exception as err:
+            logging.error(self._summary + 'unable to connect to the Juju API')
+            logging.exception(err)
+            if self.connected:
+                self.close()
+            return
+        if connection is None:
+            # The login failed and the user has been notified.
+            return
+        if self.juju_connected or not self.connected:
+            return connection.close()
+        self.juju_connection = connection
+        self.juju_connected = True
+        self._juju_connected_future.set_result(connection)
+        logging.info(self._summary + 'shared Juju API connection joined')
+        self._send_queued_messages()
+
     def on_juju_message(self, message):
         """Hook called when a new message is received from the Juju API server.
 
-        The message is propagated to the browser.
+        The message is propagated to the browser. Messages are only decoded
+        while the authentication is in progress: after that, they are relayed
+        as they arrived.
         """
         if message is None:
             # The Juju API closed the connection.
             return self.on_juju_close()
-        data = json_decode_dict(message)
-        if (data is not None) and self.auth.in_progress():
-            encoded = escape.json_encode(
-                self.auth.process_response(data))
-            message = encoded.decode('utf8')
+        if self._timer is not None:
+            self._timer.received(message)
+        if self._reconnecting:
+            data = json_decode_dict(message)
+            if data is not None:
+                callback = self._reconnect_requests.pop(
+                    data.get('RequestId'), None)
+                if callback is not None:
+                    return callback(data)
+        if (self._watcher_pending or self._discarded_requests or
+                self._parked_next_id is not None):
+            request_id = get_request_id(message)
+            if request_id in self._discarded_requests:
+                self._discarded_requests.remove(request_id)
+                return
+            if request_id == self._parked_next_id:
+                self._parked_next_id = None
+                return self._on_parked_next(message)
+            if self._watcher_pending and (
+                    request_id == self._watcher_request.get('RequestId')):
+                self._watcher_pending = False
+        decoded = False
+        if self._response_cache is not None:
+            decoded = self._cache_response(message)
+        if self.auth.in_progress():
+            decoded = True
+            data = json_decode_dict(message)
+            if data is not None:
+                authenticated = self.user.is_authenticated
+                encoded = escape.json_encode(self.auth.process_response(data))
+                message = encoded.decode('utf8')
+                if self.user.is_authenticated and not authenticated:
+                    # Keep the login response in case the session is parked.
+                    self._login_response = data
+        if decoded:
+            _juju_frames_decoded.inc()
         else:
+            _juju_frames_raw.inc()
+        if logging.root.isEnabledFor(logging.DEBUG):
             encoded = message.encode('utf-8')
-        logging.debug(self._summary + 'juju -> client: {}'.format(encoded))
-        self.write_message(message)
+            logging.debug(self._summary + 'juju -> client: {}'.format(encoded))
+        self.write_batched(message)
+
+    def open(self):
+        """Hook called when the WebSocket connection is established."""
+        _browser_connections.inc()
 
     def on_close(self):
         """Hook called when the WebSocket connection is terminated."""
         logging.info(self._summary + 'client connection closed')
         self.connected = False
+        _browser_connections.dec()
+        if self._timer is not None:
+            self._timer.clear()
+        # Discard the messages that will never be sent.
+        _juju_queued_messages.dec(len(self._juju_message_queue))
+        self._juju_message_queue.clear()
+        if self._resume_token is not None and self._park():
+            return
         # At this point the WebSocket client connection to the Juju API server
         # might not yet be established. For this reason the connection is
         # terminated adding a callback to the corresponding future.
-        callback = lambda _: self.juju_connection.close()
-        self._io_loop.add_future(self._juju_connected_future, callback)
+        self._io_loop.add_future(
+            self._juju_connected_future, self._close_juju_connection)
+
+    def _park(self):
+        """Park the authenticated Juju API connection so it can be resumed.
+
+        Return True if the session has been parked, False otherwise.
+        """
+        if not (self.juju_connected and self.user.is_authenticated):
+            # The connection is not established or is being reconnected.
+            return False
+        user = self.user
+        session = ParkedSession(
+            self.juju_connection, user.username, user.password,
+            self._login_response, watcher_request=self._watcher_request,
+            watcher_id=self._watcher_id, watcher_pending=self._watcher_pending)
+        self._parking.park(self._resume_token, session)
+        logging.info(self._summary + 'Juju API session parked')
+        self.juju_connected = False
+        self.juju_connection = None
+        return True
+
+    def _close_juju_connection(self, future):
+        """Close the current connection to the Juju API, if any."""
+        if self.juju_connection is not None:
+            self.juju_connection.close()
 
     def on_juju_close(self):
-        """Hook called when the WebSocket connection to Juju is terminated."""
+        """Hook called when the WebSocket connection to Juju is terminated.
+
+        Usually the Juju API connection is terminated as a consequence of a
+        browser disconnection. A server disconnection is unexpected: this can
+        happen for instance when a controller in a highly available
+        environment goes down. In that case try to transparently reconnect
+        the session, disconnecting the browser if that is not possible.
+        """
         logging.info(self._summary + 'Juju API connection closed')
         self.juju_connected = False
         self.juju_connection = None
-        # Usually the Juju API connection is terminated as a consequence of a
-        # browser disconnection. A server disconnection is unexpected and
-        # unlikely to happen. In the future Juju will support HA and we will
-        # need to react accordingly to server disconnections, but for the time
-        # being we just disconnect the browser and log an error.
-        if self.connected:
-            logging.error(self._summary + 'Juju API unexpectedly disconnected')
-            self.close()
+        # Pending requests will never be answered.
+        self._cache_requests.clear()
+        if self._timer is not None:
+            self._timer.clear()
+        if not self.connected:
+            return
+        logging.error(self._summary + 'Juju API unexpectedly disconnected')
+        if self._reconnects_left and self.user.is_authenticated:
+            return self._reconnect()
+        self.close()
+
+    def _track_watcher(self, data):
+        """Keep track of the given AllWatcher request sent by the browser.
+
+        Return the data to be sent to the Juju API, referring to the current
+        AllWatcher, or None if the request must be held until the session is
+        reconnected.
+        """
+        if data.get('Request') == 'Next':
+            self._watcher_request = data
+            self._watcher_pending = self._parking is not None
+            if self._reconnecting:
+                return None
+        elif data.get('Request') == 'Stop':
+            self._watcher_request = None
+            self._watcher_pending = False
+        if (self._watcher_id is not None) and (
+                data.get('Id') != self._watcher_id):
+            return dict(data, Id=self._watcher_id)
+        return data
+
+    def _reconnect(self):
+        """Connect to the Juju API again and restore the session."""
+        self._reconnects_left -= 1
+        self._reconnecting = True
+        self._reconnect_requests = {}
+        logging.info(self._summary + 'reconnecting to the Juju API')
+        future = self._connect(
+            self._apiurl, self.on_juju_message, headers=self._juju_headers)
+        self._io_loop.add_future(future, self._on_reconnected)
+
+    def _on_reconnected(self, future):
+        """Log in again after reconnecting to the Juju API."""
+        try:
+            connection = future.result()
+        except Exception as err:
+            logging.error(
+                self._summary + 'unable to reconnect to the Juju API')
+            logging.exception(err)
+            if self.connected:
+                self.close()
+            return
+        if not self.connected:
+            return connection.close()
+        self.juju_connection = connection
+        user = self.user
+        self._send_reconnect_request(
+            self._auth_backend.make_request(
+                None, user.username, user.password),
+            self._on_reconnect_login)
+
+    def _send_reconnect_request(self, data, callback):
+        """Send a request to the Juju API while reconnecting.
+
+        The callback is called passing the response data.
+        """
+        request_id = next(_server_request_ids)
+        self._reconnect_requests[request_id] = callback
+        data['RequestId'] = request_id
+        self.juju_connection.write_message(escape.json_encode(data))
+
+    def _on_reconnect_login(self, data):
+        """Restart the AllWatcher, if required, after logging in again."""
+        if not self._auth_backend.login_succeeded(data):
+            logging.error(
+                self._summary + 'unable to log in again to the Juju API')
+            return self.close()
+        if self._watcher_request is None:
+            return self._restore_session()
+        request = {'Type': 'Client', 'Request': 'WatchAll', 'Params': {}}
+        self._send_reconnect_request(request, self._on_reconnect_watch_all)
+
+    def _on_reconnect_watch_all(self, data):
+        """Resend the pending AllWatcher.Next request to the new AllWatcher.
+        """
+        if 'Error' in data:
+            logging.error(
+                self._summary + 'unable to restart the AllWatcher: ' +
+                data['Error'])
+            return self.close()
+        self._watcher_id = data['Response']['AllWatcherId']
+        request = dict(self._watcher_request, Id=self._watcher_id)
+        _juju_queued_messages.inc()
+        self._juju_message_queue.appendleft(
+            escape.json_encode(request).decode('utf8'))
+        self._restore_session()
+
+    def _restore_session(self):
+        """Complete the reconnection, sending the queued messages."""
+        self._reconnecting = False
+        self._reconnect_requests = {}
+        self._reconnects_left = self._reconnect_attempts
+        self.juju_connected = True
+        logging.info(self._summary + 'Juju API session restored')
+        self._send_queued_messages()
 
 
 class SandboxHandler(_WebSocketBaseHandler):
@@ -283,16 +1033,49 @@ class IndexHandler(web.StaticFileHandler):
 
 
 class ProxyHandler(web.RequestHandler):
-    """An HTTP(S) proxy from the server to the given target URL."""
+    """An HTTP(S) proxy from the server to the given target URL.
+
+    Successful responses are streamed to the client as they are received (see
+    guiserver.streaming). If enabled, text-like responses are compressed on
+    the fly (see guiserver.gzipping). Conditional requests are answered using
+    the validators of the upstream response. Range requests are forwarded to
+    the target server.
+    """
 
-    def initialize(self, target_url, validate_cert=True):
+    _stream = None
+    _flushed = None
+    _closed = None
+
+    def initialize(
+            self, target_url, validate_cert=True,
+            max_buffer=DEFAULT_MAX_BUFFER, single_flight=None, http_pool=None,
+            compress=False):
         """Initialize the proxy.
 
-        Receive the target URL where to redirect to, and a flag indicating
-        whether to validate remote server certificates.
+        Receive the target URL where to redirect to, a flag indicating
+        whether to validate remote server certificates, the maximum number
+        of response bytes buffered while waiting for the client to read them,
+        the registry of the fetches shared by identical GET requests (see
+        guiserver.coalesce), or None, the pool of connections to the target
+        server (see guiserver.httppool) and whether to compress responses.
+        If the pool is None, the default asynchronous HTTP client is used.
         """
         self.target_url = target_url
         self.validate_cert = validate_cert
+        self.max_buffer = max_buffer
+        self.single_flight = single_flight
+        self.http_pool = http_pool
+        self.compress = compress
+        # Set when the client goes away, so that pending fetches still waiting
+        # for a pool connection are cancelled.
+        self._closed = Future()
+
+    def prepare(self):
+        """Set up the compression of the response if enabled."""
+        if self.compress:
+            # Compress the body before the chunked transfer encoding is
+            # applied.
+            self._transforms.insert(0, GzipTransform(self.request))
 
     @gen.coroutine
     def get(self, path):
@@ -311,34 +1094,149 @@ class ProxyHandler(web.RequestHandler):
     post = get
 
     @gen.coroutine
-    def send_request(self, url):
+    def send_request(self, url, headers=None, sink=None):
         """Send an asynchronous request to the given URL.
 
+        The given headers, if any, are added to the ones sent by the client.
+        If a sink is provided, it also receives the streamed response body
+        (see guiserver.streaming.ResponseStream).
+
         Return the server response.
+        If the response has been already streamed to the client, return None.
         If an error occurs in the communication, return None and call
-        self._send_error with the given error.
+        self._send_error with the given error. If the request is rejected by
+        the connection pool, return None and call self._send_unavailable.
         """
         request = clone_request(
             self.request, url, validate_cert=self.validate_cert)
-        client = httpclient.AsyncHTTPClient()
+        if headers:
+            request.headers = httputil.HTTPHeaders(request.headers)
+            request.headers.update(headers)
+        flight = None
+        if self.single_flight is not None and request.method == 'GET':
+            key = request_key(request)
+            shared = self.single_flight.get(key)
+            if shared is not None:
+                response = yield shared.wait()
+                if response is not None:
+                    raise gen.Return(response)
+            else:
+                flight = sink = self.single_flight.start(key, request, sink)
+        stream = self._stream = ResponseStream(self, self.max_buffer, sink)
+        stream.attach(request)
+        upload = None
+        if request.body:
+            upload = UploadStream(url, request.body)
+            upload.attach(request)
+        if self.http_pool is None:
+            fetch = httpclient.AsyncHTTPClient().fetch
+        else:
+            # The transfers aborted because the client went away, or timed
+            # out while waiting for the client to read, do not report
+            # juju-core failures.
+            fetch = functools.partial(
+                self.http_pool.fetch,
+                aborted=lambda: stream.closed or stream.paused,
+                closed=self._closed)
+        _proxy_fetches.inc()
+        completed = False
+        response = None
         try:
-            response = yield client.fetch(request)
-        except httpclient.HTTPError as err:
-            response = getattr(err, 'response', None)
-            if not response:
-                self._send_error(url, err)
+            try:
+                response = yield fetch(request)
+                completed = True
+            except Unavailable as err:
+                self._send_unavailable(err)
+            except httpclient.HTTPError as err:
+                response = getattr(err, 'response', None)
+                if stream.closed:
+                    # The client went away and the transfer has been aborted.
+                    response = None
+                elif stream.streaming:
+                    if stream.relayed:
+                        # The response status has been already sent: the only
+                        # way to report the error is closing the connection.
+                        logging.error(
+                            'error streaming data from {}: {}'.format(
+                                url.encode('utf-8'), err))
+                        self.request.connection.stream.close()
+                    response = None
+                elif not response:
+                    self._send_error(url, err)
+            finally:
+                _proxy_fetches.dec()
+                if upload is not None:
+                    upload.finish()
+                stream.finish(completed)
+            if stream.streaming:
+                response = None
+            elif response is not None:
+                response = stream.get_response(response)
+        finally:
+            if flight is not None:
+                # Share the response with identical requests, if possible.
+                flight.finish(response)
         raise gen.Return(response)
 
     def send_response(self, response):
         """Prepare and send the response to the client."""
         self.set_status(response.code)
         set_header = self.set_header
-        for key, value in response.headers.items():
+        for key, value in relayed_headers(response.headers):
             set_header(key, value)
+        if response.code == 200 and self.check_not_modified(response.headers):
+            return
         body = response.body
         if body:
             self.write(body)
 
+    def should_relay(self, code, headers):
+        """Return whether the successful upstream response is relayed.
+
+        Receive the status code and the headers of the response. If False is
+        returned, the response body is only passed to the sink given to
+        send_request, and the handler must send its own response.
+        """
+        return True
+
+    def check_not_modified(self, headers):
+        """Check whether the browser copy of the response is still valid.
+
+        Receive the headers of the response, including its validators. If the
+        browser copy is valid, set the 304 Not Modified status and return
+        True. Otherwise return False.
+        """
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if not is_not_modified(self.request, etag, last_modified):
+            return False
+        _proxy_not_modified.inc()
+        self.set_status(304)
+        return True
+
+    def flush_data(self):
+        """Flush the data written so far to the client.
+
+        Return a future whose result is True when the data has been sent, or
+        False if the client connection is closed in the meanwhile.
+        """
+        future = self._flushed = Future()
+        self.flush(callback=lambda: future.set_result(True))
+        return future
+
+    def on_connection_close(self):
+        """Stop streaming the response when the client goes away.
+
+        Also cancel the fetch if it is still waiting for a pool connection.
+        """
+        if self._stream is not None:
+            self._stream.close()
+        closed = self._closed
+        if closed is not None and not closed.done():
+            closed.set_result(None)
+        flushed = self._flushed
+        if flushed is not None and not flushed.done():
+            flushed.set_result(False)
+
     def _send_error(self, url, exception):
         """Send a 500 internal server error to the client."""
         msg = 'error fetching data from {}: {}'.format(
@@ -347,15 +1245,42 @@ class ProxyHandler(web.RequestHandler):
         self.set_status(500)
         self.write('Internal server error:\n{}'.format(msg))
 
+    def _send_unavailable(self, exception):
+        """Send a 503 service unavailable error to the client.
+
+        The client is asked to retry after the number of seconds included in
+        the given httppool.Unavailable exception.
+        """
+        logging.warning('rejecting proxy request: {}'.format(exception))
+        self.set_status(503)
+        self.set_header('Retry-After', exception.retry_after)
+        self.write('Service unavailable:\n{}'.format(exception))
+
 
 class JujuProxyHandler(ProxyHandler):
     """A specialized proxy handler used for the juju-core HTTP API."""
 
-    def initialize(self, target_url, charmworld_url):
+    # Whether a charm icon is being retrieved from juju-core.
+    _icon_requested = False
+    # The cache writer storing a charm file requested by range.
+    _range_sink = None
+    # Whether juju-core ignored the requested range, so that the range must
+    # be served from the stored charm file.
+    _range_deferred = False
+
+    def initialize(
+            self, target_url, max_buffer=DEFAULT_MAX_BUFFER, charm_cache=None,
+            missing_icons=None, single_flight=None, http_pool=None,
+            compress=False):
         """Initialize the proxy.
 
-        Receive the target URL where to redirect to, and the charmworld URL
-        used to retrieve the default charm icon.
+        Receive the target URL where to redirect to, the maximum number of
+        response bytes buffered while waiting for the client to read them, the
+        disk cache of charm files (see guiserver.charmcache), the registry of
+        the charms lacking an icon (see guiserver.icons), the registry of the
+        shared fetches (see guiserver.coalesce), the pool of connections to
+        juju-core (see guiserver.httppool) and whether to compress responses.
+        The registries, the cache and the pool can be None.
         """
         # Server certificates are not validated: we use this handler to connect
         # to juju-core, and we would need to obtain ca-certificates from it.
@@ -363,28 +1288,195 @@ class JujuProxyHandler(ProxyHandler):
         # skip validation for both WebSocket and HTTPS connections. This is not
         # ideal but currently is our best option.
         super(JujuProxyHandler, self).initialize(
-            target_url, validate_cert=False)
-        self.default_charm_icon_url = urlparse.urljoin(
-            charmworld_url, DEFAULT_CHARM_ICON_PATH)
+            target_url, validate_cert=False, max_buffer=max_buffer,
+            single_flight=single_flight, http_pool=http_pool,
+            compress=compress)
+        self.charm_cache = charm_cache
+        self.missing_icons = missing_icons
 
     @gen.coroutine
     def get(self, path):
         """Handle GET requests.
         See the ProxyHandler.get method.
 
-        Override to handle the case when a charm icon is not found.
+        Override to handle the case when a charm icon is not found, and to
+        serve charm files from the cache if enabled. If a range of a charm
+        file is requested and juju-core sends the whole file instead, the file
+        is stored in the cache, and the range is served from there.
         """
         url = join_url(self.target_url, path, self.request.query)
-        response = yield self.send_request(url)
+        self._icon_requested = self._charm_icon_requested(path)
+        missing_icons = self.missing_icons
+        if self._icon_requested and missing_icons is not None:
+            if self.get_argument('url') in missing_icons:
+                # The charm is known to lack an icon.
+                self._send_default_icon()
+                return
+        cache = self.charm_cache
+        entry = headers = sink = None
+        if cache is not None and self._charm_file_requested(path):
+            key = make_key(url, self.request.headers)
+            entry = cache.get(key)
+            if entry is not None:
+                if cache.is_fresh(entry):
+                    sent = yield self._send_cached(entry)
+                    if sent:
+                        return
+                    entry = None
+                else:
+                    headers = entry.validators()
+            sink = cache.writer(key)
+            if 'Range' in self.request.headers:
+                self._range_sink = sink
+        response = yield self.send_request(url, headers=headers, sink=sink)
+        if self._range_deferred:
+            yield self._send_stored_range(url)
+            return
         if response is not None:
-            if response.code == 404 and self._charm_icon_requested(path):
+            if response.code == 304 and headers:
+                # The cached charm file is still valid.
+                cache.revalidated(entry)
+                sent = yield self._send_cached(entry)
+                if not sent:
+                    # The file has been removed in the meanwhile.
+                    yield self.get(path)
+            elif response.code == 404 and self._icon_requested:
                 # This is a request for a charm icon file, and the icon is not
-                # found: redirect to the fallback icon hosted on charmworld.
-                self.redirect(self.default_charm_icon_url)
+                # found: send the default icon bundled with the server.
+                _icon_misses.inc()
+                if missing_icons is not None:
+                    missing_icons.add(self.get_argument('url'))
+                self._send_default_icon()
             else:
                 # Return the response to the client as usual.
                 self.send_response(response)
 
+    def should_relay(self, code, headers):
+        """Return whether the successful upstream response is relayed.
+        See the ProxyHandler.should_relay method.
+
+        Override to store the whole charm file sent by juju-core in place of
+        the requested range, so that the range can be served from the cache.
+        """
+        if code != 200 or self._range_sink is None:
+            return True
+        length = headers.get('Content-Length', '')
+        if not length.isdigit() or int(length) > self.charm_cache.max_size:
+            # The file cannot be stored: send it whole.
+            return True
+        self._range_deferred = True
+        return False
+
+    @gen.coroutine
+    def _send_stored_range(self, url):
+        """Send the requested range of the charm file just stored."""
+        if self._stream.closed:
+            return
+        entry = self._range_sink.entry
+        sent = False
+        if entry is not None:
+            _proxy_range_fallbacks.inc()
+            sent = yield self._send_cached(entry)
+        if not sent:
+            self._send_error(url, 'the charm file has not been stored')
+
+    @gen.coroutine
+    def _send_cached(self, entry):
+        """Send the given cached charm file to the client.
+
+        The byte ranges requested by the client, if any, are sent as a partial
+        response. Return False if the file is no longer available in the
+        cache.
+        """
+        cache = self.charm_cache
+        content = cache.open(entry)
+        if content is None:
+            raise gen.Return(False)
+        with content:
+            self.set_header('ETag', entry.etag)
+            self.set_header('Cache-Control', cache.cache_control)
+            self.set_header('Accept-Ranges', 'bytes')
+            last_modified = entry.headers.get('Last-Modified')
+            validators = {'ETag': entry.etag, 'Last-Modified': last_modified}
+            if self.check_not_modified(validators):
+                raise gen.Return(True)
+            size = entry.size
+            ranges = requested_ranges(
+                self.request, size, entry.etag, last_modified)
+            if ranges is not None and not ranges:
+                # None of the requested ranges can be satisfied.
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(size))
+                raise gen.Return(True)
+            for key, value in entry.headers.items():
+                self.set_header(key, value)
+            if ranges is None:
+                self.set_header('Content-Length', size)
+                yield self._send_content(content, 0, size)
+                raise gen.Return(True)
+            _proxy_partial.inc()
+            self.set_status(206)
+            if len(ranges) == 1:
+                start, stop = ranges[0]
+                self.set_header('Content-Range', content_range(
+                    start, stop, size))
+                self.set_header('Content-Length', stop - start)
+                yield self._send_content(content, start, stop)
+                raise gen.Return(True)
+            multipart = MultipartRanges(
+                ranges, size, entry.headers.get('Content-Type'))
+            self.set_header('Content-Type', multipart.content_type)
+            self.set_header('Content-Length', multipart.length)
+            for headers, start, stop in multipart.parts:
+                self.write(headers)
+                connected = yield self._send_content(content, start, stop)
+                if not connected:
+                    raise gen.Return(True)
+            self.write(multipart.closing)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def _send_content(self, content, start, stop):
+        """Send the given range of the content file to the client.
+
+        Return False if the client connection is closed in the meanwhile.
+        """
+        content.seek(start)
+        remaining = stop - start
+        while remaining:
+            chunk = content.read(min(CHARM_FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.write(chunk)
+            connected = yield self.flush_data()
+            if not connected:
+                raise gen.Return(False)
+        raise gen.Return(True)
+
+    def on_finish(self):
+        """Track the charm icons retrieved from juju-core."""
+        if self._icon_requested and self.get_status() in (200, 304):
+            _icon_hits.inc()
+
+    def _send_default_icon(self):
+        """Send the default charm icon bundled with the server."""
+        _icon_fallbacks.inc()
+        self._icon_requested = False
+        self.set_header('Content-Type', 'image/svg+xml')
+        self.set_header('Cache-Control', DEFAULT_ICON_CACHE_CONTROL)
+        self.write(get_default_icon())
+
+    def _charm_file_requested(self, path):
+        """Return True if the current request is for a charm revision file."""
+        charm_url = self.get_argument('url', None)
+        return (
+            path == 'charms' and
+            charm_url is not None and
+            _charm_revision.search(charm_url) is not None and
+            self.get_argument('file', None) is not None
+        )
+
     def _charm_icon_requested(self, path):
         """Return True if the current request is for a charm icon."""
         return (
@@ -400,24 +1492,49 @@ class JujuProxyHandler(ProxyHandler):
 class InfoHandler(web.RequestHandler):
     """Return information about the GUI server."""
 
-    def initialize(self, apiurl, apiversion, deployer, sandbox, start_time):
+    def initialize(
+            self, apiurl, apiversion, deployer, sandbox, start_time,
+            multiplexer=None, pool=None, controllers=None,
+            response_cache=None, charm_cache=None, http_pool=None):
         """Initialize the handler."""
         self.apiurl = apiurl
         self.apiversion = apiversion
         self.deployer = deployer
         self.sandbox = sandbox
         self.start_time = start_time
+        self.multiplexer = multiplexer
+        self.pool = pool
+        self.controllers = controllers
+        self.response_cache = response_cache
+        self.charm_cache = charm_cache
+        self.http_pool = http_pool
 
     def get_info(self, settings):
-        return {
+        info = {
             'apiurl': self.apiurl,
             'apiversion': self.apiversion,
             'debug': settings.get('debug', False),
             'deployer': self.deployer.status(),
+            'metrics': metrics.snapshot(),
             'sandbox': self.sandbox,
+            'uploads': uploads_status(),
             'uptime': int(time.time()) - self.start_time,
             'version': get_version(),
         }
+        if self.multiplexer is not None:
+            info['environments'] = self.multiplexer.states.status()
+            info['upstreams'] = self.multiplexer.status()
+        if self.pool is not None:
+            info['pool'] = self.pool.status()
+        if self.controllers is not None:
+            info['controllers'] = self.controllers.status()
+        if self.response_cache is not None:
+            info['apicache'] = self.response_cache.status()
+        if self.charm_cache is not None:
+            info['charmcache'] = self.charm_cache.status()
+        if self.http_pool is not None:
+            info['httppool'] = self.http_pool.status()
+        return info
 
     def get(self):
         """Handle GET requests."""
@@ -428,6 +1545,37 @@ class InfoHandler(web.RequestHandler):
         self.write(info)
 
 
+class LatencyHandler(web.RequestHandler):
+    """Return the latency of the Juju API calls made through the GUI server.
+    """
+
+    def initialize(self, latency):
+        """Initialize the handler."""
+        self.latency = latency
+
+    def get(self):
+        """Handle GET requests."""
+        self.write(self.latency.status())
+
+
+class MetricsHandler(web.RequestHandler):
+    """Return the GUI server metrics in the Prometheus text format."""
+
+    def initialize(self, latency=None):
+        """Initialize the handler.
+
+        If an ApiLatency is provided, also include the Juju API latencies.
+        """
+        self.latency = latency
+
+    def get(self):
+        """Handle GET requests."""
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.exposition())
+        if self.latency is not None:
+            self.write(self.latency.exposition())
+
+
 class HttpsRedirectHandler(web.RequestHandler):
     """Permanently redirect all the requests to the equivalent HTTPS URL."""
 
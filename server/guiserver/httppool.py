@@ -0,0 +1,328 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server pools of HTTP connections to the proxied servers.
+
+Each upstream HTTP server reached by the proxy handlers has its own pool,
+limiting the number of fetches in progress. Fetches exceeding the limit wait
+in a queue, so that the time spent waiting for a connection is measured.
+Fetches waiting longer than the queue timeout are rejected: the proxy can
+then ask the browser to retry later instead of leaving the request hanging.
+Waiting fetches are also cancelled when the browser goes away, so that they
+do not take an upstream connection later.
+
+Each pool can also use a circuit breaker (see guiserver.breaker), so that
+fetches fail fast while the upstream server is not responding.
+
+Streamed responses are only transferred as fast as the browser reads them
+(see guiserver.streaming), so that the duration of a fetch is not limited.
+When the curl HTTP client is in use, fetches time out instead if no data is
+transferred for the configured number of seconds, including the time waiting
+for the upstream server to start responding.
+
+    - is_failure: report whether a status code reports an upstream failure;
+    - Unavailable: the upstream server cannot be reached at the moment;
+    - QueueTimeout: a fetch waited too long for an upstream connection;
+    - HTTPPool: a pool of connections to an upstream HTTP server.
+"""
+
+from collections import deque
+import functools
+import math
+
+from tornado import (
+    gen,
+    httpclient,
+    httputil,
+)
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+
+try:
+    import pycurl
+except ImportError:
+    # The curl HTTP client is not available: the request timeout limits the
+    # duration of the whole fetch.
+    pycurl = None
+
+# The default maximum number of simultaneous fetches to an upstream server.
+DEFAULT_MAX_CLIENTS = 20
+# The default number of seconds allowed for connecting to an upstream server.
+DEFAULT_CONNECT_TIMEOUT = 20
+# The default number of seconds an upstream fetch can go without transferring
+# data.
+DEFAULT_REQUEST_TIMEOUT = 20
+# The transfer speed, in bytes per second, under which a fetch is idle.
+_IDLE_SPEED = 1
+# The default number of seconds a fetch can wait for an upstream connection.
+DEFAULT_QUEUE_TIMEOUT = 10
+# The status codes reporting that the upstream server is not working. The 599
+# code is used by the HTTP client for connection errors and timeouts.
+_FAILURE_CODES = frozenset([502, 503, 504, 599])
+
+_queue_wait = metrics.histogram(
+    'proxy_queue_wait_seconds',
+    'The time proxy requests waited for an upstream connection, in seconds.')
+_queued = metrics.gauge(
+    'proxy_fetches_queued',
+    'The proxy requests waiting for an upstream connection.')
+_rejected = metrics.counter(
+    'proxy_fetches_rejected',
+    'The proxy requests rejected after waiting too long for an upstream '
+    'connection.')
+_cancelled = metrics.counter(
+    'proxy_fetches_cancelled',
+    'The proxy requests cancelled while waiting for an upstream connection, '
+    'because the browser went away.')
+
+
+def is_failure(code):
+    """Return True if the given status code reports an upstream failure."""
+    return code in _FAILURE_CODES
+
+
+class Unavailable(Exception):
+    """The upstream server cannot be reached at the moment.
+
+    The number of seconds after which the request can be retried is stored
+    in the retry_after attribute.
+    """
+
+    def __init__(self, message, retry_after):
+        super(Unavailable, self).__init__(
+            '{}: retry in {} seconds'.format(message, retry_after))
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Unavailable):
+    """A fetch waited too long for an upstream connection."""
+
+    def __init__(self, name, retry_after):
+        super(QueueTimeout, self).__init__(
+            'too many requests to {}'.format(name), retry_after)
+
+
+class HTTPPool(object):
+    """A pool of connections to an upstream HTTP server.
+
+    The pool exposes the fetch interface of the Tornado asynchronous HTTP
+    clients, and uses its own client, so that the fetches to other servers
+    do not compete for the same connections.
+
+    Note that pools are instantiated once when the application is
+    bootstrapped and used as singletons by all the proxy requests.
+    """
+
+    def __init__(
+            self, name, max_clients=DEFAULT_MAX_CLIENTS, keep_alive=True,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            request_timeout=DEFAULT_REQUEST_TIMEOUT,
+            queue_timeout=DEFAULT_QUEUE_TIMEOUT, breaker=None, io_loop=None):
+        """Initialize the pool.
+
+        The name identifies the upstream server. At most max_clients fetches
+        are in progress at the same time. If keep_alive is False, upstream
+        connections are closed after each fetch. Connecting times out after
+        connect_timeout seconds, and the fetch after request_timeout seconds
+        without transferring data (see the module docstring). Fetches are
+        rejected after waiting for queue_timeout seconds, or never if
+        queue_timeout is 0. If a circuit breaker is provided, it is notified
+        of the fetch outcomes, and fetches are rejected while it is open.
+        """
+        self.name = name
+        self.max_clients = max_clients
+        self.keep_alive = keep_alive
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.queue_timeout = queue_timeout
+        self.breaker = breaker
+        self.io_loop = io_loop or IOLoop.current()
+        # The number of fetches in progress.
+        self.active = 0
+        # The number of fetches rejected so far.
+        self.rejected = 0
+        # The (future, start time, timeout handle) of the waiting fetches.
+        self._waiters = deque()
+        self._client = None
+
+    @property
+    def retry_after(self):
+        """The seconds after which rejected requests can be retried."""
+        return max(1, int(math.ceil(self.queue_timeout)))
+
+    @gen.coroutine
+    def fetch(self, request, aborted=None, closed=None):
+        """Fetch the given httpclient.HTTPRequest.
+
+        Wait for an upstream connection to be available if required.
+        Return the response as httpclient.AsyncHTTPClient.fetch does.
+        Raise a QueueTimeout if the request waited too long, or an
+        Unavailable error if the circuit breaker is open.
+
+        If provided, aborted is a callable returning True if the fetch has
+        been aborted on purpose, e.g. because the browser went away: the
+        resulting errors do not report upstream failures, and are not
+        recorded by the circuit breaker.
+
+        If provided, closed is a Future whose result is set when the fetch is
+        no longer needed, e.g. because the browser went away: if the fetch is
+        still waiting for an upstream connection, it is then removed from the
+        queue, and an httpclient.HTTPError with code 599 is raised.
+        """
+        breaker = self.breaker
+        if breaker is not None:
+            breaker.check()
+        yield self._acquire(closed)
+        try:
+            if breaker is not None:
+                # The circuit may have been opened while waiting.
+                breaker.check()
+            self._prepare(request)
+            response = yield self._get_client().fetch(request)
+        except httpclient.HTTPError as err:
+            if breaker is not None and not (aborted and aborted()):
+                breaker.record(err.response, is_failure(err.code))
+            raise
+        except Unavailable:
+            raise
+        except Exception:
+            if breaker is not None:
+                breaker.record(None, True)
+            raise
+        else:
+            if breaker is not None:
+                breaker.record(response, False)
+        finally:
+            self._release()
+        raise gen.Return(response)
+
+    def close(self):
+        """Close the HTTP client used by this pool."""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def status(self):
+        """Return a dict describing the pool usage."""
+        status = {
+            'name': self.name,
+            'max_clients': self.max_clients,
+            'active': self.active,
+            'queued': len(self._waiters),
+            'rejected': self.rejected,
+        }
+        if self.breaker is not None:
+            status['breaker'] = self.breaker.status()
+        return status
+
+    def _get_client(self):
+        """Return the HTTP client used by this pool, creating it if needed."""
+        if self._client is None:
+            # The client queue is never used, as the pool does not start more
+            # than max_clients fetches.
+            self._client = httpclient.AsyncHTTPClient(
+                io_loop=self.io_loop, force_instance=True,
+                max_clients=self.max_clients)
+        return self._client
+
+    def _prepare(self, request):
+        """Apply the pool settings to the given request."""
+        request.connect_timeout = self.connect_timeout
+        request.request_timeout = self.request_timeout
+        if pycurl is not None:
+            self._set_idle_timeout(request)
+        if not self.keep_alive:
+            # Copy the headers, which can be shared with the browser request.
+            request.headers = httputil.HTTPHeaders(request.headers)
+            request.headers['Connection'] = 'close'
+
+    def _set_idle_timeout(self, request):
+        """Make the given request time out only when the transfer is idle.
+
+        This is only supported by the curl HTTP client.
+        """
+        prepare_curl = request.prepare_curl_callback
+        idle_timeout = self.request_timeout
+
+        def prepare_curl_callback(curl):
+            if prepare_curl is not None:
+                prepare_curl(curl)
+            # Replace the timeout of the whole transfer with an idle timeout.
+            curl.setopt(pycurl.TIMEOUT_MS, 0)
+            curl.setopt(pycurl.LOW_SPEED_LIMIT, _IDLE_SPEED)
+            curl.setopt(pycurl.LOW_SPEED_TIME, idle_timeout)
+        request.prepare_curl_callback = prepare_curl_callback
+
+    def _acquire(self, closed=None):
+        """Return a future whose result is set when a fetch can start.
+
+        The future raises a QueueTimeout if the fetch waited too long, or an
+        httpclient.HTTPError if the given closed Future is done before the
+        fetch can start.
+        """
+        future = Future()
+        now = self.io_loop.time()
+        if self.active < self.max_clients:
+            self.active += 1
+            _queue_wait.observe(0)
+            future.set_result(None)
+            return future
+        waiter = [future, now, None]
+        if self.queue_timeout:
+            waiter[2] = self.io_loop.add_timeout(
+                now + self.queue_timeout,
+                functools.partial(self._expire, waiter))
+        self._waiters.append(waiter)
+        _queued.inc()
+        if closed is not None:
+            closed.add_done_callback(functools.partial(self._cancel, waiter))
+        return future
+
+    def _release(self):
+        """A fetch is completed: start the next waiting one, if any."""
+        self.active -= 1
+        if self._waiters:
+            future, start, handle = self._waiters.popleft()
+            _queued.dec()
+            if handle is not None:
+                self.io_loop.remove_timeout(handle)
+            self.active += 1
+            _queue_wait.observe(self.io_loop.time() - start)
+            future.set_result(None)
+
+    def _expire(self, waiter):
+        """The given waiting fetch has waited too long: reject it."""
+        self._waiters.remove(waiter)
+        _queued.dec()
+        self.rejected += 1
+        _rejected.inc()
+        future, start, _ = waiter
+        _queue_wait.observe(self.io_loop.time() - start)
+        future.set_exception(QueueTimeout(self.name, self.retry_after))
+
+    def _cancel(self, waiter, closed):
+        """The given waiting fetch is no longer needed: remove it."""
+        if waiter not in self._waiters:
+            # The fetch has already started or has been rejected.
+            return
+        self._waiters.remove(waiter)
+        _queued.dec()
+        _cancelled.inc()
+        future, _, handle = waiter
+        if handle is not None:
+            self.io_loop.remove_timeout(handle)
+        future.set_exception(httpclient.HTTPError(599, 'Fetch cancelled'))
@@ -0,0 +1,89 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server fallback for missing charm icons.
+
+When juju-core does not have an icon for a charm, the GUI server sends a
+default icon bundled with the server, so that no external service is
+contacted. The charm URLs lacking an icon are remembered for a while, so
+that subsequent requests do not reach juju-core.
+
+    - MissingIcons: the bounded registry of the charms lacking an icon;
+    - get_default_icon: return the bundled default charm icon.
+"""
+
+import collections
+import os
+import time
+
+
+# The default number of seconds a charm URL is remembered as lacking an icon.
+DEFAULT_TTL = 3600
+# The default maximum number of charm URLs remembered as lacking an icon.
+DEFAULT_MAX_ENTRIES = 1000
+# The path to the bundled default charm icon.
+DEFAULT_ICON_PATH = os.path.join(
+    os.path.dirname(__file__), 'static', 'default-charm-icon.svg')
+# The cache control header sent with the default icon.
+DEFAULT_ICON_CACHE_CONTROL = 'public, max-age=86400'
+
+_default_icon = None
+
+
+def get_default_icon():
+    """Return the content of the bundled default charm icon."""
+    global _default_icon
+    if _default_icon is None:
+        with open(DEFAULT_ICON_PATH, 'rb') as icon_file:
+            _default_icon = icon_file.read()
+    return _default_icon
+
+
+class MissingIcons(object):
+    """Remember the charm URLs whose icon is not found in juju-core.
+
+    Note that the registry is instantiated once when the application is
+    bootstrapped and used as a singleton by all the proxy requests.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """Initialize the registry.
+
+        Charm URLs are remembered for ttl seconds. When max_entries URLs are
+        stored, the oldest one is discarded.
+        """
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # Map charm URLs to expiration times, the oldest entry first.
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, charm_url):
+        expires = self._entries.get(charm_url)
+        if expires is None:
+            return False
+        if expires <= time.time():
+            del self._entries[charm_url]
+            return False
+        return True
+
+    def add(self, charm_url):
+        """Remember that the given charm URL lacks an icon."""
+        self._entries.pop(charm_url, None)
+        while len(self._entries) >= self._max_entries:
+            self._entries.popitem(last=False)
+        self._entries[charm_url] = time.time() + self._ttl
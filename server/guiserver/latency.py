@@ -0,0 +1,152 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server API latency tracking.
+
+The latency of the Juju API calls made by browsers is tracked by matching
+each request sent to the Juju API with its response, using the request id.
+Messages are not decoded: the request id, type and method are extracted
+from the raw JSON messages.
+
+    - ApiLatency: aggregate the latency histograms and the error rates of the
+      Juju API calls in memory, keyed by "Type.Request" (e.g.
+      "Client.FullStatus"). A single instance is shared by all the browser
+      connections.
+    - RequestTimer: match the requests sent by a single browser connection
+      with their responses, and report their latency to ApiLatency.
+
+Note that long polling calls like AllWatcher.Next are expected to be slow.
+"""
+
+import re
+import time
+
+from guiserver import metrics
+
+
+_request_id_pattern = re.compile(r'"RequestId"\s*:\s*(\d+)')
+_type_pattern = re.compile(r'"Type"\s*:\s*"([^"]*)"')
+_request_pattern = re.compile(r'"Request"\s*:\s*"([^"]*)"')
+_error_pattern = re.compile(r'"Error"\s*:\s*"')
+
+_outstanding = metrics.gauge(
+    'juju_requests_outstanding',
+    'The Juju API requests waiting for a response.')
+_errors = metrics.counter(
+    'juju_request_errors',
+    'The Juju API responses including an error.')
+
+
+class ApiLatency(object):
+    """Aggregate the latency of the Juju API calls, by method."""
+
+    def __init__(self, buckets=metrics.DEFAULT_BUCKETS):
+        self._buckets = buckets
+        # Map "Type.Request" keys to (histogram, errors counter) tuples.
+        self._methods = {}
+
+    def observe(self, method, duration, error):
+        """Record a Juju API call to method which lasted duration seconds.
+
+        The error flag indicates whether the Juju API returned an error.
+        """
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = (
+                metrics.Histogram(method, '', self._buckets),
+                metrics.Counter(method, ''))
+        histogram, errors = stats
+        histogram.observe(duration)
+        if error:
+            errors.inc()
+
+    def status(self):
+        """Return a dict mapping methods to their latency and error rate."""
+        status = {}
+        for method, (histogram, errors) in self._methods.items():
+            info = histogram.value
+            info['errors'] = errors.value
+            info['error_rate'] = errors.value / float(histogram.count)
+            status[method] = info
+        return {
+            'methods': status,
+            'outstanding': _outstanding.value,
+        }
+
+    def exposition(self):
+        """Return the latencies and errors in the Prometheus text format."""
+        latency_name = metrics.PREFIX + 'juju_api_latency_seconds'
+        errors_name = metrics.PREFIX + 'juju_api_errors'
+        latency_lines = metrics.format_header(
+            latency_name, 'The latency of the Juju API calls.', 'histogram')
+        errors_lines = metrics.format_header(
+            errors_name, 'The Juju API calls returning an error.', 'counter')
+        for method, (histogram, errors) in sorted(self._methods.items()):
+            labels = (('method', method),)
+            latency_lines.extend(
+                metrics.format_samples(latency_name, histogram, labels))
+            errors_lines.extend(
+                metrics.format_samples(errors_name, errors, labels))
+        return '\n'.join(latency_lines + errors_lines) + '\n'
+
+
+class RequestTimer(object):
+    """Time the Juju API requests sent by a browser connection."""
+
+    def __init__(self, latency):
+        self._latency = latency
+        # Map request ids to (method, start time) tuples.
+        self._pending = {}
+
+    def sent(self, message):
+        """Start timing the request in the given message."""
+        match = _request_id_pattern.search(message)
+        if match is None:
+            return
+        request_type = _type_pattern.search(message)
+        request = _request_pattern.search(message)
+        method = '{}.{}'.format(
+            request_type.group(1) if request_type else '',
+            request.group(1) if request else '')
+        request_id = int(match.group(1))
+        if request_id not in self._pending:
+            _outstanding.inc()
+        self._pending[request_id] = (method, time.time())
+
+    def received(self, message):
+        """Stop timing the request answered by the given message, if any."""
+        match = _request_id_pattern.search(message)
+        if match is None:
+            return
+        pending = self._pending.pop(int(match.group(1)), None)
+        if pending is None:
+            return
+        _outstanding.dec()
+        method, start = pending
+        # Juju API errors are included before the response contents: only
+        # look for them there, as responses can include nested errors.
+        end = message.find('"Response"')
+        if end == -1:
+            end = len(message)
+        error = _error_pattern.search(message, 0, end) is not None
+        if error:
+            _errors.inc()
+        self._latency.observe(method, time.time() - start, error)
+
+    def clear(self):
+        """Stop timing the pending requests, e.g. when disconnected."""
+        _outstanding.dec(len(self._pending))
+        self._pending.clear()
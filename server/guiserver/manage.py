@@ -16,12 +16,18 @@
 
 """Juju GUI server management."""
 
+import atexit
 import logging
 import os
+import shutil
 import sys
+import tempfile
 
+from tornado import process
 from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.options import (
     define,
     options,
@@ -29,14 +35,34 @@ from tornado.options import (
 )
 
 import guiserver
+from guiserver import metrics
+from guiserver.apicache import parse_methods
 from guiserver.apps import (
+    get_deflate_options,
     redirector,
     server,
 )
+from guiserver.batching import SUBPROTOCOL as BATCH_SUBPROTOCOL
+from guiserver.clients import WebSocketClientConnection
+from guiserver.utils import watch_ioloop_lag
 
 
 DEFAULT_API_VERSION = 'go'
 DEFAULT_SSL_PATH = '/etc/ssl/juju-gui'
+# The default maximum number of simultaneous requests made by the HTTP proxies.
+PROXY_MAX_CLIENTS = 20
+# The default maximum size of the request bodies: this is the Tornado default.
+DEFAULT_UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+# The directory where the state shared between processes is stored by
+# default, if it exists: a memory backed file system is preferred.
+SHARED_STATE_ROOT = '/dev/shm'
+# The number of times the supervisor restarts the worker processes before
+# giving up.
+MAX_WORKER_RESTARTS = 100
+
+_proxy_max_clients = metrics.gauge(
+    'proxy_max_clients',
+    'The maximum number of simultaneous HTTP proxy requests.')
 
 
 def _add_debug(logger):
@@ -85,6 +111,17 @@ def _validate_range(option_name, min_value, max_value):
                  '{} and {}'.format(option_name, min_value, max_value))
 
 
+def _validate_methods(option_name):
+    """Ensure the value passed for the given option lists Juju API methods.
+
+    Exit with an error if the value cannot be parsed.
+    """
+    try:
+        parse_methods(options[option_name] or '')
+    except ValueError as err:
+        sys.exit('error: invalid {} argument: {}'.format(option_name, err))
+
+
 def _get_ssl_options():
     """Return a Tornado SSL options dict.
 
@@ -97,6 +134,46 @@ def _get_ssl_options():
     }
 
 
+def _make_shared_dir():
+    """Create and return the directory storing the state shared by workers.
+
+    The directory is removed when the supervisor process exits.
+    """
+    root = SHARED_STATE_ROOT if os.path.isdir(SHARED_STATE_ROOT) else None
+    path = tempfile.mkdtemp(prefix='guiserver-', dir=root)
+    pid = os.getpid()
+
+    def remove():
+        # Worker processes inherit the exit handlers of the supervisor.
+        if os.getpid() == pid:
+            shutil.rmtree(path, ignore_errors=True)
+    atexit.register(remove)
+    return path
+
+
+def _start_workers(port, ssl_options, redirect):
+    """Start the worker processes serving the applications.
+
+    The listening sockets are created before forking, so that they are shared
+    by all the workers. The current process becomes the supervisor: it
+    restarts the workers that die, and never returns. In the workers, this
+    function returns after the applications are set up.
+    """
+    sockets = bind_sockets(port)
+    redirect_sockets = bind_sockets(80) if redirect else []
+    if not options.shareddir:
+        options.shareddir = _make_shared_dir()
+    process.fork_processes(options.processes, MAX_WORKER_RESTARTS)
+    # This is now a worker process: the applications must be created here so
+    # that each worker uses its own IO loop.
+    HTTPServer(
+        server(), ssl_options=ssl_options,
+        max_buffer_size=options.uploadmaxsize).add_sockets(sockets)
+    if redirect_sockets:
+        HTTPServer(redirector()).add_sockets(redirect_sockets)
+    logging.info('worker {} started'.format(process.task_id()))
+
+
 def setup():
     """Set up options and logger. Configure the asynchronous HTTP client."""
     define(
@@ -149,32 +226,288 @@ def setup():
         help='Enables interactive login to identity manager, if applicable.')
     define(
         'gzip', type=bool, default=False,
-        help='Enable gzip compression in the gui.')
+        help='Enable gzip compression in the gui and in the responses '
+             'proxied from juju-core.')
+    define(
+        'multiplex', type=bool, default=False,
+        help='Set to True to share a single Juju API connection, login and '
+             'AllWatcher between the browser sessions authenticated as the '
+             'same user.')
+    define(
+        'apiaddresses', type=str,
+        help='A comma separated list of all the Juju API controller '
+             'addresses, e.g. "1.2.3.4:17070,1.2.3.5:17070". If provided, '
+             'connections to the Juju API are raced across all the '
+             'controllers, preferring the healthy and fastest ones.')
+    define(
+        'apiconnecttimeout', type=int, default=5,
+        help='The number of seconds allowed for connecting to a Juju API '
+             'controller when controller addresses are provided.')
+    define(
+        'apireconnect', type=int, default=0,
+        help='The number of times a browser session is transparently '
+             'reconnected to the Juju API if the connection is unexpectedly '
+             'closed. By default (0) the browser is disconnected instead.')
+    define(
+        'upstreampool', type=int, default=0,
+        help='The number of idle pre-connected Juju API connections kept '
+             'ready for new browser sessions. Set to 0 (default) to connect '
+             'on demand.')
+    define(
+        'upstreampoolidle', type=int, default=300,
+        help='The number of seconds after which idle pre-connected Juju API '
+             'connections are closed.')
+    define(
+        'allwatcherbacklog', type=int, default=10000,
+        help='When multiplexing, the maximum number of AllWatcher deltas '
+             'retained for each environment in order to serve sessions '
+             'lagging behind.')
+    define(
+        'allwatcherttl', type=int, default=60,
+        help='When multiplexing, the number of seconds the state of an '
+             'environment is kept in memory after the last session stops '
+             'watching it.')
+    define(
+        'allwatchermaxenvironments', type=int, default=100,
+        help='When multiplexing, the maximum number of environment states '
+             'kept in memory. When exceeded, the least recently used states '
+             'are evicted, starting from the ones no session is watching.')
+    define(
+        'allwatchermaxentities', type=int, default=100000,
+        help='When multiplexing, the maximum number of entities kept in '
+             'memory for each environment. The state of an environment '
+             'exceeding this limit is discarded, and the sessions watching '
+             'it receive an error.')
+    define(
+        'resumewindow', type=int, default=0,
+        help='The number of seconds the authenticated Juju API connection of '
+             'a disconnected browser is kept open, so that the GUI can '
+             'resume the session after a page reload. Set to 0 (default) to '
+             'disable session resumption.')
+    define(
+        'resumesessions', type=int, default=100,
+        help='The maximum number of sessions waiting to be resumed. When '
+             'exceeded, the oldest parked session is closed.')
+    define(
+        'resumebytes', type=int, default=1024 * 1024,
+        help='The maximum size in bytes of the Juju API messages retained '
+             'for each session waiting to be resumed. When exceeded, the '
+             'session is closed.')
+    define(
+        'apicache', type=str, default='',
+        help='A comma separated list of the read-only Juju API methods whose '
+             'responses are cached, e.g. "Client.CharmInfo". Each method can '
+             'be followed by a colon and the "+" separated AllWatcher delta '
+             'kinds invalidating its responses, e.g. '
+             '"Client.ServiceGet:service". Leave empty (default) to disable '
+             'the cache.')
+    define(
+        'apicachettl', type=int, default=60,
+        help='The number of seconds the Juju API responses are cached.')
+    define(
+        'apicachesize', type=int, default=1000,
+        help='The maximum number of cached Juju API responses.')
+    define(
+        'proxybuffer', type=int, default=256 * 1024,
+        help='The maximum number of bytes of a proxied juju-core HTTPS '
+             'response waiting to be sent to a browser. When exceeded, the '
+             'transfer from juju-core is paused until the browser catches '
+             'up.')
+    define(
+        'charmcachedir', type=str,
+        help='The directory where the charm files proxied from juju-core are '
+             'cached. If not set, charm files are not cached.')
+    define(
+        'charmcachesize', type=int, default=100 * 1024 * 1024,
+        help='The maximum size in bytes of the cached charm files. When '
+             'exceeded, the least recently used files are removed.')
+    define(
+        'charmcachettl', type=int, default=3600,
+        help='The number of seconds after which cached charm files are '
+             'revalidated with juju-core. This is also the time browsers '
+             'are allowed to cache them.')
+    define(
+        'missingiconttl', type=int, default=3600,
+        help='The number of seconds a charm is remembered as lacking an '
+             'icon. In the meanwhile, the default icon is sent without '
+             'contacting juju-core.')
+    define(
+        'missingiconsize', type=int, default=1000,
+        help='The maximum number of charms remembered as lacking an icon.')
+    define(
+        'proxycoalescewait', type=int, default=0,
+        help='The maximum number of milliseconds a juju-core HTTPS proxy GET '
+             'request waits for the response of an identical request in '
+             'progress, instead of sending its own request to juju-core. '
+             'If 0, identical requests are not coalesced.')
+    define(
+        'proxymaxclients', type=int, default=PROXY_MAX_CLIENTS,
+        help='The maximum number of simultaneous requests sent to juju-core '
+             'by the HTTPS proxy. Additional requests wait for a connection '
+             'to be available.')
+    define(
+        'proxykeepalive', type=bool, default=True,
+        help='Set to False to close the juju-core HTTPS proxy connections '
+             'after each request, instead of reusing them.')
+    define(
+        'proxyconnecttimeout', type=int, default=20,
+        help='The number of seconds allowed for connecting to juju-core when '
+             'proxying HTTPS requests.')
+    define(
+        'proxyrequesttimeout', type=int, default=20,
+        help='The number of seconds a juju-core HTTPS proxy request can go '
+             'without transferring data, including the time waiting for '
+             'juju-core to start responding.')
+    define(
+        'proxybreakerfailures', type=int, default=0,
+        help='The number of consecutive failed juju-core HTTPS proxy requests '
+             'after which juju-core is considered not responding: requests '
+             'are then rejected right away with a 503 Service Unavailable '
+             'response until juju-core responds again. Set to 0 (default) to '
+             'disable the circuit breaker and always send requests to '
+             'juju-core.')
+    define(
+        'proxybreakerlatency', type=int, default=0,
+        help='The number of milliseconds after which a juju-core HTTPS proxy '
+             'response which did not start yet is counted as a failure by '
+             'the circuit breaker. If 0, slow responses are not failures.')
+    define(
+        'proxybreakerreset', type=int, default=30,
+        help='The number of seconds between the health checks sent to '
+             'juju-core while it is considered not responding.')
+    define(
+        'proxyqueuetimeout', type=int, default=10,
+        help='The maximum number of seconds a juju-core HTTPS proxy request '
+             'waits for a connection. Requests waiting longer are rejected '
+             'with a 503 Service Unavailable response including a '
+             'Retry-After header. If 0, requests wait indefinitely.')
+    define(
+        'uploadmaxsize', type=int, default=DEFAULT_UPLOAD_MAX_SIZE,
+        help='The maximum size in bytes of the request bodies, including the '
+             'charms uploaded through the juju-core HTTPS proxy. Larger '
+             'requests are rejected before their body is read. This also '
+             'limits the size of the WebSocket messages.')
+    define(
+        'wsdeflate', type=bool, default=False,
+        help='Set to True to compress the WebSocket messages exchanged with '
+             'browsers supporting the permessage-deflate extension.')
+    define(
+        'wsdeflateupstream', type=bool, default=False,
+        help='Set to True to also offer WebSocket compression to the Juju '
+             'API. Messages are sent uncompressed if the offer is declined.')
+    define(
+        'wsdeflatelevel', type=int, default=6,
+        help='The WebSocket compression level, from 1 (fastest) to 9 (best '
+             'compression).')
+    define(
+        'wsdeflatewindow', type=int, default=15,
+        help='The base two logarithm of the WebSocket compression window '
+             'size, from 9 to 15. Lower values use less memory for each '
+             'connection.')
+    define(
+        'wsdeflateminsize', type=int, default=256,
+        help='The size in bytes below which WebSocket messages are sent '
+             'uncompressed.')
+    define(
+        'wsbatch', type=bool, default=False,
+        help='Set to True to allow browsers requesting the "{}" WebSocket '
+             'sub-protocol to receive the Juju API messages in batches, '
+             'i.e. as JSON arrays of messages.'.format(BATCH_SUBPROTOCOL))
+    define(
+        'wsbatchsize', type=int, default=100,
+        help='The maximum number of Juju API messages sent to the browser in '
+             'a single batch.')
+    define(
+        'wsbatchdelay', type=int, default=5,
+        help='The number of milliseconds Juju API messages are collected '
+             'before sending a batch to the browser. If 0, only the messages '
+             'handled within the same IO loop iteration are batched.')
+    define(
+        'processes', type=int, default=1,
+        help='The number of server processes sharing the listening sockets. '
+             'Set to 0 to start a process for each CPU. When running more '
+             'than one process, a supervisor process restarts the processes '
+             'that die.')
+    define(
+        'shareddir', type=str,
+        help='The directory where the state shared between server processes '
+             '(authentication and change set tokens, bundle deployment lock) '
+             'is stored. If not provided, a temporary directory is created '
+             'when running more than one process.')
     # In Tornado, parsing the options also sets up the default logger.
     parse_command_line()
     _validate_choices('apiversion', ('go', 'python'))
     _validate_range('port', 1, 65535)
+    _validate_range('wsdeflatelevel', 1, 9)
+    _validate_range('wsdeflatewindow', 9, 15)
+    _validate_range('wsbatchsize', 1, sys.maxint)
+    _validate_range('wsbatchdelay', 0, 10000)
+    _validate_range('processes', 0, sys.maxint)
+    _validate_range('allwatchermaxenvironments', 1, sys.maxint)
+    _validate_range('allwatchermaxentities', 1, sys.maxint)
+    _validate_range('resumewindow', 0, sys.maxint)
+    _validate_range('resumesessions', 1, sys.maxint)
+    _validate_range('resumebytes', 0, sys.maxint)
+    _validate_methods('apicache')
+    _validate_range('apicachettl', 1, sys.maxint)
+    _validate_range('apicachesize', 1, sys.maxint)
+    _validate_range('proxybuffer', 1, sys.maxint)
+    _validate_range('uploadmaxsize', 1, sys.maxint)
+    _validate_range('charmcachesize', 1, sys.maxint)
+    _validate_range('charmcachettl', 1, sys.maxint)
+    _validate_range('missingiconttl', 1, sys.maxint)
+    _validate_range('missingiconsize', 1, sys.maxint)
+    _validate_range('proxycoalescewait', 0, sys.maxint)
+    _validate_range('proxymaxclients', 1, sys.maxint)
+    _validate_range('proxyconnecttimeout', 1, sys.maxint)
+    _validate_range('proxyqueuetimeout', 0, sys.maxint)
+    _validate_range('proxyrequesttimeout', 1, sys.maxint)
+    _validate_range('proxybreakerfailures', 0, sys.maxint)
+    _validate_range('proxybreakerlatency', 0, sys.maxint)
+    _validate_range('proxybreakerreset', 1, sys.maxint)
     _add_debug(logging.getLogger())
     # Configure the asynchronous HTTP client used by proxy handlers.
     AsyncHTTPClient.configure(
-        'tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=20)
+        'tornado.curl_httpclient.CurlAsyncHTTPClient',
+        max_clients=options.proxymaxclients)
+    _proxy_max_clients.set(options.proxymaxclients)
+    # Configure the compression of the WebSocket connections to the Juju API.
+    if options.wsdeflateupstream:
+        WebSocketClientConnection.compression = get_deflate_options()
 
 
 def run():
     """Run the server"""
     port = options.port
-    if options.insecure:
+    if options.processes != 1:
+        # Run the server in multiple processes.
+        ssl_options = None
+        redirect = False
+        if options.insecure:
+            if port is None:
+                port = 80
+        else:
+            ssl_options = _get_ssl_options()
+            if port is None:
+                port = 443
+                redirect = True
+        _start_workers(port, ssl_options, redirect)
+    elif options.insecure:
         # Run the server over an insecure HTTP connection.
         if port is None:
             port = 80
-        server().listen(port)
+        server().listen(port, max_buffer_size=options.uploadmaxsize)
     else:
         # Default configuration: run the server over a secure HTTPS connection.
         if port is None:
             port = 443
             redirector().listen(80)
-        server().listen(port, ssl_options=_get_ssl_options())
+        server().listen(
+            port, ssl_options=_get_ssl_options(),
+            max_buffer_size=options.uploadmaxsize)
     version = guiserver.get_version()
     logging.info('starting Juju GUI server v{}'.format(version))
     logging.info('listening on port {}'.format(port))
-    IOLoop.instance().start()
+    io_loop = IOLoop.instance()
+    watch_ioloop_lag(io_loop)
+    io_loop.start()
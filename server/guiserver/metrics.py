@@ -0,0 +1,284 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server metrics.
+
+This module defines lightweight metric primitives (counters, gauges,
+summaries and histograms), cheap enough to be updated each time a WebSocket
+message is processed. Metrics are created at import
+time by the modules using them, and are stored in a process wide registry:
+
+    frames = metrics.counter('frames', 'The number of relayed frames.')
+    frames.inc()
+
+The current value of all the registered metrics can be retrieved by calling
+metrics.snapshot(), or in the Prometheus text exposition format by calling
+metrics.exposition().
+"""
+
+import bisect
+from collections import OrderedDict
+
+
+_INF = float('inf')
+# The default histogram bucket upper bounds, suitable for durations in seconds.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, _INF)
+
+# The prefix of the metric names in the Prometheus exposition format.
+PREFIX = 'guiserver_'
+
+# The registry maps metric names to metric instances.
+_registry = OrderedDict()
+
+
+class Counter(object):
+    """A monotonically increasing counter."""
+
+    __slots__ = ('name', 'description', 'value')
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def __repr__(self):
+        return '<Counter {}: {}>'.format(self.name, self.value)
+
+    def inc(self, amount=1):
+        """Increment the counter by the given amount."""
+        self.value += amount
+
+
+class Gauge(object):
+    """A value that can go up and down."""
+
+    __slots__ = ('name', 'description', 'value')
+    kind = 'gauge'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def __repr__(self):
+        return '<Gauge {}: {}>'.format(self.name, self.value)
+
+    def inc(self, amount=1):
+        """Increment the gauge by the given amount."""
+        self.value += amount
+
+    def dec(self, amount=1):
+        """Decrement the gauge by the given amount."""
+        self.value -= amount
+
+    def set(self, value):
+        """Set the gauge to the given value."""
+        self.value = value
+
+
+class Summary(object):
+    """Track the number and the sum of observed values (e.g. durations)."""
+
+    __slots__ = ('name', 'description', 'count', 'sum')
+    kind = 'summary'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.count = 0
+        self.sum = 0
+
+    def __repr__(self):
+        return '<Summary {}: {}/{}>'.format(self.name, self.sum, self.count)
+
+    @property
+    def value(self):
+        """Return a dict including the count and the sum of observations."""
+        return {'count': self.count, 'sum': self.sum}
+
+    def observe(self, value):
+        """Record the given observed value."""
+        self.count += 1
+        self.sum += value
+
+
+class Histogram(object):
+    """Count observed values in fixed-size buckets.
+
+    The buckets are defined by their sorted upper bounds, the last one being
+    usually infinity. Each observation increments a single bucket, so that
+    the memory used does not depend on the number of observations.
+    """
+
+    __slots__ = ('name', 'description', 'bounds', 'counts', 'count', 'sum')
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.bounds = tuple(buckets)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0
+
+    def __repr__(self):
+        return '<Histogram {}: {}/{}>'.format(self.name, self.sum, self.count)
+
+    @property
+    def value(self):
+        """Return a dict including the count, the sum and the buckets.
+
+        Buckets are returned as a list of (upper bound, count) pairs, where
+        each count only includes the observations in that bucket. The
+        infinite upper bound is represented as "+Inf", so that the value can
+        be JSON encoded.
+        """
+        bounds = ['+Inf' if bound == _INF else bound for bound in self.bounds]
+        return {
+            'buckets': zip(bounds, self.counts),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+    def observe(self, value):
+        """Record the given observed value."""
+        index = bisect.bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _register(metric_class, name, description, *args):
+    """Register and return a metric of the given class.
+
+    If a metric with the same name is already registered, return it.
+    """
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = metric_class(name, description, *args)
+    return metric
+
+
+def counter(name, description):
+    """Register and return a counter with the given name and description.
+
+    If a counter with the same name is already registered, return it.
+    """
+    return _register(Counter, name, description)
+
+
+def gauge(name, description):
+    """Register and return a gauge with the given name and description.
+
+    If a gauge with the same name is already registered, return it.
+    """
+    return _register(Gauge, name, description)
+
+
+def summary(name, description):
+    """Register and return a summary with the given name and description.
+
+    If a summary with the same name is already registered, return it.
+    """
+    return _register(Summary, name, description)
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    """Register and return a histogram with the given name and description.
+
+    If a histogram with the same name is already registered, return it.
+    """
+    return _register(Histogram, name, description, buckets)
+
+
+def snapshot():
+    """Return a dict mapping metric names to their current values."""
+    return dict((name, metric.value) for name, metric in _registry.items())
+
+
+def _format_number(value):
+    """Return the given number formatted for the exposition format."""
+    if value == _INF:
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    """Return the given sequence of (name, value) pairs as a label set."""
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in labels)
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+
+def format_header(name, description, kind):
+    """Return the HELP and TYPE exposition lines for a metric."""
+    return [
+        '# HELP {} {}'.format(name, description.replace('\n', ' ')),
+        '# TYPE {} {}'.format(name, kind),
+    ]
+
+
+def format_samples(name, metric, labels=()):
+    """Return the exposition lines for the samples of the given metric.
+
+    The name argument is the full name of the metric, and labels is an
+    optional sequence of (name, value) pairs identifying the samples.
+    """
+    labels = tuple(labels)
+    if metric.kind in ('counter', 'gauge'):
+        return ['{}{} {}'.format(
+            name, _format_labels(labels), _format_number(metric.value))]
+    lines = []
+    if metric.kind == 'histogram':
+        # Buckets are cumulative in the exposition format.
+        cumulative = 0
+        for bound, count in zip(metric.bounds, metric.counts):
+            cumulative += count
+            bucket_labels = labels + (('le', _format_number(bound)),)
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(bucket_labels), cumulative))
+        if metric.bounds[-1] != _INF:
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', '+Inf'),)),
+                metric.count))
+    label_set = _format_labels(labels)
+    lines.extend([
+        '{}_sum{} {}'.format(name, label_set, _format_number(metric.sum)),
+        '{}_count{} {}'.format(name, label_set, metric.count),
+    ])
+    return lines
+
+
+def exposition():
+    """Return the registered metrics in the Prometheus text format.
+
+    See <https://prometheus.io/docs/instrumenting/exposition_formats/>.
+    """
+    lines = []
+    for name, metric in _registry.items():
+        name = PREFIX + name
+        lines.extend(format_header(name, metric.description, metric.kind))
+        lines.extend(format_samples(name, metric))
+    return '\n'.join(lines) + '\n'
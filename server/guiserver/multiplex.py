@@ -0,0 +1,513 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server upstream connections multiplexer.
+
+When multiplexing is enabled, browser sessions authenticated as the same user
+against the same Juju API share a single upstream WebSocket connection, a
+single login and a single AllWatcher.
+
+    - Multiplexer: this is instantiated once when the application is
+      bootstrapped and is used by all WebSocket handlers in order to join a
+      shared upstream connection, using the login request sent by the browser.
+      Upstream connections are keyed by API URL and credentials.
+    - Upstream: a WebSocket connection to the Juju API shared by multiple
+      browser sessions. Request identifiers sent by the sessions are rewritten
+      on the way out and mapped back on responses. The Client.WatchAll and
+      AllWatcher requests are handled locally: one AllWatcher is started on
+      the upstream connection, and its results are applied to an environment
+      state (see guiserver.allwatcher) shared by the sessions of that
+      connection only, so that sessions subscribing later receive a snapshot
+      of the environment straight away.
+    - Session: the object returned to the WebSocket handler when joining an
+      upstream connection. It exposes the same write_message() and close()
+      methods as the WebSocket client connection, and propagates messages
+      coming from the Juju API using the given callback, so that the handler
+      can use it in place of a dedicated Juju API connection.
+"""
+
+import itertools
+import logging
+import time
+
+from tornado import escape
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.allwatcher import StateCache
+from guiserver.clients import websocket_connect
+from guiserver.utils import (
+    get_environment_uuid,
+    json_decode_dict,
+)
+from guiserver.watchers import WatcherError
+
+
+_snapshot_bytes = metrics.summary(
+    'allwatcher_snapshot_bytes',
+    'The size of the AllWatcher snapshots sent to the sessions.')
+_time_to_first_render = metrics.summary(
+    'allwatcher_time_to_first_render_seconds',
+    'The time elapsed between a WatchAll request and the snapshot response.')
+
+
+def _error_response(request_id, error):
+    """Return a Juju API error response for the given request id."""
+    return {
+        'RequestId': request_id,
+        'Error': error,
+        'ErrorCode': 'bad request',
+        'Response': {},
+    }
+
+
+class Multiplexer(object):
+    """Share upstream Juju API connections between browser sessions.
+
+    Note that the multiplexer is instantiated once when the application is
+    bootstrapped and used as a singleton by all WebSocket requests.
+    """
+
+    def __init__(self, backend, io_loop=None, states=None, connect=None):
+        """Initialize the multiplexer.
+
+        The backend argument is the authentication backend used to parse login
+        requests and responses. The states argument is the cache of AllWatcher
+        environment states: a new one is created if not provided. The connect
+        argument, if provided, is the function used to connect to the Juju API
+        (see guiserver.failover.Controllers.connect).
+        """
+        self._connect = connect
+        self._backend = backend
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        if states is None:
+            states = StateCache(io_loop=io_loop)
+        self.states = states
+        # The upstreams attribute maps (url, username, password) tuples to
+        # upstream connections.
+        self._upstreams = {}
+        self._upstream_ids = itertools.count(1)
+
+    def connect(self, apiurl, headers, data, callback):
+        """Join a shared upstream connection logging in with the given data.
+
+        The data argument is a login request. If an upstream connection to
+        apiurl logged in with the same credentials already exists, the login
+        response is sent without contacting the Juju API. Otherwise a new
+        upstream connection is created. The headers are used in the WebSocket
+        client handshake. The callback is called each time a message for this
+        session arrives from the Juju API, starting from the login response.
+
+        Return a Future whose result is a Session, or None if the login failed.
+        """
+        username, password = self._backend.get_credentials(data)
+        key = (apiurl, username, password)
+        upstream = self._upstreams.get(key)
+        if upstream is None:
+            owner = next(self._upstream_ids)
+            upstream = Upstream(
+                self._backend, apiurl, headers, self._io_loop, self.states,
+                lambda upstream: self._remove(key, upstream),
+                connect=self._connect, owner=owner)
+            self._upstreams[key] = upstream
+        return upstream.login(data, callback)
+
+    def _remove(self, key, upstream):
+        """Forget the given closed upstream connection."""
+        if self._upstreams.get(key) is upstream:
+            del self._upstreams[key]
+
+    def status(self):
+        """Return a list describing the existing upstream connections.
+
+        The list is publicly exposed: upstream connections are only
+        identified by their opaque owner number, not by their credentials.
+        """
+        upstreams = sorted(
+            self._upstreams.values(), key=lambda upstream: upstream.owner)
+        return [{
+            'upstream': upstream.owner,
+            'sessions': len(upstream.sessions),
+        } for upstream in upstreams]
+
+
+class Session(object):
+    """A browser session using a shared upstream connection."""
+
+    def __init__(self, upstream, session_id, callback):
+        self.closed = False
+        self.session_id = session_id
+        # The environment state this session is subscribed to, if any.
+        self.state = None
+        # When the session requested the AllWatcher.
+        self.watch_started = None
+        self._upstream = upstream
+        self._callback = callback
+
+    @property
+    def watching(self):
+        """Return True if this session requested the AllWatcher."""
+        return self.state is not None
+
+    def write_message(self, message):
+        """Send the given message to the Juju API."""
+        if not self.closed:
+            self._upstream.send(self, message)
+
+    def close(self):
+        """Leave the shared upstream connection."""
+        if not self.closed:
+            self.closed = True
+            self.unwatch()
+            self._upstream.detach(self)
+
+    def deliver(self, data):
+        """Propagate the given data to the session callback.
+
+        Return the length of the encoded message.
+        """
+        if self.closed:
+            return 0
+        message = escape.json_encode(data).decode('utf-8')
+        self._callback(message)
+        return len(message)
+
+    def watch(self, state):
+        """Subscribe the session to the given environment state."""
+        self.unwatch()
+        state.subscribe(self)
+        self.state = state
+        self.watch_started = time.time()
+
+    def unwatch(self):
+        """Unsubscribe the session from its environment state, if any."""
+        state, self.state = self.state, None
+        if state is not None:
+            state.unsubscribe(self)
+
+    def terminate(self):
+        """Notify the session the upstream connection has been closed."""
+        if not self.closed:
+            self.closed = True
+            self.unwatch()
+            self._callback(None)
+
+
+class Upstream(object):
+    """A Juju API connection shared by multiple browser sessions.
+
+    The on_close callback is called passing this upstream connection when
+    the connection is closed. The owner argument is an opaque number
+    identifying the connection in the status and in the environment states
+    cache: the state fed by this connection is only shared by its own
+    sessions, as they are authenticated as the same user and their feed must
+    not depend on a connection they do not use.
+    """
+
+    def __init__(self, backend, apiurl, headers, io_loop, states, on_close,
+                 connect=None, owner=None):
+        self.closed = False
+        self.owner = owner
+        # The sessions attribute maps session ids to sessions.
+        self.sessions = {}
+        self._backend = backend
+        self._io_loop = io_loop
+        self._on_close = on_close
+        self._ids = itertools.count(1)
+        self._connection = None
+        self._queue = []
+        # The requests attribute maps upstream request ids to
+        # (session, request id) tuples.
+        self._requests = {}
+        # Login state: the pending logins and the successful login response.
+        self._login_request_id = None
+        self._login_response = None
+        self._logins = []
+        # AllWatcher state: the environment state fed by this connection, if
+        # any, and the ids of the pending upstream AllWatcher requests.
+        self._states = states
+        self._state_key = (get_environment_uuid(apiurl) or apiurl, owner)
+        self._state = None
+        self._watcher_id = None
+        self._watch_request_id = None
+        self._next_request_id = None
+        # The ids of the upstream requests whose responses must be ignored.
+        self._discarded = set()
+        if connect is None:
+            future = websocket_connect(
+                io_loop, apiurl, self.on_message, headers=headers)
+        else:
+            future = connect(apiurl, self.on_message, headers=headers)
+        io_loop.add_future(future, self._on_connected)
+
+    def _on_connected(self, future):
+        """Called when the connection to the Juju API is established."""
+        try:
+            self._connection = future.result()
+        except Exception as err:
+            logging.error('multiplex: unable to connect to the Juju API')
+            logging.exception(err)
+            return self._close(error=err)
+        if self.closed:
+            return self._connection.close()
+        for message in self._queue:
+            self._connection.write_message(message)
+        self._queue = []
+
+    def _write(self, data):
+        """Send the given data to the Juju API."""
+        message = escape.json_encode(data)
+        if self._connection is None:
+            self._queue.append(message)
+        else:
+            self._connection.write_message(message)
+
+    def login(self, data, callback):
+        """Log in a new session using the given login request data.
+
+        See Multiplexer.connect.
+        """
+        future = Future()
+        login = (self._backend.get_request_id(data), callback, future)
+        if self._login_response is not None:
+            self._complete_login(login, self._login_response)
+            return future
+        self._logins.append(login)
+        if self._login_request_id is None:
+            self._login_request_id = next(self._ids)
+            self._write(dict(data, RequestId=self._login_request_id))
+        return future
+
+    def _complete_login(self, login, response):
+        """Send the login response to a session and fire its Future."""
+        request_id, callback, future = login
+        response = dict(response, RequestId=request_id)
+        if not self._backend.login_succeeded(response):
+            callback(escape.json_encode(response).decode('utf-8'))
+            return future.set_result(None)
+        session_id = next(self._ids)
+        session = Session(self, session_id, callback)
+        self.sessions[session_id] = session
+        session.deliver(response)
+        future.set_result(session)
+
+    def send(self, session, message):
+        """Send a message from the given session to the Juju API.
+
+        AllWatcher related requests are handled locally.
+        """
+        data = json_decode_dict(message)
+        if data is None:
+            return
+        request_id = data.get('RequestId')
+        request = (data.get('Type'), data.get('Request'))
+        if request == ('Client', 'WatchAll'):
+            return self._watch_all(session, request_id)
+        if request == ('AllWatcher', 'Next'):
+            return self._watcher_next(session, request_id)
+        if request == ('AllWatcher', 'Stop'):
+            session.unwatch()
+            return session.deliver({'RequestId': request_id, 'Response': {}})
+        upstream_request_id = next(self._ids)
+        self._requests[upstream_request_id] = (session, request_id)
+        data['RequestId'] = upstream_request_id
+        self._write(data)
+
+    def _watch_all(self, session, request_id):
+        """Subscribe the session to the shared environment state.
+
+        Start the AllWatcher on the Juju API if the environment is not already
+        being watched by this connection.
+        """
+        state = self._states.get(self._state_key)
+        if state is None:
+            state = self._states.create(
+                self._state_key, self._on_state_closed)
+            self._state = state
+            self._watch_request_id = next(self._ids)
+            self._write({
+                'RequestId': self._watch_request_id,
+                'Type': 'Client',
+                'Request': 'WatchAll',
+                'Params': {},
+            })
+        session.watch(state)
+        session.deliver({
+            'RequestId': request_id,
+            'Response': {'AllWatcherId': state.watcher_id},
+        })
+
+    def _watcher_next(self, session, request_id):
+        """Send the session the AllWatcher changes it has not yet seen."""
+        if not session.watching:
+            return session.deliver(
+                _error_response(request_id, 'AllWatcher not started'))
+        try:
+            future = session.state.next(session)
+        except WatcherError as err:
+            return session.deliver(_error_response(request_id, str(err)))
+        callback = lambda future: self._send_deltas(
+            session, request_id, future)
+        self._io_loop.add_future(future, callback)
+
+    def _send_deltas(self, session, request_id, future):
+        """Send the session the AllWatcher changes in the given Future."""
+        try:
+            deltas, snapshot = future.result()
+        except WatcherError as err:
+            return session.deliver(_error_response(request_id, str(err)))
+        size = session.deliver({
+            'RequestId': request_id,
+            'Response': {'Deltas': deltas},
+        })
+        if snapshot and size:
+            _snapshot_bytes.observe(size)
+            _time_to_first_render.observe(time.time() - session.watch_started)
+
+    def _request_next(self):
+        """Ask the Juju API for the next AllWatcher changes."""
+        self._next_request_id = next(self._ids)
+        self._write({
+            'RequestId': self._next_request_id,
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': self._watcher_id,
+            'Params': {},
+        })
+
+    def _on_state_closed(self, state):
+        """Stop the upstream AllWatcher feeding the given closed state.
+
+        Close the connection if it is no longer used.
+        """
+        if state is not self._state:
+            return
+        self._state = None
+        for request_id in (self._watch_request_id, self._next_request_id):
+            if request_id is not None:
+                self._discarded.add(request_id)
+        self._watch_request_id = self._next_request_id = None
+        watcher_id, self._watcher_id = self._watcher_id, None
+        if self.closed:
+            return
+        if watcher_id is not None:
+            stop_request_id = next(self._ids)
+            self._discarded.add(stop_request_id)
+            self._write({
+                'RequestId': stop_request_id,
+                'Type': 'AllWatcher',
+                'Request': 'Stop',
+                'Id': watcher_id,
+                'Params': {},
+            })
+        if not (self.sessions or self._logins):
+            self._close()
+
+    def on_message(self, message):
+        """Hook called when a new message is received from the Juju API."""
+        if message is None:
+            # The Juju API closed the connection.
+            return self._close()
+        data = json_decode_dict(message)
+        if data is None:
+            return
+        request_id = data.get('RequestId')
+        if request_id == self._login_request_id:
+            return self._on_login(data)
+        if request_id == self._watch_request_id:
+            return self._on_watch_all(data)
+        if request_id == self._next_request_id:
+            return self._on_next(data)
+        if request_id in self._discarded:
+            self._discarded.remove(request_id)
+            return
+        if request_id not in self._requests:
+            logging.warning(
+                'multiplex: unexpected response: {!r}'.format(message))
+            return
+        session, data['RequestId'] = self._requests.pop(request_id)
+        session.deliver(data)
+
+    def _on_login(self, data):
+        """Handle the response to the upstream login request."""
+        logins, self._logins = self._logins, []
+        if self._backend.login_succeeded(data):
+            self._login_response = data
+        for login in logins:
+            self._complete_login(login, data)
+        if self._login_response is None:
+            # Do not reuse a connection on which the login failed.
+            self._close()
+
+    def _on_watch_all(self, data):
+        """Handle the response to the upstream WatchAll request."""
+        self._watch_request_id = None
+        if 'Error' in data:
+            logging.error(
+                'multiplex: WatchAll error: {}'.format(data['Error']))
+            return self._state.close(data['Error'])
+        self._watcher_id = data['Response']['AllWatcherId']
+        self._request_next()
+
+    def _on_next(self, data):
+        """Handle the response to the upstream AllWatcher.Next request."""
+        self._next_request_id = None
+        if 'Error' in data:
+            logging.error(
+                'multiplex: AllWatcher error: {}'.format(data['Error']))
+            self._watcher_id = None
+            return self._state.close(data['Error'])
+        self._state.apply(data['Response']['Deltas'])
+        if self._state is not None:
+            self._request_next()
+
+    def detach(self, session):
+        """Remove the given session from this upstream connection.
+
+        Close the connection if no sessions are left and the connection is not
+        feeding an environment state.
+        """
+        self.sessions.pop(session.session_id, None)
+        for request_id, (owner, _) in self._requests.items():
+            if owner is session:
+                del self._requests[request_id]
+        if not (self.sessions or self._logins) and self._state is None:
+            self._close()
+
+    def _close(self, error=None):
+        """Close the upstream connection and terminate all the sessions.
+
+        Pending logins are failed with the given error, if provided.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._on_close(self)
+        if self._connection is not None:
+            self._connection.close()
+        if error is None:
+            error = IOError('Juju API connection closed')
+        logins, self._logins = self._logins, []
+        for _, _, future in logins:
+            future.set_exception(error)
+        sessions, self.sessions = self.sessions.values(), {}
+        for session in sessions:
+            session.terminate()
+        if self._state is not None:
+            self._state.close('Juju API connection closed')
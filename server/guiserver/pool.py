@@ -0,0 +1,187 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server pre-warmed upstream connections pool.
+
+Establishing a WebSocket connection to the Juju API requires a TCP connection,
+a TLS handshake and a WebSocket handshake: browser messages are queued in the
+meanwhile. The pool keeps a few idle unauthenticated connections ready for
+each Juju API address and origin, so that new browser sessions can start
+talking to Juju straight away. The pool is refilled in the background each
+time a connection is requested, and idle connections are closed after a
+configurable amount of time, so that pools which are not used drain.
+"""
+
+import collections
+import datetime
+import functools
+import logging
+
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.clients import websocket_connect
+from guiserver.utils import add_future
+
+
+# The default number of idle connections kept for each Juju API address.
+DEFAULT_SIZE = 2
+# The default number of seconds after which idle connections are closed.
+DEFAULT_MAX_IDLE = 300
+
+_hits = metrics.counter(
+    'upstream_pool_hits',
+    'The Juju API connections served from the pool.')
+_misses = metrics.counter(
+    'upstream_pool_misses',
+    'The Juju API connections established on demand.')
+
+
+def _ignore_message(message):
+    """Discard messages received by connections not yet in the pool."""
+
+
+class ConnectionPool(object):
+    """A pool of pre-connected WebSocket connections to the Juju API.
+
+    Note that the pool is instantiated once when the application is
+    bootstrapped and used as a singleton by all WebSocket requests.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                 io_loop=None, connect=None):
+        """Initialize the pool.
+
+        The connect argument, if provided, is the function used to establish
+        new connections. It receives the same arguments as
+        ConnectionPool.connect. By default guiserver.clients.websocket_connect
+        is used.
+        """
+        self._size = size
+        self._connect = connect
+        self._max_idle = datetime.timedelta(seconds=max_idle)
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        # The idle attribute maps (url, headers) keys to deques of
+        # (connection, timeout) tuples, the oldest connection first.
+        self._idle = {}
+        # The connecting attribute maps keys to the number of connections
+        # being established.
+        self._connecting = collections.Counter()
+
+    def connect(self, url, on_message_callback, headers=None):
+        """Return a Future whose result is a connection to the Juju API.
+
+        Receive the same arguments as guiserver.clients.websocket_connect,
+        except for the IO loop. Use an idle connection if available.
+        """
+        if headers is None:
+            headers = {}
+        key = (url, tuple(sorted(headers.items())))
+        idle = self._idle.get(key)
+        connection = None
+        while idle and connection is None:
+            connection, timeout = idle.popleft()
+            self._io_loop.remove_timeout(timeout)
+            if connection.stream.closed():
+                connection = None
+        if connection is None:
+            _misses.inc()
+            future = self._establish(url, on_message_callback, headers)
+        else:
+            _hits.inc()
+            connection.set_message_callback(on_message_callback)
+            # The connect Future is already done: its result is the connection.
+            future = connection.connect_future
+        self._fill(key, url, headers)
+        return future
+
+    def _establish(self, url, on_message_callback, headers):
+        """Return a Future whose result is a new Juju API connection."""
+        if self._connect is None:
+            return websocket_connect(
+                self._io_loop, url, on_message_callback, headers=headers)
+        return self._connect(url, on_message_callback, headers=headers)
+
+    def _fill(self, key, url, headers):
+        """Start connecting until the pool for the given key is full."""
+        idle = self._idle.setdefault(key, collections.deque())
+        while len(idle) + self._connecting[key] < self._size:
+            self._connecting[key] += 1
+            future = self._establish(url, _ignore_message, headers)
+            add_future(self._io_loop, future, self._on_connected, key)
+
+    def _on_connected(self, key, future):
+        """Add the newly established connection to the pool."""
+        self._connecting[key] -= 1
+        try:
+            connection = future.result()
+        except Exception as err:
+            logging.error('pool: unable to connect to the Juju API')
+            logging.exception(err)
+            return self._cleanup(key)
+        timeout = self._io_loop.add_timeout(
+            self._max_idle, functools.partial(self._expire, key, connection))
+        connection.set_message_callback(
+            functools.partial(self._on_idle_message, key, connection))
+        self._idle[key].append((connection, timeout))
+
+    def _on_idle_message(self, key, connection, message):
+        """Handle messages received by idle connections.
+
+        Idle connections are not expected to receive messages: remove the
+        connection from the pool if closed by the Juju API.
+        """
+        if message is None:
+            self._discard(key, connection)
+
+    def _expire(self, key, connection):
+        """Close the given connection, idle for too long."""
+        self._discard(key, connection)
+        connection.set_message_callback(_ignore_message)
+        connection.close()
+
+    def _discard(self, key, connection):
+        """Remove the given connection from the pool."""
+        idle = self._idle.get(key, ())
+        for item in idle:
+            if item[0] is connection:
+                idle.remove(item)
+                self._io_loop.remove_timeout(item[1])
+                break
+        self._cleanup(key)
+
+    def _cleanup(self, key):
+        """Forget the given key if there are no connections for it."""
+        if not (self._idle.get(key) or self._connecting[key]):
+            self._idle.pop(key, None)
+            self._connecting.pop(key, None)
+
+    def status(self):
+        """Return a dict describing the pool usage."""
+        hits, misses = _hits.value, _misses.value
+        requests = hits + misses
+        idle = collections.Counter()
+        for (url, _), connections in self._idle.items():
+            idle[url] += len(connections)
+        return {
+            'size': self._size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / requests if requests else None,
+            'idle': dict(idle),
+        }
@@ -0,0 +1,155 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server support for HTTP range requests (RFC 7233).
+
+Browsers resume interrupted downloads of large charm archives by requesting
+the missing byte ranges. Range requests are forwarded to juju-core, and the
+charm files stored in the disk cache (see guiserver.charmcache) are served
+by range by the juju-core proxy handler.
+
+    - requested_ranges: return the byte ranges to be sent to the browser;
+    - content_range: return the Content-Range header value for a range;
+    - MultipartRanges: the layout of a multipart/byteranges response body.
+"""
+
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
+import uuid
+
+
+# The maximum number of ranges served in a single response: larger sets of
+# ranges are ignored, and the whole content is sent.
+MAX_RANGES = 16
+
+
+def requested_ranges(request, size, etag=None, last_modified=None):
+    """Return the byte ranges of the content requested by the browser.
+
+    Receive the browser request (usually a tornado.httpserver.HTTPRequest),
+    the size of the content and its ETag and Last-Modified validators.
+    Ranges are (start, stop) tuples, stop excluded, sorted by offset:
+    overlapping and adjacent ranges are coalesced.
+
+    Return None if the whole content must be sent, i.e. if no ranges are
+    requested, if the Range header is not valid or requests too many ranges,
+    or if the If-Range condition fails. Return an empty list if none of the
+    requested ranges can be satisfied.
+    """
+    header = request.headers.get('Range')
+    if header is None or request.method != 'GET':
+        return None
+    if not _if_range_matches(request, etag, last_modified):
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, separator, last = [part.strip() for part in spec.partition('-')]
+        if not separator or not (first or last):
+            return None
+        if not all(part.isdigit() for part in (first, last) if part):
+            return None
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            stop = int(last) + 1 if last else size
+        else:
+            # A suffix range, requesting the final bytes of the content.
+            start, stop = max(size - int(last), 0), size
+            if start == stop:
+                continue
+        if start < size:
+            ranges.append((start, min(stop, size)))
+    return _coalesce(ranges)
+
+
+def _if_range_matches(request, etag, last_modified):
+    """Return True if the Range header of the given request can be honored.
+
+    As required by RFC 7233, the If-Range entity tag is compared using the
+    strong comparison, and the date must exactly match the last modification.
+    """
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return (
+            etag is not None and
+            not if_range.startswith('W/') and
+            if_range == etag.strip())
+    if last_modified is None:
+        return False
+    date, modified = map(parsedate_tz, (if_range, last_modified))
+    if date is None or modified is None:
+        return False
+    return mktime_tz(date) == mktime_tz(modified)
+
+
+def _coalesce(ranges):
+    """Sort the given ranges, merging the overlapping and adjacent ones."""
+    coalesced = []
+    for start, stop in sorted(ranges):
+        if coalesced and start <= coalesced[-1][1]:
+            previous_start, previous_stop = coalesced[-1]
+            coalesced[-1] = (previous_start, max(previous_stop, stop))
+        else:
+            coalesced.append((start, stop))
+    return coalesced
+
+
+def content_range(start, stop, size):
+    """Return the Content-Range header value for the given range."""
+    return 'bytes {}-{}/{}'.format(start, stop - 1, size)
+
+
+class MultipartRanges(object):
+    """The layout of a multipart/byteranges response body.
+
+    The body is composed of a part for each range, introduced by its own
+    headers, followed by the closing boundary.
+    """
+
+    def __init__(self, ranges, size, content_type=None):
+        """Initialize the layout.
+
+        Receive the list of (start, stop) ranges, the size of the whole
+        content and its content type, if known.
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/byteranges; boundary={}'.format(
+            boundary)
+        headers = '\r\n--{}\r\n'.format(boundary)
+        if content_type is not None:
+            headers += 'Content-Type: {}\r\n'.format(content_type)
+        # A list of (headers, start, stop) tuples.
+        self.parts = [
+            (headers + 'Content-Range: {}\r\n\r\n'.format(
+                content_range(start, stop, size)), start, stop)
+            for start, stop in ranges
+        ]
+        self.closing = '\r\n--{}--\r\n'.format(boundary)
+        # The size in bytes of the resulting body.
+        self.length = len(self.closing) + sum(
+            len(part_headers) + stop - start
+            for part_headers, start, stop in self.parts)
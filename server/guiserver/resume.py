@@ -0,0 +1,254 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server browser session resumption.
+
+Reloading the GUI closes the browser WebSocket connection and, with it, the
+connection to the Juju API: the new page must then wait for a TLS handshake,
+a login and a new AllWatcher. When session resumption is enabled, browsers
+can ask the GUI server for a resume token:
+
+    {
+        'RequestId': 42,
+        'Type': 'GUISession',
+        'Request': 'Park',
+        'Params': {},
+    }
+
+Here is an example of a successful response:
+
+    {
+        'RequestId': 42,
+        'Response': {'Token': 'TOKEN-STRING', 'Window': 30, 'Resumed': False},
+    }
+
+When the browser disconnects, its authenticated Juju API connection is kept
+open, together with its AllWatcher, for the given number of seconds. The
+AllWatcher deltas sent by Juju in the meanwhile are retained, while the
+responses to the other requests of the disconnected page are discarded, as
+the new page never issued them. A browser connecting with the
+"resume=TOKEN-STRING" query argument within that window adopts the parked
+connection. The token alone does not authenticate the browser: no requests
+are relayed to Juju until the browser sends a login request with the
+credentials of the parked session, which is answered without contacting
+Juju. The retained deltas are sent in response to the first AllWatcher.Next
+request for the AllWatcher of the parked page; if the browser starts a new
+AllWatcher instead, the parked one is stopped. The token is redacted from
+the logged request summaries. The "Resumed" field
+of the park responses tells whether the current session was resumed. Note
+that, when running more than one server process, sessions can only be
+resumed by the process which parked them.
+
+    - ParkedSession: a Juju API connection waiting for its browser;
+    - SessionParking: the registry of parked sessions.
+"""
+
+import collections
+import datetime
+import functools
+import logging
+import uuid
+
+from tornado.ioloop import IOLoop
+
+from guiserver import metrics
+from guiserver.apicache import get_request_id
+
+
+# The default number of seconds sessions are parked.
+DEFAULT_WINDOW = 30
+# The default maximum number of sessions parked at the same time.
+DEFAULT_MAX_SESSIONS = 100
+# The default maximum size of the messages retained for each parked session.
+DEFAULT_MAX_BYTES = 1024 * 1024
+
+_parked = metrics.gauge(
+    'parked_sessions', 'The browser sessions waiting to be resumed.')
+_parked_total = metrics.counter(
+    'sessions_parked', 'The browser sessions parked on disconnection.')
+_resumed = metrics.counter(
+    'sessions_resumed', 'The parked browser sessions resumed.')
+_dropped = metrics.counter(
+    'parked_sessions_dropped',
+    'The parked browser sessions expired, evicted, exceeding the retained '
+    'messages size or disconnected by Juju.')
+
+
+def _ignore_message(message):
+    """Discard messages received by dropped sessions."""
+
+
+class ParkedSession(object):
+    """A Juju API connection waiting for its browser to reconnect."""
+
+    def __init__(
+            self, connection, username, password, login_response,
+            watcher_request=None, watcher_id=None, watcher_pending=False):
+        """Initialize the session.
+
+        Receive the connection to the Juju API, the credentials used to log
+        in and the Juju response to the login request. The watcher_request
+        and watcher_id arguments are the AllWatcher state tracked by the
+        WebSocket handler: the response to the watcher_request, if
+        watcher_pending is True, is the only message retained while the
+        session is parked.
+        """
+        self.connection = connection
+        self.username = username
+        self.password = password
+        self.login_response = login_response
+        self.watcher_request = watcher_request
+        self.watcher_id = watcher_id
+        self.watcher_pending = watcher_pending
+        # The AllWatcher messages received from Juju while parked, and their
+        # size.
+        self.messages = collections.deque()
+        self.size = 0
+
+
+class SessionParking(object):
+    """Keep track of the parked browser sessions.
+
+    Note that the registry is instantiated once when the application is
+    bootstrapped and used as a singleton by all WebSocket requests.
+    """
+
+    def __init__(
+            self, window=DEFAULT_WINDOW, max_sessions=DEFAULT_MAX_SESSIONS,
+            max_bytes=DEFAULT_MAX_BYTES, io_loop=None):
+        """Initialize the registry.
+
+        Sessions are parked for window seconds. When max_sessions are already
+        parked, the oldest one is dropped. Sessions retaining more than
+        max_bytes characters of Juju messages are dropped.
+        """
+        self.window = window
+        self._max_sessions = max_sessions
+        self._max_bytes = max_bytes
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        # The sessions attribute maps tokens to (session, timeout) tuples,
+        # the oldest session first.
+        self._sessions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def park_requested(self, data):
+        """Does data represent a park request?  True or False."""
+        return (
+            'RequestId' in data and
+            data.get('Type') == 'GUISession' and
+            data.get('Request') == 'Park'
+        )
+
+    def process_park_request(self, data, user, resumed, write_message):
+        """Create a resume token and send it back.
+
+        Return the token, or None if the user is not authenticated. The
+        resumed flag reports whether the current session was resumed.
+        """
+        if not user.is_authenticated:
+            write_message(dict(
+                RequestId=data['RequestId'],
+                Error='sessions can only be parked by authenticated users.',
+                ErrorCode='unauthorized access',
+                Response={}))
+            return None
+        token = uuid.uuid4().hex
+        write_message({
+            'RequestId': data['RequestId'],
+            'Response': {
+                'Token': token,
+                'Window': self.window,
+                'Resumed': resumed,
+            },
+        })
+        return token
+
+    def park(self, token, session):
+        """Park the given session under the given token.
+
+        From now on, the AllWatcher deltas received from Juju are retained
+        until the session is resumed or dropped.
+        """
+        while len(self._sessions) >= self._max_sessions:
+            oldest = next(iter(self._sessions))
+            logging.info('resume: evicting session {}'.format(oldest))
+            self._drop(oldest)
+        timeout = self._io_loop.add_timeout(
+            datetime.timedelta(seconds=self.window),
+            functools.partial(self._expire, token))
+        session.connection.set_message_callback(
+            functools.partial(self._on_message, token))
+        self._sessions[token] = (session, timeout)
+        _parked_total.inc()
+        _parked.set(len(self._sessions))
+
+    def resume(self, token):
+        """Return the session parked under the given token.
+
+        Return None if the token is unknown or the session has been dropped.
+        The caller is responsible for setting the connection message
+        callback.
+        """
+        item = self._sessions.pop(token, None)
+        if item is None:
+            return None
+        session, timeout = item
+        self._io_loop.remove_timeout(timeout)
+        _resumed.inc()
+        _parked.set(len(self._sessions))
+        return session
+
+    def _on_message(self, token, message):
+        """Retain the AllWatcher deltas received by the parked session.
+
+        Discard the responses to the other requests of the disconnected page.
+        """
+        if message is None:
+            logging.info('resume: session {} disconnected'.format(token))
+            return self._drop(token, close=False)
+        session = self._sessions[token][0]
+        request = session.watcher_request
+        if not session.watcher_pending or (
+                get_request_id(message) != request.get('RequestId')):
+            return
+        session.watcher_pending = False
+        session.messages.append(message)
+        session.size += len(message)
+        if session.size > self._max_bytes:
+            logging.info('resume: session {} is too large'.format(token))
+            self._drop(token)
+
+    def _expire(self, token):
+        """Drop the session, not resumed in time."""
+        logging.info('resume: session {} expired'.format(token))
+        self._drop(token)
+
+    def _drop(self, token, close=True):
+        """Forget the session parked under the given token.
+
+        Also close its Juju API connection if close is True.
+        """
+        session, timeout = self._sessions.pop(token)
+        self._io_loop.remove_timeout(timeout)
+        connection = session.connection
+        connection.set_message_callback(_ignore_message)
+        if close:
+            connection.close()
+        _dropped.inc()
+        _parked.set(len(self._sessions))
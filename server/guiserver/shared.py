@@ -0,0 +1,222 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server state shared between processes.
+
+When the GUI server runs multiple worker processes (see the --processes
+option), requests from the same browser can be handled by different workers.
+This module includes the pieces used to coordinate the workers.
+
+Stores are used to save single-use tokens, e.g. authentication tokens. They
+are key/value stores whose entries expire after a given time, and implement
+the following interface:
+    - put(key, value, ttl): store value for ttl seconds;
+    - pop(key) -> value or None: remove the entry and return its value, only
+      if the entry is not expired;
+    - len(store) -> int: return the number of entries not expired.
+Stores remove expired entries by themselves, without requiring IO loop
+timeouts. The following stores are available:
+
+    - MemoryStore: entries are stored in memory, and are only available to
+      the current process.
+    - SharedStore: entries are stored in a SQLite database, so that all the
+      processes opening the same database file see the same entries. The
+      database is intended to live in memory (tmpfs), e.g. in /dev/shm.
+    - FileLock: an exclusive lock held by one process at the time, implemented
+      using flock on a lock file.
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import sqlite3
+import time
+
+
+# The number of seconds a process waits for the database to be unlocked.
+_DATABASE_TIMEOUT = 5
+
+
+class MemoryStore(object):
+    """A key/value store local to the current process.
+
+    Each entry is set with a time to live, after which the entry is no longer
+    returned. Expired entries are removed when the store is used.
+    """
+
+    def __init__(self):
+        # Map keys to (value, expiration time) tuples.
+        self._data = {}
+        # A heap of (expiration time, key) tuples.
+        self._expirations = []
+
+    def _expire(self, now):
+        """Remove the entries expired at the given time."""
+        expirations = self._expirations
+        while expirations and expirations[0][0] <= now:
+            expires, key = heapq.heappop(expirations)
+            entry = self._data.get(key)
+            # The entry could have been replaced in the meanwhile.
+            if entry is not None and entry[1] == expires:
+                del self._data[key]
+
+    def put(self, key, value, ttl):
+        """Store the given value for key, for ttl seconds."""
+        now = time.time()
+        self._expire(now)
+        expires = now + ttl
+        self._data[key] = (value, expires)
+        heapq.heappush(self._expirations, (expires, key))
+
+    def pop(self, key):
+        """Remove the entry for key and return its value.
+
+        Return None if the entry does not exist or is expired.
+        """
+        entry = self._data.pop(key, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def __len__(self):
+        """Return the number of entries which are not expired."""
+        self._expire(time.time())
+        return len(self._data)
+
+
+class SharedStore(object):
+    """A key/value store shared between processes.
+
+    Values must be JSON serializable. Each entry is set with a time to live,
+    after which the entry is no longer returned. Expired entries are removed
+    from the database when new entries are added, so that no timeouts are
+    required to expire them.
+    """
+
+    def __init__(self, path, table='entries'):
+        """Initialize the store.
+
+        The path argument is the path of the SQLite database file, created if
+        it does not exist. Multiple stores can share the same database file
+        using different table names.
+        """
+        self._path = path
+        self._table = table
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        """Return the database connection for the current process.
+
+        SQLite connections must not be shared with forked processes: a new
+        connection is created if the process changed.
+        """
+        pid = os.getpid()
+        if self._connection is None or self._pid != pid:
+            connection = sqlite3.connect(
+                self._path, timeout=_DATABASE_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'expires REAL NOT NULL)'.format(self._table))
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_expires '
+                'ON {0} (expires)'.format(self._table))
+            self._connection = connection
+            self._pid = pid
+        return self._connection
+
+    def put(self, key, value, ttl):
+        """Store the given value for key, for ttl seconds."""
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'DELETE FROM {} WHERE expires <= ?'.format(self._table),
+                (now,))
+            connection.execute(
+                'INSERT OR REPLACE INTO {} (key, value, expires) '
+                'VALUES (?, ?, ?)'.format(self._table),
+                (key, json.dumps(value), now + ttl))
+
+    def pop(self, key):
+        """Remove the entry for key and return its value.
+
+        Return None if the entry does not exist or is expired. The entry is
+        returned at most once, even if multiple processes pop it concurrently.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                'SELECT value, expires FROM {} WHERE key = ?'.format(
+                    self._table),
+                (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'DELETE FROM {} WHERE key = ?'.format(self._table), (key,))
+        value, expires = row
+        if expires <= time.time():
+            return None
+        return json.loads(value)
+
+    def __len__(self):
+        """Return the number of entries which are not expired."""
+        row = self._connect().execute(
+            'SELECT COUNT(*) FROM {} WHERE expires > ?'.format(self._table),
+            (time.time(),)).fetchone()
+        return row[0]
+
+
+class FileLock(object):
+    """An exclusive lock shared between processes.
+
+    Use it as a context manager, e.g.:
+
+        with FileLock('/path/to/file.lock'):
+            # Only one process at the time executes this block.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def acquire(self):
+        """Acquire the lock, blocking until it is available."""
+        lock_file = open(self._path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except Exception:
+            lock_file.close()
+            raise
+        self._file = lock_file
+
+    def release(self):
+        """Release the lock."""
+        lock_file, self._file = self._file, None
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,326 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Juju GUI server streaming of proxied HTTP requests and responses.
+
+This module includes the following classes:
+- ResponseStream: relay an upstream HTTP response to the browser as it arrives;
+- UploadStream: send a browser request body upstream, tracking its progress.
+"""
+
+from io import BytesIO
+import logging
+import time
+
+from tornado import (
+    httpclient,
+    httputil,
+)
+
+from guiserver import metrics
+from guiserver.utils import end_to_end_headers
+
+try:
+    import pycurl
+except ImportError:
+    # The curl HTTP client is not available: responses are still streamed,
+    # but upstream transfers cannot be paused.
+    pycurl = None
+
+
+# The default maximum number of bytes of a proxied response which can be
+# waiting to be sent to the browser before the upstream transfer is paused.
+DEFAULT_MAX_BUFFER = 256 * 1024
+# The content encodings removed from the response body by the HTTP client.
+_DECODED_ENCODINGS = frozenset(['gzip', 'deflate'])
+
+_streamed_bytes = metrics.counter(
+    'proxy_streamed_bytes',
+    'The proxied response bytes streamed to browsers.')
+_paused_transfers = metrics.counter(
+    'proxy_paused_transfers',
+    'The times an upstream transfer has been paused for a slow browser.')
+_uploads_in_flight = metrics.gauge(
+    'proxy_uploads_in_flight',
+    'The request bodies being sent upstream by the HTTP proxy.')
+_uploaded_bytes = metrics.counter(
+    'proxy_uploaded_bytes',
+    'The request body bytes sent upstream by the HTTP proxy.')
+_upload_throughput = metrics.summary(
+    'proxy_upload_throughput',
+    'The throughput of the completed uploads, in bytes per second.')
+# The uploads in progress.
+_uploads = set()
+
+
+def relayed_headers(headers):
+    """Return the (name, value) pairs of the given upstream response headers
+    which can be relayed to the browser.
+
+    Hop-by-hop headers are never relayed. The content encoding and length are
+    not relayed either if the HTTP client decoded the body.
+    """
+    headers = end_to_end_headers(headers)
+    skipped = ()
+    if headers.get('Content-Encoding', '').lower() in _DECODED_ENCODINGS:
+        skipped = ('Content-Encoding', 'Content-Length')
+    return [
+        (key, value) for key, value in headers.items() if key not in skipped]
+
+
+def _is_success(code):
+    """Return True if the given HTTP status code reports a success."""
+    return code is not None and 200 <= code < 300
+
+
+class ResponseStream(object):
+    """Relay an upstream HTTP response to a request handler as it arrives.
+
+    The stream is attached to the upstream httpclient.HTTPRequest. Successful
+    responses are written to the handler chunk by chunk, and each chunk is
+    flushed to the browser straight away. Other responses are buffered, so
+    that the handler can process them as usual when the fetch completes.
+
+    When the curl HTTP client is in use, the upstream transfer is paused if
+    more than max_buffer bytes are waiting to be sent to the browser, and it
+    is resumed as soon as they are written to the socket. This way the memory
+    used by each proxied request is bounded regardless of the response size.
+
+    Before streaming, the handler should_relay(code, headers) method is called
+    with the upstream response status and headers: if it returns False, the
+    response is not relayed, and the body is only passed to the sink. Then
+    the handler check_not_modified(headers) method is called: if it returns
+    True, the browser copy of the response is still valid, and the body is
+    not sent.
+
+    If a sink is provided, the streamed body is also passed to it. A sink has
+    a headers dict, added to the streamed response, and write(chunk),
+    commit(code, headers) and abort() methods: commit is called if the
+    response has been completely streamed, abort otherwise.
+    """
+
+    def __init__(self, handler, max_buffer=DEFAULT_MAX_BUFFER, sink=None):
+        self.handler = handler
+        self.max_buffer = max_buffer
+        self.sink = sink
+        # The status code and headers of the upstream response.
+        self.code = None
+        self.headers = httputil.HTTPHeaders()
+        # Whether a successful response is being streamed.
+        self.streaming = False
+        # Whether the streamed response is relayed to the browser.
+        self.relayed = False
+        # Whether the browser copy of the relayed response is still valid.
+        self.not_modified = False
+        # Whether the browser connection has been closed.
+        self.closed = False
+        self._chunks = []
+        self._pending = 0
+        self._paused = False
+        self._curl = None
+
+    @property
+    def paused(self):
+        """Whether the upstream transfer waits for the browser to read."""
+        return self._paused
+
+    def attach(self, request):
+        """Set up the given httpclient.HTTPRequest to use this stream."""
+        request.header_callback = self._on_header
+        request.streaming_callback = self._on_chunk
+        request.prepare_curl_callback = self._on_curl
+
+    def close(self):
+        """Stop relaying data: the browser connection has been closed.
+
+        The upstream transfer is aborted when the next chunk is received.
+        """
+        self.closed = True
+        self._resume()
+
+    def get_response(self, response):
+        """Return the given completed upstream response.
+
+        If the response has not been streamed, the returned response includes
+        the buffered headers and body.
+        """
+        if self.code is None:
+            # The response callbacks have not been called.
+            return response
+        return httpclient.HTTPResponse(
+            response.request, response.code, headers=self.headers,
+            buffer=BytesIO(b''.join(self._chunks)),
+            effective_url=response.effective_url,
+            request_time=response.request_time, reason=response.reason)
+
+    def finish(self, completed):
+        """The upstream transfer ended, successfully if completed is True."""
+        self._curl = None
+        sink = self.sink
+        if sink is not None:
+            if completed and self.streaming:
+                sink.commit(self.code, self.headers)
+            else:
+                sink.abort()
+
+    def _on_curl(self, curl):
+        """Store the curl handle used to fetch the upstream response."""
+        self._curl = curl
+
+    def _on_header(self, line):
+        """Parse a response header line."""
+        if line.startswith('HTTP/'):
+            # A new response starts: this also happens when redirects are
+            # followed or when a 100 Continue response is received.
+            self.code = int(line.split()[1])
+            self.headers = httputil.HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+
+    def _on_chunk(self, chunk):
+        """Relay or buffer a chunk of the response body.
+
+        Return a value requesting curl to pause or abort the transfer when
+        required.
+        """
+        if self.closed:
+            # Returning a wrong size makes curl abort the transfer.
+            return 0
+        if not self.streaming:
+            if not _is_success(self.code):
+                self._chunks.append(chunk)
+                return
+            self._start()
+        if self.not_modified or not self.relayed:
+            # The body is not sent to the browser, but the sink still needs
+            # it.
+            if self.sink is not None:
+                self.sink.write(chunk)
+            return
+        if self._pending >= self.max_buffer and self._curl is not None:
+            # The chunk will be delivered again when the transfer is resumed.
+            self._paused = True
+            _paused_transfers.inc()
+            return pycurl.WRITEFUNC_PAUSE
+        self._pending += len(chunk)
+        _streamed_bytes.inc(len(chunk))
+        self.handler.write(chunk)
+        self.handler.flush(callback=self._on_flush)
+        if self.sink is not None:
+            self.sink.write(chunk)
+
+    def _start(self):
+        """Send the response status and headers to the browser."""
+        self.streaming = True
+        handler = self.handler
+        if not handler.should_relay(self.code, self.headers):
+            return
+        self.relayed = True
+        handler.set_status(self.code)
+        for key, value in relayed_headers(self.headers):
+            handler.set_header(key, value)
+        if self.sink is not None:
+            for key, value in self.sink.headers.items():
+                handler.set_header(key, value)
+        self.not_modified = handler.check_not_modified(self.headers)
+
+    def _on_flush(self):
+        """The data written so far has been sent to the browser."""
+        self._pending = 0
+        self._resume()
+
+    def _resume(self):
+        """Resume the upstream transfer if it is paused."""
+        if self._paused:
+            self._paused = False
+            self._curl.pause(pycurl.PAUSE_CONT)
+
+
+class UploadStream(object):
+    """Send the body of a proxied request upstream, tracking its progress.
+
+    When the curl HTTP client is in use, the body is handed to curl slice by
+    slice as the transfer proceeds, so that the bytes actually sent upstream
+    can be tracked. This does not reduce memory usage in any significant way:
+    Tornado reads and buffers the whole request body before calling the
+    handler, and the body is kept in memory until the upload completes. The
+    memory used by uploads is bounded by the --uploadmaxsize option instead.
+    """
+
+    def __init__(self, url, body):
+        self.url = url
+        self.body = body
+        self.size = len(body)
+        # The number of bytes sent upstream so far.
+        self.sent = 0
+        self.start_time = None
+        self._offset = 0
+
+    def attach(self, request):
+        """Set up the given httpclient.HTTPRequest to use this stream.
+
+        Also start tracking the upload progress.
+        """
+        prepare_curl = request.prepare_curl_callback
+
+        def prepare_curl_callback(curl):
+            if prepare_curl is not None:
+                prepare_curl(curl)
+            curl.setopt(pycurl.READFUNCTION, self.read)
+            curl.setopt(pycurl.IOCTLFUNCTION, self._ioctl)
+        request.prepare_curl_callback = prepare_curl_callback
+        self.start_time = time.time()
+        _uploads.add(self)
+        _uploads_in_flight.inc()
+
+    def read(self, size):
+        """Return the next slice of the body, at most size bytes long."""
+        offset = self._offset
+        chunk = self.body[offset:offset + size]
+        self._offset = offset = offset + len(chunk)
+        if offset > self.sent:
+            _uploaded_bytes.inc(offset - self.sent)
+            self.sent = offset
+        return chunk
+
+    def finish(self):
+        """Stop tracking the upload progress and record its throughput."""
+        _uploads.discard(self)
+        _uploads_in_flight.dec()
+        elapsed = time.time() - self.start_time
+        if elapsed and self.sent:
+            _upload_throughput.observe(self.sent / elapsed)
+        logging.debug('streaming: sent {} of {} bytes to {} in {:.3f}s'.format(
+            self.sent, self.size, self.url.encode('utf-8'), elapsed))
+
+    def status(self):
+        """Return a dict describing the upload progress."""
+        return {
+            'url': self.url,
+            'size': self.size,
+            'sent': self.sent,
+            'elapsed': time.time() - self.start_time,
+        }
+
+    def _ioctl(self, command):
+        """Rewind the body when curl needs to send it again."""
+        if command == pycurl.IOCMD_RESTARTREAD:
+            self._offset = 0
+
+
+def uploads_status():
+    """Return the progress of the uploads in progress, oldest first."""
+    uploads = sorted(_uploads, key=lambda upload: upload.start_time)
+    return [upload.status() for upload in uploads]
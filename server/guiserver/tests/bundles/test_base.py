@@ -16,6 +16,10 @@
 
 """Tests for the bundle deployment base objects."""
 
+import os
+import shutil
+import tempfile
+
 from deployer import cli as deployer_cli
 import jujuclient
 import mock
@@ -110,6 +114,16 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
             self.apiurl, self.user.username, self.user.password, self.bundle)
         mock_validate.assert_called_in_a_separate_process()
 
+    @gen_test
+    def test_validation_metrics(self):
+        # The validation time is recorded.
+        deployer = self.make_deployer()
+        histogram = base._validation_time
+        count = histogram.count
+        with self.patch_validate():
+            yield deployer.validate(self.user, self.bundle)
+        self.assertEqual(count + 1, histogram.count)
+
     @gen_test
     def test_unsupported_api_version(self):
         # An error message is returned the API version is not supported.
@@ -143,6 +157,39 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
             self.bundle, self.version, deployer.importer_options)
         mock_import_bundle.assert_called_in_a_separate_process()
 
+    def test_import_bundle_lock(self):
+        # If a lock path is provided, the deployment is executed holding the
+        # lock shared with the other server processes.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lock_path = os.path.join(directory, 'deployer.lock')
+        deployer = base.Deployer(self.apiurl, 'go', lock_path=lock_path)
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        # Wait for the deployment to be completed.
+        self.wait()
+        mock_import_bundle.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, 'bundle',
+            self.bundle, self.version, deployer.importer_options)
+        self.assertTrue(os.path.exists(lock_path))
+
+    def test_import_bundle_metrics(self):
+        # The deployment queue and the import time are tracked.
+        deployer = self.make_deployer()
+        histogram = base._import_time
+        count = histogram.count
+        with self.patch_import_bundle():
+            deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        self.assertEqual(1, base._queue_depth.value)
+        # Wait for the deployment to be completed.
+        self.wait()
+        self.assertEqual(0, base._queue_depth.value)
+        self.assertEqual(count + 1, histogram.count)
+
     def test_options_are_fully_populated(self):
         # The options passed to the deployer match what it expects and are not
         # missing any entries.
@@ -16,6 +16,10 @@
 
 """Tests for the bundle deployment views."""
 
+import os
+import shutil
+import tempfile
+
 import mock
 from tornado import concurrent
 from tornado.testing import(
@@ -26,6 +30,7 @@ from tornado.testing import(
 )
 import yaml
 
+from guiserver import shared
 from guiserver.bundles import views
 from guiserver.tests import helpers
 
@@ -752,6 +757,35 @@ class TestSetChanges(
         response = yield views.get_changes(request)
         self.assertEqual(expected_response, response)
 
+    @gen_test
+    def test_shared_store(self):
+        # Change sets can be stored in a store shared between processes.
+        content = yaml.safe_dump({
+            'services': {'django': {'charm': 'cs:trusty/django-42'}},
+        })
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'shared.db')
+        request = self.make_view_request(
+            params={'YAML': content},
+            store=shared.SharedStore(path, table='changesets'))
+        response = yield self.view(request)
+        token = response['Response']['Token']
+        self.assertIsNone(views._bundle_changesets.pop(token))
+        # The change set can be retrieved using another store instance, e.g.
+        # in another process.
+        request = self.make_view_request(
+            params={'Token': token},
+            store=shared.SharedStore(path, table='changesets'))
+        response = yield views.get_changes(request)
+        self.assertEqual(
+            ['addCharm-0', 'addService-1'],
+            [change['id'] for change in response['Response']['Changes']])
+        # The token can only be used once.
+        response = yield views.get_changes(request)
+        self.assertEqual(
+            'unknown, fulfilled, or expired bundle token', response['Error'])
+
     @gen_test
     def test_invalid_parameters(self):
         # An error response is returned if the parameters in the request are
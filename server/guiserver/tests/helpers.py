@@ -119,8 +119,8 @@ class GoAPITestMixin(object):
                                  token='DEFACED', username=None,
                                  password=None):
         if username is not None and password is not None:
-            tokens._data[token] = dict(
-                username=username, password=password, handle="handle")
+            credentials = dict(username=username, password=password)
+            tokens._store.put(token, credentials, 60)
         return dict(
             RequestId=request_id, Type='GUIToken', Request='Login',
             Params={'Token': token})
@@ -135,10 +135,11 @@ class BundlesTestMixin(object):
         """Create and return a Deployer instance."""
         return base.Deployer(self.apiurl, apiversion)
 
-    def make_view_request(self, params=None, is_authenticated=True):
+    def make_view_request(
+            self, params=None, is_authenticated=True, store=None):
         """Create and return a mock request to be passed to bundle views.
 
-        The resulting request contains the given parameters and a
+        The resulting request contains the given parameters and store, and a
         guiserver.auth.User instance.
         If is_authenticated is True, the user in the request is logged in.
         """
@@ -147,7 +148,7 @@ class BundlesTestMixin(object):
         user = auth.User(
             username='user', password='passwd',
             is_authenticated=is_authenticated)
-        return mock.Mock(params=params, user=user)
+        return mock.Mock(params=params, user=user, store=store)
 
     def make_deployment_request(
             self, request, request_id=42, params=None, encoded=False,
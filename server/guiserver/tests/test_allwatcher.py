@@ -0,0 +1,301 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server shared AllWatcher state."""
+
+import datetime
+import unittest
+
+import mock
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
+
+from guiserver import allwatcher
+from guiserver.watchers import WatcherError
+
+
+class TestEnvironmentState(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestEnvironmentState, self).setUp()
+        self.on_close = mock.Mock()
+        self.state = self.make_state()
+
+    def make_state(self, max_deltas=10, ttl=0, max_entities=10):
+        """Create and return an environment state."""
+        return allwatcher.EnvironmentState(
+            '1', max_deltas, ttl, self.io_loop, self.on_close,
+            max_entities=max_entities)
+
+    def test_snapshot_not_ready(self):
+        # The snapshot is sent when the first deltas are applied.
+        self.state.subscribe('s1')
+        future = self.state.next('s1')
+        self.assertFalse(future.done())
+        self.state.apply([['service', 'change', {'Name': 'django'}]])
+        self.assertTrue(self.state.ready)
+        expected = [['service', 'change', {'Name': 'django'}]], True
+        self.assertEqual(expected, future.result())
+
+    def test_snapshot(self):
+        # The snapshot only includes the current state of existing entities.
+        self.state.apply([
+            ['machine', 'change', {'Id': '0', 'Status': 'pending'}],
+            ['service', 'change', {'Name': 'django'}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ])
+        self.state.apply([
+            ['unit', 'remove', {'Name': 'django/0'}],
+            ['machine', 'change', {'Id': '0', 'Status': 'started'}],
+        ])
+        self.state.subscribe('s1')
+        expected = [
+            ['machine', 'change', {'Id': '0', 'Status': 'started'}],
+            ['service', 'change', {'Name': 'django'}],
+        ], True
+        self.assertEqual(expected, self.state.next('s1').result())
+        self.assertEqual(2, self.state.entities)
+
+    def test_deltas(self):
+        # After the snapshot, subscribers receive the deltas not yet seen.
+        self.state.apply([['service', 'change', {'Name': 'django'}]])
+        self.state.subscribe('s1')
+        self.state.next('s1')
+        future = self.state.next('s1')
+        self.assertFalse(future.done())
+        self.state.apply([['unit', 'change', {'Name': 'django/0'}]])
+        self.state.apply([['unit', 'remove', {'Name': 'django/0'}]])
+        expected = [['unit', 'change', {'Name': 'django/0'}]], False
+        self.assertEqual(expected, future.result())
+        expected = [['unit', 'remove', {'Name': 'django/0'}]], False
+        self.assertEqual(expected, self.state.next('s1').result())
+
+    def test_lagging_subscriber(self):
+        # Subscribers falling behind the deltas log are resynchronized with a
+        # snapshot, preceded by the removal of the entities they have seen.
+        value = allwatcher._resyncs.value
+        state = self.make_state(max_deltas=1)
+        state.apply([
+            ['service', 'change', {'Name': 'django'}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ])
+        state.subscribe('s1')
+        state.next('s1')
+        state.apply([['unit', 'change', {'Name': 'django/1'}]])
+        state.apply([['unit', 'remove', {'Name': 'django/0'}]])
+        state.apply([['unit', 'change', {'Name': 'django/2'}]])
+        state.apply([['unit', 'remove', {'Name': 'django/2'}]])
+        expected = [
+            ['unit', 'remove', {'Name': 'django/0'}],
+            ['unit', 'remove', {'Name': 'django/2'}],
+            ['service', 'change', {'Name': 'django'}],
+            ['unit', 'change', {'Name': 'django/1'}],
+        ], False
+        self.assertEqual(expected, state.next('s1').result())
+        self.assertEqual(value + 1, allwatcher._resyncs.value)
+        # Then the subscriber receives the deltas as usual.
+        state.apply([['unit', 'change', {'Name': 'django/3'}]])
+        expected = [['unit', 'change', {'Name': 'django/3'}]], False
+        self.assertEqual(expected, state.next('s1').result())
+
+    def test_removals_forgotten(self):
+        # Removals are forgotten once all the subscribers have seen them.
+        state = self.make_state(max_deltas=1)
+        state.apply([['unit', 'change', {'Name': 'django/0'}]])
+        state.subscribe('s1')
+        state.subscribe('s2')
+        state.next('s1')
+        state.next('s2')
+        state.apply([['unit', 'remove', {'Name': 'django/0'}]])
+        self.assertEqual(1, len(state._removed))
+        state.next('s1')
+        state.apply([['unit', 'change', {'Name': 'django/1'}]])
+        self.assertEqual(1, len(state._removed))
+        state.next('s2')
+        state.apply([['unit', 'change', {'Name': 'django/2'}]])
+        self.assertEqual(0, len(state._removed))
+
+    def test_removal_of_readded_entity(self):
+        # Entities added again after their removal are not removed.
+        state = self.make_state(max_deltas=1)
+        state.apply([['unit', 'change', {'Name': 'django/0'}]])
+        state.subscribe('s1')
+        state.next('s1')
+        state.apply([['unit', 'remove', {'Name': 'django/0'}]])
+        state.apply([['unit', 'change', {'Name': 'django/0', 'Life': 'x'}]])
+        expected = [['unit', 'change', {'Name': 'django/0', 'Life': 'x'}]]
+        self.assertEqual(expected, state.next('s1').result()[0])
+
+    def test_unknown_entity(self):
+        # Entities without an identifier are not included in the snapshot.
+        with ExpectLog('', 'allwatcher: unknown entity', required=True):
+            self.state.apply([['service', 'change', {'Exposed': True}]])
+        self.assertEqual(0, self.state.entities)
+
+    def test_max_entities(self):
+        # The state is closed if the environment has too many entities.
+        value = allwatcher._oversized.value
+        state = self.make_state(max_entities=2)
+        state.subscribe('s1')
+        future = state.next('s1')
+        state.apply([
+            ['machine', 'change', {'Id': '0'}],
+            ['machine', 'change', {'Id': '1'}],
+        ])
+        self.assertFalse(state.closed)
+        future = state.next('s1')
+        with ExpectLog('', 'allwatcher: too many entities', required=True):
+            state.apply([['machine', 'change', {'Id': '2'}]])
+        self.assertTrue(state.closed)
+        self.assertEqual(
+            'AllWatcher state too large', str(future.exception()))
+        self.assertEqual(0, state.entities)
+        self.assertEqual(value + 1, allwatcher._oversized.value)
+        self.on_close.assert_called_once_with(state)
+
+    def test_max_entities_after_removals(self):
+        # Removed entities do not count towards the maximum.
+        state = self.make_state(max_entities=1)
+        state.apply([
+            ['machine', 'change', {'Id': '0'}],
+            ['machine', 'remove', {'Id': '0'}],
+            ['machine', 'change', {'Id': '1'}],
+        ])
+        self.assertFalse(state.closed)
+        self.assertEqual(1, state.entities)
+
+    def test_not_subscribed(self):
+        # An error is raised if changes are requested without subscribing.
+        with self.assertRaises(WatcherError):
+            self.state.next('s1')
+
+    def test_already_waiting(self):
+        # An error is raised if the subscriber is already waiting.
+        self.state.subscribe('s1')
+        self.state.next('s1')
+        with self.assertRaises(WatcherError):
+            self.state.next('s1')
+
+    def test_unsubscribe(self):
+        # Pending requests are failed, and the state is closed when the last
+        # subscriber leaves.
+        self.state.subscribe('s1')
+        self.state.subscribe('s2')
+        future = self.state.next('s1')
+        self.state.unsubscribe('s1')
+        self.assertIsInstance(future.exception(), WatcherError)
+        self.assertFalse(self.state.closed)
+        self.state.unsubscribe('s2')
+        self.assertTrue(self.state.closed)
+        self.on_close.assert_called_once_with(self.state)
+
+    def test_unsubscribe_ttl(self):
+        # The state is closed after the given grace period.
+        state = self.make_state(ttl=1)
+        state.subscribe('s1')
+        state.unsubscribe('s1')
+        self.assertFalse(state.closed)
+        self.io_loop.add_timeout(datetime.timedelta(seconds=1.1), self.stop)
+        self.wait()
+        self.assertTrue(state.closed)
+
+    def test_resubscribe_within_ttl(self):
+        # The state is not closed if a subscriber joins during the grace
+        # period.
+        state = self.make_state(ttl=0.1)
+        state.subscribe('s1')
+        state.unsubscribe('s1')
+        state.subscribe('s2')
+        self.io_loop.add_timeout(datetime.timedelta(seconds=0.2), self.stop)
+        self.wait()
+        self.assertFalse(state.closed)
+
+    def test_close(self):
+        # Closing the state fails pending and subsequent requests.
+        self.state.subscribe('s1')
+        future = self.state.next('s1')
+        self.state.close('bad wolf')
+        self.assertEqual('bad wolf', str(future.exception()))
+        self.assertEqual('bad wolf', str(self.state.next('s1').exception()))
+        with self.assertRaises(WatcherError):
+            self.state.subscribe('s2')
+        self.on_close.assert_called_once_with(self.state)
+
+
+class TestStateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = allwatcher.StateCache(io_loop=mock.Mock())
+
+    def test_create(self):
+        # New states are stored in the cache.
+        on_close = mock.Mock()
+        state = self.cache.create(('env-uuid', 1), on_close)
+        self.assertIs(state, self.cache.get(('env-uuid', 1)))
+        self.assertEqual('1', state.watcher_id)
+        self.assertEqual(
+            allwatcher.DEFAULT_MAX_ENTITIES, state._max_entities)
+        expected = [{
+            'environment': 'env-uuid',
+            'upstream': 1,
+            'entities': 0,
+            'ready': False,
+            'subscribers': 0,
+        }]
+        self.assertEqual(expected, self.cache.status())
+        self.assertFalse(on_close.called)
+
+    def test_eviction(self):
+        # Closed states are removed from the cache.
+        on_close = mock.Mock()
+        state = self.cache.create(('env-uuid', 1), on_close)
+        state.close()
+        self.assertIsNone(self.cache.get(('env-uuid', 1)))
+        self.assertEqual([], self.cache.status())
+        on_close.assert_called_once_with(state)
+
+    def test_max_environments(self):
+        # The least recently used states are evicted when too many
+        # environments are cached.
+        value = allwatcher._evictions.value
+        cache = allwatcher.StateCache(max_environments=2, io_loop=mock.Mock())
+        state1 = cache.create(('env1', 1), mock.Mock())
+        state2 = cache.create(('env2', 1), mock.Mock())
+        state1.subscribe('s1')
+        state2.subscribe('s2')
+        cache.get(('env1', 1))
+        state3 = cache.create(('env3', 1), mock.Mock())
+        self.assertTrue(state2.closed)
+        self.assertEqual(
+            'AllWatcher state evicted', str(state2.next('s2').exception()))
+        self.assertFalse(state1.closed)
+        self.assertIs(state3, cache.get(('env3', 1)))
+        self.assertIsNone(cache.get(('env2', 1)))
+        self.assertEqual(value + 1, allwatcher._evictions.value)
+
+    def test_idle_evicted_first(self):
+        # States nobody is subscribed to are evicted first.
+        cache = allwatcher.StateCache(max_environments=2, io_loop=mock.Mock())
+        state1 = cache.create(('env1', 1), mock.Mock())
+        state2 = cache.create(('env2', 1), mock.Mock())
+        state1.subscribe('s1')
+        cache.create(('env3', 1), mock.Mock())
+        self.assertFalse(state1.closed)
+        self.assertTrue(state2.closed)
+        self.assertEqual(2, len(cache.status()))
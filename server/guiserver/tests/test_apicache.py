@@ -0,0 +1,202 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server Juju API responses cache."""
+
+import json
+import unittest
+
+import mock
+
+from guiserver import apicache
+
+
+class TestParseMethods(unittest.TestCase):
+
+    def test_methods(self):
+        # Methods and their related delta kinds are correctly parsed.
+        methods = apicache.parse_methods(
+            'Client.CharmInfo, Client.ServiceGet:service,'
+            'Client.Status:service+unit,')
+        self.assertEqual({
+            'Client.CharmInfo': frozenset(),
+            'Client.ServiceGet': frozenset(['service']),
+            'Client.Status': frozenset(['service', 'unit']),
+        }, methods)
+
+    def test_empty(self):
+        # An empty value does not include methods.
+        self.assertEqual({}, apicache.parse_methods(''))
+
+    def test_invalid(self):
+        # A ValueError is raised if the request type is missing.
+        for value in ('CharmInfo', 'Client.', '.CharmInfo:service'):
+            with self.assertRaises(ValueError):
+                apicache.parse_methods(value)
+
+
+class TestGetRequestId(unittest.TestCase):
+
+    def test_request_id(self):
+        # The request id is returned.
+        message = '{"RequestId": 42, "Response": {}}'
+        self.assertEqual(42, apicache.get_request_id(message))
+
+    def test_no_request_id(self):
+        # None is returned if the message does not include a request id.
+        self.assertIsNone(apicache.get_request_id('{"Response": {}}'))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    apiurl = 'wss://api.example.com:17070'
+    request = {
+        'RequestId': 1,
+        'Type': 'Client',
+        'Request': 'ServiceGet',
+        'Params': {'ServiceName': 'mysql'},
+    }
+
+    def setUp(self):
+        methods = apicache.parse_methods(
+            'Client.CharmInfo,Client.ServiceGet:service')
+        self.cache = apicache.ResponseCache(methods, ttl=10, max_entries=2)
+        # Reset the cache metrics.
+        for metric in (apicache._hits, apicache._misses,
+                       apicache._invalidations):
+            patcher = mock.patch.object(metric, 'value', 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_key(self, username='user', **kwargs):
+        """Return the key for the request, updated with the given kwargs."""
+        return self.cache.make_key(
+            self.apiurl, username, dict(self.request, **kwargs))
+
+    def test_markers(self):
+        # The markers include the cached request names.
+        self.assertEqual(('"CharmInfo"', '"ServiceGet"'), self.cache.markers)
+
+    def test_key(self):
+        # Keys are built using the API URL, user, method and parameters.
+        expected = (
+            self.apiurl, 'user', 'Client.ServiceGet', None, None,
+            '{"ServiceName": "mysql"}')
+        self.assertEqual(expected, self.make_key())
+
+    def test_key_normalized(self):
+        # Parameters are normalized and the request id is ignored.
+        key1 = self.make_key(Params={'a': 1, 'b': 2})
+        key2 = self.make_key(RequestId=2, Params={'b': 2, 'a': 1})
+        self.assertEqual(key1, key2)
+
+    def test_key_scoped(self):
+        # Keys differ for different users.
+        self.assertNotEqual(self.make_key(), self.make_key(username='who'))
+
+    def test_key_not_cacheable(self):
+        # None is returned for requests not in the allowlist.
+        self.assertIsNone(self.make_key(Request='ServiceSet'))
+        self.assertIsNone(self.make_key(Type='Admin'))
+
+    def test_hit(self):
+        # Cached responses are returned with the given request id.
+        key = self.make_key()
+        self.cache.put(key, {'RequestId': 1, 'Response': {'Config': {}}})
+        self.assertEqual(
+            {'RequestId': 42, 'Response': {'Config': {}}},
+            self.cache.get(key, 42))
+        self.assertEqual(1, apicache._hits.value)
+        self.assertEqual(1, self.cache.status()['hit_rate'])
+
+    def test_miss(self):
+        # None is returned if the response is not cached.
+        self.assertIsNone(self.cache.get(self.make_key(), 42))
+        self.assertEqual(1, apicache._misses.value)
+        self.assertEqual(0, self.cache.status()['hit_rate'])
+
+    def test_errors_not_cached(self):
+        # Error responses are not cached.
+        key = self.make_key()
+        self.cache.put(key, {'RequestId': 1, 'Error': 'bad wolf'})
+        self.assertIsNone(self.cache.get(key, 42))
+
+    def test_expiration(self):
+        # Responses expire after the TTL.
+        key = self.make_key()
+        with mock.patch('time.time', mock.Mock(return_value=100)):
+            self.cache.put(key, {'RequestId': 1, 'Response': {}})
+        with mock.patch('time.time', mock.Mock(return_value=109)):
+            self.assertIsNotNone(self.cache.get(key, 42))
+        with mock.patch('time.time', mock.Mock(return_value=110)):
+            self.assertIsNone(self.cache.get(key, 42))
+        self.assertEqual(0, len(self.cache))
+
+    def test_eviction(self):
+        # The least recently used response is discarded when full.
+        keys = [self.make_key(username=str(num)) for num in range(3)]
+        self.cache.put(keys[0], {'Response': {}})
+        self.cache.put(keys[1], {'Response': {}})
+        self.cache.get(keys[0], 1)
+        self.cache.put(keys[2], {'Response': {}})
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get(keys[1], 1))
+        self.assertIsNotNone(self.cache.get(keys[0], 1))
+
+    def deltas(self, *deltas):
+        """Return a raw AllWatcher message including the given deltas."""
+        return json.dumps({'RequestId': 3, 'Response': {'Deltas': deltas}})
+
+    def test_invalidate(self):
+        # Entries related to the deltas kinds are invalidated.
+        key1 = self.make_key()
+        key2 = self.make_key(Request='CharmInfo')
+        self.cache.put(key1, {'Response': {}})
+        self.cache.put(key2, {'Response': {}})
+        self.cache.invalidate(
+            self.apiurl, self.deltas(
+                ['unit', 'change', {'Name': 'a/0'}],
+                ['service', 'remove', {'Name': 'a'}]))
+        self.assertIsNone(self.cache.get(key1, 1))
+        self.assertIsNotNone(self.cache.get(key2, 1))
+        self.assertEqual(1, apicache._invalidations.value)
+
+    def test_invalidate_unrelated(self):
+        # Entries are not invalidated by unrelated deltas or environments.
+        key = self.make_key()
+        self.cache.put(key, {'Response': {}})
+        self.cache.invalidate(
+            self.apiurl, self.deltas(['unit', 'change', {'Service': 'a'}]))
+        self.cache.invalidate(
+            'wss://other', self.deltas(['service', 'change', {}]))
+        self.assertIsNotNone(self.cache.get(key, 1))
+        self.assertEqual(0, apicache._invalidations.value)
+
+    def test_invalidate_without_deltas(self):
+        # Messages not including deltas do not invalidate entries.
+        key = self.make_key()
+        self.cache.put(key, {'Response': {}})
+        self.cache.invalidate(
+            self.apiurl,
+            json.dumps({'Response': {'Kinds': ['service', 'change', {}]}}))
+        self.assertIsNotNone(self.cache.get(key, 1))
+
+    def test_invalidate_no_kinds(self):
+        # Messages are not scanned if no methods are related to deltas.
+        cache = apicache.ResponseCache({'Client.CharmInfo': frozenset()})
+        with mock.patch('guiserver.apicache._delta_kinds') as mock_kinds:
+            cache.invalidate(
+                self.apiurl, self.deltas(['service', 'change', {}]))
+        self.assertFalse(mock_kinds.called)
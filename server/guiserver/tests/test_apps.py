@@ -16,15 +16,31 @@
 
 """Tests for the Juju GUI server applications."""
 
+import shutil
+import tempfile
 import unittest
 
 import mock
 
 from guiserver import (
+    apicache,
     apps,
     auth,
+    batching,
+    breaker,
+    charmcache,
+    coalesce,
+    compression,
+    failover,
     handlers,
+    httppool,
+    icons,
+    latency,
     manage,
+    multiplex,
+    pool,
+    resume,
+    shared,
 )
 from guiserver.bundles import base
 
@@ -82,6 +98,45 @@ class TestServer(AppsTestMixin, unittest.TestCase):
             'sandbox': False,
             'jujuguidebug': False,
             'gzip': True,
+            'multiplex': False,
+            'allwatcherbacklog': 10000,
+            'allwatcherttl': 60,
+            'allwatchermaxenvironments': 100,
+            'allwatchermaxentities': 100000,
+            'upstreampool': 0,
+            'upstreampoolidle': 300,
+            'apiaddresses': None,
+            'apiconnecttimeout': 5,
+            'apireconnect': 0,
+            'resumewindow': 0,
+            'resumesessions': 100,
+            'resumebytes': 1024,
+            'apicache': '',
+            'apicachettl': 60,
+            'apicachesize': 1000,
+            'proxybuffer': 1024,
+            'charmcachedir': None,
+            'charmcachesize': 1024,
+            'charmcachettl': 60,
+            'missingiconttl': 60,
+            'missingiconsize': 10,
+            'proxycoalescewait': 0,
+            'proxymaxclients': 20,
+            'proxykeepalive': True,
+            'proxyconnecttimeout': 20,
+            'proxyqueuetimeout': 10,
+            'proxyrequesttimeout': 20,
+            'proxybreakerfailures': 0,
+            'proxybreakerlatency': 0,
+            'proxybreakerreset': 30,
+            'wsdeflate': False,
+            'wsdeflatelevel': 6,
+            'wsdeflatewindow': 15,
+            'wsdeflateminsize': 256,
+            'wsbatch': False,
+            'wsbatchsize': 100,
+            'wsbatchdelay': 5,
+            'shareddir': None,
         }
         options_dict.update(kwargs)
         options = mock.Mock(**options_dict)
@@ -117,6 +172,276 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         tokens = self.assert_in_spec(spec, 'tokens')
         self.assertIsInstance(tokens, auth.AuthenticationTokenHandler)
 
+    def test_no_shared_state(self):
+        # By default the server state is not shared with other processes.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(spec.kwargs['changesets'])
+        self.assertIsInstance(
+            spec.kwargs['tokens']._store, shared.MemoryStore)
+        self.assertIsNone(spec.kwargs['deployer']._lock_path)
+
+    def test_shared_state(self):
+        # Tokens, change sets and deployments are shared between processes
+        # if a shared directory is provided.
+        app = self.get_app(shareddir='/my/shared')
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        changesets = spec.kwargs['changesets']
+        self.assertIsInstance(changesets, shared.SharedStore)
+        self.assertIsInstance(
+            spec.kwargs['tokens']._store, shared.SharedStore)
+        self.assertEqual(
+            '/my/shared/deployer.lock', spec.kwargs['deployer']._lock_path)
+
+    def test_multiplexer_disabled(self):
+        # By default upstream connections are not shared.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'multiplexer'))
+
+    def test_multiplexer_enabled(self):
+        # The multiplexer is passed to the WebSocket and info handlers if
+        # upstream connections are shared.
+        app = self.get_app(multiplex=True)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        multiplexer = self.assert_in_spec(spec, 'multiplexer')
+        self.assertIsInstance(multiplexer, multiplex.Multiplexer)
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'multiplexer', value=multiplexer)
+
+    def test_pool_disabled(self):
+        # By default upstream connections are not pre-warmed.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'pool'))
+
+    def test_pool_enabled(self):
+        # The pool is passed to the WebSocket and info handlers if enabled.
+        app = self.get_app(upstreampool=3, upstreampoolidle=10)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        connection_pool = self.assert_in_spec(spec, 'pool')
+        self.assertIsInstance(connection_pool, pool.ConnectionPool)
+        self.assertEqual(3, connection_pool._size)
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'pool', value=connection_pool)
+
+    def test_parking_disabled(self):
+        # By default sessions are not parked on disconnection.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'parking'))
+
+    def test_parking_enabled(self):
+        # The session parking is passed to the WebSocket handler if a resume
+        # window is provided.
+        app = self.get_app(resumewindow=10, resumesessions=5)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        parking = self.assert_in_spec(spec, 'parking')
+        self.assertIsInstance(parking, resume.SessionParking)
+        self.assertEqual(10, parking.window)
+        self.assertEqual(5, parking._max_sessions)
+        self.assertEqual(1024, parking._max_bytes)
+
+    def test_response_cache_disabled(self):
+        # By default Juju API responses are not cached.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'response_cache'))
+
+    def test_response_cache_enabled(self):
+        # The response cache is passed to the WebSocket and info handlers if
+        # cached methods are provided.
+        app = self.get_app(
+            apicache='Client.CharmInfo,Client.ServiceGet:service',
+            apicachettl=10)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        response_cache = self.assert_in_spec(spec, 'response_cache')
+        self.assertIsInstance(response_cache, apicache.ResponseCache)
+        self.assertEqual(
+            {'Client.CharmInfo': frozenset(),
+             'Client.ServiceGet': frozenset(['service'])},
+            response_cache._methods)
+        self.assertEqual(10, response_cache._ttl)
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'response_cache', value=response_cache)
+
+    def test_missing_icons(self):
+        # The registry of the charms lacking an icon is set up.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        missing_icons = self.assert_in_spec(spec, 'missing_icons')
+        self.assertIsInstance(missing_icons, icons.MissingIcons)
+        self.assertEqual(60, missing_icons._ttl)
+        self.assertEqual(10, missing_icons._max_entries)
+
+    def test_single_flight_disabled(self):
+        # By default identical proxy requests are not coalesced.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        self.assertIsNone(self.assert_in_spec(spec, 'single_flight'))
+
+    def test_single_flight_enabled(self):
+        # Identical proxy requests are coalesced if a waiting time is set.
+        app = self.get_app(proxycoalescewait=1500)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        single_flight = self.assert_in_spec(spec, 'single_flight')
+        self.assertIsInstance(single_flight, coalesce.SingleFlight)
+        self.assertEqual(1.5, single_flight.timeout)
+
+    def test_http_pool(self):
+        # The pool of connections to juju-core is passed to the juju-core
+        # proxy and info handlers.
+        app = self.get_app(
+            proxymaxclients=50, proxykeepalive=False, proxyconnecttimeout=5,
+            proxyrequesttimeout=60, proxyqueuetimeout=0)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        http_pool = self.assert_in_spec(spec, 'http_pool')
+        self.assertIsInstance(http_pool, httppool.HTTPPool)
+        self.assertEqual('juju-core', http_pool.name)
+        self.assertEqual(50, http_pool.max_clients)
+        self.assertFalse(http_pool.keep_alive)
+        self.assertEqual(5, http_pool.connect_timeout)
+        self.assertEqual(60, http_pool.request_timeout)
+        self.assertEqual(0, http_pool.queue_timeout)
+        self.assertIsNone(http_pool.breaker)
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'http_pool', value=http_pool)
+
+    def test_proxy_compression(self):
+        # Proxied juju-core responses are compressed if gzip is enabled.
+        app = self.get_app(gzip=True)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        self.assert_in_spec(spec, 'compress', value=True)
+        app = self.get_app(gzip=False)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        self.assert_in_spec(spec, 'compress', value=False)
+
+    def test_circuit_breaker(self):
+        # A circuit breaker is used for juju-core if a failure count is set.
+        app = self.get_app(
+            proxybreakerfailures=3, proxybreakerlatency=1500,
+            proxybreakerreset=10)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        circuit_breaker = self.assert_in_spec(spec, 'http_pool').breaker
+        self.assertIsInstance(circuit_breaker, breaker.CircuitBreaker)
+        self.assertEqual('juju-core', circuit_breaker.name)
+        self.assertEqual(
+            'https://example.com:17070', circuit_breaker.probe_url)
+        self.assertFalse(circuit_breaker.validate_cert)
+        self.assertEqual(3, circuit_breaker.max_failures)
+        self.assertEqual(1.5, circuit_breaker.max_latency)
+        self.assertEqual(10, circuit_breaker.reset_timeout)
+
+    def test_charm_cache_disabled(self):
+        # By default charm files are not cached.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        self.assertIsNone(self.assert_in_spec(spec, 'charm_cache'))
+
+    def test_charm_cache_enabled(self):
+        # The charm cache is passed to the juju-core proxy and info handlers
+        # if a cache directory is provided.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = self.get_app(charmcachedir=directory, charmcachettl=10)
+        spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
+        charm_cache = self.assert_in_spec(spec, 'charm_cache')
+        self.assertIsInstance(charm_cache, charmcache.CharmFileCache)
+        self.assertEqual(1024, charm_cache.max_size)
+        self.assertEqual(10, charm_cache.ttl)
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'charm_cache', value=charm_cache)
+
+    def test_controllers_disabled(self):
+        # By default connections are not raced across controllers.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'controllers'))
+        self.assert_in_spec(spec, 'reconnect_attempts', value=0)
+
+    def test_reconnect_enabled(self):
+        # The number of reconnection attempts is passed to the WebSocket
+        # handler.
+        app = self.get_app(apireconnect=3)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assert_in_spec(spec, 'reconnect_attempts', value=3)
+
+    def test_controllers_enabled(self):
+        # The controllers are passed to the WebSocket and info handlers if
+        # the API addresses are provided.
+        app = self.get_app(apiaddresses='1.2.3.4:17070,1.2.3.5:17070')
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        controllers = self.assert_in_spec(spec, 'controllers')
+        self.assertIsInstance(controllers, failover.Controllers)
+        self.assertEqual(
+            ['1.2.3.4:17070', '1.2.3.5:17070'],
+            [info['address'] for info in controllers.status()])
+        spec = self.get_url_spec(app, r'^/gui-server-info$')
+        self.assert_in_spec(spec, 'controllers', value=controllers)
+
+    def test_allwatcher_state_cache(self):
+        # The AllWatcher state cache is configured using the options.
+        app = self.get_app(
+            multiplex=True, allwatcherbacklog=100, allwatcherttl=10,
+            allwatchermaxenvironments=5, allwatchermaxentities=1000)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        states = self.assert_in_spec(spec, 'multiplexer').states
+        self.assertEqual(100, states._max_deltas)
+        self.assertEqual(10, states._ttl)
+        self.assertEqual(5, states._max_environments)
+        self.assertEqual(1000, states._max_entities)
+
+    def test_compression_disabled(self):
+        # By default browser WebSocket messages are not compressed.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'compression'))
+
+    def test_compression_enabled(self):
+        # The compression options are passed to the WebSocket handler.
+        app = self.get_app(
+            wsdeflate=True, wsdeflatelevel=1, wsdeflatewindow=10,
+            wsdeflateminsize=42)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        options = self.assert_in_spec(spec, 'compression')
+        self.assertIsInstance(options, compression.DeflateOptions)
+        self.assertEqual(1, options.level)
+        self.assertEqual(10, options.max_window_bits)
+        self.assertEqual(42, options.min_size)
+
+    def test_batching_disabled(self):
+        # By default Juju API messages are not batched.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'batching'))
+
+    def test_batching_enabled(self):
+        # The batching options are passed to the WebSocket handler.
+        app = self.get_app(wsbatch=True, wsbatchsize=10, wsbatchdelay=5)
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        options = self.assert_in_spec(spec, 'batching')
+        self.assertIsInstance(options, batching.BatchOptions)
+        self.assertEqual(10, options.max_size)
+        self.assertEqual(5, options.delay)
+
+    def test_latency(self):
+        # The API latency aggregator is shared by the WebSocket and latency
+        # handlers.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        api_latency = self.assert_in_spec(spec, 'latency')
+        self.assertIsInstance(api_latency, latency.ApiLatency)
+        spec = self.get_url_spec(app, r'^/gui-server-latency$')
+        self.assert_in_spec(spec, 'latency', value=api_latency)
+
+    def test_metrics(self):
+        # The metrics handler also exports the API latency.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws(?:/.*)?$')
+        api_latency = self.assert_in_spec(spec, 'latency')
+        spec = self.get_url_spec(app, r'^/metrics$')
+        self.assert_in_spec(spec, 'latency', value=api_latency)
+
     def test_websocket_in_sandbox_mode(self):
         # The sandbox WebSocket handler is used if sandbox mode is enabled.
         app = self.get_app(sandbox=True)
@@ -138,6 +463,7 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         spec = self.get_url_spec(app, r'^/juju-core/(.*)$')
         self.assert_in_spec(
             spec, 'target_url', value='https://example.com:17070')
+        self.assert_in_spec(spec, 'max_buffer', value=1024)
 
     def test_serving_gui_tests(self):
         # The server can be configured to serve GUI unit tests.
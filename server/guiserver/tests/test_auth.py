@@ -17,12 +17,19 @@
 """Tests for the Juju GUI server authentication management."""
 
 import datetime
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 import mock
 from tornado.testing import LogTrapTestCase
 
-from guiserver import auth
+from guiserver import (
+    auth,
+    shared,
+)
 from guiserver.tests import helpers
 
 
@@ -62,9 +69,8 @@ class AuthMiddlewareTestMixin(object):
 
     def setUp(self):
         self.user = auth.User()
-        self.io_loop = mock.Mock()
         self.write_message = mock.Mock()
-        self.tokens = auth.AuthenticationTokenHandler(io_loop=self.io_loop)
+        self.tokens = auth.AuthenticationTokenHandler()
         self.auth = auth.AuthMiddleware(
             self.user, self.get_auth_backend(), self.tokens,
             self.write_message)
@@ -286,25 +292,22 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
 
     def setUp(self):
         super(TestAuthenticationTokenHandler, self).setUp()
-        self.io_loop = mock.Mock()
         self.max_life = datetime.timedelta(minutes=1)
+        self.store = shared.MemoryStore()
         self.tokens = auth.AuthenticationTokenHandler(
-            self.max_life, self.io_loop)
+            self.max_life, self.store)
 
     def test_explicit_initialization(self):
         # The class accepted the explicit initialization.
         self.assertEqual(self.max_life, self.tokens._max_life)
-        self.assertEqual(self.io_loop, self.tokens._io_loop)
-        self.assertEqual({}, self.tokens._data)
+        self.assertIs(self.store, self.tokens._store)
 
-    @mock.patch('tornado.ioloop.IOLoop.current',
-                mock.Mock(return_value='mockloop'))
     def test_default_initialization(self):
         # The class has sane initialization defaults.
         tokens = auth.AuthenticationTokenHandler()
         self.assertEqual(
             datetime.timedelta(minutes=2), tokens._max_life)
-        self.assertEqual('mockloop', tokens._io_loop)
+        self.assertIsInstance(tokens._store, shared.MemoryStore)
 
     def test_token_requested(self):
         # It recognizes a token request.
@@ -342,20 +345,32 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
                 Expires='2013-11-21T21:01:00Z'
             )
         ))
-        self.assertTrue('DEFACED' in self.tokens._data)
         self.assertEqual(
-            {'username', 'password', 'handle'},
-            set(self.tokens._data['DEFACED'].keys()))
-        self.assertEqual(
-            user.username, self.tokens._data['DEFACED']['username'])
-        self.assertEqual(
-            user.password, self.tokens._data['DEFACED']['password'])
-        self.assertEqual(
-            self.max_life, self.io_loop.add_timeout.call_args[0][0])
-        self.assertTrue('DEFACED' in self.tokens._data)
-        expire_token = self.io_loop.add_timeout.call_args[0][1]
-        expire_token()
-        self.assertFalse('DEFACED' in self.tokens._data)
+            {'username': user.username, 'password': user.password},
+            self.store.pop('DEFACED'))
+
+    def test_token_expiration(self):
+        # Tokens are stored for the token max life.
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        data = dict(RequestId=42, Type='GUIToken', Request='Create')
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            self.tokens.process_token_request(data, user, mock.Mock())
+        self.assertEqual([(1060, mock.ANY)], self.store._expirations)
+
+    def test_tokens_metric(self):
+        # The number of stored tokens is tracked.
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        data = dict(RequestId=42, Type='GUIToken', Request='Create')
+        write_message = mock.Mock()
+        self.tokens.process_token_request(data, user, write_message)
+        self.tokens.process_token_request(data, user, mock.Mock())
+        self.assertEqual(2, auth._tokens.value)
+        token = write_message.call_args[0][0]['Response']['Token']
+        request = dict(
+            RequestId=43, Type='GUIToken', Request='Login',
+            Params={'Token': token})
+        self.tokens.process_authentication_request(request, mock.Mock())
+        self.assertEqual(1, auth._tokens.value)
 
     def test_unauthenticated_process_token_request(self):
         # Unauthenticated token requests get an informative error.
@@ -369,8 +384,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             ErrorCode='unauthorized access',
             Response={}
         ))
-        self.assertEqual({}, self.tokens._data)
-        self.assertFalse(self.io_loop.add_timeout.called)
+        self.assertEqual(0, len(self.store))
 
     def test_authentication_requested(self):
         # It recognizes an authentication request.
@@ -397,8 +411,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         # It correctly responds to authentication requests with known tokens.
         username = 'user-admin'
         password = 'ADMINSECRET'
-        self.tokens._data['DEFACED'] = dict(
-            handle='handle marker', username=username, password=password)
+        self.store.put(
+            'DEFACED', dict(username=username, password=password), 60)
         request = dict(
             RequestId=42, Type='GUIToken', Request='Login',
             Params={'Token': 'DEFACED'})
@@ -406,9 +420,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             (username, password),
             self.tokens.process_authentication_request(request, write_message))
-        self.io_loop.remove_timeout.assert_called_once_with('handle marker')
         self.assertFalse(write_message.called)
-        self.assertFalse('DEFACED' in self.tokens._data)
+        self.assertIsNone(self.store.pop('DEFACED'))
 
     def test_unknown_authentication_request(self):
         # It correctly rejects authentication requests with unknown tokens.
@@ -419,7 +432,6 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             None,
             self.tokens.process_authentication_request(request, write_message))
-        self.assertFalse(self.io_loop.remove_timeout.called)
         write_message.assert_called_once_with(dict(
             RequestId=42,
             Error='unknown, fulfilled, or expired token',
@@ -450,3 +462,70 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             dict(RequestId=42,
                  Response=dict(AuthTag=user.username, Password=user.password)),
             self.tokens.process_authentication_response(response, user))
+
+
+class TestAuthenticationTokenHandlerSharedStore(
+        LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(TestAuthenticationTokenHandlerSharedStore, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'shared.db')
+        self.store = shared.SharedStore(path, table='tokens')
+        self.tokens = auth.AuthenticationTokenHandler(
+            datetime.timedelta(minutes=1), store=self.store)
+        # Another handler sharing the store, e.g. in another process.
+        self.other_tokens = auth.AuthenticationTokenHandler(
+            datetime.timedelta(minutes=1),
+            store=shared.SharedStore(path, table='tokens'))
+
+    def create_token(self):
+        """Create a token and return its value."""
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        self.tokens.process_token_request(request, user, write_message)
+        return write_message.call_args[0][0]['Response']['Token']
+
+    def login(self, tokens, token):
+        """Use the given token, and return the credentials and the writer."""
+        request = dict(
+            RequestId=43, Type='GUIToken', Request='Login',
+            Params={'Token': token})
+        write_message = mock.Mock()
+        credentials = tokens.process_authentication_request(
+            request, write_message)
+        return credentials, write_message
+
+    def test_token_stored(self):
+        # Tokens are saved in the shared store.
+        self.create_token()
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(1, auth._tokens.value)
+
+    def test_token_shared(self):
+        # A token can be used by another handler sharing the store.
+        token = self.create_token()
+        credentials, write_message = self.login(self.other_tokens, token)
+        self.assertEqual(('user-admin', 'ADMINSECRET'), credentials)
+        self.assertFalse(write_message.called)
+        self.assertEqual(0, len(self.store))
+
+    def test_token_used_once(self):
+        # A token can only be used once.
+        token = self.create_token()
+        self.login(self.tokens, token)
+        credentials, write_message = self.login(self.other_tokens, token)
+        self.assertIsNone(credentials)
+        self.assertEqual(
+            'unknown, fulfilled, or expired token',
+            write_message.call_args[0][0]['Error'])
+
+    def test_token_expired(self):
+        # Expired tokens are rejected.
+        token = self.create_token()
+        with mock.patch('time.time', mock.Mock(return_value=time.time() + 61)):
+            credentials, write_message = self.login(self.tokens, token)
+        self.assertIsNone(credentials)
+        self.assertTrue(write_message.called)
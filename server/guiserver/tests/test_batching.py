@@ -0,0 +1,94 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server WebSocket frame batching."""
+
+from tornado import gen
+from tornado.testing import (
+    AsyncTestCase,
+    gen_test,
+)
+
+from guiserver import batching
+
+
+class TestFrameBatcher(AsyncTestCase):
+
+    def make_batcher(self, max_size=3, delay=0):
+        """Return a FrameBatcher storing the frames in self.frames."""
+        self.frames = []
+        options = batching.BatchOptions(max_size=max_size, delay=delay)
+        return batching.FrameBatcher(
+            self.frames.append, options, io_loop=self.io_loop)
+
+    @gen_test
+    def test_same_iteration(self):
+        # With no delay, messages added in the same iteration are batched.
+        batcher = self.make_batcher()
+        batcher.add('{"RequestId": 1}')
+        batcher.add('{"RequestId": 2}')
+        self.assertEqual([], self.frames)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(['[{"RequestId": 1},{"RequestId": 2}]'], self.frames)
+
+    @gen_test
+    def test_delay(self):
+        # Messages are collected for the given number of milliseconds.
+        batcher = self.make_batcher(delay=10)
+        batcher.add('1')
+        yield gen.Task(self.io_loop.add_callback)
+        batcher.add('2')
+        self.assertEqual([], self.frames)
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.02)
+        self.assertEqual(['[1,2]'], self.frames)
+
+    def test_max_size(self):
+        # The batch is sent as soon as it is full.
+        batcher = self.make_batcher(max_size=2, delay=1000)
+        batcher.add('1')
+        batcher.add('2')
+        batcher.add('3')
+        self.assertEqual(['[1,2]'], self.frames)
+
+    def test_flush(self):
+        # Pending messages can be sent immediately.
+        batcher = self.make_batcher(delay=1000)
+        batcher.add('1')
+        batcher.flush()
+        self.assertEqual(['[1]'], self.frames)
+        # Nothing is sent if no messages are pending.
+        batcher.flush()
+        self.assertEqual(['[1]'], self.frames)
+
+    @gen_test
+    def test_cancel(self):
+        # The scheduled flush can be cancelled.
+        batcher = self.make_batcher(delay=5)
+        batcher.add('1')
+        batcher.cancel()
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.01)
+        self.assertEqual([], self.frames)
+
+    def test_metrics(self):
+        # The number of messages in each batch is recorded.
+        summary = batching._batch_messages
+        count, total = summary.value['count'], summary.value['sum']
+        batcher = self.make_batcher()
+        batcher.add('1')
+        batcher.add('2')
+        batcher.flush()
+        self.assertEqual(count + 1, summary.value['count'])
+        self.assertEqual(total + 2, summary.value['sum'])
@@ -0,0 +1,172 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server circuit breakers."""
+
+from tornado import (
+    gen,
+    httpclient,
+    web,
+)
+from tornado.concurrent import Future
+from tornado.testing import (
+    AsyncHTTPTestCase,
+    AsyncTestCase,
+    gen_test,
+)
+
+from guiserver import breaker
+
+
+def make_response(request_time=0.1, **time_info):
+    """Create and return an HTTP response with the given timings."""
+    request = httpclient.HTTPRequest('https://example.com/')
+    return httpclient.HTTPResponse(
+        request, 200, request_time=request_time, time_info=time_info)
+
+
+class TestCircuitBreaker(AsyncTestCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.breaker = breaker.CircuitBreaker(
+            'juju-core', 'https://example.com/', max_failures=2,
+            max_latency=1, reset_timeout=0.05, io_loop=self.io_loop)
+        # Probes return the futures stored in self.probes.
+        self.probes = []
+        self.breaker.probe = self.probe
+
+    def probe(self):
+        future = Future()
+        self.probes.append(future)
+        return future
+
+    def test_closed(self):
+        # Requests are allowed while the circuit is closed.
+        self.breaker.check()
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+
+    def test_consecutive_failures(self):
+        # The circuit opens after consecutive failures.
+        opened = breaker._opened.value
+        self.breaker.record(None, True)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.breaker.record(None, True)
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertEqual(opened + 1, breaker._opened.value)
+        with self.assertRaises(breaker.CircuitOpen) as context:
+            self.breaker.check()
+        self.assertEqual(1, context.exception.retry_after)
+        self.assertIn('juju-core is not responding', str(context.exception))
+
+    def test_success_resets_failures(self):
+        # Failures must be consecutive for the circuit to open.
+        self.breaker.record(None, True)
+        self.breaker.record(make_response(), False)
+        self.breaker.record(None, True)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.assertEqual(1, self.breaker.failures)
+
+    def test_slow_responses(self):
+        # Responses slower than the threshold are counted as failures.
+        slow = breaker._slow_fetches.value
+        self.breaker.record(make_response(request_time=2), False)
+        self.breaker.record(make_response(request_time=2), False)
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.assertEqual(slow + 2, breaker._slow_fetches.value)
+
+    def test_time_to_first_byte(self):
+        # The time to the first response byte is used if available.
+        self.breaker.record(
+            make_response(request_time=60, starttransfer=0.5), False)
+        self.assertEqual(0, self.breaker.failures)
+        self.breaker.record(
+            make_response(request_time=60, starttransfer=1.5), False)
+        self.assertEqual(1, self.breaker.failures)
+
+    def test_no_latency_threshold(self):
+        # Slow responses are not failures if no threshold is set.
+        self.breaker.max_latency = 0
+        self.breaker.record(make_response(request_time=60), False)
+        self.assertEqual(0, self.breaker.failures)
+
+    @gen_test
+    def test_probe_success(self):
+        # The circuit closes when a probe succeeds.
+        self.breaker.record(None, True)
+        self.breaker.record(None, True)
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+        self.assertEqual(1, len(self.probes))
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+        self.probes[0].set_result(True)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(breaker.CLOSED, self.breaker.state)
+        self.assertEqual(0, self.breaker.failures)
+        self.breaker.check()
+
+    @gen_test
+    def test_probe_failure(self):
+        # Probes are repeated while the upstream server is not responding.
+        self.breaker.record(None, True)
+        self.breaker.record(None, True)
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+        self.probes[0].set_result(False)
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+        self.assertEqual(2, len(self.probes))
+        self.assertEqual(breaker.OPEN, self.breaker.state)
+
+    def test_status(self):
+        # The circuit breaker state is reported.
+        self.breaker.record(None, True)
+        self.assertEqual(
+            {'state': 'closed', 'failures': 1}, self.breaker.status())
+
+
+class HealthHandler(web.RequestHandler):
+    """Respond with the status code stored in the application settings."""
+
+    def get(self):
+        self.set_status(self.settings['code'])
+
+
+class TestProbe(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application([(r'/', HealthHandler)], code=404)
+
+    def make_breaker(self, url=None):
+        return breaker.CircuitBreaker(
+            'juju-core', url or self.get_url('/'), io_loop=self.io_loop)
+
+    @gen_test
+    def test_responding(self):
+        # The upstream server is healthy if it responds, even with an error.
+        probes = breaker._probes.value
+        healthy = yield self.make_breaker().probe()
+        self.assertTrue(healthy)
+        self.assertEqual(probes + 1, breaker._probes.value)
+
+    @gen_test
+    def test_failure(self):
+        # The upstream server is not healthy if it reports a failure.
+        self._app.settings['code'] = 503
+        healthy = yield self.make_breaker().probe()
+        self.assertFalse(healthy)
+
+    @gen_test
+    def test_connection_error(self):
+        # The upstream server is not healthy if it cannot be reached.
+        healthy = yield self.make_breaker('http://127.0.0.1:1/').probe()
+        self.assertFalse(healthy)
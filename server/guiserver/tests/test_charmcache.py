@@ -0,0 +1,267 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server charm files disk cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from tornado.testing import LogTrapTestCase
+
+from guiserver import charmcache
+
+
+class TestMakeKey(unittest.TestCase):
+
+    def test_query_sorted(self):
+        # The query arguments are sorted.
+        key1 = charmcache.make_key(
+            'https://1.2.3.4:17070/charms?url=local:trusty/django-42&file=a')
+        key2 = charmcache.make_key(
+            'https://1.2.3.4:17070/charms?file=a&url=local:trusty/django-42')
+        self.assertEqual(key1, key2)
+        self.assertEqual(
+            'https://1.2.3.4:17070/charms?'
+            'file=a&url=local%3Atrusty%2Fdjango-42', key1)
+
+    def test_host_normalized(self):
+        # The host name is case insensitive.
+        self.assertEqual(
+            'https://example.com/charms?file=a',
+            charmcache.make_key('https://EXAMPLE.com/charms?file=a'))
+
+    def test_fragment_removed(self):
+        # The URL fragment is ignored.
+        self.assertEqual(
+            'https://example.com/charms',
+            charmcache.make_key('https://example.com/charms#frag'))
+
+    def test_credentials(self):
+        # The credentials are part of the key, but are not included as is.
+        url = 'https://example.com/charms?file=a'
+        key1 = charmcache.make_key(url, {'Authorization': 'Basic secret1'})
+        key2 = charmcache.make_key(url, {'Authorization': 'Basic secret2'})
+        key3 = charmcache.make_key(url, {'Cookie': 'macaroon=secret1'})
+        self.assertEqual(4, len(set([key1, key2, key3, url])))
+        for key in (key1, key2, key3):
+            self.assertTrue(key.startswith(url + ' '))
+            self.assertNotIn('secret', key)
+        self.assertEqual(
+            key1, charmcache.make_key(url, {'Authorization': 'Basic secret1'}))
+
+    def test_no_credentials(self):
+        # The key only includes the URL if no credentials are provided.
+        url = 'https://example.com/charms?file=a'
+        self.assertEqual(url, charmcache.make_key(url, {'Accept': '*/*'}))
+
+
+class TestCharmFileCache(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = self.make_cache()
+
+    def make_cache(self, max_size=10, ttl=60):
+        """Return a cache using the test directory."""
+        return charmcache.CharmFileCache(
+            self.directory, max_size=max_size, ttl=ttl)
+
+    def store(self, key, chunks, headers=None, code=200):
+        """Store the response with the given body chunks in the cache."""
+        writer = self.cache.writer(key)
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.commit(code, headers or {})
+
+    def read(self, entry):
+        """Return the content of the given entry."""
+        with self.cache.open(entry) as content:
+            return content.read()
+
+    def test_store_and_get(self):
+        # Responses are stored and can be retrieved.
+        headers = {'Content-Type': 'image/svg+xml', 'Server': 'juju'}
+        self.store('key', ['<svg', '/>'], headers)
+        entry = self.cache.get('key')
+        self.assertEqual('key', entry.key)
+        self.assertEqual(6, entry.size)
+        # Only the relevant headers are stored.
+        self.assertEqual({'Content-Type': 'image/svg+xml'}, entry.headers)
+        self.assertEqual('<svg/>', self.read(entry))
+        self.assertEqual(1, len(self.cache))
+
+    def test_missing(self):
+        # None is returned if the entry is not cached.
+        self.assertIsNone(self.cache.get('no-such-key'))
+
+    def test_cache_control(self):
+        # The cache control header uses the cache TTL.
+        self.assertEqual('private, max-age=60', self.cache.cache_control)
+        writer = self.cache.writer('key')
+        self.assertEqual(
+            {'Cache-Control': 'private, max-age=60'}, writer.headers)
+
+    def test_writer_entry(self):
+        # The writer exposes the entry storing the response.
+        writer = self.cache.writer('key')
+        self.assertIsNone(writer.entry)
+        writer.write('data')
+        entry = writer.commit(200, {})
+        self.assertIs(entry, writer.entry)
+        self.assertEqual(4, entry.size)
+
+    def test_errors_not_stored(self):
+        # Unsuccessful responses are not stored.
+        self.assertIsNone(self.store('key', ['not found'], code=404))
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.directory, 'blobs')))
+
+    def test_empty_not_stored(self):
+        # Empty responses are not stored.
+        self.assertIsNone(self.store('key', []))
+        self.assertEqual(0, len(self.cache))
+
+    def test_aborted(self):
+        # Aborted responses are not stored.
+        writer = self.cache.writer('key')
+        writer.write('data')
+        writer.abort()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.directory, 'blobs')))
+
+    def test_too_large(self):
+        # Responses larger than the cache are not stored.
+        self.assertIsNone(self.store('key', ['0123456', '789ab']))
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.directory, 'blobs')))
+
+    def test_content_addressed(self):
+        # Identical contents are stored once.
+        entry1 = self.store('key1', ['same'])
+        entry2 = self.store('key2', ['same'])
+        self.assertEqual(entry1.digest, entry2.digest)
+        self.assertEqual(
+            [entry1.digest], os.listdir(os.path.join(self.directory, 'blobs')))
+        # The content is still available if one of the entries is removed.
+        self.cache._remove('key1')
+        self.assertEqual('same', self.read(self.cache.get('key2')))
+
+    def test_replace(self):
+        # Storing a response replaces the previous one.
+        self.store('key', ['old'])
+        self.store('key', ['new'])
+        self.assertEqual('new', self.read(self.cache.get('key')))
+        self.assertEqual(3, self.cache.status()['size'])
+
+    def test_replace_same_content(self):
+        # Storing the same response again preserves the content.
+        self.store('key', ['same'])
+        self.store('key', ['same'])
+        self.assertEqual('same', self.read(self.cache.get('key')))
+
+    def test_eviction(self):
+        # The least recently used entries are removed when the cache is full.
+        self.store('key1', ['1111'])
+        self.store('key2', ['2222'])
+        # Use the first entry.
+        self.cache.get('key1')
+        self.store('key3', ['3333'])
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertIsNotNone(self.cache.get('key1'))
+        self.assertIsNotNone(self.cache.get('key3'))
+        self.assertEqual(8, self.cache.status()['size'])
+
+    def test_load(self):
+        # Entries stored by previous runs are reused.
+        self.store('key', ['data'], {'ETag': '"abc"'})
+        cache = self.make_cache()
+        entry = cache.get('key')
+        self.assertEqual({'ETag': '"abc"'}, entry.headers)
+        with cache.open(entry) as content:
+            self.assertEqual('data', content.read())
+
+    def test_load_evicts(self):
+        # Entries exceeding a reduced cache size are removed when loading.
+        self.store('key1', ['1111'])
+        self.store('key2', ['2222'])
+        cache = self.make_cache(max_size=5)
+        self.assertEqual(1, len(cache))
+
+    def test_load_ignores_invalid(self):
+        # Invalid index files are ignored.
+        path = os.path.join(self.directory, 'index', 'bad.json')
+        with open(path, 'w') as index_file:
+            index_file.write('{')
+        cache = self.make_cache()
+        self.assertEqual(0, len(cache))
+
+    def test_file_removed(self):
+        # Entries whose file has been removed are discarded.
+        entry = self.store('key', ['data'])
+        os.remove(os.path.join(self.directory, 'blobs', entry.digest))
+        self.assertIsNone(self.cache.open(entry))
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_freshness(self):
+        # Entries must be revalidated after the TTL.
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            entry = self.store('key', ['data'])
+        with mock.patch('time.time', mock.Mock(return_value=1059)):
+            self.assertTrue(self.cache.is_fresh(entry))
+        with mock.patch('time.time', mock.Mock(return_value=1060)):
+            self.assertFalse(self.cache.is_fresh(entry))
+            self.cache.revalidated(entry)
+            self.assertTrue(self.cache.is_fresh(entry))
+        # The revalidation is persisted.
+        self.assertEqual(1060, self.make_cache().get('key').stored)
+
+    def test_validators(self):
+        # Entries are revalidated using the stored ETag and Last-Modified.
+        headers = {
+            'ETag': '"abc"',
+            'Last-Modified': 'Tue, 15 Nov 1994 08:12:31 GMT',
+        }
+        entry = self.store('key', ['data'], headers)
+        self.assertEqual({
+            'If-None-Match': '"abc"',
+            'If-Modified-Since': 'Tue, 15 Nov 1994 08:12:31 GMT',
+        }, entry.validators())
+        self.assertEqual('"abc"', entry.etag)
+
+    def test_etag_from_digest(self):
+        # If juju-core does not provide an ETag, the digest is used.
+        entry = self.store('key', ['data'])
+        self.assertEqual({}, entry.validators())
+        self.assertEqual('"{}"'.format(entry.digest), entry.etag)
+
+    def test_status(self):
+        # The cache usage is reported.
+        hits, misses = charmcache._hits.value, charmcache._misses.value
+        self.store('key', ['data'])
+        self.cache.get('missing')
+        self.cache.open(self.cache.get('key')).close()
+        status = self.cache.status()
+        self.assertEqual(1, status['entries'])
+        self.assertEqual(4, status['size'])
+        self.assertEqual(10, status['max_size'])
+        self.assertEqual(hits + 1, status['hits'])
+        self.assertEqual(misses + 1, status['misses'])
@@ -75,6 +75,17 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         # Ensure the provided callback has been called both times.
         self.assertEqual(['hello', 'world'], self.received)
 
+    @gen_test
+    def test_set_message_callback(self):
+        # The callback can be replaced after the connection is established.
+        client = yield self.connect()
+        received = []
+        client.set_message_callback(received.append)
+        client.write_message('hello')
+        yield client.read_message()
+        self.assertEqual([], self.received)
+        self.assertEqual(['hello'], received)
+
     @gen_test
     def test_customized_headers(self):
         # Customized headers can be passed when connecting the WebSocket.
@@ -84,6 +95,17 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         self.assertIn('Origin', headers)
         self.assertEqual(origin, headers['Origin'])
 
+    @gen_test
+    def test_connections_metric(self):
+        # The open connections are tracked.
+        gauge = clients._connections
+        value = gauge.value
+        client = yield self.connect()
+        self.assertEqual(value + 1, gauge.value)
+        client.close()
+        yield client.read_message()
+        self.assertEqual(value, gauge.value)
+
     @gen_test
     def test_connection_close(self):
         # The client connection is correctly terminated.
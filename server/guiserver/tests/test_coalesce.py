@@ -0,0 +1,154 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server coalescing of identical proxy requests."""
+
+import mock
+from tornado import httpclient
+from tornado.testing import (
+    AsyncTestCase,
+    gen_test,
+)
+
+from guiserver import coalesce
+from guiserver.tests import helpers
+
+
+class TestRequestKey(AsyncTestCase):
+
+    def make_request(self, url='https://example.com/path', **headers):
+        return httpclient.HTTPRequest(url, headers=headers)
+
+    def test_identical(self):
+        # Identical requests share the key.
+        self.assertEqual(
+            coalesce.request_key(self.make_request(Accept='text/plain')),
+            coalesce.request_key(self.make_request(Accept='text/plain')))
+
+    def test_url(self):
+        # Requests for different URLs have different keys.
+        self.assertNotEqual(
+            coalesce.request_key(self.make_request()),
+            coalesce.request_key(self.make_request('https://example.com/')))
+
+    def test_headers(self):
+        # Only the headers which can change the response are relevant.
+        key = coalesce.request_key(self.make_request(Authorization='Basic a'))
+        self.assertNotEqual(
+            key,
+            coalesce.request_key(self.make_request(Authorization='Basic b')))
+        self.assertEqual(
+            key,
+            coalesce.request_key(
+                self.make_request(Authorization='Basic a', Referer='/')))
+
+
+class TestSingleFlight(AsyncTestCase):
+
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.flights = coalesce.SingleFlight(
+            timeout=0.05, max_size=10, io_loop=self.io_loop)
+        self.request = httpclient.HTTPRequest('https://example.com/path')
+        self.flight = self.flights.start('key', self.request)
+
+    def test_start(self):
+        # Flights in progress are registered.
+        self.assertIs(self.flight, self.flights.get('key'))
+        self.assertIsNone(self.flights.get('other'))
+        self.assertEqual(1, len(self.flights))
+
+    @gen_test
+    def test_streamed_response(self):
+        # Streamed responses are recorded and shared with the waiters.
+        saved = coalesce._saved.value
+        future = self.flight.wait()
+        self.flight.write('hi ')
+        self.flight.write('world')
+        self.flight.commit(200, {'Content-Type': 'text/plain'})
+        self.flight.finish(None)
+        response = yield future
+        self.assertEqual(200, response.code)
+        self.assertEqual('hi world', response.body)
+        self.assertEqual({'Content-Type': 'text/plain'}, response.headers)
+        self.assertEqual(saved + 1, coalesce._saved.value)
+        # The flight is no longer shared.
+        self.assertEqual(0, len(self.flights))
+
+    @gen_test
+    def test_buffered_response(self):
+        # Responses which have not been streamed are shared.
+        future = self.flight.wait()
+        original = helpers.make_response(404, body='not found')
+        self.flight.finish(original)
+        response = yield future
+        self.assertIs(original, response)
+
+    @gen_test
+    def test_failure(self):
+        # Waiters fetch the response themselves if the fetch fails.
+        fallbacks = coalesce._fallbacks.value
+        future = self.flight.wait()
+        self.flight.write('partial')
+        self.flight.abort()
+        self.flight.finish(None)
+        response = yield future
+        self.assertIsNone(response)
+        self.assertEqual(fallbacks + 1, coalesce._fallbacks.value)
+
+    @gen_test
+    def test_too_large(self):
+        # Waiters are released as soon as the response is too large.
+        future = self.flight.wait()
+        self.flight.write('0123456789')
+        self.assertFalse(future.done())
+        self.flight.write('a')
+        response = yield future
+        self.assertIsNone(response)
+        self.assertEqual(0, len(self.flights))
+        # New requests do not wait for this flight.
+        self.flight.commit(200, {})
+        self.flight.finish(None)
+
+    @gen_test
+    def test_timeout(self):
+        # Waiters are released if the response is not received in time.
+        fallbacks = coalesce._fallbacks.value
+        future = self.flight.wait()
+        response = yield future
+        self.assertIsNone(response)
+        self.assertEqual(fallbacks + 1, coalesce._fallbacks.value)
+        # The flight is still in progress.
+        self.assertIs(self.flight, self.flights.get('key'))
+
+    def test_sink(self):
+        # The sink of the request performing the fetch is wrapped.
+        sink = mock.Mock(headers={'Cache-Control': 'public'})
+        flight = self.flights.start('other', self.request, sink)
+        self.assertEqual({'Cache-Control': 'public'}, flight.headers)
+        flight.write('chunk')
+        sink.write.assert_called_once_with('chunk')
+        flight.commit(200, {})
+        sink.commit.assert_called_once_with(200, {})
+        flight.abort()
+        sink.abort.assert_called_once_with()
+
+    def test_remove(self):
+        # Only the registered flight is removed.
+        other = self.flights.start('key', self.request)
+        self.flights.remove(self.flight)
+        self.assertIs(other, self.flights.get('key'))
+        self.flights.remove(other)
+        self.assertEqual(0, len(self.flights))
@@ -0,0 +1,287 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server WebSocket compression."""
+
+import unittest
+import zlib
+
+import mock
+from tornado import (
+    concurrent,
+    web,
+    websocket,
+)
+from tornado.testing import (
+    AsyncHTTPSTestCase,
+    gen_test,
+)
+
+from guiserver import (
+    clients,
+    compression,
+    handlers,
+)
+from guiserver.tests import helpers
+
+
+class TestParseExtensions(unittest.TestCase):
+
+    def test_empty(self):
+        # An empty list is returned if no extensions are included.
+        self.assertEqual([], compression.parse_extensions(''))
+
+    def test_extensions(self):
+        # Extensions and their parameters are correctly parsed.
+        header = (
+            'permessage-deflate; client_max_window_bits; '
+            'server_max_window_bits="10", x-webkit-deflate-frame')
+        expected = [
+            ('permessage-deflate', {
+                'client_max_window_bits': None,
+                'server_max_window_bits': '10',
+            }),
+            ('x-webkit-deflate-frame', {}),
+        ]
+        self.assertEqual(expected, compression.parse_extensions(header))
+
+
+class TestNegotiate(unittest.TestCase):
+
+    options = compression.DeflateOptions(level=6, max_window_bits=15)
+
+    def test_accepted(self):
+        # A permessage-deflate offer is accepted.
+        response, deflate = compression.negotiate(
+            'permessage-deflate; client_max_window_bits', self.options)
+        self.assertEqual('permessage-deflate', response)
+        self.assertIsInstance(deflate, compression.PerMessageDeflate)
+
+    def test_no_offers(self):
+        # None is returned if the client does not offer the extension.
+        self.assertIsNone(compression.negotiate('', self.options))
+        self.assertIsNone(
+            compression.negotiate('x-webkit-deflate-frame', self.options))
+
+    def test_server_parameters(self):
+        # Server parameters requested by the client are honored.
+        response, _ = compression.negotiate(
+            'permessage-deflate; server_no_context_takeover; '
+            'server_max_window_bits=10', self.options)
+        self.assertEqual(
+            'permessage-deflate; server_no_context_takeover; '
+            'server_max_window_bits=10', response)
+
+    def test_server_window(self):
+        # The configured window size is included in the response.
+        options = compression.DeflateOptions(max_window_bits=12)
+        response, _ = compression.negotiate('permessage-deflate', options)
+        self.assertEqual(
+            'permessage-deflate; server_max_window_bits=12', response)
+
+    def test_unsupported_offers(self):
+        # Offers including unsupported parameters are declined, and the next
+        # offer is considered.
+        header = (
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; unknown, '
+            'permessage-deflate; server_no_context_takeover')
+        response, _ = compression.negotiate(header, self.options)
+        self.assertEqual(
+            'permessage-deflate; server_no_context_takeover', response)
+
+
+class TestAcceptResponse(unittest.TestCase):
+
+    options = compression.DeflateOptions()
+
+    def test_accepted(self):
+        # A PerMessageDeflate is returned if the server accepted the offer.
+        deflate = compression.accept_response(
+            'permessage-deflate; client_max_window_bits=10', self.options)
+        self.assertIsInstance(deflate, compression.PerMessageDeflate)
+
+    def test_declined(self):
+        # None is returned if the server did not accept the offer.
+        self.assertIsNone(compression.accept_response('', self.options))
+
+    def test_invalid(self):
+        # A ValueError is raised if the server response is not valid.
+        with self.assertRaises(ValueError):
+            compression.accept_response(
+                'permessage-deflate; client_max_window_bits=42', self.options)
+
+
+class TestPerMessageDeflate(unittest.TestCase):
+
+    message = b'{"RequestId": 1, "Type": "Client"}' * 20
+
+    def make_deflate(self, no_context_takeover=False, min_size=100):
+        return compression.PerMessageDeflate(
+            6, 15, no_context_takeover, min_size)
+
+    def test_round_trip(self):
+        # Compressed messages can be decompressed.
+        deflate = self.make_deflate()
+        compressed = deflate.compress(self.message)
+        self.assertLess(len(compressed), len(self.message))
+        self.assertEqual(self.message, deflate.decompress(compressed))
+
+    def test_trailer(self):
+        # The empty deflate block trailer is removed from messages.
+        compressed = self.make_deflate().compress(self.message)
+        self.assertFalse(compressed.endswith(b'\x00\x00\xff\xff'))
+
+    def test_context_takeover(self):
+        # By default, the compression context is reused between messages.
+        deflate = self.make_deflate()
+        first = deflate.compress(self.message)
+        second = deflate.compress(self.message)
+        self.assertLess(len(second), len(first))
+        self.assertEqual(self.message, deflate.decompress(first))
+        self.assertEqual(self.message, deflate.decompress(second))
+
+    def test_no_context_takeover(self):
+        # The compression context can be reset for each message.
+        deflate = self.make_deflate(no_context_takeover=True)
+        first = deflate.compress(self.message)
+        self.assertEqual(first, deflate.compress(self.message))
+
+    def test_threshold(self):
+        # Messages smaller than the threshold are not compressed.
+        self.assertIsNone(self.make_deflate().compress(b'{}'))
+
+    def test_invalid_data(self):
+        # A zlib.error is raised when decompressing invalid data.
+        with self.assertRaises(zlib.error):
+            self.make_deflate().decompress(b'\xff' * 10)
+
+    def test_too_big(self):
+        # A ValueError is raised if the decompressed message is too big.
+        deflate = self.make_deflate()
+        compressed = deflate.compress(b'0' * 1000)
+        with mock.patch('guiserver.compression.MAX_MESSAGE_SIZE', 100):
+            with self.assertRaises(ValueError):
+                deflate.decompress(compressed)
+
+
+class EchoHandler(handlers._WebSocketBaseHandler):
+    """A WebSocket server echoing back messages, supporting compression."""
+
+    def initialize(self, options, close_future):
+        self.compression = options
+        self.close_future = close_future
+
+    def on_message(self, message):
+        self.write_message(message)
+
+    def on_close(self):
+        self.close_future.set_result(None)
+
+
+class TestDeflateProtocol(AsyncHTTPSTestCase, helpers.WSSTestMixin):
+
+    message = '{"RequestId": 1, "Response": {}}' * 20
+
+    def get_app(self):
+        self.server_options = compression.DeflateOptions(min_size=100)
+        self.server_closed_future = concurrent.Future()
+        options = {
+            'options': self.server_options,
+            'close_future': self.server_closed_future,
+        }
+        return web.Application([(r'/', EchoHandler, options)])
+
+    def connect(self, options):
+        """Return a future whose result is a connected client.
+
+        The client offers compression if options are provided.
+        """
+        patcher = mock.patch.object(
+            clients.WebSocketClientConnection, 'compression', options)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return clients.websocket_connect(
+            self.io_loop, self.get_wss_url('/'), lambda message: None)
+
+    @gen_test
+    def test_compressed(self):
+        # Messages are compressed when both peers support the extension.
+        client = yield self.connect(compression.DeflateOptions(min_size=100))
+        self.assertIsInstance(client.protocol, compression.DeflateProtocol)
+        self.assertEqual(
+            'permessage-deflate', client.headers['Sec-WebSocket-Extensions'])
+        with mock.patch.object(
+                client.protocol.deflate, 'compress',
+                wraps=client.protocol.deflate.compress) as mock_compress:
+            client.write_message(self.message)
+            message = yield client.read_message()
+        self.assertEqual(self.message, message)
+        mock_compress.assert_called_once_with(self.message)
+        client.close()
+        yield self.server_closed_future
+
+    @gen_test
+    def test_small_messages(self):
+        # Messages below the threshold are exchanged uncompressed.
+        client = yield self.connect(compression.DeflateOptions(min_size=100))
+        client.write_message('hello')
+        message = yield client.read_message()
+        self.assertEqual('hello', message)
+
+    @gen_test
+    def test_not_offered(self):
+        # Clients not offering compression are served without it.
+        client = yield self.connect(None)
+        self.assertNotIsInstance(
+            client.protocol, compression.DeflateProtocol)
+        self.assertNotIn('Sec-WebSocket-Extensions', client.headers)
+        client.write_message(self.message)
+        message = yield client.read_message()
+        self.assertEqual(self.message, message)
+
+    @gen_test
+    def test_unsupported_tornado(self):
+        # Compression is not offered if the Tornado release is not the one
+        # the handshake has been written for.
+        with mock.patch('guiserver.clients._deflate_supported', False):
+            client = yield self.connect(compression.DeflateOptions())
+        self.assertNotIsInstance(
+            client.protocol, compression.DeflateProtocol)
+        self.assertNotIn(
+            'Sec-WebSocket-Extensions', client.request.headers)
+
+    def test_invalid_handshake(self):
+        # Invalid handshake responses are rejected.
+        client = clients.WebSocketClientConnection.__new__(
+            clients.WebSocketClientConnection)
+        client.key = 'key'
+        accept = websocket.WebSocketProtocol13.compute_accept_value('key')
+        client.headers = {
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-Websocket-Accept': accept,
+        }
+        client._check_handshake(101)
+        with self.assertRaises(websocket.WebSocketError) as context:
+            client._check_handshake(200)
+        self.assertEqual(
+            'unexpected handshake response code: 200', str(context.exception))
+        client.headers['Sec-Websocket-Accept'] = 'bad-key'
+        with self.assertRaises(websocket.WebSocketError) as context:
+            client._check_handshake(101)
+        self.assertEqual(
+            'invalid Sec-WebSocket-Accept header', str(context.exception))
@@ -0,0 +1,201 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server Juju API controllers failover."""
+
+import datetime
+import unittest
+
+import mock
+from tornado import concurrent
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
+
+from guiserver import failover
+
+
+class TestController(unittest.TestCase):
+
+    def test_rtt(self):
+        # The round trip time is tracked as a moving average.
+        controller = failover.Controller('1.2.3.4:17070')
+        self.assertIsNone(controller.rtt)
+        controller.succeeded(1)
+        self.assertEqual(1, controller.rtt)
+        controller.succeeded(2)
+        self.assertAlmostEqual(1 + failover.RTT_WEIGHT, controller.rtt)
+
+    def test_health(self):
+        # A controller is unhealthy for a while after failing.
+        controller = failover.Controller('1.2.3.4:17070')
+        self.assertTrue(controller.healthy(100, 30))
+        controller.failed(100)
+        self.assertEqual(1, controller.failures)
+        self.assertFalse(controller.healthy(110, 30))
+        self.assertTrue(controller.healthy(131, 30))
+        controller.succeeded(1)
+        self.assertEqual(0, controller.failures)
+        self.assertTrue(controller.healthy(110, 30))
+
+
+class TestControllers(LogTrapTestCase, AsyncTestCase):
+
+    addresses = ('1.2.3.4:17070', '1.2.3.5:17070', '1.2.3.6:17070')
+    path = '/environment/env-uuid/api'
+
+    def setUp(self):
+        super(TestControllers, self).setUp()
+        # Map URLs to the Futures returned when connecting.
+        self.attempts = {}
+        patcher = mock.patch(
+            'guiserver.failover.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controllers = failover.Controllers(
+            self.addresses, connect_timeout=1, stagger=0.05,
+            io_loop=self.io_loop)
+
+    def websocket_connect(self, io_loop, url, callback, headers=None,
+                          connect_timeout=None, request_timeout=None):
+        """Return a pending Future, storing it in self.attempts."""
+        self.assertEqual(1, connect_timeout)
+        self.assertEqual(1, request_timeout)
+        future = self.attempts[url] = concurrent.Future()
+        return future
+
+    def url(self, address):
+        """Return the Juju API URL for the given address."""
+        return 'wss://{}{}'.format(address, self.path)
+
+    def succeed(self, address):
+        """Simulate a successful connection to the given address.
+
+        Return the mock connection.
+        """
+        connection = mock.Mock()
+        self.attempts[self.url(address)].set_result(connection)
+        self.run_callbacks()
+        return connection
+
+    def fail(self, address):
+        """Simulate a failed connection to the given address."""
+        self.attempts[self.url(address)].set_exception(ValueError('bad wolf'))
+        with ExpectLog('', 'failover: unable to connect', required=True):
+            self.run_callbacks()
+
+    def run_callbacks(self):
+        """Run the callbacks currently scheduled in the IO loop."""
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+    def sleep(self, seconds):
+        """Run the IO loop for the given number of seconds."""
+        self.io_loop.add_timeout(
+            datetime.timedelta(seconds=seconds), self.stop)
+        self.wait()
+
+    def connect(self, address=None):
+        """Connect to the Juju API and return the resulting Future."""
+        if address is None:
+            address = self.addresses[0]
+        return self.controllers.connect(
+            self.url(address), mock.Mock(), headers={'Origin': 'https://gui'})
+
+    def test_candidates(self):
+        # Initially the controllers are tried in the given order.
+        candidates = self.controllers.candidates(self.url(self.addresses[1]))
+        self.assertEqual(
+            [self.url(address) for address in self.addresses],
+            [url for _, url in candidates])
+
+    def test_candidates_unknown_address(self):
+        # Unknown addresses are returned as they are.
+        url = self.url('4.3.2.1:17070')
+        self.assertEqual(
+            [(None, url)], self.controllers.candidates(url))
+
+    def test_preferred_controller(self):
+        # The first controller is tried first, and the others are not tried
+        # if it connects quickly.
+        future = self.connect()
+        connection = self.succeed(self.addresses[0])
+        self.assertIs(connection, future.result())
+        self.sleep(0.1)
+        self.assertEqual([self.url(self.addresses[0])], self.attempts.keys())
+
+    def test_message_callback(self):
+        # The message callback is only set on the winning connection.
+        callback = mock.Mock()
+        self.controllers.connect(self.url(self.addresses[0]), callback)
+        connection = self.succeed(self.addresses[0])
+        connection.set_message_callback.assert_called_once_with(callback)
+
+    def test_race(self):
+        # The next controller is tried if the previous one is slow, and the
+        # first connection established wins.
+        future = self.connect()
+        self.sleep(0.07)
+        self.assertEqual(2, len(self.attempts))
+        connection = self.succeed(self.addresses[1])
+        self.assertIs(connection, future.result())
+        # The slow connection is closed if it completes later.
+        slow_connection = self.succeed(self.addresses[0])
+        slow_connection.close.assert_called_once_with()
+        self.assertFalse(slow_connection.set_message_callback.called)
+
+    def test_fail_fast(self):
+        # The next controller is tried as soon as an attempt fails.
+        future = self.connect()
+        self.fail(self.addresses[0])
+        self.assertIn(self.url(self.addresses[1]), self.attempts)
+        connection = self.succeed(self.addresses[1])
+        self.assertIs(connection, future.result())
+        # The failing controller is now tried last.
+        candidates = self.controllers.candidates(self.url(self.addresses[0]))
+        self.assertEqual(
+            [self.addresses[1], self.addresses[2], self.addresses[0]],
+            [controller.address for controller, _ in candidates])
+
+    def test_all_failing(self):
+        # The error is propagated if no controllers can be reached.
+        future = self.connect()
+        for address in self.addresses:
+            self.fail(address)
+        self.assertIsInstance(future.exception(), ValueError)
+
+    def test_fastest_preferred(self):
+        # Controllers with the lowest round trip time are preferred.
+        for controller, rtt in zip(self.controllers._sorted(0), (3, 1, 2)):
+            controller.succeeded(rtt)
+        candidates = self.controllers.candidates(self.url(self.addresses[0]))
+        self.assertEqual(
+            [self.addresses[1], self.addresses[2], self.addresses[0]],
+            [controller.address for controller, _ in candidates])
+
+    def test_status(self):
+        # The status includes the controllers statistics.
+        self.connect()
+        self.succeed(self.addresses[0])
+        status = self.controllers.status()
+        self.assertEqual(
+            list(self.addresses), [info['address'] for info in status])
+        self.assertTrue(status[0]['healthy'])
+        self.assertEqual(0, status[0]['failures'])
+        self.assertIsNotNone(status[0]['rtt'])
+        self.assertIsNone(status[1]['rtt'])
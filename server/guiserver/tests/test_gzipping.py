@@ -0,0 +1,148 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server compression of proxied responses."""
+
+import gzip
+from io import BytesIO
+import unittest
+
+from tornado import (
+    httpserver,
+    httputil,
+)
+
+from guiserver import gzipping
+
+
+def decompress(data):
+    """Return the given gzip compressed data decompressed."""
+    return gzip.GzipFile(fileobj=BytesIO(data)).read()
+
+
+class TestIsCompressible(unittest.TestCase):
+
+    def test_compressible(self):
+        # Text-like content types are compressible.
+        for content_type in (
+                'application/json', 'image/svg+xml', 'text/markdown',
+                'text/plain; charset=UTF-8', 'Application/JSON'):
+            self.assertTrue(
+                gzipping.is_compressible(content_type), content_type)
+
+    def test_not_compressible(self):
+        # Binary content types are not compressible.
+        for content_type in ('application/zip', 'image/png', ''):
+            self.assertFalse(
+                gzipping.is_compressible(content_type), content_type)
+
+
+class TestGzipTransform(unittest.TestCase):
+
+    body = 'x' * 1000
+
+    def make_transform(self, method='GET', accept_encoding='gzip, deflate'):
+        """Create and return a transform for a request."""
+        headers = {}
+        if accept_encoding:
+            headers['Accept-Encoding'] = accept_encoding
+        request = httpserver.HTTPRequest(method, '/path', headers=headers)
+        return gzipping.GzipTransform(request, min_size=10)
+
+    def make_headers(self, **kwargs):
+        """Create and return response headers."""
+        headers = httputil.HTTPHeaders({'Content-Type': 'application/json'})
+        headers.update(kwargs)
+        return headers
+
+    def test_complete_response(self):
+        # Complete responses are compressed.
+        transform = self.make_transform()
+        saved = gzipping._saved.value
+        code, headers, chunk = transform.transform_first_chunk(
+            200, self.make_headers(), self.body, True)
+        self.assertEqual(200, code)
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', headers['Vary'])
+        self.assertEqual(str(len(chunk)), headers['Content-Length'])
+        self.assertEqual(self.body, decompress(chunk))
+        self.assertEqual(
+            saved + len(self.body) - len(chunk), gzipping._saved.value)
+
+    def test_streamed_response(self):
+        # Streamed responses are compressed chunk by chunk, and their length
+        # is removed.
+        transform = self.make_transform()
+        headers = self.make_headers(**{'Content-Length': '2000'})
+        _, headers, first = transform.transform_first_chunk(
+            200, headers, self.body, False)
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        last = transform.transform_chunk(self.body, True)
+        self.assertEqual(self.body * 2, decompress(first + last))
+
+    def test_weak_etag(self):
+        # Strong entity tags are made weak.
+        transform = self.make_transform()
+        _, headers, _ = transform.transform_first_chunk(
+            200, self.make_headers(Etag='"v1"'), self.body, True)
+        self.assertEqual('W/"v1"', headers['Etag'])
+
+    def test_vary(self):
+        # Accept-Encoding is added to the existing Vary header.
+        transform = self.make_transform()
+        _, headers, _ = transform.transform_first_chunk(
+            200, self.make_headers(Vary='Cookie'), self.body, True)
+        self.assertEqual('Cookie, Accept-Encoding', headers['Vary'])
+
+    def assert_not_compressed(self, transform, code=200, headers=None):
+        """Ensure the response is not compressed by the given transform."""
+        if headers is None:
+            headers = self.make_headers()
+        _, headers, chunk = transform.transform_first_chunk(
+            code, headers, self.body, False)
+        self.assertNotEqual('gzip', headers.get('Content-Encoding'))
+        self.assertEqual(self.body, chunk)
+        self.assertEqual('more', transform.transform_chunk('more', True))
+
+    def test_not_accepted(self):
+        # Responses are not compressed if the client does not accept gzip.
+        self.assert_not_compressed(self.make_transform(accept_encoding=None))
+
+    def test_head(self):
+        # Responses to HEAD requests are not compressed.
+        self.assert_not_compressed(self.make_transform(method='HEAD'))
+
+    def test_binary(self):
+        # Binary responses are not compressed.
+        self.assert_not_compressed(
+            self.make_transform(),
+            headers=self.make_headers(**{'Content-Type': 'image/png'}))
+
+    def test_already_encoded(self):
+        # Responses already encoded are not compressed again.
+        self.assert_not_compressed(
+            self.make_transform(),
+            headers=self.make_headers(**{'Content-Encoding': 'br'}))
+
+    def test_small(self):
+        # Responses smaller than the threshold are not compressed.
+        self.assert_not_compressed(
+            self.make_transform(),
+            headers=self.make_headers(**{'Content-Length': '5'}))
+
+    def test_partial_content(self):
+        # Partial content responses are not compressed.
+        self.assert_not_compressed(self.make_transform(), code=206)
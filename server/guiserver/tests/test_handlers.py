@@ -16,6 +16,9 @@
 
 """Tests for the Juju GUI server handlers."""
 
+import functools
+import gzip
+from io import BytesIO
 import json
 import os
 import shutil
@@ -28,6 +31,7 @@ from tornado import (
     escape,
     gen,
     httpclient,
+    ioloop,
     web,
 )
 from tornado.testing import (
@@ -40,12 +44,23 @@ from tornado.testing import (
 import yaml
 
 from guiserver import (
+    apicache,
     apps,
     auth,
+    batching,
+    breaker,
+    charmcache,
     clients,
+    coalesce,
     get_version,
+    gzipping,
     handlers,
+    httppool,
+    icons,
+    latency,
     manage,
+    resume,
+    streaming,
 )
 from guiserver.bundles import base
 from guiserver.tests import helpers
@@ -56,6 +71,8 @@ class WebSocketHandlerTestMixin(object):
 
     auth_backend = auth.get_backend(manage.DEFAULT_API_VERSION)
     hello_message = json.dumps({'hello': 'world'})
+    # The batching options passed to the WebSocket handler.
+    batching_options = None
 
     def get_app(self):
         # In test cases including this mixin a WebSocket server is created.
@@ -70,7 +87,7 @@ class WebSocketHandlerTestMixin(object):
         self.api_close_future = concurrent.Future()
         self.deployer = base.Deployer(
             self.apiurl, manage.DEFAULT_API_VERSION, io_loop=self.io_loop)
-        self.tokens = auth.AuthenticationTokenHandler(io_loop=self.io_loop)
+        self.tokens = auth.AuthenticationTokenHandler()
         echo_options = {
             'close_future': self.api_close_future,
             'io_loop': self.io_loop,
@@ -82,18 +99,20 @@ class WebSocketHandlerTestMixin(object):
             'io_loop': self.io_loop,
             'tokens': self.tokens,
             'ws_url_template': apps.WEBSOCKET_URL_TEMPLATE,
+            'batching': self.batching_options,
         }
         return web.Application([
             (r'/echo', helpers.EchoWebSocketHandler, echo_options),
             (r'/ws', handlers.WebSocketHandler, ws_options),
         ])
 
-    def make_client(self):
+    def make_client(self, headers=None):
         """Return a WebSocket client ready to be connected to the server."""
         url = self.get_wss_url('/ws')
         # The client callback is tested elsewhere.
         callback = lambda message: None
-        return clients.websocket_connect(self.io_loop, url, callback)
+        return clients.websocket_connect(
+            self.io_loop, url, callback, headers=headers)
 
     def make_handler(self, headers=None, mock_protocol=False, path=None):
         """Create and return a WebSocketHandler instance."""
@@ -101,7 +120,7 @@ class WebSocketHandlerTestMixin(object):
             headers = {}
         if path is None:
             path = ''
-        request = mock.Mock(headers=headers, path=path)
+        request = mock.Mock(headers=headers, path=path, uri=path)
         handler = handlers.WebSocketHandler(self.get_app(), request)
         if mock_protocol:
             # Mock the underlying connection protocol.
@@ -229,6 +248,17 @@ class TestWebSocketHandlerConnection(
         subprotocol = handler.select_subprotocol(['foo', 'bar'])
         self.assertEqual('foo', subprotocol)
 
+    @gen_test
+    def test_connections_metric(self):
+        # The open browser connections are tracked.
+        gauge = handlers._browser_connections
+        value = gauge.value
+        client = yield self.make_client()
+        self.assertEqual(value + 1, gauge.value)
+        client.close()
+        yield self.api_close_future
+        self.assertEqual(value, gauge.value)
+
 
 class TestWebSocketHandlerProxy(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
@@ -242,6 +272,36 @@ class TestWebSocketHandlerProxy(
         mock_juju_connection.write_message.assert_called_once_with(
             self.hello_message)
 
+    @gen_test
+    def test_from_browser_to_juju_not_decoded(self):
+        # Messages not intercepted by the GUI server are propagated to the
+        # Juju API server without being decoded.
+        handler = yield self.make_initialized_handler()
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'Client', 'Request': 'FullStatus'})
+        decode_path = 'guiserver.handlers.json_decode_dict'
+        with mock.patch(decode_path) as mock_decode:
+            with mock.patch.object(
+                    handler.juju_connection, 'write_message') as mock_write:
+                handler.on_message(message)
+        self.assertFalse(mock_decode.called)
+        mock_write.assert_called_once_with(message)
+
+    @gen_test
+    def test_from_browser_to_juju_decoded(self):
+        # Messages possibly intercepted by the GUI server are decoded before
+        # being propagated to the Juju API server.
+        handler = yield self.make_initialized_handler()
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'Deployer', 'Request': 'Unknown'})
+        decode_path = 'guiserver.handlers.json_decode_dict'
+        with mock.patch(decode_path, side_effect=json.loads) as mock_decode:
+            with mock.patch.object(
+                    handler.juju_connection, 'write_message') as mock_write:
+                handler.on_message(message)
+        mock_decode.assert_called_once_with(message)
+        mock_write.assert_called_once_with(message)
+
     @gen_test
     def test_from_juju_to_browser(self):
         # A message from the remote server is returned to the browser.
@@ -250,6 +310,36 @@ class TestWebSocketHandlerProxy(
             handler.on_juju_message(self.hello_message)
             handler.write_message.assert_called_once_with(self.hello_message)
 
+    @gen_test
+    def test_from_juju_to_browser_not_decoded(self):
+        # Once the authentication is completed, messages from the remote
+        # server are relayed without being decoded.
+        handler = yield self.make_initialized_handler()
+        counter = handlers._juju_frames_raw
+        value = counter.value
+        decode_path = 'guiserver.handlers.json_decode_dict'
+        with mock.patch(decode_path) as mock_decode:
+            with mock.patch.object(handler, 'write_message'):
+                handler.on_juju_message(self.hello_message)
+                handler.write_message.assert_called_once_with(
+                    self.hello_message)
+        self.assertFalse(mock_decode.called)
+        self.assertEqual(value + 1, counter.value)
+
+    @gen_test
+    def test_from_juju_to_browser_decoded(self):
+        # Messages from the remote server are decoded while the
+        # authentication is in progress.
+        handler = yield self.make_initialized_handler()
+        counter = handlers._juju_frames_decoded
+        value = counter.value
+        with mock.patch.object(handler.auth, 'in_progress', return_value=True):
+            with mock.patch.object(handler, 'write_message'):
+                handler.on_juju_message(self.hello_message)
+                handler.write_message.assert_called_once_with(
+                    self.hello_message)
+        self.assertEqual(value + 1, counter.value)
+
     @gen_test
     def test_queued_messages(self):
         # Messages sent before the client connection is established are
@@ -265,6 +355,34 @@ class TestWebSocketHandlerProxy(
             yield initialization
         mock_write_message.assert_called_once_with(self.hello_message)
 
+    @gen_test
+    def test_queued_messages_metric(self):
+        # The messages waiting for the Juju API connection are tracked.
+        gauge = handlers._juju_queued_messages
+        value = gauge.value
+        handler = self.make_handler()
+        mock_path = 'guiserver.clients.WebSocketClientConnection.write_message'
+        with mock.patch(mock_path):
+            initialization = handler.initialize(
+                self.apiurl, self.auth_backend, self.deployer, self.tokens,
+                apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop)
+            handler.on_message(self.hello_message)
+            self.assertEqual(value + 1, gauge.value)
+            yield initialization
+        self.assertEqual(value, gauge.value)
+
+    @gen_test
+    def test_bytes_metrics(self):
+        # The size of the messages exchanged with the browser is tracked.
+        bytes_in = handlers._browser_bytes_in.value
+        bytes_out = handlers._browser_bytes_out.value
+        client = yield self.make_client()
+        client.write_message(self.hello_message)
+        yield client.read_message()
+        size = len(self.hello_message)
+        self.assertEqual(bytes_in + size, handlers._browser_bytes_in.value)
+        self.assertEqual(bytes_out + size, handlers._browser_bytes_out.value)
+
     @gen_test
     def test_end_to_end_proxy(self):
         # Messages are correctly forwarded from the client to the echo server
@@ -403,10 +521,9 @@ class TestWebSocketHandlerAuthentication(
         # It supports authenticating with a token.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        # The token has been used.
+        self.assertEqual(0, len(self.tokens._store))
         self.assertEqual(
             self.make_login_request(
                 request_id=42, username='user', password='passwd'),
@@ -423,10 +540,9 @@ class TestWebSocketHandlerAuthentication(
         # It correctly handles a token that will not authenticate.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        # The token has been used.
+        self.assertEqual(0, len(self.tokens._store))
         self.send_login_response(False)
         message = self.handler.ws_connection.write_message.call_args[0][0]
         self.assertEqual(
@@ -445,6 +561,702 @@ class TestWebSocketHandlerAuthentication(
         self.assertEqual(0, len(self.handler._juju_message_queue))
 
 
+class TestWebSocketHandlerMultiplex(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    def setUp(self):
+        super(TestWebSocketHandlerMultiplex, self).setUp()
+        self.connect_future = concurrent.Future()
+        self.multiplexer = mock.Mock()
+        self.multiplexer.connect.return_value = self.connect_future
+        self.handler = self.make_handler(mock_protocol=True)
+        self.handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop,
+            multiplexer=self.multiplexer)
+
+    def test_not_connected_before_login(self):
+        # The Juju API is not connected until the user logs in.
+        self.handler.on_message(self.hello_message)
+        self.assertFalse(self.handler.juju_connected)
+        self.assertFalse(self.multiplexer.connect.called)
+        self.assertEqual(
+            [self.hello_message], list(self.handler._juju_message_queue))
+
+    @gen_test
+    def test_login_joins_upstream(self):
+        # A shared upstream connection is joined when the user logs in, and
+        # queued messages are then sent.
+        self.handler.on_message(self.hello_message)
+        self.handler.on_message(self.make_login_request(encoded=True))
+        self.multiplexer.connect.assert_called_once_with(
+            self.apiurl, {'Origin': self.get_url('/echo')},
+            self.make_login_request(), self.handler.on_juju_message)
+        self.assertTrue(self.handler.auth.in_progress())
+        connection = mock.Mock()
+        self.connect_future.set_result(connection)
+        yield self.handler._juju_connected_future
+        self.assertTrue(self.handler.juju_connected)
+        self.assertIs(connection, self.handler.juju_connection)
+        connection.write_message.assert_called_once_with(self.hello_message)
+
+    @gen_test
+    def test_login_failure(self):
+        # The handler is not connected if the login fails.
+        self.handler.on_message(self.make_login_request(encoded=True))
+        self.connect_future.set_result(None)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertFalse(self.handler.juju_connected)
+        self.assertFalse(self.handler._juju_connected_future.done())
+
+    @gen_test
+    def test_connection_failure(self):
+        # The browser connection is closed if the Juju API cannot be reached.
+        self.handler.on_message(self.make_login_request(encoded=True))
+        self.connect_future.set_exception(ValueError('bad wolf'))
+        expected_log = '.*unable to connect to the Juju API'
+        with mock.patch.object(self.handler, 'close') as mock_close:
+            with ExpectLog('', expected_log, required=True):
+                yield gen.Task(self.io_loop.add_callback)
+        mock_close.assert_called_once_with()
+        self.assertFalse(self.handler.juju_connected)
+
+
+class TestWebSocketHandlerPool(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    @gen_test
+    def test_pooled_connection(self):
+        # The Juju API connection is requested to the pool if provided.
+        connection = mock.Mock()
+        connect_future = concurrent.Future()
+        connect_future.set_result(connection)
+        pool = mock.Mock()
+        pool.connect.return_value = connect_future
+        handler = self.make_handler(mock_protocol=True)
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop, pool=pool)
+        pool.connect.assert_called_once_with(
+            self.apiurl, handler.on_juju_message,
+            headers={'Origin': self.get_url('/echo')})
+        self.assertTrue(handler.juju_connected)
+        self.assertIs(connection, handler.juju_connection)
+
+
+class TestWebSocketHandlerBatching(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
+        AsyncHTTPSTestCase):
+
+    batching_options = batching.BatchOptions(max_size=3, delay=50)
+    batch_headers = {'Sec-WebSocket-Protocol': batching.SUBPROTOCOL}
+
+    def test_select_subprotocol(self):
+        # The batching sub-protocol is selected if requested.
+        handler = self.make_handler()
+        handler.batching = self.batching_options
+        subprotocol = handler.select_subprotocol(
+            ['foo', batching.SUBPROTOCOL])
+        self.assertEqual(batching.SUBPROTOCOL, subprotocol)
+        self.assertIsNotNone(handler._batcher)
+
+    def test_select_subprotocol_disabled(self):
+        # The batching sub-protocol is not selected if batching is disabled.
+        handler = self.make_handler()
+        subprotocol = handler.select_subprotocol(
+            [batching.SUBPROTOCOL, 'foo'])
+        self.assertEqual('foo', subprotocol)
+        self.assertIsNone(handler._batcher)
+        subprotocol = handler.select_subprotocol([batching.SUBPROTOCOL])
+        self.assertIsNone(subprotocol)
+
+    @gen_test
+    def test_batched_messages(self):
+        # Juju API messages are sent in batches to clients requesting it.
+        client = yield self.make_client(headers=self.batch_headers)
+        self.assertEqual(
+            batching.SUBPROTOCOL, client.headers['Sec-WebSocket-Protocol'])
+        client.write_message('{"RequestId": 1}')
+        client.write_message('{"RequestId": 2}')
+        message = yield client.read_message()
+        self.assertEqual('[{"RequestId": 1},{"RequestId": 2}]', message)
+
+    @gen_test
+    def test_legacy_clients(self):
+        # Clients not requesting batches receive a frame for each message.
+        client = yield self.make_client()
+        client.write_message('{"RequestId": 1}')
+        client.write_message('{"RequestId": 2}')
+        message = yield client.read_message()
+        self.assertEqual('{"RequestId": 1}', message)
+        message = yield client.read_message()
+        self.assertEqual('{"RequestId": 2}', message)
+
+
+class TestWebSocketHandlerLatency(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
+        AsyncHTTPSTestCase):
+
+    @gen_test
+    def test_latency(self):
+        # The latency of the Juju API calls is recorded.
+        api_latency = latency.ApiLatency()
+        handler = self.make_handler(mock_protocol=True)
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop,
+            latency=api_latency)
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'Client', 'Request': 'FullStatus'})
+        handler.on_message(message)
+        self.assertEqual({}, api_latency.status()['methods'])
+        handler.on_juju_message('{"RequestId": 1, "Response": {}}')
+        methods = api_latency.status()['methods']
+        self.assertEqual(['Client.FullStatus'], methods.keys())
+        self.assertEqual(1, methods['Client.FullStatus']['count'])
+        handler.on_close()
+
+
+class TestWebSocketHandlerReconnect(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    next_message = json.dumps({
+        'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Next', 'Id': '1'})
+
+    def connect_juju(self, url, callback, headers=None):
+        """Return a Future whose result is a mock Juju API connection."""
+        connection = mock.Mock()
+        self.connections.append(connection)
+        future = concurrent.Future()
+        future.set_result(connection)
+        return future
+
+    @gen.coroutine
+    def make_reconnecting_handler(self, reconnect_attempts=1):
+        """Create and return an initialized and authenticated handler."""
+        self.connections = []
+        controllers = mock.Mock()
+        controllers.connect.side_effect = self.connect_juju
+        handler = self.make_handler(mock_protocol=True)
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop,
+            controllers=controllers, reconnect_attempts=reconnect_attempts)
+        handler.user.username = 'user'
+        handler.user.password = 'passwd'
+        handler.user.is_authenticated = True
+        raise gen.Return(handler)
+
+    def written(self, connection):
+        """Return the decoded messages written to the given connection."""
+        return [
+            json.loads(call[0][0])
+            for call in connection.write_message.call_args_list]
+
+    def disconnect(self, handler):
+        """Simulate an unexpected Juju API disconnection.
+
+        Return the new Juju API connection.
+        """
+        expected_log = '.*Juju API unexpectedly disconnected'
+        with ExpectLog('', expected_log, required=True):
+            handler.on_juju_message(None)
+        return self.connections[-1]
+
+    @gen.coroutine
+    def respond(self, handler, connection, response):
+        """Respond to the last request sent to the given connection."""
+        request_id = self.written(connection)[-1]['RequestId']
+        handler.on_juju_message(
+            json.dumps(dict(response, RequestId=request_id)))
+        yield gen.Task(self.io_loop.add_callback)
+
+    @gen_test
+    def test_reconnect(self):
+        # The session is transparently restored when the Juju API connection
+        # is unexpectedly closed.
+        handler = yield self.make_reconnecting_handler()
+        connection = self.disconnect(handler)
+        self.assertFalse(handler.ws_connection.close.called)
+        yield gen.Task(self.io_loop.add_callback)
+        # The user logs in again.
+        request = self.written(connection)[0]
+        self.assertEqual(
+            self.make_login_request(request_id=request['RequestId']),
+            request)
+        # Messages are queued until the session is restored.
+        handler.on_message(self.hello_message)
+        self.assertFalse(handler.juju_connected)
+        yield self.respond(handler, connection, {'Response': {}})
+        self.assertTrue(handler.juju_connected)
+        self.assertIs(connection, handler.juju_connection)
+        self.assertEqual(
+            self.hello_message,
+            connection.write_message.call_args[0][0])
+        # The login response is not propagated to the browser.
+        self.assertFalse(handler.ws_connection.write_message.called)
+
+    @gen_test
+    def test_restart_watcher(self):
+        # The AllWatcher is restarted when reconnecting, and the pending
+        # AllWatcher.Next request is sent to the new watcher.
+        handler = yield self.make_reconnecting_handler()
+        handler.on_message(self.next_message)
+        connection = self.disconnect(handler)
+        yield gen.Task(self.io_loop.add_callback)
+        yield self.respond(handler, connection, {'Response': {}})
+        self.assertEqual('WatchAll', self.written(connection)[-1]['Request'])
+        yield self.respond(
+            handler, connection, {'Response': {'AllWatcherId': '2'}})
+        expected = {
+            'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Next', 'Id': '2'}
+        self.assertEqual(expected, self.written(connection)[-1])
+        # Subsequent requests are sent to the new watcher.
+        handler.on_message(self.next_message)
+        self.assertEqual(expected, self.written(connection)[-1])
+
+    @gen_test
+    def test_login_failure(self):
+        # The browser is disconnected if the user cannot log in again.
+        handler = yield self.make_reconnecting_handler()
+        ws_connection = handler.ws_connection
+        connection = self.disconnect(handler)
+        yield gen.Task(self.io_loop.add_callback)
+        with ExpectLog('', '.*unable to log in again', required=True):
+            yield self.respond(handler, connection, {'Error': 'bad wolf'})
+        ws_connection.close.assert_called_once_with()
+
+    @gen_test
+    def test_no_attempts_left(self):
+        # The browser is disconnected if reconnections are disabled.
+        handler = yield self.make_reconnecting_handler(reconnect_attempts=0)
+        ws_connection = handler.ws_connection
+        self.disconnect(handler)
+        ws_connection.close.assert_called_once_with()
+        self.assertEqual(1, len(self.connections))
+
+
+class TestWebSocketHandlerParking(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    park_message = json.dumps({
+        'RequestId': 2, 'Type': 'GUISession', 'Request': 'Park',
+        'Params': {}})
+    next_message = json.dumps({
+        'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Next', 'Id': '1'})
+
+    def setUp(self):
+        super(TestWebSocketHandlerParking, self).setUp()
+        self.connections = []
+        self.controllers = mock.Mock()
+        self.controllers.connect.side_effect = self.connect_juju
+        self.parking = resume.SessionParking(window=30, io_loop=self.io_loop)
+
+    def connect_juju(self, url, callback, headers=None):
+        """Return a Future whose result is a mock Juju API connection."""
+        connection = mock.Mock()
+        self.connections.append(connection)
+        future = concurrent.Future()
+        future.set_result(connection)
+        return future
+
+    @gen.coroutine
+    def make_parking_handler(self, token=None):
+        """Create and return an initialized handler.
+
+        If a token is provided, the session resumption is requested.
+        """
+        arguments = {}
+        if token is not None:
+            arguments['resume'] = [token]
+        request = mock.Mock(
+            headers={}, path='', uri='', arguments=arguments)
+        handler = handlers.WebSocketHandler(self.get_app(), request)
+        handler.ws_connection = mock.Mock()
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop,
+            controllers=self.controllers, parking=self.parking)
+        raise gen.Return(handler)
+
+    @gen.coroutine
+    def make_parked_session(self):
+        """Log in, watch, park and disconnect a session.
+
+        Return the resume token.
+        """
+        handler = yield self.make_parking_handler()
+        handler.on_message(self.make_login_request(encoded=True))
+        handler.on_juju_message(self.make_login_response(encoded=True))
+        handler.on_message(self.next_message)
+        handler.on_message(self.park_message)
+        response = self.written(handler)[-1]
+        handler.on_close()
+        raise gen.Return(response['Response']['Token'])
+
+    @gen.coroutine
+    def make_resumed_session(self, token):
+        """Resume the session parked under the given token and log in.
+
+        Return the handler.
+        """
+        handler = yield self.make_parking_handler(token=token)
+        handler.on_message(self.make_login_request(request_id=7, encoded=True))
+        handler.juju_connection.write_message.reset_mock()
+        handler.ws_connection.write_message.reset_mock()
+        raise gen.Return(handler)
+
+    def written(self, handler):
+        """Return the decoded messages sent to the browser."""
+        return [
+            json.loads(call[0][0])
+            for call in handler.ws_connection.write_message.call_args_list]
+
+    def juju_written(self, connection):
+        """Return the decoded messages sent to the given Juju connection."""
+        return [
+            json.loads(call[0][0])
+            for call in connection.write_message.call_args_list]
+
+    @gen_test
+    def test_park(self):
+        # Authenticated sessions are parked on disconnection.
+        token = yield self.make_parked_session()
+        self.assertEqual(1, len(self.parking))
+        connection = self.connections[0]
+        self.assertFalse(connection.close.called)
+        self.assertIs(connection, self.parking.resume(token).connection)
+
+    @gen_test
+    def test_park_unauthenticated(self):
+        # Anonymous users cannot park their sessions.
+        handler = yield self.make_parking_handler()
+        handler.on_message(self.park_message)
+        self.assertEqual(
+            'unauthorized access', self.written(handler)[0]['ErrorCode'])
+        handler.on_close()
+        yield gen.Task(self.io_loop.add_callback)
+        self.connections[0].close.assert_called_once_with()
+        self.assertEqual(0, len(self.parking))
+
+    @gen_test
+    def test_not_requested(self):
+        # Sessions are not parked unless a resume token has been requested.
+        handler = yield self.make_parking_handler()
+        handler.on_message(self.make_login_request(encoded=True))
+        handler.on_juju_message(self.make_login_response(encoded=True))
+        handler.on_close()
+        yield gen.Task(self.io_loop.add_callback)
+        self.connections[0].close.assert_called_once_with()
+        self.assertEqual(0, len(self.parking))
+
+    @gen_test
+    def test_resume(self):
+        # Resumed sessions adopt the parked connection, already logged in.
+        token = yield self.make_parked_session()
+        connection = self.connections[0]
+        handler = yield self.make_parking_handler(token=token)
+        self.assertEqual(1, self.controllers.connect.call_count)
+        self.assertTrue(handler.resumed)
+        self.assertTrue(handler.juju_connected)
+        self.assertIs(connection, handler.juju_connection)
+        connection.set_message_callback.assert_called_with(
+            handler.on_juju_message)
+        # The browser must log in again to use the session.
+        self.assertFalse(handler.user.is_authenticated)
+        handler.on_message(self.make_login_request(encoded=True))
+        self.assertTrue(handler.user.is_authenticated)
+        self.assertEqual('user', handler.user.username)
+        # The session reports it has been resumed.
+        handler.on_message(self.park_message)
+        self.assertTrue(self.written(handler)[-1]['Response']['Resumed'])
+
+    @gen_test
+    def test_resumed_not_logged_in(self):
+        # Requests sent before logging in are not relayed to Juju.
+        token = yield self.make_parked_session()
+        handler = yield self.make_parking_handler(token=token)
+        connection = handler.juju_connection
+        connection.write_message.reset_mock()
+        request = {'RequestId': 8, 'Type': 'Client', 'Request': 'FullStatus'}
+        handler.on_message(json.dumps(request))
+        response = self.written(handler)[0]
+        self.assertEqual(8, response['RequestId'])
+        self.assertEqual('unauthorized access', response['ErrorCode'])
+        self.assertFalse(connection.write_message.called)
+
+    @gen_test
+    def test_resumed_deltas(self):
+        # The AllWatcher deltas retained while parked are sent in response to
+        # the first AllWatcher.Next request for the parked AllWatcher, while
+        # the responses to the other requests of the previous page are
+        # discarded.
+        token = yield self.make_parked_session()
+        connection = self.connections[0]
+        callback = connection.set_message_callback.call_args[0][0]
+        callback('{"RequestId": 5, "Response": {"Service": "django"}}')
+        callback(json.dumps({
+            'RequestId': 3,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'x'}]]},
+        }))
+        handler = yield self.make_resumed_session(token)
+        handler.open()
+        self.assertEqual([], self.written(handler))
+        next_message = json.dumps({
+            'RequestId': 8, 'Type': 'AllWatcher', 'Request': 'Next',
+            'Id': '1'})
+        handler.on_message(next_message)
+        expected = {
+            'RequestId': 8,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'x'}]]},
+        }
+        self.assertEqual([expected], self.written(handler))
+        self.assertFalse(connection.write_message.called)
+        # Subsequent requests are sent to Juju.
+        handler.on_message(next_message)
+        connection.write_message.assert_called_once_with(next_message)
+
+    @gen_test
+    def test_resumed_deltas_other_watcher(self):
+        # The retained deltas are not sent to other AllWatchers.
+        token = yield self.make_parked_session()
+        connection = self.connections[0]
+        callback = connection.set_message_callback.call_args[0][0]
+        callback(json.dumps({
+            'RequestId': 3,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'x'}]]},
+        }))
+        handler = yield self.make_resumed_session(token)
+        next_message = json.dumps({
+            'RequestId': 8, 'Type': 'AllWatcher', 'Request': 'Next',
+            'Id': '2'})
+        handler.on_message(next_message)
+        self.assertEqual([], self.written(handler))
+        connection.write_message.assert_called_once_with(next_message)
+
+    @gen_test
+    def test_resumed_pending_next(self):
+        # A request for the parked AllWatcher receives the response to the
+        # request of the parked page, when it arrives.
+        token = yield self.make_parked_session()
+        handler = yield self.make_resumed_session(token)
+        connection = handler.juju_connection
+        handler.on_message(json.dumps({
+            'RequestId': 8, 'Type': 'AllWatcher', 'Request': 'Next',
+            'Id': '1'}))
+        self.assertEqual([], self.written(handler))
+        self.assertFalse(connection.write_message.called)
+        handler.on_juju_message(json.dumps({
+            'RequestId': 3,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'x'}]]},
+        }))
+        expected = {
+            'RequestId': 8,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'x'}]]},
+        }
+        self.assertEqual([expected], self.written(handler))
+
+    @gen_test
+    def test_resumed_watch_all(self):
+        # Starting a new AllWatcher stops the parked one, and the responses
+        # to the parked page requests are discarded.
+        token = yield self.make_parked_session()
+        handler = yield self.make_resumed_session(token)
+        connection = handler.juju_connection
+        watch_all = json.dumps(
+            {'RequestId': 8, 'Type': 'Client', 'Request': 'WatchAll'})
+        handler.on_message(watch_all)
+        stop, sent = self.juju_written(connection)
+        self.assertEqual(
+            ('AllWatcher', 'Stop', '1'),
+            (stop['Type'], stop['Request'], stop['Id']))
+        self.assertEqual(8, sent['RequestId'])
+        handler.on_juju_message(json.dumps(
+            {'RequestId': stop['RequestId'], 'Response': {}}))
+        handler.on_juju_message(json.dumps(
+            {'RequestId': 3, 'Error': 'watcher was stopped'}))
+        self.assertEqual([], self.written(handler))
+        handler.on_juju_message('{"RequestId": 8, "Response": {}}')
+        self.assertEqual([{'RequestId': 8, 'Response': {}}], self.written(
+            handler))
+
+    @gen_test
+    def test_resume_token_redacted(self):
+        # The resume token is not included in the access logs.
+        handler = yield self.make_parking_handler()
+        handler.request = mock.Mock(
+            method='GET', uri='/ws?resume=secret', remote_ip='127.0.0.1')
+        self.assertEqual(
+            'GET /ws?resume=REDACTED (127.0.0.1)',
+            handler._request_summary())
+
+    @gen_test
+    def test_resumed_login(self):
+        # Login requests are answered without contacting Juju.
+        token = yield self.make_parked_session()
+        handler = yield self.make_parking_handler(token=token)
+        connection = handler.juju_connection
+        connection.write_message.reset_mock()
+        handler.on_message(self.make_login_request(request_id=7, encoded=True))
+        self.assertEqual(
+            [self.make_login_response(request_id=7)], self.written(handler))
+        self.assertFalse(connection.write_message.called)
+
+    @gen_test
+    def test_resumed_login_other_user(self):
+        # The resumed session cannot be used by other users.
+        token = yield self.make_parked_session()
+        handler = yield self.make_parking_handler(token=token)
+        handler.on_message(
+            self.make_login_request(username='who', encoded=True))
+        response = self.written(handler)[0]
+        self.assertEqual('unauthorized access', response['ErrorCode'])
+        self.assertFalse(handler.user.is_authenticated)
+
+    @gen_test
+    def test_resume_unknown_token(self):
+        # A new connection is established if the session cannot be resumed.
+        handler = yield self.make_parking_handler(token='no-such')
+        self.assertEqual(1, self.controllers.connect.call_count)
+        self.assertFalse(handler.resumed)
+        self.assertFalse(handler.user.is_authenticated)
+
+
+class TestWebSocketHandlerResponseCache(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    request = {
+        'RequestId': 5,
+        'Type': 'Client',
+        'Request': 'ServiceGet',
+        'Params': {'ServiceName': 'mysql'},
+    }
+    response = {'RequestId': 5, 'Response': {'Service': 'mysql'}}
+
+    def setUp(self):
+        super(TestWebSocketHandlerResponseCache, self).setUp()
+        self.connections = []
+        self.controllers = mock.Mock()
+        self.controllers.connect.side_effect = self.connect_juju
+        self.cache = apicache.ResponseCache(
+            apicache.parse_methods('Client.ServiceGet:service'))
+
+    def connect_juju(self, url, callback, headers=None):
+        """Return a Future whose result is a mock Juju API connection."""
+        connection = mock.Mock()
+        self.connections.append(connection)
+        future = concurrent.Future()
+        future.set_result(connection)
+        return future
+
+    @gen.coroutine
+    def make_caching_handler(self, username='user'):
+        """Create and return an initialized and authenticated handler."""
+        handler = self.make_handler(mock_protocol=True)
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, io_loop=self.io_loop,
+            controllers=self.controllers, response_cache=self.cache)
+        handler.user.username = username
+        handler.user.password = 'passwd'
+        handler.user.is_authenticated = True
+        raise gen.Return(handler)
+
+    def written(self, handler):
+        """Return the decoded messages sent to the browser."""
+        return [
+            json.loads(call[0][0])
+            for call in handler.ws_connection.write_message.call_args_list]
+
+    @gen.coroutine
+    def cache_response(self):
+        """Send the request through a handler and cache its response."""
+        handler = yield self.make_caching_handler()
+        handler.on_message(json.dumps(self.request))
+        handler.juju_connection.write_message.assert_called_once_with(
+            json.dumps(self.request))
+        handler.on_juju_message(json.dumps(self.response))
+        self.assertEqual([self.response], self.written(handler))
+        self.assertEqual(1, len(self.cache))
+
+    @gen_test
+    def test_hit(self):
+        # Cached responses are sent without contacting the Juju API, using
+        # the request id of the caller.
+        yield self.cache_response()
+        handler = yield self.make_caching_handler()
+        handler.on_message(json.dumps(dict(self.request, RequestId=9)))
+        self.assertEqual(
+            [dict(self.response, RequestId=9)], self.written(handler))
+        self.assertFalse(handler.juju_connection.write_message.called)
+
+    @gen_test
+    def test_other_user(self):
+        # Cached responses are not shared between users.
+        yield self.cache_response()
+        handler = yield self.make_caching_handler(username='who')
+        handler.on_message(json.dumps(self.request))
+        self.assertTrue(handler.juju_connection.write_message.called)
+        self.assertEqual([], self.written(handler))
+
+    @gen_test
+    def test_unauthenticated(self):
+        # Requests sent by anonymous users are not cached.
+        handler = yield self.make_caching_handler()
+        handler.user.is_authenticated = False
+        handler.on_message(json.dumps(self.request))
+        handler.on_juju_message(json.dumps(self.response))
+        self.assertEqual(0, len(self.cache))
+
+    @gen_test
+    def test_not_cacheable(self):
+        # Responses to other requests are not cached.
+        handler = yield self.make_caching_handler()
+        handler.on_message(json.dumps(dict(self.request, Request='Status')))
+        handler.on_juju_message(json.dumps(self.response))
+        self.assertEqual(0, len(self.cache))
+
+    @gen_test
+    def test_invalidation(self):
+        # Cached responses are invalidated by related AllWatcher deltas.
+        yield self.cache_response()
+        handler = yield self.make_caching_handler()
+        handler.on_juju_message(json.dumps({
+            'RequestId': 3,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'a'}]]},
+        }))
+        self.assertEqual(0, len(self.cache))
+
+    @gen_test
+    def test_invalidation_without_decoding(self):
+        # AllWatcher deltas are relayed without being decoded.
+        raw = handlers._juju_frames_raw.value
+        decoded = handlers._juju_frames_decoded.value
+        handler = yield self.make_caching_handler()
+        with mock.patch('guiserver.handlers.json_decode_dict') as mock_decode:
+            handler.on_juju_message(json.dumps({
+                'RequestId': 3,
+                'Response': {'Deltas': [['service', 'change', {}]]},
+            }))
+        self.assertFalse(mock_decode.called)
+        self.assertEqual(raw + 1, handlers._juju_frames_raw.value)
+        self.assertEqual(decoded, handlers._juju_frames_decoded.value)
+
+    @gen_test
+    def test_cached_response_decoded(self):
+        # The responses to cache are decoded, and counted as such.
+        raw = handlers._juju_frames_raw.value
+        decoded = handlers._juju_frames_decoded.value
+        yield self.cache_response()
+        self.assertEqual(raw, handlers._juju_frames_raw.value)
+        self.assertEqual(decoded + 1, handlers._juju_frames_decoded.value)
+
+
 class TestWebSocketHandlerBundles(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin,
         helpers.BundlesTestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
@@ -538,6 +1350,16 @@ class TestWebSocketHandlerChangeSet(
         yield handler.on_message(self.request)
         mock_write_message().assert_called_once_with(self.response)
 
+    @gen_test
+    def test_shared_store(self):
+        # The change set store shared between processes is used if provided.
+        store = mock.Mock()
+        handler = self.make_handler()
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_URL_TEMPLATE, self.io_loop, changesets=store)
+        self.assertIs(store, handler.changeset._store)
+
     @gen_test
     def test_not_authenticated(self):
         # The bundle change set support is only activated for logged in users.
@@ -707,6 +1529,23 @@ class TestProxyHandler(LogTrapTestCase, AsyncHTTPTestCase):
         self.assert_include_headers(
             self.request_headers, remote_request.headers)
 
+    def test_fetches_metric(self):
+        # The proxy requests in progress are tracked.
+        gauge = handlers._proxy_fetches
+        value = gauge.value
+        remote_response = helpers.make_response(200, body='ok')
+        with self.patch_http_client(remote_response) as mock_client:
+            fetch = mock_client().fetch
+            values = []
+
+            def record_value(request):
+                values.append(gauge.value)
+                return fetch.return_value
+            fetch.side_effect = record_value
+            self.fetch('/base/remote-path/')
+        self.assertEqual([value + 1], values)
+        self.assertEqual(value, gauge.value)
+
     def test_post_request(self):
         # POST requests are properly sent to the target URL.
         remote_response = helpers.make_response(
@@ -729,6 +1568,71 @@ class TestProxyHandler(LogTrapTestCase, AsyncHTTPTestCase):
         # Also the body is propagated.
         self.assertEqual('original body', remote_request.body)
 
+    def test_hop_by_hop_headers(self):
+        # Hop-by-hop headers are not forwarded in either direction.
+        remote_response = helpers.make_response(200, body='ok', headers={
+            'Connection': 'X-Hop',
+            'Keep-Alive': 'timeout=5',
+            'X-Hop': 'hop',
+            'X-End': 'end',
+        })
+        with self.patch_http_client(remote_response) as mock_client:
+            response = self.fetch('/base/remote-path/', headers={
+                'Connection': 'X-Hop, close',
+                'TE': 'trailers',
+                'X-Hop': 'hop',
+                'X-End': 'end',
+            })
+        self.assertEqual('end', response.headers['X-End'])
+        self.assertNotIn('X-Hop', response.headers)
+        self.assertNotIn('Keep-Alive', response.headers)
+        remote_request = mock_client().fetch.call_args[0][0]
+        self.assertEqual('end', remote_request.headers['X-End'])
+        for name in ('Connection', 'Te', 'X-Hop'):
+            self.assertNotIn(name, remote_request.headers)
+
+    def test_decoded_response(self):
+        # The encoding of bodies decoded by the HTTP client is not relayed.
+        remote_response = helpers.make_response(200, body='ok', headers={
+            'Content-Encoding': 'gzip',
+            'Content-Length': '42',
+        })
+        with self.patch_http_client(remote_response):
+            response = self.fetch('/base/remote-path/')
+        self.assertEqual('ok', response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('2', response.headers['Content-Length'])
+
+    def test_not_modified(self):
+        # Responses are not sent if the client copy is still valid.
+        remote_response = helpers.make_response(200, body='ok', headers={
+            'ETag': '"v1"',
+        })
+        with self.patch_http_client(remote_response):
+            response = self.fetch(
+                '/base/remote-path/', headers={'If-None-Match': '"v1"'})
+        self.assertEqual(304, response.code)
+        self.assertEqual('', response.body)
+        self.assertEqual('"v1"', response.headers['ETag'])
+
+    def test_upload_progress(self):
+        # The progress of the request bodies sent upstream is tracked.
+        remote_response = helpers.make_response(200, body='ok')
+        with self.patch_http_client(remote_response) as mock_client:
+            fetch = mock_client().fetch
+            uploads = []
+
+            def record_uploads(request):
+                uploads.extend(streaming.uploads_status())
+                return fetch.return_value
+            fetch.side_effect = record_uploads
+            self.fetch('/base/remote-path/', method='POST', body='charm')
+        self.assertEqual(1, len(uploads))
+        self.assertEqual(5, uploads[0]['size'])
+        self.assertEqual(
+            self.target_url + '/remote-path/', uploads[0]['url'])
+        self.assertEqual([], streaming.uploads_status())
+
     def test_validate_certificates(self):
         # Server certificates are properly handled.
         remote_response = helpers.make_response(200)
@@ -790,29 +1694,60 @@ class TestProxyHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
 class TestJujuProxyHandler(TestProxyHandler):
 
-    charmworld_url = 'https://charmworld.example.com'
     expected_validate_cert = False
+    icon_path = '/base/charms?url=local:trusty/django-42&file=icon.svg'
 
     def get_app(self):
         # Set up an application exposing the proxy handler.
+        self.missing_icons = icons.MissingIcons()
         options = {
             'target_url': self.target_url,
-            'charmworld_url': self.charmworld_url,
+            'missing_icons': self.missing_icons,
         }
         return web.Application([
             (r'^/base/(.*)', handlers.JujuProxyHandler, options)])
 
+    def assert_default_icon(self, response):
+        """Ensure the given response includes the bundled default icon."""
+        self.assertEqual(200, response.code)
+        self.assertEqual(icons.get_default_icon(), response.body)
+        self.assertEqual('image/svg+xml', response.headers['Content-Type'])
+        self.assertEqual(
+            icons.DEFAULT_ICON_CACHE_CONTROL,
+            response.headers['Cache-Control'])
+
     def test_default_charm_icon(self):
-        # If a charm icon is not found, a GET request redirects to the fallback
-        # icon available on charmworld.
+        # If a charm icon is not found, the default icon bundled with the
+        # server is sent.
+        misses = handlers._icon_misses.value
+        fallbacks = handlers._icon_fallbacks.value
         remote_response = helpers.make_response(404)
-        path = '/base/charms?url=local:trusty/django=42&file=icon.svg'
         with self.patch_http_client(remote_response):
-            response = self.fetch(path, follow_redirects=False)
-        self.assertEqual(302, response.code)
-        self.assertEqual(
-            self.charmworld_url + handlers.DEFAULT_CHARM_ICON_PATH,
-            response.headers['location'])
+            response = self.fetch(self.icon_path, follow_redirects=False)
+        self.assert_default_icon(response)
+        self.assertEqual(misses + 1, handlers._icon_misses.value)
+        self.assertEqual(fallbacks + 1, handlers._icon_fallbacks.value)
+        self.assertIn('local:trusty/django-42', self.missing_icons)
+
+    def test_missing_icon_remembered(self):
+        # Charms known to lack an icon are not requested to juju-core.
+        self.missing_icons.add('local:trusty/django-42')
+        fallbacks = handlers._icon_fallbacks.value
+        with self.patch_http_client(None) as mock_client:
+            response = self.fetch(self.icon_path)
+        self.assert_default_icon(response)
+        self.assertFalse(mock_client().fetch.called)
+        self.assertEqual(fallbacks + 1, handlers._icon_fallbacks.value)
+
+    def test_charm_icon(self):
+        # Charm icons found in juju-core are tracked.
+        hits = handlers._icon_hits.value
+        remote_response = helpers.make_response(200, body='<svg/>')
+        with self.patch_http_client(remote_response):
+            response = self.fetch(self.icon_path)
+        self.assertEqual(200, response.code)
+        self.assertEqual('<svg/>', response.body)
+        self.assertEqual(hits + 1, handlers._icon_hits.value)
 
     def test_charm_file_not_found(self):
         # If a charm file is not found and it is not the icon, a 404 is
@@ -825,11 +1760,658 @@ class TestJujuProxyHandler(TestProxyHandler):
         self.assertEqual('Not Found', response.reason)
 
 
+class UpstreamHandler(web.RequestHandler):
+    """A remote server handler used to exercise the proxy."""
+
+    @web.asynchronous
+    def get(self, path):
+        """Send the requested number of chunks, or an error."""
+        if path == 'missing':
+            self.set_status(404)
+            self.finish('try later')
+            return
+        self.set_header('Content-Type', 'text/plain')
+        if path == 'sized':
+            self.set_header('Content-Length', 21)
+        self.chunks = ['chunk{}\n'.format(i) for i in range(3)]
+        self._send_chunk()
+
+    def _send_chunk(self):
+        if not self.chunks:
+            self.finish()
+            return
+        self.write(self.chunks.pop(0))
+        self.flush(callback=self._send_chunk)
+
+
+class TestProxyHandlerStreaming(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        options = {
+            'target_url': self.get_url('/remote'),
+            'max_buffer': 4,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.ProxyHandler, options),
+            (r'^/remote/(.*)', UpstreamHandler),
+        ])
+
+    def test_chunked_response(self):
+        # Chunked responses are streamed to the client.
+        value = streaming._streamed_bytes.value
+        response = self.fetch('/base/chunked')
+        self.assertEqual(200, response.code)
+        self.assertEqual('chunk0\nchunk1\nchunk2\n', response.body)
+        self.assertEqual('text/plain', response.headers['Content-Type'])
+        self.assertEqual('chunked', response.headers['Transfer-Encoding'])
+        self.assertEqual(value + 21, streaming._streamed_bytes.value)
+
+    def test_sized_response(self):
+        # The content length of the remote response is preserved.
+        response = self.fetch('/base/sized')
+        self.assertEqual(200, response.code)
+        self.assertEqual('chunk0\nchunk1\nchunk2\n', response.body)
+        self.assertEqual('21', response.headers['Content-Length'])
+
+    def test_error_response(self):
+        # Error responses are returned to the client.
+        response = self.fetch('/base/missing')
+        self.assertEqual(404, response.code)
+        self.assertEqual('try later', response.body)
+
+    def test_streaming_error(self):
+        # The client connection is closed if the remote server fails while
+        # the response is being streamed.
+        def fetch(request):
+            request.header_callback('HTTP/1.1 200 OK\r\n')
+            request.header_callback('Content-Length: 100\r\n')
+            request.header_callback('\r\n')
+            request.streaming_callback('partial')
+            future = futures.Future()
+            future.set_exception(httpclient.HTTPError(599, 'reset'))
+            return future
+        mock_client = mock.Mock()
+        mock_client().fetch.side_effect = fetch
+        with mock.patch('tornado.httpclient.AsyncHTTPClient', mock_client):
+            response = self.fetch('/base/chunked')
+        self.assertEqual(599, response.code)
+
+
+class DocumentHandler(web.RequestHandler):
+    """A remote server handler sending JSON documents with validators."""
+
+    def get(self, path):
+        """Send a large or small document."""
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('ETag', '"v1"')
+        self.set_header('Last-Modified', 'Tue, 15 Nov 1994 08:12:31 GMT')
+        if path == 'small':
+            self.write('{}')
+            return
+        self.write(json.dumps({'values': range(500)}))
+
+
+class TestProxyHandlerEncoding(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        options = {
+            'target_url': self.get_url('/remote'),
+            'compress': True,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.ProxyHandler, options),
+            (r'^/remote/(.*)', DocumentHandler),
+        ])
+
+    def fetch(self, path, **headers):
+        """Fetch the given path without decompressing the response."""
+        return super(TestProxyHandlerEncoding, self).fetch(
+            path, headers=headers, use_gzip=False)
+
+    def test_compressed(self):
+        # Text-like responses are compressed if the client accepts gzip.
+        saved = gzipping._saved.value
+        response = self.fetch('/base/large', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.code)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual('W/"v1"', response.headers['ETag'])
+        body = gzip.GzipFile(fileobj=BytesIO(response.body)).read()
+        self.assertEqual({'values': range(500)}, json.loads(body))
+        self.assertGreater(gzipping._saved.value, saved)
+
+    def test_not_accepted(self):
+        # Responses are not compressed if the client does not accept gzip.
+        response = self.fetch('/base/large')
+        self.assertEqual(200, response.code)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('"v1"', response.headers['ETag'])
+        self.assertEqual(
+            {'values': range(500)}, json.loads(response.body))
+
+    def test_small(self):
+        # Small responses are not compressed.
+        response = self.fetch('/base/small', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.code)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('{}', response.body)
+
+    def test_if_none_match(self):
+        # Streamed responses are not sent if the client copy is valid.
+        not_modified = handlers._proxy_not_modified.value
+        response = self.fetch('/base/large', **{'If-None-Match': 'W/"v1"'})
+        self.assertEqual(304, response.code)
+        self.assertEqual('', response.body)
+        self.assertEqual('"v1"', response.headers['ETag'])
+        self.assertEqual(not_modified + 1, handlers._proxy_not_modified.value)
+
+    def test_if_modified_since(self):
+        # Responses are not sent if not modified since the client copy.
+        response = self.fetch(
+            '/base/small',
+            **{'If-Modified-Since': 'Wed, 16 Nov 1994 08:12:31 GMT'})
+        self.assertEqual(304, response.code)
+        self.assertEqual('', response.body)
+
+    def test_modified(self):
+        # Responses are sent if the client copy is not valid.
+        response = self.fetch('/base/small', **{'If-None-Match': '"v0"'})
+        self.assertEqual(200, response.code)
+        self.assertEqual('{}', response.body)
+
+
+class SlowUpstreamHandler(web.RequestHandler):
+    """A remote server handler responding after a while."""
+
+    def initialize(self, requests):
+        self.requests = requests
+
+    @gen.coroutine
+    def get(self, path):
+        """Send the path back, after a delay."""
+        self.requests.append(path)
+        io_loop = ioloop.IOLoop.current()
+        yield gen.Task(io_loop.add_timeout, io_loop.time() + 0.05)
+        self.write('response for ' + path)
+        self.flush()
+
+
+class ConcurrentFetchMixin(object):
+    """Send concurrent requests to the application."""
+
+    def fetch_all(self, *paths):
+        """Fetch the given paths concurrently and return the responses."""
+        responses = {}
+
+        def callback(index, response):
+            responses[index] = response
+            if len(responses) == len(paths):
+                self.stop()
+        for index, path in enumerate(paths):
+            self.http_client.fetch(
+                self.get_url(path), functools.partial(callback, index))
+        self.wait()
+        return [responses[index] for index in range(len(paths))]
+
+
+class TestProxyHandlerCoalescing(
+        ConcurrentFetchMixin, LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        self.requests = []
+        self.single_flight = coalesce.SingleFlight(timeout=5)
+        options = {
+            'target_url': self.get_url('/remote'),
+            'single_flight': self.single_flight,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.ProxyHandler, options),
+            (r'^/remote/(.*)', SlowUpstreamHandler,
+             {'requests': self.requests}),
+        ])
+
+    def test_identical_requests(self):
+        # Identical concurrent requests share the upstream fetch.
+        saved = coalesce._saved.value
+        responses = self.fetch_all('/base/path', '/base/path', '/base/path')
+        self.assertEqual(['path'], self.requests)
+        for response in responses:
+            self.assertEqual(200, response.code)
+            self.assertEqual('response for path', response.body)
+        self.assertEqual(saved + 2, coalesce._saved.value)
+        self.assertEqual(0, len(self.single_flight))
+
+    def test_different_requests(self):
+        # Different requests are sent upstream separately.
+        responses = self.fetch_all('/base/path1', '/base/path2')
+        self.assertEqual(['path1', 'path2'], sorted(self.requests))
+        self.assertEqual('response for path1', responses[0].body)
+        self.assertEqual('response for path2', responses[1].body)
+
+    def test_sequential_requests(self):
+        # Requests are only coalesced while the fetch is in progress.
+        self.fetch('/base/path')
+        self.fetch('/base/path')
+        self.assertEqual(['path', 'path'], self.requests)
+
+
+class TestProxyHandlerPool(
+        ConcurrentFetchMixin, LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        self.requests = []
+        self.http_pool = httppool.HTTPPool(
+            'remote', max_clients=1, queue_timeout=0, io_loop=self.io_loop)
+        self.addCleanup(self.http_pool.close)
+        options = {
+            'target_url': self.get_url('/remote'),
+            'http_pool': self.http_pool,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.ProxyHandler, options),
+            (r'^/remote/(.*)', SlowUpstreamHandler,
+             {'requests': self.requests}),
+        ])
+
+    def test_queued_requests(self):
+        # Requests exceeding the pool size wait for a connection.
+        responses = self.fetch_all('/base/path1', '/base/path2')
+        self.assertEqual(['path1', 'path2'], self.requests)
+        self.assertEqual('response for path1', responses[0].body)
+        self.assertEqual('response for path2', responses[1].body)
+        self.assertEqual(0, self.http_pool.active)
+
+    def test_rejected_requests(self):
+        # Requests waiting too long are rejected with a 503 response.
+        self.http_pool.queue_timeout = 0.01
+        responses = self.fetch_all('/base/path1', '/base/path2')
+        self.assertEqual(['path1'], self.requests)
+        self.assertEqual(200, responses[0].code)
+        self.assertEqual(503, responses[1].code)
+        self.assertEqual('1', responses[1].headers['Retry-After'])
+        self.assertIn('too many requests to remote', responses[1].body)
+        self.assertEqual(1, self.http_pool.rejected)
+
+    def test_circuit_open(self):
+        # Requests fail fast while the circuit breaker is open.
+        circuit_breaker = self.http_pool.breaker = breaker.CircuitBreaker(
+            'remote', self.get_url('/remote/'), max_failures=1,
+            reset_timeout=60, io_loop=self.io_loop)
+        circuit_breaker.record(None, True)
+        response = self.fetch('/base/path')
+        self.assertEqual(503, response.code)
+        self.assertEqual('60', response.headers['Retry-After'])
+        self.assertIn('remote is not responding', response.body)
+        self.assertEqual([], self.requests)
+
+    def test_aborted(self):
+        # The pool is told whether the fetch has been aborted because the
+        # browser went away.
+        with mock.patch.object(
+                self.http_pool, 'fetch',
+                wraps=self.http_pool.fetch) as mock_fetch:
+            response = self.fetch('/base/path')
+        self.assertEqual(200, response.code)
+        aborted = mock_fetch.call_args[1]['aborted']
+        self.assertFalse(aborted())
+
+    def test_cancelled_when_client_goes_away(self):
+        # Queued requests are cancelled when the browser goes away, and do not
+        # reach the remote server later.
+        self.http_client.fetch(self.get_url('/base/path1'), self.stop)
+        self.http_client.fetch(
+            self.get_url('/base/path2'), lambda response: None,
+            request_timeout=0.01)
+        response = self.wait()
+        self.assertEqual(200, response.code)
+        self.io_loop.add_timeout(self.io_loop.time() + 0.1, self.stop)
+        self.wait()
+        self.assertEqual(['path1'], self.requests)
+        self.assertEqual(0, self.http_pool.status()['queued'])
+        self.assertEqual(0, self.http_pool.active)
+
+
+class CharmFilesHandler(web.RequestHandler):
+    """A juju-core charm files handler used to exercise the proxy cache."""
+
+    def initialize(self, requests, files, ranges=None, auth=None):
+        self.requests = requests
+        self.files = files
+        # Whether single byte ranges are supported.
+        self.ranges = ranges and ranges['enabled']
+        # The required Authorization header, or None.
+        self.authorization = auth and auth['authorization']
+
+    def get(self):
+        """Send the charm file, honoring its ETag."""
+        self.requests.append(self.request)
+        authorization = self.authorization
+        if authorization is not None and (
+                self.request.headers.get('Authorization') != authorization):
+            self.set_status(401)
+            return
+        content = self.files.get(self.get_argument('file'))
+        if content is None:
+            self.set_status(404)
+            return
+        etag = '"{}"'.format(len(content))
+        self.set_header('ETag', etag)
+        if self.request.headers.get('If-None-Match') == etag:
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'text/plain')
+        header = self.request.headers.get('Range')
+        if self.ranges and header is not None:
+            start, stop = map(int, header[len('bytes='):].split('-'))
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, stop, len(content)))
+            content = content[start:stop + 1]
+        self.set_header('Content-Length', len(content))
+        self.write(content)
+        self.flush()
+
+
+class TestJujuProxyHandlerCharmCache(LogTrapTestCase, AsyncHTTPTestCase):
+
+    charm_path = '/base/charms?url=local:trusty/django-42&file=README.md'
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = charmcache.CharmFileCache(self.directory)
+        self.requests = []
+        self.files = {'README.md': 'django readme'}
+        self.auth = {'authorization': None}
+        options = {
+            'target_url': self.get_url('/remote'),
+            'charm_cache': self.cache,
+        }
+        remote_options = {
+            'requests': self.requests,
+            'files': self.files,
+            'auth': self.auth,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.JujuProxyHandler, options),
+            (r'^/remote/charms', CharmFilesHandler, remote_options),
+        ])
+
+    def expire_entries(self):
+        """Make the cached entries require revalidation."""
+        for entry in self.cache._entries.values():
+            entry.stored = 0
+
+    def test_cached(self):
+        # Charm files are retrieved from juju-core only once.
+        response = self.fetch(self.charm_path)
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual(
+            'private, max-age=3600', response.headers['Cache-Control'])
+        self.assertEqual(1, len(self.requests))
+        response = self.fetch(self.charm_path)
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual('text/plain', response.headers['Content-Type'])
+        self.assertEqual('"13"', response.headers['ETag'])
+        self.assertEqual(
+            'private, max-age=3600', response.headers['Cache-Control'])
+        self.assertEqual('13', response.headers['Content-Length'])
+        self.assertEqual(1, len(self.requests))
+
+    def test_credentials(self):
+        # Cached files are only served to clients presenting the credentials
+        # used to retrieve them.
+        self.auth['authorization'] = 'Basic secret'
+        headers = {'Authorization': 'Basic secret'}
+        response = self.fetch(self.charm_path, headers=headers)
+        self.assertEqual(200, response.code)
+        response = self.fetch(self.charm_path)
+        self.assertEqual(401, response.code)
+        response = self.fetch(
+            self.charm_path, headers={'Authorization': 'Basic bad'})
+        self.assertEqual(401, response.code)
+        self.assertEqual(3, len(self.requests))
+        response = self.fetch(self.charm_path, headers=headers)
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual(3, len(self.requests))
+
+    def test_query_normalized(self):
+        # Requests with reordered query arguments share the entry.
+        self.fetch(self.charm_path)
+        self.fetch('/base/charms?file=README.md&url=local:trusty/django-42')
+        self.assertEqual(1, len(self.requests))
+
+    def test_not_modified(self):
+        # Browsers can revalidate cached files using the ETag.
+        self.fetch(self.charm_path)
+        response = self.fetch(
+            self.charm_path, headers={'If-None-Match': '"13"'})
+        self.assertEqual(304, response.code)
+        self.assertEqual('', response.body)
+        self.assertEqual(1, len(self.requests))
+
+    def test_revalidated(self):
+        # Expired entries are revalidated with juju-core.
+        value = charmcache._revalidations.value
+        self.fetch(self.charm_path)
+        self.expire_entries()
+        response = self.fetch(self.charm_path)
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual('"13"', self.requests[1].headers['If-None-Match'])
+        self.assertEqual(value + 1, charmcache._revalidations.value)
+        # The entry is fresh again.
+        self.fetch(self.charm_path)
+        self.assertEqual(2, len(self.requests))
+
+    def test_changed(self):
+        # Entries are replaced if juju-core returns a different content.
+        self.fetch(self.charm_path)
+        self.expire_entries()
+        self.files['README.md'] = 'new readme'
+        response = self.fetch(self.charm_path)
+        self.assertEqual('new readme', response.body)
+        self.assertEqual(1, len(self.cache))
+        entry = self.cache.get(self.cache._entries.keys()[0])
+        self.assertEqual({'ETag': '"10"', 'Content-Type': 'text/plain'},
+                         entry.headers)
+
+    def test_file_removed(self):
+        # Files removed from the disk are retrieved again.
+        self.fetch(self.charm_path)
+        shutil.rmtree(os.path.join(self.directory, 'blobs'))
+        os.mkdir(os.path.join(self.directory, 'blobs'))
+        response = self.fetch(self.charm_path)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual(2, len(self.requests))
+
+    def test_without_revision(self):
+        # Charm files are not cached if the charm URL has no revision.
+        path = '/base/charms?url=local:trusty/django&file=README.md'
+        self.fetch(path)
+        self.fetch(path)
+        self.assertEqual(2, len(self.requests))
+        self.assertEqual(0, len(self.cache))
+
+    def test_missing_icon(self):
+        # Missing icons are not cached, and the default icon is still used.
+        path = '/base/charms?url=local:trusty/django-42&file=icon.svg'
+        response = self.fetch(path)
+        self.assertEqual(200, response.code)
+        self.assertEqual(icons.get_default_icon(), response.body)
+        self.assertEqual(0, len(self.cache))
+
+
+class TestJujuProxyHandlerCharmRanges(LogTrapTestCase, AsyncHTTPTestCase):
+
+    charm_path = '/base/charms?url=local:trusty/django-42&file=README.md'
+
+    def get_app(self):
+        # Set up an application exposing both the proxy and remote handlers.
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = charmcache.CharmFileCache(self.directory)
+        self.requests = []
+        self.files = {'README.md': 'django readme'}
+        self.ranges = {'enabled': False}
+        self.auth = {'authorization': None}
+        options = {
+            'target_url': self.get_url('/remote'),
+            'charm_cache': self.cache,
+        }
+        remote_options = {
+            'requests': self.requests,
+            'files': self.files,
+            'ranges': self.ranges,
+            'auth': self.auth,
+        }
+        return web.Application([
+            (r'^/base/(.*)', handlers.JujuProxyHandler, options),
+            (r'^/remote/charms', CharmFilesHandler, remote_options),
+        ])
+
+    def fetch_range(self, value, **headers):
+        """Fetch the given range of the charm file."""
+        headers['Range'] = value
+        return self.fetch(self.charm_path, headers=headers)
+
+    def test_cached_range(self):
+        # Ranges of cached charm files are served from the cache.
+        value = handlers._proxy_partial.value
+        self.fetch(self.charm_path)
+        response = self.fetch_range('bytes=7-')
+        self.assertEqual(206, response.code)
+        self.assertEqual('readme', response.body)
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+        self.assertEqual('bytes 7-12/13', response.headers['Content-Range'])
+        self.assertEqual('6', response.headers['Content-Length'])
+        self.assertEqual('text/plain', response.headers['Content-Type'])
+        self.assertEqual('"13"', response.headers['ETag'])
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual(value + 1, handlers._proxy_partial.value)
+
+    def test_cached_multiple_ranges(self):
+        # Multiple ranges are served as a multipart response.
+        self.fetch(self.charm_path)
+        response = self.fetch_range('bytes=0-1,-6')
+        self.assertEqual(206, response.code)
+        content_type = response.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges'))
+        boundary = content_type.split('boundary=')[1]
+        expected = (
+            '\r\n--{0}\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-Range: bytes 0-1/13\r\n\r\n'
+            'dj'
+            '\r\n--{0}\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-Range: bytes 7-12/13\r\n\r\n'
+            'readme'
+            '\r\n--{0}--\r\n'
+        ).format(boundary)
+        self.assertEqual(expected, response.body)
+        self.assertEqual(
+            str(len(expected)), response.headers['Content-Length'])
+        self.assertNotIn('Content-Range', response.headers)
+
+    def test_cached_range_not_satisfiable(self):
+        # A 416 error is returned if the ranges cannot be satisfied.
+        self.fetch(self.charm_path)
+        response = self.fetch_range('bytes=13-')
+        self.assertEqual(416, response.code)
+        self.assertEqual('bytes */13', response.headers['Content-Range'])
+        self.assertEqual('', response.body)
+
+    def test_cached_if_range(self):
+        # The whole file is sent if it changed since the range was requested.
+        self.fetch(self.charm_path)
+        response = self.fetch_range('bytes=7-', **{'If-Range': '"12"'})
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        response = self.fetch_range('bytes=7-', **{'If-Range': '"13"'})
+        self.assertEqual(206, response.code)
+        self.assertEqual('readme', response.body)
+
+    def test_cached_range_credentials(self):
+        # Ranges of cached files are only served to clients presenting the
+        # credentials used to retrieve them.
+        self.auth['authorization'] = 'Basic secret'
+        headers = {'Authorization': 'Basic secret'}
+        self.fetch(self.charm_path, headers=headers)
+        for value in ('bytes=7-', 'bytes=0-1,7-', 'bytes=13-'):
+            response = self.fetch_range(value)
+            self.assertEqual(401, response.code, value)
+            self.assertEqual('', response.body, value)
+        self.assertEqual(4, len(self.requests))
+        response = self.fetch_range('bytes=7-', **headers)
+        self.assertEqual(206, response.code)
+        self.assertEqual('readme', response.body)
+        self.assertEqual(4, len(self.requests))
+
+    def test_range_forwarded(self):
+        # Ranges are forwarded to juju-core, and partial responses relayed.
+        self.ranges['enabled'] = True
+        response = self.fetch_range('bytes=0-5')
+        self.assertEqual(206, response.code)
+        self.assertEqual('django', response.body)
+        self.assertEqual('bytes 0-5/13', response.headers['Content-Range'])
+        self.assertEqual('bytes=0-5', self.requests[0].headers['Range'])
+        # Partial responses are not cached.
+        self.assertEqual(0, len(self.cache))
+
+    def test_range_ignored_upstream(self):
+        # If juju-core sends the whole file in place of the range, the file
+        # is cached and the range is served from the cache.
+        value = handlers._proxy_range_fallbacks.value
+        response = self.fetch_range('bytes=7-')
+        self.assertEqual(206, response.code)
+        self.assertEqual('readme', response.body)
+        self.assertEqual('bytes 7-12/13', response.headers['Content-Range'])
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(value + 1, handlers._proxy_range_fallbacks.value)
+        # Further ranges are served from the cache.
+        response = self.fetch_range('bytes=0-5')
+        self.assertEqual('django', response.body)
+        self.assertEqual(1, len(self.requests))
+
+    def test_range_ignored_upstream_too_large(self):
+        # Files too large to be cached are sent whole.
+        self.cache.max_size = 10
+        response = self.fetch_range('bytes=7-')
+        self.assertEqual(200, response.code)
+        self.assertEqual('django readme', response.body)
+        self.assertEqual(0, len(self.cache))
+
+    def test_range_ignored_upstream_revalidated(self):
+        # Ranges of changed files are served from the new cached content.
+        self.fetch(self.charm_path)
+        for entry in self.cache._entries.values():
+            entry.stored = 0
+        self.files['README.md'] = 'new readme'
+        response = self.fetch_range('bytes=4-')
+        self.assertEqual(206, response.code)
+        self.assertEqual('readme', response.body)
+        self.assertEqual('bytes 4-9/10', response.headers['Content-Range'])
+        self.assertEqual(2, len(self.requests))
+
+
 class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
     def get_app(self):
         mock_deployer = mock.Mock()
         mock_deployer.status.return_value = 'deployments status'
+        self.addCleanup(mock.patch.stopall)
+        mock.patch(
+            'guiserver.metrics.snapshot', return_value={'frames': 1}).start()
         options = {
             'apiurl': 'wss://api.example.com:17070',
             'apiversion': 'clojure',
@@ -839,6 +2421,39 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
         }
         return web.Application([(r'^/info', handlers.InfoHandler, options)])
 
+    def test_info_response_cache(self):
+        # The response cache status is included if the cache is enabled.
+        cache = mock.Mock()
+        cache.status.return_value = 'cache status'
+        handler = handlers.InfoHandler(
+            self._app, mock.Mock(), apiurl='wss://api.example.com:17070',
+            apiversion='go', deployer=mock.Mock(), sandbox=False,
+            start_time=10, response_cache=cache)
+        info = handler.get_info({})
+        self.assertEqual('cache status', info['apicache'])
+
+    def test_info_charm_cache(self):
+        # The charm cache status is included if the cache is enabled.
+        cache = mock.Mock()
+        cache.status.return_value = 'cache status'
+        handler = handlers.InfoHandler(
+            self._app, mock.Mock(), apiurl='wss://api.example.com:17070',
+            apiversion='go', deployer=mock.Mock(), sandbox=False,
+            start_time=10, charm_cache=cache)
+        info = handler.get_info({})
+        self.assertEqual('cache status', info['charmcache'])
+
+    def test_info_http_pool(self):
+        # The status of the pool of connections to juju-core is included.
+        http_pool = mock.Mock()
+        http_pool.status.return_value = 'pool status'
+        handler = handlers.InfoHandler(
+            self._app, mock.Mock(), apiurl='wss://api.example.com:17070',
+            apiversion='go', deployer=mock.Mock(), sandbox=False,
+            start_time=10, http_pool=http_pool)
+        info = handler.get_info({})
+        self.assertEqual('pool status', info['httppool'])
+
     @mock.patch('time.time', mock.Mock(return_value=52))
     def test_info(self):
         # The handler correctly returns information about the GUI server.
@@ -847,7 +2462,9 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
             'apiversion': 'clojure',
             'debug': False,
             'deployer': 'deployments status',
+            'metrics': {'frames': 1},
             'sandbox': False,
+            'uploads': [],
             'uptime': 42,
             'version': get_version(),
         }
@@ -860,6 +2477,52 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
         self.assertEqual(expected, info)
 
 
+class TestLatencyHandler(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.latency = latency.ApiLatency(buckets=(1,))
+        options = {'latency': self.latency}
+        return web.Application(
+            [(r'^/latency', handlers.LatencyHandler, options)])
+
+    def test_latency(self):
+        # The handler returns the Juju API calls latency.
+        self.latency.observe('Client.FullStatus', 0.5, False)
+        response = self.fetch('/latency')
+        self.assertEqual(200, response.code)
+        info = escape.json_decode(response.body)
+        self.assertEqual({
+            'buckets': [[1, 1]],
+            'count': 1,
+            'error_rate': 0,
+            'errors': 0,
+            'sum': 0.5,
+        }, info['methods']['Client.FullStatus'])
+        self.assertIn('outstanding', info)
+
+
+class TestMetricsHandler(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.latency = latency.ApiLatency()
+        options = {'latency': self.latency}
+        return web.Application(
+            [(r'^/metrics$', handlers.MetricsHandler, options)])
+
+    def test_metrics(self):
+        # The handler returns the metrics in the Prometheus text format.
+        self.latency.observe('Client.FullStatus', 0.5, False)
+        response = self.fetch('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertEqual(
+            'text/plain; version=0.0.4', response.headers['Content-Type'])
+        self.assertIn('\n# TYPE guiserver_browser_websockets gauge\n',
+                      response.body)
+        self.assertIn(
+            '\nguiserver_juju_api_latency_seconds_count{'
+            'method="Client.FullStatus"} 1\n', response.body)
+
+
 class TestHttpsRedirectHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
     def get_app(self):
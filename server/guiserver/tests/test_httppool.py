@@ -0,0 +1,360 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server pools of HTTP connections."""
+
+import mock
+from tornado import (
+    gen,
+    httpclient,
+)
+from tornado.concurrent import Future
+from tornado.testing import (
+    AsyncTestCase,
+    gen_test,
+)
+
+from guiserver import (
+    httppool,
+    streaming,
+)
+
+
+class TestHTTPPool(AsyncTestCase):
+
+    def setUp(self):
+        super(TestHTTPPool, self).setUp()
+        self.pool = httppool.HTTPPool(
+            'juju-core', max_clients=1, connect_timeout=5, request_timeout=60,
+            queue_timeout=0.05, io_loop=self.io_loop)
+        # Each fetch returns a future which is resolved by the test.
+        self.fetches = []
+        client = self.pool._client = mock.Mock()
+        client.fetch.side_effect = self.fetch
+
+    def fetch(self, request):
+        future = Future()
+        self.fetches.append((request, future))
+        return future
+
+    def make_request(self, **headers):
+        return httpclient.HTTPRequest(
+            'https://example.com/path', headers=headers)
+
+    @gen_test
+    def test_fetch(self):
+        # The response is returned and the connection is released.
+        request = self.make_request()
+        future = self.pool.fetch(request)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(1, self.pool.active)
+        self.assertEqual(5, request.connect_timeout)
+        self.assertEqual(60, request.request_timeout)
+        fetched_request, fetched = self.fetches[0]
+        self.assertIs(request, fetched_request)
+        fetched.set_result('response')
+        response = yield future
+        self.assertEqual('response', response)
+        self.assertEqual(0, self.pool.active)
+
+    def test_idle_timeout(self):
+        # When curl is used, fetches time out when they are idle, rather than
+        # when they take too long.
+        request = self.make_request()
+        previous_callback = request.prepare_curl_callback = mock.Mock()
+        curl = mock.Mock()
+        with mock.patch('guiserver.httppool.pycurl') as mock_pycurl:
+            self.pool._prepare(request)
+            request.prepare_curl_callback(curl)
+        previous_callback.assert_called_once_with(curl)
+        self.assertEqual([
+            mock.call(mock_pycurl.TIMEOUT_MS, 0),
+            mock.call(mock_pycurl.LOW_SPEED_LIMIT, 1),
+            mock.call(mock_pycurl.LOW_SPEED_TIME, 60),
+        ], curl.setopt.call_args_list)
+
+    def test_no_idle_timeout(self):
+        # Without curl, the request timeout limits the whole fetch and the
+        # curl callback is left untouched.
+        request = self.make_request()
+        with mock.patch('guiserver.httppool.pycurl', None):
+            self.pool._prepare(request)
+        self.assertIsNone(request.prepare_curl_callback)
+        self.assertEqual(60, request.request_timeout)
+
+    @gen_test
+    def test_slow_reader(self):
+        # A streamed fetch can last longer than the request timeout while the
+        # browser reads slowly, and timing out while waiting for the browser
+        # is not an upstream failure.
+        self.pool.request_timeout = 0.01
+        self.pool.breaker = mock.Mock()
+        handler = mock.Mock()
+        handler.should_relay.return_value = True
+        handler.check_not_modified.return_value = False
+        stream = streaming.ResponseStream(handler, max_buffer=4)
+        request = self.make_request()
+        stream.attach(request)
+        pool_patcher = mock.patch('guiserver.httppool.pycurl')
+        pool_patcher.start()
+        self.addCleanup(pool_patcher.stop)
+        future = self.pool.fetch(
+            request, aborted=lambda: stream.closed or stream.paused)
+        yield gen.Task(self.io_loop.add_callback)
+        curl = mock.Mock()
+        with mock.patch('guiserver.streaming.pycurl') as mock_pycurl:
+            request.prepare_curl_callback(curl)
+            request.header_callback('HTTP/1.1 200 OK\r\n')
+            request.streaming_callback('chunk1')
+            # The browser has not read the first chunk yet, and the transfer
+            # is paused for longer than the request timeout.
+            self.assertEqual(
+                mock_pycurl.WRITEFUNC_PAUSE,
+                request.streaming_callback('chunk2'))
+            yield gen.Task(
+                self.io_loop.add_timeout, self.io_loop.time() + 0.02)
+            self.assertTrue(stream.paused)
+            self.fetches[0][1].set_exception(httpclient.HTTPError(599))
+            with self.assertRaises(httpclient.HTTPError):
+                yield future
+        self.assertFalse(self.pool.breaker.record.called)
+
+    @gen_test
+    def test_fetch_error(self):
+        # The connection is released when the fetch fails.
+        future = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_exception(httpclient.HTTPError(500))
+        with self.assertRaises(httpclient.HTTPError):
+            yield future
+        self.assertEqual(0, self.pool.active)
+
+    @gen_test
+    def test_queued(self):
+        # Fetches exceeding the pool size wait for a connection.
+        self.pool.queue_timeout = 0
+        first = self.pool.fetch(self.make_request())
+        second = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(1, len(self.fetches))
+        self.assertEqual(1, self.pool.status()['queued'])
+        count = httppool._queue_wait.count
+        self.fetches[0][1].set_result('first')
+        self.assertEqual('first', (yield first))
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(2, len(self.fetches))
+        self.assertEqual(count + 1, httppool._queue_wait.count)
+        self.fetches[1][1].set_result('second')
+        self.assertEqual('second', (yield second))
+        self.assertEqual(0, self.pool.active)
+
+    @gen_test
+    def test_rejected(self):
+        # Fetches waiting too long are rejected.
+        rejected = httppool._rejected.value
+        self.pool.fetch(self.make_request())
+        with self.assertRaises(httppool.QueueTimeout) as context:
+            yield self.pool.fetch(self.make_request())
+        self.assertEqual(1, context.exception.retry_after)
+        self.assertEqual(1, len(self.fetches))
+        self.assertEqual(1, self.pool.rejected)
+        self.assertEqual(rejected + 1, httppool._rejected.value)
+        self.assertEqual(0, self.pool.status()['queued'])
+
+    @gen_test
+    def test_no_queue_timeout(self):
+        # Fetches wait indefinitely if the queue timeout is 0.
+        self.pool.queue_timeout = 0
+        first = self.pool.fetch(self.make_request())
+        second = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+        self.assertFalse(second.done())
+        self.fetches[0][1].set_result('first')
+        yield first
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[1][1].set_result('second')
+        self.assertEqual('second', (yield second))
+
+    @gen_test
+    def test_cancelled(self):
+        # Waiting fetches are removed from the queue when closed.
+        self.pool.queue_timeout = 0
+        cancelled = httppool._cancelled.value
+        closed = Future()
+        first = self.pool.fetch(self.make_request())
+        second = self.pool.fetch(self.make_request(), closed=closed)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(1, self.pool.status()['queued'])
+        closed.set_result(None)
+        with self.assertRaises(httpclient.HTTPError) as context:
+            yield second
+        self.assertEqual(599, context.exception.code)
+        self.assertEqual(0, self.pool.status()['queued'])
+        self.assertEqual(cancelled + 1, httppool._cancelled.value)
+        # The cancelled fetch does not take the released connection.
+        self.fetches[0][1].set_result('first')
+        yield first
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(1, len(self.fetches))
+        self.assertEqual(0, self.pool.active)
+
+    @gen_test
+    def test_cancelled_with_queue_timeout(self):
+        # The queue timeout of a cancelled fetch is removed.
+        closed = Future()
+        self.pool.fetch(self.make_request())
+        second = self.pool.fetch(self.make_request(), closed=closed)
+        yield gen.Task(self.io_loop.add_callback)
+        closed.set_result(None)
+        with self.assertRaises(httpclient.HTTPError):
+            yield second
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+        self.assertEqual(0, self.pool.rejected)
+
+    @gen_test
+    def test_closed_after_start(self):
+        # Closing has no effect on fetches already started.
+        closed = Future()
+        future = self.pool.fetch(self.make_request(), closed=closed)
+        yield gen.Task(self.io_loop.add_callback)
+        closed.set_result(None)
+        self.fetches[0][1].set_result('response')
+        self.assertEqual('response', (yield future))
+        self.assertEqual(0, self.pool.active)
+
+    @gen_test
+    def test_keep_alive(self):
+        # Upstream connections are reused by default.
+        request = self.make_request()
+        self.pool.fetch(request)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertNotIn('Connection', request.headers)
+
+    @gen_test
+    def test_no_keep_alive(self):
+        # Upstream connections can be closed after each fetch, without
+        # changing the original request headers.
+        self.pool.keep_alive = False
+        headers = {'Accept': 'text/plain'}
+        request = self.make_request(**headers)
+        self.pool.fetch(request)
+        yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual('close', request.headers['Connection'])
+        self.assertEqual('text/plain', request.headers['Accept'])
+        self.assertNotIn('Connection', headers)
+
+    def test_retry_after(self):
+        # The retry delay is rounded up to whole seconds.
+        self.pool.queue_timeout = 2.5
+        self.assertEqual(3, self.pool.retry_after)
+        self.pool.queue_timeout = 0
+        self.assertEqual(1, self.pool.retry_after)
+
+    def test_status(self):
+        # The pool usage is reported.
+        expected = {
+            'name': 'juju-core',
+            'max_clients': 1,
+            'active': 0,
+            'queued': 0,
+            'rejected': 0,
+        }
+        self.assertEqual(expected, self.pool.status())
+
+    @gen_test
+    def test_breaker_success(self):
+        # Successful fetches are reported to the circuit breaker.
+        self.pool.breaker = mock.Mock()
+        future = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_result('response')
+        yield future
+        self.pool.breaker.record.assert_called_once_with('response', False)
+
+    @gen_test
+    def test_breaker_failure(self):
+        # Upstream failures are reported to the circuit breaker.
+        self.pool.breaker = mock.Mock()
+        future = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_exception(httpclient.HTTPError(599))
+        with self.assertRaises(httpclient.HTTPError):
+            yield future
+        self.pool.breaker.record.assert_called_once_with(None, True)
+
+    @gen_test
+    def test_breaker_aborted(self):
+        # Fetches aborted on purpose are not reported to the circuit breaker.
+        self.pool.breaker = mock.Mock()
+        future = self.pool.fetch(self.make_request(), aborted=lambda: True)
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_exception(httpclient.HTTPError(599))
+        with self.assertRaises(httpclient.HTTPError):
+            yield future
+        self.assertFalse(self.pool.breaker.record.called)
+        self.assertEqual(0, self.pool.active)
+
+    @gen_test
+    def test_breaker_not_aborted(self):
+        # Failures are reported if the fetch has not been aborted on purpose.
+        self.pool.breaker = mock.Mock()
+        future = self.pool.fetch(self.make_request(), aborted=lambda: False)
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_exception(httpclient.HTTPError(599))
+        with self.assertRaises(httpclient.HTTPError):
+            yield future
+        self.pool.breaker.record.assert_called_once_with(None, True)
+
+    @gen_test
+    def test_breaker_error_response(self):
+        # Error responses not reporting upstream failures are not failures.
+        self.pool.breaker = mock.Mock()
+        future = self.pool.fetch(self.make_request())
+        yield gen.Task(self.io_loop.add_callback)
+        self.fetches[0][1].set_exception(httpclient.HTTPError(404))
+        with self.assertRaises(httpclient.HTTPError):
+            yield future
+        self.pool.breaker.record.assert_called_once_with(None, False)
+
+    @gen_test
+    def test_breaker_open(self):
+        # Fetches are rejected while the circuit breaker is open.
+        self.pool.breaker = mock.Mock()
+        self.pool.breaker.check.side_effect = httppool.Unavailable('bad', 5)
+        with self.assertRaises(httppool.Unavailable):
+            yield self.pool.fetch(self.make_request())
+        self.assertEqual([], self.fetches)
+        self.assertEqual(0, self.pool.active)
+
+    def test_breaker_status(self):
+        # The circuit breaker state is included in the pool status.
+        self.pool.breaker = mock.Mock()
+        self.pool.breaker.status.return_value = 'breaker status'
+        self.assertEqual('breaker status', self.pool.status()['breaker'])
+
+    def test_is_failure(self):
+        # Connection errors, timeouts and gateway errors are failures.
+        for code in (502, 503, 504, 599):
+            self.assertTrue(httppool.is_failure(code), code)
+        for code in (200, 404, 500):
+            self.assertFalse(httppool.is_failure(code), code)
+
+    def test_client(self):
+        # Each pool uses its own HTTP client.
+        pool = httppool.HTTPPool('other', io_loop=self.io_loop)
+        self.addCleanup(pool.close)
+        client = pool._get_client()
+        self.assertIsNot(httpclient.AsyncHTTPClient(), client)
+        self.assertIs(client, pool._get_client())
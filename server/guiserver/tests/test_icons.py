@@ -0,0 +1,64 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server fallback for missing charm icons."""
+
+import unittest
+
+import mock
+
+from guiserver import icons
+
+
+class TestGetDefaultIcon(unittest.TestCase):
+
+    def test_icon(self):
+        # The bundled default icon is returned.
+        icon = icons.get_default_icon()
+        self.assertIn('<svg', icon)
+        # The icon is only read once.
+        self.assertIs(icon, icons.get_default_icon())
+
+
+class TestMissingIcons(unittest.TestCase):
+
+    def setUp(self):
+        self.missing_icons = icons.MissingIcons(ttl=10, max_entries=2)
+
+    def test_add(self):
+        # Charm URLs lacking an icon are remembered.
+        self.missing_icons.add('cs:trusty/django-42')
+        self.assertIn('cs:trusty/django-42', self.missing_icons)
+        self.assertNotIn('cs:trusty/django-43', self.missing_icons)
+        self.assertEqual(1, len(self.missing_icons))
+
+    def test_expiration(self):
+        # Charm URLs are forgotten after the TTL.
+        with mock.patch('time.time', mock.Mock(return_value=100)):
+            self.missing_icons.add('cs:trusty/django-42')
+        with mock.patch('time.time', mock.Mock(return_value=109)):
+            self.assertIn('cs:trusty/django-42', self.missing_icons)
+        with mock.patch('time.time', mock.Mock(return_value=110)):
+            self.assertNotIn('cs:trusty/django-42', self.missing_icons)
+        self.assertEqual(0, len(self.missing_icons))
+
+    def test_bounded(self):
+        # The oldest charm URLs are forgotten when the registry is full.
+        for charm_url in ('cs:a-1', 'cs:b-1', 'cs:c-1'):
+            self.missing_icons.add(charm_url)
+        self.assertEqual(2, len(self.missing_icons))
+        self.assertNotIn('cs:a-1', self.missing_icons)
+        self.assertIn('cs:b-1', self.missing_icons)
+        self.assertIn('cs:c-1', self.missing_icons)
@@ -0,0 +1,142 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server API latency tracking."""
+
+import json
+import unittest
+
+import mock
+
+from guiserver import latency
+
+
+def make_request(request_id, request_type='Client', request='FullStatus'):
+    """Return a Juju API request message."""
+    return json.dumps({
+        'RequestId': request_id,
+        'Type': request_type,
+        'Request': request,
+        'Params': {},
+    })
+
+
+class TestApiLatency(unittest.TestCase):
+
+    def test_empty(self):
+        # No methods are reported before any calls are observed.
+        status = latency.ApiLatency().status()
+        self.assertEqual({}, status['methods'])
+
+    def test_observe(self):
+        # Latencies and errors are aggregated by method.
+        api_latency = latency.ApiLatency(buckets=(0.1, 1))
+        api_latency.observe('Client.FullStatus', 0.05, False)
+        api_latency.observe('Client.FullStatus', 0.5, True)
+        api_latency.observe('Client.ServiceGet', 2, False)
+        methods = api_latency.status()['methods']
+        self.assertEqual({
+            'buckets': [(0.1, 1), (1, 1)],
+            'count': 2,
+            'error_rate': 0.5,
+            'errors': 1,
+            'sum': 0.55,
+        }, methods['Client.FullStatus'])
+        self.assertEqual({
+            'buckets': [(0.1, 0), (1, 0)],
+            'count': 1,
+            'error_rate': 0,
+            'errors': 0,
+            'sum': 2,
+        }, methods['Client.ServiceGet'])
+
+    def test_exposition(self):
+        # Latencies and errors are exported in the Prometheus format.
+        api_latency = latency.ApiLatency(buckets=(1,))
+        api_latency.observe('Client.FullStatus', 0.5, True)
+        expected = (
+            '# HELP guiserver_juju_api_latency_seconds The latency of the '
+            'Juju API calls.\n'
+            '# TYPE guiserver_juju_api_latency_seconds histogram\n'
+            'guiserver_juju_api_latency_seconds_bucket{'
+            'method="Client.FullStatus",le="1"} 1\n'
+            'guiserver_juju_api_latency_seconds_bucket{'
+            'method="Client.FullStatus",le="+Inf"} 1\n'
+            'guiserver_juju_api_latency_seconds_sum{'
+            'method="Client.FullStatus"} 0.5\n'
+            'guiserver_juju_api_latency_seconds_count{'
+            'method="Client.FullStatus"} 1\n'
+            '# HELP guiserver_juju_api_errors The Juju API calls returning '
+            'an error.\n'
+            '# TYPE guiserver_juju_api_errors counter\n'
+            'guiserver_juju_api_errors{method="Client.FullStatus"} 1\n')
+        self.assertEqual(expected, api_latency.exposition())
+
+
+class TestRequestTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.latency = mock.Mock()
+        self.timer = latency.RequestTimer(self.latency)
+        self.addCleanup(self.timer.clear)
+
+    @mock.patch('time.time')
+    def test_round_trip(self, mock_time):
+        # The latency of a request is recorded when the response arrives.
+        mock_time.return_value = 10
+        self.timer.sent(make_request(42))
+        mock_time.return_value = 10.5
+        self.timer.received('{"RequestId": 42, "Response": {}}')
+        self.latency.observe.assert_called_once_with(
+            'Client.FullStatus', 0.5, False)
+
+    def test_error(self):
+        # Juju API errors are detected.
+        self.timer.sent(make_request(1))
+        self.timer.received(
+            '{"RequestId": 1, "Error": "bad wolf", "ErrorCode": "", '
+            '"Response": {}}')
+        method, _, error = self.latency.observe.call_args[0]
+        self.assertTrue(error)
+
+    def test_nested_error(self):
+        # Errors included in the response contents are ignored.
+        self.timer.sent(make_request(1))
+        self.timer.received(
+            '{"RequestId": 1, "Response": {"Results": [{"Error": "no"}]}}')
+        method, _, error = self.latency.observe.call_args[0]
+        self.assertFalse(error)
+
+    def test_unknown_response(self):
+        # Responses to requests not sent by the browser are ignored.
+        self.timer.received('{"RequestId": 1, "Response": {}}')
+        self.timer.received('{"Response": {}}')
+        self.assertFalse(self.latency.observe.called)
+
+    def test_outstanding(self):
+        # Requests waiting for a response are tracked.
+        gauge = latency._outstanding
+        value = gauge.value
+        self.timer.sent(make_request(1))
+        self.timer.sent(make_request(2))
+        self.assertEqual(value + 2, gauge.value)
+        self.timer.received('{"RequestId": 1, "Response": {}}')
+        self.assertEqual(value + 1, gauge.value)
+        self.timer.clear()
+        self.assertEqual(value, gauge.value)
+        # Responses to cleared requests are ignored.
+        self.timer.received('{"RequestId": 2, "Response": {}}')
+        self.assertEqual(1, self.latency.observe.call_count)
@@ -18,6 +18,7 @@
 
 from contextlib import contextmanager
 import logging
+import os
 import unittest
 
 import mock
@@ -151,6 +152,27 @@ class TestValidateRange(ValidatorTestMixin, unittest.TestCase):
             manage._validate_range('arg1', *self.value_range)
 
 
+class TestValidateMethods(ValidatorTestMixin, unittest.TestCase):
+
+    def test_success(self):
+        # The validation passes if the methods are valid.
+        methods = 'Client.CharmInfo,Client.ServiceGet:service'
+        with mock.patch('guiserver.manage.options', {'arg1': methods}):
+            manage._validate_methods('arg1')
+
+    def test_success_missing(self):
+        # The validation succeeds if the value is missing.
+        with mock.patch('guiserver.manage.options', {'arg1': None}):
+            manage._validate_methods('arg1')
+
+    def test_failure(self):
+        # The validation fails if a method does not include the type.
+        error = 'error: invalid arg1 argument: invalid method: CharmInfo'
+        with mock.patch('guiserver.manage.options', {'arg1': 'CharmInfo'}):
+            with self.assert_sysexit(error):
+                manage._validate_methods('arg1')
+
+
 class TestGetSslOptions(unittest.TestCase):
 
     def test_options(self):
@@ -179,11 +201,14 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         options = {
             'apiversion': 'go',
             'port': None,
+            'processes': 1,
             'sslpath': '/my/sslpath',
+            'uploadmaxsize': 1024,
         }
         options.update(kwargs)
         with \
                 mock.patch('guiserver.manage.IOLoop') as ioloop, \
+                mock.patch('guiserver.manage.watch_ioloop_lag'), \
                 mock.patch('guiserver.manage.options', mock.Mock(**options)), \
                 mock.patch('guiserver.manage.redirector') as redirector, \
                 mock.patch('guiserver.manage.server') as server:
@@ -195,13 +220,13 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         _, redirector_listen, server_listen = self.mock_and_run(insecure=False)
         redirector_listen.assert_called_once_with(80)
         server_listen.assert_called_once_with(
-            443, ssl_options=self.expected_ssl_options)
+            443, ssl_options=self.expected_ssl_options, max_buffer_size=1024)
 
     def test_insecure_mode(self):
         # The application is correctly run in insecure mode.
         _, redirector_listen, server_listen = self.mock_and_run(insecure=True)
         self.assertFalse(redirector_listen.called)
-        server_listen.assert_called_once_with(80)
+        server_listen.assert_called_once_with(80, max_buffer_size=1024)
 
     def test_customized_port_secure_mode(self):
         # If the user provided a port, the server starts listening on that port
@@ -210,7 +235,7 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
             insecure=False, port=8080)
         self.assertFalse(redirector_listen.called)
         server_listen.assert_called_once_with(
-            8080, ssl_options=self.expected_ssl_options)
+            8080, ssl_options=self.expected_ssl_options, max_buffer_size=1024)
 
     def test_customized_port_insecure_mode(self):
         # The application is correctly run in insecure mode with a user
@@ -218,9 +243,107 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         _, redirector_listen, server_listen = self.mock_and_run(
             insecure=True, port=12345)
         self.assertFalse(redirector_listen.called)
-        server_listen.assert_called_once_with(12345)
+        server_listen.assert_called_once_with(12345, max_buffer_size=1024)
 
     def test_ioloop_started(self):
         # The IO loop instance is started when the application is run.
         ioloop_start, _, _ = self.mock_and_run()
         ioloop_start.assert_called_once_with()
+
+
+class TestRunProcesses(LogTrapTestCase, unittest.TestCase):
+
+    expected_ssl_options = {
+        'certfile': '/my/sslpath/juju.crt',
+        'keyfile': '/my/sslpath/juju.key',
+    }
+    redirector = mock.Mock(return_value='redirector-app')
+    server = mock.Mock(return_value='server-app')
+
+    def mock_and_run(self, **kwargs):
+        """Run the application in multiple processes after mocking the IO loop,
+        the options, the apps and the processes infrastructure.
+
+        Additional options can be specified using kwargs.
+        Return the mock options, bind_sockets, fork_processes and HTTPServer.
+        """
+        options = {
+            'apiversion': 'go',
+            'insecure': False,
+            'port': None,
+            'processes': 4,
+            'shareddir': '/my/shared',
+            'sslpath': '/my/sslpath',
+            'uploadmaxsize': 1024,
+        }
+        options.update(kwargs)
+        mock_options = mock.Mock(**options)
+        with \
+                mock.patch('guiserver.manage.IOLoop'), \
+                mock.patch('guiserver.manage.watch_ioloop_lag'), \
+                mock.patch('guiserver.manage.options', mock_options), \
+                mock.patch('guiserver.manage.redirector', self.redirector), \
+                mock.patch('guiserver.manage.server', self.server), \
+                mock.patch('guiserver.manage.bind_sockets') as bind_sockets, \
+                mock.patch('guiserver.manage.process') as process, \
+                mock.patch('guiserver.manage.HTTPServer') as http_server:
+            bind_sockets.side_effect = lambda port: ['socket-{}'.format(port)]
+            process.task_id.return_value = 0
+            manage.run()
+        return mock_options, bind_sockets, process.fork_processes, http_server
+
+    def test_secure_mode(self):
+        # The sockets are bound before forking and then served by workers.
+        _, bind_sockets, fork_processes, http_server = self.mock_and_run()
+        self.assertEqual(
+            [mock.call(443), mock.call(80)], bind_sockets.call_args_list)
+        fork_processes.assert_called_once_with(4, manage.MAX_WORKER_RESTARTS)
+        self.assertEqual([
+            mock.call(
+                'server-app', ssl_options=self.expected_ssl_options,
+                max_buffer_size=1024),
+            mock.call('redirector-app'),
+        ], http_server.call_args_list)
+        http_server().add_sockets.assert_has_calls([
+            mock.call(['socket-443']), mock.call(['socket-80'])])
+
+    def test_insecure_mode(self):
+        # In insecure mode, the redirector is not used.
+        _, bind_sockets, _, http_server = self.mock_and_run(
+            insecure=True, port=8080)
+        bind_sockets.assert_called_once_with(8080)
+        http_server.assert_called_once_with(
+            'server-app', ssl_options=None, max_buffer_size=1024)
+        http_server().add_sockets.assert_called_once_with(['socket-8080'])
+
+    def test_one_process_for_each_cpu(self):
+        # Passing 0 processes starts a worker for each CPU.
+        _, _, fork_processes, _ = self.mock_and_run(processes=0)
+        fork_processes.assert_called_once_with(0, manage.MAX_WORKER_RESTARTS)
+
+    def test_shared_dir(self):
+        # A temporary shared directory is created if not provided.
+        with mock.patch('guiserver.manage._make_shared_dir') as make_dir:
+            make_dir.return_value = '/tmp/guiserver-shared'
+            options, _, _, _ = self.mock_and_run(shareddir=None)
+        self.assertEqual('/tmp/guiserver-shared', options.shareddir)
+
+
+class TestMakeSharedDir(unittest.TestCase):
+
+    def test_directory(self):
+        # The directory is created and removed when the process exits.
+        with mock.patch('atexit.register') as register:
+            path = manage._make_shared_dir()
+        self.assertTrue(os.path.isdir(path))
+        register.call_args[0][0]()
+        self.assertFalse(os.path.exists(path))
+
+    def test_directory_not_removed_by_workers(self):
+        # The directory is not removed when a worker process exits.
+        with mock.patch('atexit.register') as register:
+            path = manage._make_shared_dir()
+        self.addCleanup(os.rmdir, path)
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            register.call_args[0][0]()
+        self.assertTrue(os.path.isdir(path))
@@ -0,0 +1,197 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server metrics."""
+
+import unittest
+
+import mock
+
+from guiserver import metrics
+
+
+class RegistryTestMixin(object):
+    """Use an empty metrics registry in each test."""
+
+    def setUp(self):
+        super(RegistryTestMixin, self).setUp()
+        patcher = mock.patch('guiserver.metrics._registry', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestCounter(RegistryTestMixin, unittest.TestCase):
+
+    def test_initial_value(self):
+        # A new counter starts from zero.
+        counter = metrics.counter('frames', 'The frames.')
+        self.assertEqual(0, counter.value)
+        self.assertEqual('frames', counter.name)
+        self.assertEqual('The frames.', counter.description)
+
+    def test_inc(self):
+        # A counter can be incremented.
+        counter = metrics.counter('frames', 'The frames.')
+        counter.inc()
+        counter.inc(41)
+        self.assertEqual(42, counter.value)
+
+    def test_repr(self):
+        # The counter representation includes its name and value.
+        counter = metrics.counter('frames', 'The frames.')
+        self.assertEqual('<Counter frames: 0>', repr(counter))
+
+    def test_already_registered(self):
+        # The same counter is returned if already registered.
+        counter = metrics.counter('frames', 'The frames.')
+        self.assertIs(counter, metrics.counter('frames', 'The frames.'))
+
+
+class TestGauge(RegistryTestMixin, unittest.TestCase):
+
+    def test_initial_value(self):
+        # A new gauge starts from zero.
+        gauge = metrics.gauge('connections', 'The connections.')
+        self.assertEqual(0, gauge.value)
+        self.assertEqual('<Gauge connections: 0>', repr(gauge))
+
+    def test_inc_dec(self):
+        # A gauge can be incremented and decremented.
+        gauge = metrics.gauge('connections', 'The connections.')
+        gauge.inc(3)
+        gauge.dec()
+        self.assertEqual(2, gauge.value)
+
+    def test_set(self):
+        # A gauge can be set to a specific value.
+        gauge = metrics.gauge('connections', 'The connections.')
+        gauge.set(47)
+        self.assertEqual(47, gauge.value)
+
+
+class TestSummary(RegistryTestMixin, unittest.TestCase):
+
+    def test_initial_value(self):
+        # A new summary has no observations.
+        summary = metrics.summary('latency', 'The latency.')
+        self.assertEqual({'count': 0, 'sum': 0}, summary.value)
+        self.assertEqual('<Summary latency: 0/0>', repr(summary))
+
+    def test_observe(self):
+        # Observed values are counted and summed.
+        summary = metrics.summary('latency', 'The latency.')
+        summary.observe(0.5)
+        summary.observe(1.5)
+        self.assertEqual({'count': 2, 'sum': 2}, summary.value)
+
+
+class TestHistogram(RegistryTestMixin, unittest.TestCase):
+
+    def test_initial_value(self):
+        # A new histogram has no observations.
+        histogram = metrics.histogram('latency', 'The latency.', (1, 2))
+        expected = {'buckets': [(1, 0), (2, 0)], 'count': 0, 'sum': 0}
+        self.assertEqual(expected, histogram.value)
+        self.assertEqual('<Histogram latency: 0/0>', repr(histogram))
+
+    def test_observe(self):
+        # Observed values are counted in their bucket.
+        histogram = metrics.histogram('latency', 'The latency.', (1, 2))
+        histogram.observe(0.5)
+        histogram.observe(1)
+        histogram.observe(1.5)
+        expected = {'buckets': [(1, 2), (2, 1)], 'count': 3, 'sum': 3}
+        self.assertEqual(expected, histogram.value)
+
+    def test_out_of_range(self):
+        # Values greater than the last bound are only counted in the total.
+        histogram = metrics.histogram('latency', 'The latency.', (1,))
+        histogram.observe(10)
+        expected = {'buckets': [(1, 0)], 'count': 1, 'sum': 10}
+        self.assertEqual(expected, histogram.value)
+
+    def test_default_buckets(self):
+        # By default, the last bucket has no upper bound.
+        histogram = metrics.histogram('latency', 'The latency.')
+        histogram.observe(1000)
+        bound, count = histogram.value['buckets'][-1]
+        self.assertEqual('+Inf', bound)
+        self.assertEqual(1, count)
+
+
+class TestSnapshot(RegistryTestMixin, unittest.TestCase):
+
+    def test_empty(self):
+        # An empty dict is returned if no metrics are registered.
+        self.assertEqual({}, metrics.snapshot())
+
+    def test_values(self):
+        # The snapshot includes the current values of all metrics.
+        metrics.counter('frames', 'The frames.').inc(2)
+        metrics.counter('bytes', 'The bytes.')
+        self.assertEqual({'bytes': 0, 'frames': 2}, metrics.snapshot())
+
+
+class TestExposition(RegistryTestMixin, unittest.TestCase):
+
+    def test_empty(self):
+        # Only a new line is returned if no metrics are registered.
+        self.assertEqual('\n', metrics.exposition())
+
+    def test_counter_and_gauge(self):
+        # Counters and gauges are exported with their help and type.
+        metrics.counter('frames', 'The frames.').inc(2)
+        metrics.gauge('lag', 'The lag.').set(0.5)
+        expected = (
+            '# HELP guiserver_frames The frames.\n'
+            '# TYPE guiserver_frames counter\n'
+            'guiserver_frames 2\n'
+            '# HELP guiserver_lag The lag.\n'
+            '# TYPE guiserver_lag gauge\n'
+            'guiserver_lag 0.5\n')
+        self.assertEqual(expected, metrics.exposition())
+
+    def test_summary(self):
+        # Summaries are exported as a count and a sum.
+        metrics.summary('size', 'The size.').observe(42)
+        expected = (
+            '# HELP guiserver_size The size.\n'
+            '# TYPE guiserver_size summary\n'
+            'guiserver_size_sum 42\n'
+            'guiserver_size_count 1\n')
+        self.assertEqual(expected, metrics.exposition())
+
+    def test_histogram(self):
+        # Histogram buckets are exported as cumulative counts.
+        histogram = metrics.histogram('latency', 'The latency.', (1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+        expected = (
+            '# HELP guiserver_latency The latency.\n'
+            '# TYPE guiserver_latency histogram\n'
+            'guiserver_latency_bucket{le="1"} 1\n'
+            'guiserver_latency_bucket{le="2"} 3\n'
+            'guiserver_latency_bucket{le="+Inf"} 4\n'
+            'guiserver_latency_sum 6.5\n'
+            'guiserver_latency_count 4\n')
+        self.assertEqual(expected, metrics.exposition())
+
+    def test_labels(self):
+        # Samples can be identified by labels, whose values are escaped.
+        counter = metrics.Counter('errors', 'The errors.')
+        lines = metrics.format_samples(
+            'errors', counter, [('method', 'a"b\\c')])
+        self.assertEqual(['errors{method="a\\"b\\\\c"} 0'], lines)
@@ -0,0 +1,417 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server upstream connections multiplexer."""
+
+import json
+
+import mock
+from tornado import concurrent
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
+
+from guiserver import (
+    allwatcher,
+    multiplex,
+)
+from guiserver.tests import helpers
+
+
+class MultiplexerTestMixin(helpers.GoAPITestMixin):
+    """Set up a multiplexer whose upstream connections are mocked."""
+
+    apiurl = 'wss://api.example.com:17070/environment/env-uuid/api'
+
+    def setUp(self):
+        super(MultiplexerTestMixin, self).setUp()
+        self.connections = []
+        patcher = mock.patch(
+            'guiserver.multiplex.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        states = allwatcher.StateCache(ttl=0, io_loop=self.io_loop)
+        self.multiplexer = multiplex.Multiplexer(
+            self.get_auth_backend(), io_loop=self.io_loop, states=states)
+        # Store the messages received by the sessions.
+        self.received = {}
+
+    def websocket_connect(self, io_loop, url, callback, headers=None):
+        """Return a future whose result is a mock WebSocket connection."""
+        connection = mock.Mock(url=url, callback=callback, headers=headers)
+        self.connections.append(connection)
+        future = concurrent.Future()
+        future.set_result(connection)
+        return future
+
+    def connect(self, name, request_id=42, username='user',
+                password='passwd'):
+        """Join an upstream connection as the session with the given name.
+
+        Return the Future returned by the multiplexer.
+        """
+        messages = self.received.setdefault(name, [])
+        data = self.make_login_request(
+            request_id=request_id, username=username, password=password)
+        return self.multiplexer.connect(
+            self.apiurl, {'Origin': 'https://gui'}, data, messages.append)
+
+    def written(self, connection):
+        """Return the decoded messages written to the given connection."""
+        return [
+            json.loads(call[0][0])
+            for call in connection.write_message.call_args_list]
+
+    def respond(self, connection, data):
+        """Simulate the given response sent by the Juju API."""
+        connection.callback(json.dumps(data))
+
+    def last_received(self, name):
+        """Return the last message received by the named session."""
+        return json.loads(self.received[name][-1])
+
+    def run_callbacks(self):
+        """Run the callbacks currently scheduled in the IO loop."""
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+    def login(self, name, **kwargs):
+        """Log in the named session, simulating Juju responses if required.
+
+        Return the resulting session.
+        """
+        future = self.connect(name, **kwargs)
+        self.run_callbacks()
+        if not future.done():
+            connection = self.connections[-1]
+            request_id = self.written(connection)[-1]['RequestId']
+            self.respond(connection, self.make_login_response(
+                request_id=request_id))
+        return future.result()
+
+
+class TestMultiplexerLogin(
+        MultiplexerTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    def test_first_login(self):
+        # The first session logging in creates a new upstream connection.
+        future = self.connect('s1')
+        self.assertEqual(1, len(self.connections))
+        connection = self.connections[0]
+        self.assertEqual(self.apiurl, connection.url)
+        self.assertEqual({'Origin': 'https://gui'}, connection.headers)
+        # The login request is sent with a rewritten request id.
+        self.run_callbacks()
+        request = self.written(connection)[0]
+        self.assertEqual(
+            self.make_login_request(request_id=request['RequestId']),
+            request)
+        self.assertFalse(future.done())
+        # The response is propagated using the original request id.
+        self.respond(connection, self.make_login_response(
+            request_id=request['RequestId']))
+        self.assertEqual(
+            self.make_login_response(request_id=42), self.last_received('s1'))
+        self.assertIsInstance(future.result(), multiplex.Session)
+
+    def test_shared_login(self):
+        # Sessions logged in with the same credentials share the connection
+        # and the login response is sent without contacting the Juju API.
+        self.login('s1')
+        connection = self.connections[0]
+        session = self.login('s2', request_id=1)
+        self.assertIsInstance(session, multiplex.Session)
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(1, connection.write_message.call_count)
+        self.assertEqual(
+            self.make_login_response(request_id=1), self.last_received('s2'))
+        expected = [{'upstream': 1, 'sessions': 2}]
+        self.assertEqual(expected, self.multiplexer.status())
+
+    def test_different_credentials(self):
+        # Sessions logged in with different credentials use separate
+        # upstream connections.
+        self.login('s1')
+        self.login('s2', username='another-user')
+        self.assertEqual(2, len(self.connections))
+        status = self.multiplexer.status()
+        self.assertEqual([1, 2], [info['upstream'] for info in status])
+        # Credentials are not exposed.
+        self.assertNotIn('user', repr(status))
+
+    def test_login_failure(self):
+        # The error is propagated if the login fails, and the upstream
+        # connection is closed.
+        future = self.connect('s1')
+        self.run_callbacks()
+        connection = self.connections[0]
+        request_id = self.written(connection)[0]['RequestId']
+        self.respond(connection, self.make_login_response(
+            request_id=request_id, successful=False))
+        self.assertIsNone(future.result())
+        self.assertEqual(
+            self.make_login_response(request_id=42, successful=False),
+            self.last_received('s1'))
+        connection.close.assert_called_once_with()
+        self.assertEqual([], self.multiplexer.status())
+
+    def test_connection_failure(self):
+        # The login Future is failed if the Juju API cannot be reached.
+        error = ValueError('bad wolf')
+        future = concurrent.Future()
+        future.set_exception(error)
+        path = 'guiserver.multiplex.websocket_connect'
+        with mock.patch(path, mock.Mock(return_value=future)):
+            login_future = self.connect('s1')
+        with ExpectLog('', 'multiplex: unable to connect', required=True):
+            self.run_callbacks()
+        self.assertIs(error, login_future.exception())
+        self.assertEqual([], self.multiplexer.status())
+
+
+class TestUpstream(MultiplexerTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestUpstream, self).setUp()
+        self.s1 = self.login('s1')
+        self.s2 = self.login('s2')
+        self.connection = self.connections[0]
+        self.connection.write_message.reset_mock()
+
+    def test_request_ids(self):
+        # Request identifiers are rewritten on the way out and mapped back
+        # on responses.
+        request = {'RequestId': 1, 'Type': 'Client', 'Request': 'FullStatus'}
+        self.s1.write_message(json.dumps(request))
+        self.s2.write_message(json.dumps(request))
+        first, second = self.written(self.connection)
+        self.assertNotEqual(first['RequestId'], second['RequestId'])
+        self.respond(self.connection, {
+            'RequestId': second['RequestId'], 'Response': 'second'})
+        self.assertEqual(
+            {'RequestId': 1, 'Response': 'second'}, self.last_received('s2'))
+        self.respond(self.connection, {
+            'RequestId': first['RequestId'], 'Response': 'first'})
+        self.assertEqual(
+            {'RequestId': 1, 'Response': 'first'}, self.last_received('s1'))
+
+    def test_unexpected_response(self):
+        # Unexpected responses are logged and discarded.
+        with ExpectLog('', 'multiplex: unexpected response', required=True):
+            self.respond(self.connection, {'RequestId': 4242})
+
+    def watch_all(self, session):
+        """Send a Client.WatchAll request from the given session."""
+        session.write_message(json.dumps(
+            {'RequestId': 2, 'Type': 'Client', 'Request': 'WatchAll'}))
+
+    def start_watcher(self):
+        """Subscribe both sessions to the AllWatcher."""
+        self.watch_all(self.s1)
+        self.watch_all(self.s2)
+        # The sessions are subscribed to the environment state straight away.
+        expected = {'RequestId': 2, 'Response': {'AllWatcherId': '1'}}
+        self.assertEqual(expected, self.last_received('s1'))
+        self.assertEqual(expected, self.last_received('s2'))
+        written = self.written(self.connection)
+        # Only one upstream AllWatcher is started.
+        self.assertEqual(1, len(written))
+        self.assertEqual('WatchAll', written[0]['Request'])
+        self.respond(self.connection, {
+            'RequestId': written[0]['RequestId'],
+            'Response': {'AllWatcherId': '47'},
+        })
+
+    def send_next(self, session, request_id=3):
+        """Send an AllWatcher.Next request from the given session."""
+        session.write_message(json.dumps({
+            'RequestId': request_id,
+            'Type': 'AllWatcher',
+            'Request': 'Next',
+            'Id': '47',
+        }))
+
+    def respond_next(self, deltas=None, error=None):
+        """Simulate an AllWatcher.Next response from the Juju API."""
+        request = self.written(self.connection)[-1]
+        self.assertEqual('Next', request['Request'])
+        self.assertEqual('47', request['Id'])
+        response = {'RequestId': request['RequestId']}
+        if error is None:
+            response['Response'] = {'Deltas': deltas}
+        else:
+            response['Error'] = error
+        self.respond(self.connection, response)
+
+    def wait_for_deltas(self, name, deltas):
+        """Ensure the named session receives the given deltas."""
+        expected = {'RequestId': 3, 'Response': {'Deltas': deltas}}
+        self.run_callbacks()
+        self.assertEqual(expected, self.last_received(name))
+
+    def test_watcher_fan_out(self):
+        # AllWatcher results are sent to all the subscribed sessions.
+        self.start_watcher()
+        self.send_next(self.s1)
+        self.send_next(self.s2)
+        self.respond_next([['service', 'change', {'Name': 'django'}]])
+        self.wait_for_deltas('s1', [['service', 'change', {'Name': 'django'}]])
+        self.wait_for_deltas('s2', [['service', 'change', {'Name': 'django'}]])
+
+    def test_watcher_late_session(self):
+        # A session requesting changes later receives all the unseen deltas.
+        self.start_watcher()
+        self.send_next(self.s1)
+        self.respond_next([['service', 'change', {'Name': 'django'}]])
+        self.respond_next([['unit', 'change', {'Name': 'django/0'}]])
+        self.send_next(self.s2)
+        self.wait_for_deltas('s2', [
+            ['service', 'change', {'Name': 'django'}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ])
+
+    def test_watcher_snapshot(self):
+        # A session requesting changes later receives a compact snapshot.
+        self.start_watcher()
+        self.send_next(self.s1)
+        self.respond_next([
+            ['service', 'change', {'Name': 'django', 'Exposed': False}],
+            ['unit', 'change', {'Name': 'django/0'}],
+        ])
+        self.respond_next([
+            ['unit', 'remove', {'Name': 'django/0'}],
+            ['service', 'change', {'Name': 'django', 'Exposed': True}],
+        ])
+        self.send_next(self.s2)
+        self.wait_for_deltas('s2', [
+            ['service', 'change', {'Name': 'django', 'Exposed': True}],
+        ])
+
+    def test_watcher_not_shared_between_upstreams(self):
+        # Sessions on other upstream connections to the same environment
+        # start their own AllWatcher, as they may be authenticated as other
+        # users.
+        self.start_watcher()
+        self.send_next(self.s1)
+        self.respond_next([['service', 'change', {'Name': 'django'}]])
+        s3 = self.login('s3', username='another-user')
+        connection = self.connections[-1]
+        self.assertIsNot(self.connection, connection)
+        connection.write_message.reset_mock()
+        self.watch_all(s3)
+        self.assertEqual(
+            {'RequestId': 2, 'Response': {'AllWatcherId': '2'}},
+            self.last_received('s3'))
+        self.assertEqual('WatchAll', self.written(connection)[0]['Request'])
+        status = self.multiplexer.states.status()
+        self.assertEqual(
+            [1, 2], [info['upstream'] for info in status])
+        self.assertEqual(
+            ['env-uuid', 'env-uuid'], [info['environment'] for info in status])
+
+    def test_watcher_metrics(self):
+        # The snapshot size and the time to first render are recorded.
+        snapshot_bytes = multiplex._snapshot_bytes.count
+        first_render = multiplex._time_to_first_render.count
+        self.start_watcher()
+        self.send_next(self.s1)
+        self.respond_next([['service', 'change', {'Name': 'django'}]])
+        self.run_callbacks()
+        self.assertEqual(snapshot_bytes + 1, multiplex._snapshot_bytes.count)
+        self.assertEqual(
+            first_render + 1, multiplex._time_to_first_render.count)
+
+    def test_watcher_error(self):
+        # AllWatcher errors are propagated to the sessions.
+        self.start_watcher()
+        self.send_next(self.s1)
+        with ExpectLog('', 'multiplex: AllWatcher error', required=True):
+            self.respond_next(error='bad wolf')
+        self.run_callbacks()
+        self.assertEqual('bad wolf', self.last_received('s1')['Error'])
+        self.assertEqual([], self.multiplexer.states.status())
+
+    def test_watcher_not_started(self):
+        # An error is returned if the session did not request the watcher.
+        self.send_next(self.s1)
+        self.assertEqual('AllWatcher not started', self.last_received('s1')[
+            'Error'])
+
+    def test_watcher_stop(self):
+        # Stopping the watcher is handled locally.
+        self.start_watcher()
+        self.s1.write_message(json.dumps({
+            'RequestId': 4, 'Type': 'AllWatcher', 'Request': 'Stop'}))
+        self.assertEqual(
+            {'RequestId': 4, 'Response': {}}, self.last_received('s1'))
+        self.assertFalse(self.s1.watching)
+
+    def test_watcher_eviction(self):
+        # The upstream AllWatcher is stopped and the environment state is
+        # evicted when no sessions are watching the environment.
+        self.start_watcher()
+        self.s1.close()
+        self.assertEqual(1, self.multiplexer.states.status()[0]['subscribers'])
+        self.s2.close()
+        self.assertEqual([], self.multiplexer.states.status())
+        request = self.written(self.connection)[-1]
+        self.assertEqual('Stop', request['Request'])
+        self.assertEqual('47', request['Id'])
+        self.connection.close.assert_called_once_with()
+
+    def test_watcher_not_kept_alive(self):
+        # Sessions on other connections watching the environment do not keep
+        # alive the upstream connection once its own sessions have left.
+        self.start_watcher()
+        s3 = self.login('s3', username='another-user')
+        self.watch_all(s3)
+        self.s1.close()
+        self.s2.close()
+        self.connection.close.assert_called_once_with()
+        self.assertEqual(1, len(self.multiplexer.states.status()))
+        self.assertTrue(s3.watching)
+
+    def test_detach(self):
+        # The upstream connection is closed when the last session leaves.
+        self.s1.close()
+        self.assertFalse(self.connection.close.called)
+        self.assertEqual(1, self.multiplexer.status()[0]['sessions'])
+        self.s2.close()
+        self.connection.close.assert_called_once_with()
+        self.assertEqual([], self.multiplexer.status())
+
+    def test_upstream_closed(self):
+        # All the sessions are terminated when the Juju API disconnects.
+        self.connection.callback(None)
+        self.assertIsNone(self.received['s1'][-1])
+        self.assertIsNone(self.received['s2'][-1])
+        self.assertTrue(self.s1.closed)
+        self.assertEqual([], self.multiplexer.status())
+
+    def test_upstream_closed_while_watching(self):
+        # The environment state is closed when its upstream disconnects, while
+        # the states fed by other connections are preserved.
+        self.start_watcher()
+        s3 = self.login('s3', username='another-user')
+        self.watch_all(s3)
+        self.connection.callback(None)
+        status = self.multiplexer.states.status()
+        self.assertEqual(
+            [2], [info['upstream'] for info in status])
+        self.assertIsNone(self.received['s1'][-1])
+        self.assertTrue(s3.watching)
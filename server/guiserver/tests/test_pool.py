@@ -0,0 +1,147 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server pre-warmed upstream connections pool."""
+
+import datetime
+
+import mock
+from tornado import concurrent
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
+
+from guiserver import pool
+
+
+class TestConnectionPool(LogTrapTestCase, AsyncTestCase):
+
+    apiurl = 'wss://api.example.com:17070/environment/env-uuid/api'
+    headers = {'Origin': 'https://gui'}
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.connections = []
+        self.failing = False
+        patcher = mock.patch(
+            'guiserver.pool.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = pool.ConnectionPool(
+            size=2, max_idle=0.1, io_loop=self.io_loop)
+        # Reset the pool metrics.
+        for metric in (pool._hits, pool._misses):
+            patcher = mock.patch.object(metric, 'value', 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def websocket_connect(self, io_loop, url, callback, headers=None):
+        """Return a future whose result is a mock WebSocket connection."""
+        future = concurrent.Future()
+        if self.failing:
+            future.set_exception(ValueError('bad wolf'))
+            return future
+        connection = mock.Mock(url=url, callback=callback, headers=headers)
+        connection.stream.closed.return_value = False
+        connection.connect_future = future
+        connection.set_message_callback.side_effect = lambda callback: (
+            setattr(connection, 'callback', callback))
+        self.connections.append(connection)
+        future.set_result(connection)
+        return future
+
+    def connect(self):
+        """Request a connection to the pool and return the resulting Future.
+        """
+        callback = mock.Mock()
+        future = self.pool.connect(self.apiurl, callback, self.headers)
+        self.run_callbacks()
+        return future, callback
+
+    def run_callbacks(self):
+        """Run the callbacks currently scheduled in the IO loop."""
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+    def test_miss(self):
+        # The first connection is established on demand, and the pool is
+        # filled in the background.
+        future, callback = self.connect()
+        self.assertEqual(3, len(self.connections))
+        connection = future.result()
+        self.assertIs(callback, connection.callback)
+        self.assertEqual(self.headers, connection.headers)
+        self.assertEqual(
+            {'size': 2, 'hits': 0, 'misses': 1, 'hit_rate': 0.0,
+             'idle': {self.apiurl: 2}},
+            self.pool.status())
+
+    def test_hit(self):
+        # Idle connections are reused, and the pool is refilled.
+        self.connect()
+        future, callback = self.connect()
+        connection = future.result()
+        self.assertIs(self.connections[1], connection)
+        self.assertIs(callback, connection.callback)
+        self.assertEqual(4, len(self.connections))
+        status = self.pool.status()
+        self.assertEqual(1, status['hits'])
+        self.assertEqual(0.5, status['hit_rate'])
+        self.assertEqual({self.apiurl: 2}, status['idle'])
+
+    def test_different_headers(self):
+        # Connections are pooled separately for each set of headers.
+        self.connect()
+        future = self.pool.connect(
+            self.apiurl, mock.Mock(), {'Origin': 'https://other'})
+        self.assertEqual(self.connections[3], future.result())
+        self.assertEqual(2, self.pool.status()['misses'])
+
+    def test_closed_by_juju(self):
+        # Idle connections closed by the Juju API are removed from the pool.
+        self.connect()
+        self.connections[1].callback(None)
+        self.assertEqual({self.apiurl: 1}, self.pool.status()['idle'])
+
+    def test_closed_stream(self):
+        # Idle connections whose stream is closed are not reused.
+        self.connect()
+        self.connections[1].stream.closed.return_value = True
+        future, _ = self.connect()
+        self.assertIs(self.connections[2], future.result())
+
+    def test_max_idle(self):
+        # Idle connections are closed after the given amount of time, and the
+        # pool drains if not used.
+        self.connect()
+        self.io_loop.add_timeout(datetime.timedelta(seconds=0.2), self.stop)
+        self.wait()
+        self.connections[1].close.assert_called_once_with()
+        self.connections[2].close.assert_called_once_with()
+        self.assertEqual({}, self.pool.status()['idle'])
+        # The request is served creating a new connection.
+        future, _ = self.connect()
+        self.assertIs(self.connections[3], future.result())
+
+    def test_connection_failure(self):
+        # Errors while filling the pool are logged.
+        self.failing = True
+        with ExpectLog('', 'pool: unable to connect', required=True):
+            future, _ = self.connect()
+        self.assertIsInstance(future.exception(), ValueError)
+        self.assertEqual({}, self.pool.status()['idle'])
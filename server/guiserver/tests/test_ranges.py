@@ -0,0 +1,168 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server support for HTTP range requests."""
+
+import unittest
+
+from tornado import httpserver
+
+from guiserver import ranges
+
+
+class TestRequestedRanges(unittest.TestCase):
+
+    last_modified = 'Tue, 15 Nov 1994 08:12:31 GMT'
+
+    def get_ranges(self, header, size=100, method='GET', **headers):
+        """Return the ranges requested with the given Range header."""
+        if header is not None:
+            headers['Range'] = header
+        request = httpserver.HTTPRequest(method, '/path', headers=headers)
+        return ranges.requested_ranges(
+            request, size, '"v1"', self.last_modified)
+
+    def test_no_range(self):
+        # The whole content is sent if no ranges are requested.
+        self.assertIsNone(self.get_ranges(None))
+
+    def test_ranges(self):
+        # Byte ranges are returned as (start, stop) tuples.
+        for header, expected in (
+                ('bytes=0-9', [(0, 10)]),
+                ('bytes=10-', [(10, 100)]),
+                ('bytes=-10', [(90, 100)]),
+                ('bytes=90-200', [(90, 100)]),
+                ('bytes=-200', [(0, 100)]),
+                ('BYTES = 0-0 , 99-99', [(0, 1), (99, 100)])):
+            self.assertEqual(expected, self.get_ranges(header), header)
+
+    def test_coalesced(self):
+        # Ranges are sorted, and overlapping or adjacent ranges are merged.
+        self.assertEqual(
+            [(0, 30), (50, 60)],
+            self.get_ranges('bytes=50-59,10-29,0-9,5-14'))
+
+    def test_unsatisfiable(self):
+        # An empty list is returned if no ranges can be satisfied.
+        for header in ('bytes=100-', 'bytes=200-300', 'bytes=-0'):
+            self.assertEqual([], self.get_ranges(header), header)
+        # Unsatisfiable ranges are ignored if others can be satisfied.
+        self.assertEqual([(0, 10)], self.get_ranges('bytes=200-,0-9'))
+
+    def test_invalid(self):
+        # The whole content is sent if the Range header is not valid.
+        for header in (
+                'bytes=', 'bytes=-', 'bytes=10-5', 'bytes=a-b', 'bytes=1-2-3',
+                'bytes=+1-2', 'items=0-9', '0-9'):
+            self.assertIsNone(self.get_ranges(header), header)
+
+    def test_too_many_ranges(self):
+        # The whole content is sent if too many ranges are requested.
+        header = 'bytes=' + ','.join(
+            '{0}-{0}'.format(offset * 2)
+            for offset in range(ranges.MAX_RANGES + 1))
+        self.assertIsNone(self.get_ranges(header))
+
+    def test_unsafe_methods(self):
+        # Ranges are only honored for GET requests.
+        self.assertIsNone(self.get_ranges('bytes=0-9', method='POST'))
+
+    def test_if_range_etag(self):
+        # The If-Range entity tag is compared using the strong comparison.
+        for if_range, expected in (
+                ('"v1"', [(0, 10)]),
+                ('"v0"', None),
+                ('W/"v1"', None)):
+            headers = {'If-Range': if_range}
+            self.assertEqual(
+                expected, self.get_ranges('bytes=0-9', **headers), if_range)
+        request = httpserver.HTTPRequest('GET', '/path', headers={
+            'Range': 'bytes=0-9', 'If-Range': '"v1"'})
+        self.assertIsNone(ranges.requested_ranges(request, 100, 'W/"v1"'))
+
+    def test_if_range_date(self):
+        # The If-Range date must match the last modification.
+        for if_range, expected in (
+                (self.last_modified, [(0, 10)]),
+                ('Wed, 16 Nov 1994 08:12:31 GMT', None),
+                ('invalid', None)):
+            headers = {'If-Range': if_range}
+            self.assertEqual(
+                expected, self.get_ranges('bytes=0-9', **headers), if_range)
+        request = httpserver.HTTPRequest('GET', '/path', headers={
+            'Range': 'bytes=0-9', 'If-Range': self.last_modified})
+        self.assertIsNone(ranges.requested_ranges(request, 100, '"v1"'))
+
+
+class TestContentRange(unittest.TestCase):
+
+    def test_content_range(self):
+        # The last byte position is included in the range.
+        self.assertEqual('bytes 0-9/100', ranges.content_range(0, 10, 100))
+        self.assertEqual('bytes 99-99/100', ranges.content_range(99, 100, 100))
+
+
+class TestMultipartRanges(unittest.TestCase):
+
+    def setUp(self):
+        self.content = 'abcdefghijklmnopqrstuvwxyz'
+        self.multipart = ranges.MultipartRanges(
+            [(0, 3), (10, 12)], len(self.content), 'text/plain')
+
+    def get_body(self):
+        """Return the multipart body for the content."""
+        body = ''
+        for headers, start, stop in self.multipart.parts:
+            body += headers + self.content[start:stop]
+        return body + self.multipart.closing
+
+    def test_content_type(self):
+        # The content type includes the parts boundary.
+        media_type, boundary = self.multipart.content_type.split('; ')
+        self.assertEqual('multipart/byteranges', media_type)
+        self.assertTrue(boundary.startswith('boundary='))
+
+    def test_body(self):
+        # Each part includes the range content type and position.
+        boundary = self.multipart.content_type.split('boundary=')[1]
+        expected = (
+            '\r\n--{0}\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-Range: bytes 0-2/26\r\n\r\n'
+            'abc'
+            '\r\n--{0}\r\n'
+            'Content-Type: text/plain\r\n'
+            'Content-Range: bytes 10-11/26\r\n\r\n'
+            'kl'
+            '\r\n--{0}--\r\n'
+        ).format(boundary)
+        self.assertEqual(expected, self.get_body())
+
+    def test_length(self):
+        # The length of the resulting body is precomputed.
+        self.assertEqual(len(self.get_body()), self.multipart.length)
+
+    def test_without_content_type(self):
+        # The parts content type is omitted if not known.
+        multipart = ranges.MultipartRanges([(0, 1), (5, 6)], 10)
+        for headers, _, _ in multipart.parts:
+            self.assertNotIn('Content-Type', headers)
+
+    def test_unique_boundary(self):
+        # Each response uses a different boundary.
+        other = ranges.MultipartRanges([(0, 1)], 10)
+        self.assertNotEqual(
+            self.multipart.content_type, other.content_type)
@@ -0,0 +1,186 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server browser session resumption."""
+
+import mock
+from tornado.testing import (
+    AsyncTestCase,
+    LogTrapTestCase,
+)
+
+from guiserver import resume
+from guiserver.auth import User
+
+
+class TestSessionParking(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestSessionParking, self).setUp()
+        self.parking = resume.SessionParking(
+            window=0.05, max_sessions=2, max_bytes=50, io_loop=self.io_loop)
+        # Reset the parking metrics.
+        for metric in (resume._parked_total, resume._resumed,
+                       resume._dropped):
+            patcher = mock.patch.object(metric, 'value', 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_session(self):
+        """Return a parked session using a mock Juju API connection."""
+        connection = mock.Mock()
+        connection.set_message_callback.side_effect = lambda callback: (
+            setattr(connection, 'callback', callback))
+        watcher_request = {
+            'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Next', 'Id': '1'}
+        return resume.ParkedSession(
+            connection, 'user', 'passwd', {'Response': {}},
+            watcher_request=watcher_request, watcher_pending=True)
+
+    def test_park_and_resume(self):
+        # Parked sessions can be resumed using their token.
+        session = self.make_session()
+        self.parking.park('token', session)
+        self.assertEqual(1, len(self.parking))
+        self.assertEqual(1, resume._parked.value)
+        self.assertIs(session, self.parking.resume('token'))
+        self.assertEqual(0, len(self.parking))
+        self.assertEqual(1, resume._resumed.value)
+        self.assertFalse(session.connection.close.called)
+
+    def test_single_use(self):
+        # Sessions can only be resumed once.
+        self.parking.park('token', self.make_session())
+        self.parking.resume('token')
+        self.assertIsNone(self.parking.resume('token'))
+
+    def test_unknown_token(self):
+        # None is returned if the token is not known.
+        self.assertIsNone(self.parking.resume('no-such'))
+        self.assertEqual(0, resume._resumed.value)
+
+    def test_retained_messages(self):
+        # AllWatcher responses received while parked are retained.
+        session = self.make_session()
+        self.parking.park('token', session)
+        message = '{"RequestId": 3, "Response": {}}'
+        session.connection.callback(message)
+        self.assertEqual([message], list(session.messages))
+        self.assertEqual(len(message), session.size)
+        self.assertFalse(session.watcher_pending)
+        self.assertIs(session, self.parking.resume('token'))
+
+    def test_discarded_messages(self):
+        # The responses to the other requests of the disconnected page are
+        # discarded.
+        session = self.make_session()
+        self.parking.park('token', session)
+        session.connection.callback('{"RequestId": 4, "Response": {}}')
+        self.assertEqual([], list(session.messages))
+        self.assertEqual(0, session.size)
+
+    def test_no_pending_watcher_request(self):
+        # No messages are retained if the page was not waiting for changes.
+        session = self.make_session()
+        session.watcher_pending = False
+        self.parking.park('token', session)
+        session.connection.callback('{"RequestId": 3, "Response": {}}')
+        self.assertEqual([], list(session.messages))
+
+    def test_too_large(self):
+        # Sessions retaining too many messages are dropped.
+        session = self.make_session()
+        self.parking.park('token', session)
+        session.connection.callback(
+            '{"RequestId": 3, "Response": {"Deltas": ["hello world"]}}')
+        session.connection.close.assert_called_once_with()
+        self.assertIsNone(self.parking.resume('token'))
+        self.assertEqual(1, resume._dropped.value)
+
+    def test_expiration(self):
+        # Sessions not resumed in time are dropped.
+        session = self.make_session()
+        self.parking.park('token', session)
+        self.io_loop.add_timeout(0.1 + self.io_loop.time(), self.stop)
+        self.wait()
+        session.connection.close.assert_called_once_with()
+        self.assertIsNone(self.parking.resume('token'))
+        self.assertEqual(0, resume._parked.value)
+
+    def test_eviction(self):
+        # The oldest session is dropped when too many sessions are parked.
+        sessions = [self.make_session() for _ in range(3)]
+        for num, session in enumerate(sessions):
+            self.parking.park('token{}'.format(num), session)
+        self.assertEqual(2, len(self.parking))
+        sessions[0].connection.close.assert_called_once_with()
+        self.assertIsNone(self.parking.resume('token0'))
+        self.assertIs(sessions[2], self.parking.resume('token2'))
+
+    def test_juju_disconnection(self):
+        # Sessions disconnected by Juju are dropped.
+        session = self.make_session()
+        self.parking.park('token', session)
+        session.connection.callback(None)
+        self.assertFalse(session.connection.close.called)
+        self.assertIsNone(self.parking.resume('token'))
+        self.assertEqual(1, resume._dropped.value)
+
+
+class TestParkRequests(LogTrapTestCase, AsyncTestCase):
+
+    request = {
+        'RequestId': 42,
+        'Type': 'GUISession',
+        'Request': 'Park',
+        'Params': {},
+    }
+
+    def setUp(self):
+        super(TestParkRequests, self).setUp()
+        self.parking = resume.SessionParking(window=30, io_loop=self.io_loop)
+        self.write_message = mock.Mock()
+
+    def test_park_requested(self):
+        # Park requests are correctly identified.
+        self.assertTrue(self.parking.park_requested(self.request))
+        self.assertFalse(self.parking.park_requested(
+            dict(self.request, Request='Resume')))
+        self.assertFalse(self.parking.park_requested(
+            dict(self.request, Type='GUIToken')))
+
+    @mock.patch('uuid.uuid4', mock.Mock(return_value=mock.Mock(hex='TOKEN')))
+    def test_process_park_request(self):
+        # A resume token is sent to authenticated users.
+        user = User('user', 'passwd', is_authenticated=True)
+        token = self.parking.process_park_request(
+            self.request, user, True, self.write_message)
+        self.assertEqual('TOKEN', token)
+        self.write_message.assert_called_once_with({
+            'RequestId': 42,
+            'Response': {'Token': 'TOKEN', 'Window': 30, 'Resumed': True},
+        })
+
+    def test_process_park_request_unauthenticated(self):
+        # Sessions cannot be parked by anonymous users.
+        token = self.parking.process_park_request(
+            self.request, User(), False, self.write_message)
+        self.assertIsNone(token)
+        self.write_message.assert_called_once_with({
+            'RequestId': 42,
+            'Error': 'sessions can only be parked by authenticated users.',
+            'ErrorCode': 'unauthorized access',
+            'Response': {},
+        })
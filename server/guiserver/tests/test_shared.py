@@ -0,0 +1,204 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server state shared between processes."""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from guiserver import shared
+
+
+def pop_token(path, key, results):
+    """Pop the given key from the store at path, and save the result.
+
+    This function is defined at module level so that it can be easily run in
+    another process.
+    """
+    results.put(shared.SharedStore(path).pop(key))
+
+
+class TestMemoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = shared.MemoryStore()
+
+    def test_put_and_pop(self):
+        # Stored values can be retrieved only once.
+        self.store.put('key', {'answer': 42}, 60)
+        self.assertEqual({'answer': 42}, self.store.pop('key'))
+        self.assertIsNone(self.store.pop('key'))
+
+    def test_missing(self):
+        # None is returned if the key is not found.
+        self.assertIsNone(self.store.pop('no-such'))
+
+    def test_expired(self):
+        # Expired entries are not returned.
+        self.store.put('key', 'value', 60)
+        with mock.patch('time.time', mock.Mock(return_value=time.time() + 61)):
+            self.assertIsNone(self.store.pop('key'))
+
+    def test_expired_removed(self):
+        # Expired entries are removed when new entries are added.
+        now = time.time()
+        self.store.put('key1', 'value', 60)
+        self.store.put('key2', 'value', 120)
+        with mock.patch('time.time', mock.Mock(return_value=now + 61)):
+            self.store.put('key3', 'value', 60)
+        self.assertEqual({'key2', 'key3'}, set(self.store._data))
+        self.assertEqual(2, len(self.store._expirations))
+
+    def test_replace(self):
+        # Storing an existing key replaces its value and expiration.
+        now = time.time()
+        self.store.put('key', 'value1', 60)
+        self.store.put('key', 'value2', 120)
+        with mock.patch('time.time', mock.Mock(return_value=now + 61)):
+            self.assertEqual(1, len(self.store))
+            self.assertEqual('value2', self.store.pop('key'))
+
+    def test_len(self):
+        # The number of entries not expired is returned.
+        now = time.time()
+        self.assertEqual(0, len(self.store))
+        self.store.put('key1', 'value', 60)
+        self.store.put('key2', 'value', 120)
+        self.assertEqual(2, len(self.store))
+        with mock.patch('time.time', mock.Mock(return_value=now + 61)):
+            self.assertEqual(1, len(self.store))
+
+
+class SharedTestMixin(object):
+    """Set up a temporary directory for the shared state."""
+
+    def setUp(self):
+        super(SharedTestMixin, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'shared.db')
+
+
+class TestSharedStore(SharedTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSharedStore, self).setUp()
+        self.store = shared.SharedStore(self.path)
+
+    def test_put_and_pop(self):
+        # Stored values can be retrieved only once.
+        self.store.put('key', {'answer': 42}, 60)
+        self.assertEqual({'answer': 42}, self.store.pop('key'))
+        self.assertIsNone(self.store.pop('key'))
+
+    def test_missing(self):
+        # None is returned if the key is not found.
+        self.assertIsNone(self.store.pop('no-such'))
+
+    def test_replace(self):
+        # Storing an existing key replaces its value.
+        self.store.put('key', 'value1', 60)
+        self.store.put('key', 'value2', 60)
+        self.assertEqual(1, len(self.store))
+        self.assertEqual('value2', self.store.pop('key'))
+
+    def test_expired(self):
+        # Expired entries are not returned.
+        self.store.put('key', 'value', 60)
+        with mock.patch('time.time', mock.Mock(return_value=time.time() + 61)):
+            self.assertEqual(0, len(self.store))
+            self.assertIsNone(self.store.pop('key'))
+
+    def test_expired_removed(self):
+        # Expired entries are removed when new entries are added.
+        self.store.put('key1', 'value', 60)
+        with mock.patch('time.time', mock.Mock(return_value=time.time() + 61)):
+            self.store.put('key2', 'value', 60)
+        connection = self.store._connect()
+        keys = connection.execute('SELECT key FROM entries').fetchall()
+        self.assertEqual([('key2',)], keys)
+
+    def test_len(self):
+        # The number of entries is returned.
+        self.assertEqual(0, len(self.store))
+        self.store.put('key1', 'value', 60)
+        self.store.put('key2', 'value', 60)
+        self.assertEqual(2, len(self.store))
+
+    def test_tables(self):
+        # Stores using different tables in the same database are isolated.
+        other = shared.SharedStore(self.path, table='other')
+        self.store.put('key', 'value', 60)
+        self.assertIsNone(other.pop('key'))
+        self.assertEqual('value', self.store.pop('key'))
+
+    def test_shared_between_processes(self):
+        # Entries are shared between processes, and only one process can
+        # retrieve each entry.
+        self.store.put('key', 'value', 60)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=pop_token, args=(self.path, 'key', results))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        values = [results.get() for _ in processes]
+        self.assertEqual(['value'], [value for value in values if value])
+
+    def test_connection_not_shared_with_children(self):
+        # A new database connection is created in forked processes.
+        connection = self.store._connect()
+        self.assertIs(connection, self.store._connect())
+        with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+            self.assertIsNot(connection, self.store._connect())
+
+
+class TestFileLock(SharedTestMixin, unittest.TestCase):
+
+    def test_context_manager(self):
+        # The lock is acquired and released using a context manager.
+        lock = shared.FileLock(self.path)
+        with lock as acquired:
+            self.assertIs(lock, acquired)
+            self.assertIsNotNone(lock._file)
+        self.assertIsNone(lock._file)
+
+    def test_exclusive(self):
+        # The lock can be held by one owner at the time.
+        lock = shared.FileLock(self.path)
+        other = shared.FileLock(self.path)
+        lock.acquire()
+        with self.assertRaises(IOError):
+            with mock.patch('fcntl.LOCK_EX', shared.fcntl.LOCK_EX |
+                            shared.fcntl.LOCK_NB):
+                other.acquire()
+        self.assertIsNone(other._file)
+        lock.release()
+        other.acquire()
+        other.release()
+
+    def test_release_not_acquired(self):
+        # Releasing a lock not acquired is a no-op.
+        shared.FileLock(self.path).release()
@@ -0,0 +1,362 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Tests for the Juju GUI server streaming of proxied HTTP responses."""
+
+import unittest
+
+import mock
+from tornado import (
+    httpclient,
+    httputil,
+)
+
+from guiserver import streaming
+
+
+class TestResponseStream(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.handler.should_relay.return_value = True
+        self.handler.check_not_modified.return_value = False
+        self.stream = streaming.ResponseStream(self.handler, max_buffer=10)
+        self.request = httpclient.HTTPRequest('https://example.com/path')
+        self.stream.attach(self.request)
+        # Patch the curl module, which may not be available.
+        patcher = mock.patch(
+            'guiserver.streaming.pycurl',
+            mock.Mock(WRITEFUNC_PAUSE='pause', PAUSE_CONT='cont'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_headers(self, *lines):
+        """Send the given header lines to the stream."""
+        for line in lines:
+            self.request.header_callback(line + '\r\n')
+        self.request.header_callback('\r\n')
+
+    def make_response(self, code=200):
+        """Return a completed response as returned by the HTTP client."""
+        return httpclient.HTTPResponse(self.request, code)
+
+    def test_attach(self):
+        # The stream callbacks are set up in the HTTP request.
+        self.assertIsNotNone(self.request.header_callback)
+        self.assertIsNotNone(self.request.streaming_callback)
+        self.assertIsNotNone(self.request.prepare_curl_callback)
+
+    def test_headers(self):
+        # The response status code and headers are parsed.
+        self.send_headers(
+            'HTTP/1.1 200 OK', 'Content-Type: text/plain',
+            'Content-Length: 42')
+        self.assertEqual(200, self.stream.code)
+        self.assertEqual('text/plain', self.stream.headers['Content-Type'])
+        self.assertEqual('42', self.stream.headers['Content-Length'])
+
+    def test_headers_reset(self):
+        # Only the headers of the last response are retained.
+        self.send_headers('HTTP/1.1 302 Found', 'Location: /other')
+        self.send_headers('HTTP/1.1 200 OK', 'Content-Type: text/plain')
+        self.assertEqual(200, self.stream.code)
+        self.assertNotIn('Location', self.stream.headers)
+
+    def test_streaming(self):
+        # Successful responses are relayed to the handler chunk by chunk.
+        self.send_headers(
+            'HTTP/1.1 200 OK', 'Content-Type: text/plain',
+            'Transfer-Encoding: chunked')
+        self.request.streaming_callback('chunk1')
+        self.assertTrue(self.stream.streaming)
+        self.assertTrue(self.stream.relayed)
+        self.handler.should_relay.assert_called_once_with(
+            200, self.stream.headers)
+        self.handler.set_status.assert_called_once_with(200)
+        # The chunked transfer encoding is not relayed.
+        self.handler.set_header.assert_called_once_with(
+            'Content-Type', 'text/plain')
+        self.handler.write.assert_called_once_with('chunk1')
+        self.request.streaming_callback('chunk2')
+        self.assertEqual(
+            [mock.call('chunk1'), mock.call('chunk2')],
+            self.handler.write.call_args_list)
+        self.assertEqual(2, self.handler.flush.call_count)
+        # Headers are only sent once.
+        self.assertEqual(1, self.handler.set_status.call_count)
+
+    def test_not_modified(self):
+        # The body is not relayed if the handler reports the browser copy of
+        # the response as still valid.
+        self.handler.check_not_modified.return_value = True
+        self.send_headers('HTTP/1.1 200 OK', 'ETag: "v1"')
+        self.request.streaming_callback('chunk')
+        self.assertTrue(self.stream.streaming)
+        self.assertTrue(self.stream.not_modified)
+        self.handler.check_not_modified.assert_called_once_with(
+            self.stream.headers)
+        self.assertFalse(self.handler.write.called)
+        self.assertFalse(self.handler.flush.called)
+
+    def test_streamed_bytes_metric(self):
+        # The streamed bytes are tracked.
+        value = streaming._streamed_bytes.value
+        self.send_headers('HTTP/1.1 200 OK')
+        self.request.streaming_callback('chunk')
+        self.assertEqual(value + 5, streaming._streamed_bytes.value)
+
+    def test_error_buffered(self):
+        # Error responses are buffered and returned when the fetch completes.
+        self.send_headers('HTTP/1.1 404 Not Found', 'Content-Type: text/plain')
+        self.request.streaming_callback('not ')
+        self.request.streaming_callback('found')
+        self.assertFalse(self.stream.streaming)
+        self.assertFalse(self.handler.write.called)
+        response = self.stream.get_response(self.make_response(404))
+        self.assertEqual(404, response.code)
+        self.assertEqual('not found', response.body)
+        self.assertEqual('text/plain', response.headers['Content-Type'])
+
+    def test_response_without_callbacks(self):
+        # The response is returned as is if no data has been received.
+        response = self.make_response()
+        self.assertIs(response, self.stream.get_response(response))
+
+    def test_pause_and_resume(self):
+        # The curl transfer is paused when too many bytes are waiting to be
+        # sent to the browser, and resumed when they have been sent.
+        curl = mock.Mock()
+        self.request.prepare_curl_callback(curl)
+        self.send_headers('HTTP/1.1 200 OK')
+        self.assertIsNone(self.request.streaming_callback('0123456789'))
+        self.assertEqual('pause', self.request.streaming_callback('more'))
+        self.assertTrue(self.stream.paused)
+        self.assertEqual(1, self.handler.write.call_count)
+        self.assertFalse(curl.pause.called)
+        # The flush callback resumes the transfer.
+        callback = self.handler.flush.call_args[1]['callback']
+        callback()
+        curl.pause.assert_called_once_with('cont')
+        self.assertFalse(self.stream.paused)
+        self.assertIsNone(self.request.streaming_callback('more'))
+        self.assertEqual(2, self.handler.write.call_count)
+
+    def test_no_pause_without_curl(self):
+        # Transfers cannot be paused if the curl client is not in use.
+        self.send_headers('HTTP/1.1 200 OK')
+        self.request.streaming_callback('0123456789')
+        self.assertIsNone(self.request.streaming_callback('more'))
+        self.assertEqual(2, self.handler.write.call_count)
+
+    def test_close(self):
+        # The transfer is aborted when the browser connection is closed.
+        self.send_headers('HTTP/1.1 200 OK')
+        self.stream.close()
+        self.assertEqual(0, self.request.streaming_callback('chunk'))
+        self.assertFalse(self.handler.write.called)
+
+    def test_close_paused(self):
+        # Paused transfers are resumed so that they can be aborted.
+        curl = mock.Mock()
+        self.request.prepare_curl_callback(curl)
+        self.send_headers('HTTP/1.1 200 OK')
+        self.request.streaming_callback('0123456789')
+        self.request.streaming_callback('more')
+        self.stream.close()
+        curl.pause.assert_called_once_with('cont')
+        self.assertEqual(0, self.request.streaming_callback('more'))
+
+    def test_sink(self):
+        # The streamed body is also passed to the sink, which is committed
+        # when the response is complete.
+        sink = mock.Mock(headers={'Cache-Control': 'public'})
+        stream = streaming.ResponseStream(self.handler, sink=sink)
+        stream.attach(self.request)
+        self.send_headers('HTTP/1.1 200 OK')
+        self.request.streaming_callback('chunk')
+        sink.write.assert_called_once_with('chunk')
+        self.handler.set_header.assert_called_once_with(
+            'Cache-Control', 'public')
+        stream.finish(True)
+        sink.commit.assert_called_once_with(200, stream.headers)
+        self.assertFalse(sink.abort.called)
+
+    def test_sink_aborted(self):
+        # The sink is aborted if the transfer fails.
+        sink = mock.Mock(headers={})
+        stream = streaming.ResponseStream(self.handler, sink=sink)
+        stream.attach(self.request)
+        self.send_headers('HTTP/1.1 200 OK')
+        self.request.streaming_callback('chunk')
+        stream.finish(False)
+        sink.abort.assert_called_once_with()
+        self.assertFalse(sink.commit.called)
+
+    def test_sink_only(self):
+        # The body is only passed to the sink if the handler does not relay
+        # the response.
+        self.handler.should_relay.return_value = False
+        sink = mock.Mock(headers={'Cache-Control': 'public'})
+        stream = streaming.ResponseStream(self.handler, sink=sink)
+        stream.attach(self.request)
+        self.send_headers('HTTP/1.1 200 OK', 'Content-Type: text/plain')
+        self.request.streaming_callback('chunk')
+        self.assertTrue(stream.streaming)
+        self.assertFalse(stream.relayed)
+        sink.write.assert_called_once_with('chunk')
+        self.assertFalse(self.handler.set_status.called)
+        self.assertFalse(self.handler.set_header.called)
+        self.assertFalse(self.handler.write.called)
+        self.assertFalse(self.handler.check_not_modified.called)
+        stream.finish(True)
+        sink.commit.assert_called_once_with(200, stream.headers)
+
+    def test_sink_not_streamed(self):
+        # The sink is aborted if the response is not streamed.
+        sink = mock.Mock(headers={})
+        stream = streaming.ResponseStream(self.handler, sink=sink)
+        stream.attach(self.request)
+        self.send_headers('HTTP/1.1 404 Not Found')
+        self.request.streaming_callback('not found')
+        stream.finish(True)
+        self.assertFalse(sink.write.called)
+        sink.abort.assert_called_once_with()
+
+
+class TestRelayedHeaders(unittest.TestCase):
+
+    def test_end_to_end(self):
+        # End-to-end headers are relayed.
+        headers = httputil.HTTPHeaders({
+            'Content-Type': 'text/plain',
+            'Content-Length': '42',
+        })
+        self.assertEqual(
+            sorted(headers.items()),
+            sorted(streaming.relayed_headers(headers)))
+
+    def test_hop_by_hop(self):
+        # Hop-by-hop headers are not relayed.
+        headers = httputil.HTTPHeaders({
+            'Connection': 'keep-alive, X-Hop',
+            'Transfer-Encoding': 'chunked',
+            'X-Hop': 'hop',
+            'X-End': 'end',
+        })
+        self.assertEqual(
+            [('X-End', 'end')], streaming.relayed_headers(headers))
+
+    def test_decoded(self):
+        # The content encoding and length are not relayed if the body has
+        # been decoded by the HTTP client.
+        headers = httputil.HTTPHeaders({
+            'Content-Encoding': 'gzip',
+            'Content-Length': '42',
+            'Content-Type': 'text/plain',
+        })
+        self.assertEqual(
+            [('Content-Type', 'text/plain')],
+            streaming.relayed_headers(headers))
+
+
+class TestUploadStream(unittest.TestCase):
+
+    def setUp(self):
+        self.request = httpclient.HTTPRequest(
+            'https://example.com/path', method='POST', body='0123456789')
+        self.upload = streaming.UploadStream(
+            'https://example.com/path', self.request.body)
+        # Patch the curl module, which may not be available.
+        patcher = mock.patch(
+            'guiserver.streaming.pycurl',
+            mock.Mock(
+                READFUNCTION='read', IOCTLFUNCTION='ioctl',
+                IOCMD_RESTARTREAD='restart'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prepare_curl(self):
+        """Attach the upload and return the curl handle."""
+        self.upload.attach(self.request)
+        self.addCleanup(streaming._uploads.discard, self.upload)
+        curl = mock.Mock()
+        self.request.prepare_curl_callback(curl)
+        return curl
+
+    def test_curl_setup(self):
+        # The body is read from the upload stream.
+        curl = self.prepare_curl()
+        curl.setopt.assert_has_calls([
+            mock.call('read', self.upload.read),
+            mock.call('ioctl', self.upload._ioctl),
+        ])
+
+    def test_previous_curl_callback(self):
+        # A previously set curl callback is preserved.
+        callback = self.request.prepare_curl_callback = mock.Mock()
+        curl = self.prepare_curl()
+        callback.assert_called_once_with(curl)
+
+    def test_read(self):
+        # The body is returned in slices, and the progress is tracked.
+        value = streaming._uploaded_bytes.value
+        self.prepare_curl()
+        self.assertEqual('0123', self.upload.read(4))
+        self.assertEqual(4, self.upload.sent)
+        self.assertEqual('456789', self.upload.read(8))
+        self.assertEqual('', self.upload.read(8))
+        self.assertEqual(10, self.upload.sent)
+        self.assertEqual(value + 10, streaming._uploaded_bytes.value)
+
+    def test_restart(self):
+        # The body can be sent again, without counting the bytes twice.
+        value = streaming._uploaded_bytes.value
+        self.prepare_curl()
+        self.upload.read(4)
+        self.upload._ioctl('restart')
+        self.assertEqual('012345', self.upload.read(6))
+        self.assertEqual(6, self.upload.sent)
+        self.assertEqual(value + 6, streaming._uploaded_bytes.value)
+
+    @mock.patch('time.time', mock.Mock(return_value=10))
+    def test_status(self):
+        # The progress of the uploads is reported.
+        self.prepare_curl()
+        self.upload.read(3)
+        expected = {
+            'url': 'https://example.com/path',
+            'size': 10,
+            'sent': 3,
+            'elapsed': 0,
+        }
+        self.assertEqual(expected, self.upload.status())
+        self.assertEqual([expected], streaming.uploads_status())
+
+    def test_finish(self):
+        # Completed uploads are no longer tracked, and their throughput is
+        # recorded.
+        gauge = streaming._uploads_in_flight
+        summary = streaming._upload_throughput
+        value, count, total = gauge.value, summary.count, summary.sum
+        with mock.patch('time.time', mock.Mock(return_value=10)):
+            self.prepare_curl()
+            self.assertEqual(value + 1, gauge.value)
+            self.upload.read(10)
+        with mock.patch('time.time', mock.Mock(return_value=12)):
+            self.upload.finish()
+        self.assertEqual(value, gauge.value)
+        self.assertEqual([], streaming.uploads_status())
+        self.assertEqual(count + 1, summary.count)
+        self.assertEqual(total + 5, summary.sum)
@@ -25,6 +25,7 @@ from tornado import (
     gen,
     httpclient,
     httpserver,
+    httputil,
 )
 from tornado.testing import (
     AsyncTestCase,
@@ -110,6 +111,58 @@ class TestCloneRequest(unittest.TestCase):
         request = utils.clone_request(self.request, 'http://example.com')
         self.assertIsInstance(request, httpclient.HTTPRequest)
 
+    def test_hop_by_hop_headers(self):
+        # Hop-by-hop headers are not included in the resulting request.
+        original = httpserver.HTTPRequest('GET', '/test/', headers={
+            'Connection': 'keep-alive',
+            'Keep-Alive': 'timeout=5',
+            'Accept': 'text/plain',
+        })
+        request = utils.clone_request(original, 'http://example.com/test')
+        self.assertEqual({'Accept': 'text/plain'}, request.headers)
+
+
+class TestEndToEndHeaders(unittest.TestCase):
+
+    def test_hop_by_hop(self):
+        # Standard hop-by-hop headers are removed.
+        headers = httputil.HTTPHeaders({
+            'Proxy-Authorization': 'Basic auth',
+            'TE': 'trailers',
+            'Trailer': 'Expires',
+            'Transfer-Encoding': 'chunked',
+            'Upgrade': 'h2c',
+            'Accept': 'text/plain',
+        })
+        self.assertEqual(
+            {'Accept': 'text/plain'}, utils.end_to_end_headers(headers))
+
+    def test_connection_headers(self):
+        # The headers listed in the Connection header are removed.
+        headers = httputil.HTTPHeaders({
+            'Connection': 'X-First, x-second',
+            'X-First': '1',
+            'X-Second': '2',
+            'X-Third': '3',
+        })
+        self.assertEqual(
+            {'X-Third': '3'}, utils.end_to_end_headers(headers))
+
+    def test_multiple_values(self):
+        # Headers with multiple values are preserved.
+        headers = httputil.HTTPHeaders()
+        headers.add('Set-Cookie', 'a=1')
+        headers.add('Set-Cookie', 'b=2')
+        result = utils.end_to_end_headers(headers)
+        self.assertIsInstance(result, httputil.HTTPHeaders)
+        self.assertEqual(['a=1', 'b=2'], result.get_list('Set-Cookie'))
+
+    def test_copy(self):
+        # The original headers are not modified.
+        headers = httputil.HTTPHeaders({'Connection': 'close'})
+        utils.end_to_end_headers(headers)
+        self.assertEqual({'Connection': 'close'}, headers)
+
 
 class TestGetHeaders(unittest.TestCase):
 
@@ -127,6 +180,20 @@ class TestGetHeaders(unittest.TestCase):
         self.assertEqual({'Origin': 'https://server.example.com'}, headers)
 
 
+class TestGetEnvironmentUuid(unittest.TestCase):
+
+    def test_uuid(self):
+        # The environment UUID is returned.
+        uuid = utils.get_environment_uuid(
+            'wss://1.2.3.4:17070/environment/env-uuid/api')
+        self.assertEqual('env-uuid', uuid)
+
+    def test_no_uuid(self):
+        # None is returned if the URL does not include the UUID.
+        uuid = utils.get_environment_uuid('wss://1.2.3.4:17070')
+        self.assertIsNone(uuid)
+
+
 class TestGetJujuApiUrl(unittest.TestCase):
 
     template = '/api/$server/$port/$uuid'
@@ -150,6 +217,60 @@ class TestGetJujuApiUrl(unittest.TestCase):
         self.assertEqual('wss://1.2.3.4:47/environment/uuid/api', url)
 
 
+class TestIsNotModified(unittest.TestCase):
+
+    last_modified = 'Tue, 15 Nov 1994 08:12:31 GMT'
+
+    def make_request(self, method='GET', **headers):
+        return httpserver.HTTPRequest(method, '/path', headers=headers)
+
+    def test_no_conditions(self):
+        # Unconditional requests always require the response.
+        request = self.make_request()
+        self.assertFalse(
+            utils.is_not_modified(request, '"v1"', self.last_modified))
+
+    def test_if_none_match(self):
+        # Entity tags are compared using the weak comparison.
+        for tags in ('"v1"', 'W/"v1"', '"v0", "v1"', '*'):
+            request = self.make_request(**{'If-None-Match': tags})
+            self.assertTrue(utils.is_not_modified(request, '"v1"'), tags)
+            self.assertTrue(utils.is_not_modified(request, 'W/"v1"'), tags)
+        request = self.make_request(**{'If-None-Match': '"v0"'})
+        self.assertFalse(utils.is_not_modified(request, '"v1"'))
+        self.assertFalse(utils.is_not_modified(request))
+
+    def test_if_modified_since(self):
+        # Responses not modified after the given date are not modified.
+        for since, expected in (
+                ('Tue, 15 Nov 1994 08:12:31 GMT', True),
+                ('Wed, 16 Nov 1994 08:12:31 GMT', True),
+                ('Mon, 14 Nov 1994 08:12:31 GMT', False),
+                ('invalid', False)):
+            request = self.make_request(**{'If-Modified-Since': since})
+            self.assertEqual(
+                expected,
+                utils.is_not_modified(
+                    request, last_modified=self.last_modified),
+                since)
+        request = self.make_request(**{'If-Modified-Since': since})
+        self.assertFalse(utils.is_not_modified(request))
+
+    def test_if_none_match_precedence(self):
+        # If-Modified-Since is ignored if If-None-Match is present.
+        request = self.make_request(**{
+            'If-None-Match': '"v0"',
+            'If-Modified-Since': self.last_modified,
+        })
+        self.assertFalse(
+            utils.is_not_modified(request, '"v1"', self.last_modified))
+
+    def test_unsafe_methods(self):
+        # Conditions are only evaluated for GET and HEAD requests.
+        request = self.make_request('POST', **{'If-None-Match': '*'})
+        self.assertFalse(utils.is_not_modified(request, '"v1"'))
+
+
 class TestJoinUrl(unittest.TestCase):
 
     def test_url_parts(self):
@@ -208,6 +329,35 @@ class TestJsonDecodeDict(unittest.TestCase):
             self.assertIsNone(utils.json_decode_dict('"not-a-dict"'))
 
 
+class TestMessageRequiresDecoding(unittest.TestCase):
+
+    markers = ('"Deployer"', '"ChangeSet"')
+
+    def test_marker_found(self):
+        # True is returned if the message includes one of the markers.
+        message = json.dumps({'Type': 'Deployer', 'Request': 'Import'})
+        self.assertTrue(utils.message_requires_decoding(message, self.markers))
+
+    def test_marker_not_found(self):
+        # False is returned if the message does not include any markers.
+        message = json.dumps({'Type': 'Client', 'Request': 'FullStatus'})
+        self.assertFalse(
+            utils.message_requires_decoding(message, self.markers))
+
+    def test_leading_whitespace(self):
+        # Leading whitespace is ignored when looking for a JSON object.
+        message = '  \n{"Type": "Client"}'
+        self.assertFalse(
+            utils.message_requires_decoding(message, self.markers))
+
+    def test_not_an_object(self):
+        # True is returned if the message does not look like a JSON object.
+        for message in ('not-json', '"not-a-dict"', '[1, 2]', ''):
+            self.assertTrue(
+                utils.message_requires_decoding(message, self.markers),
+                message)
+
+
 class TestRequestSummary(unittest.TestCase):
 
     def test_summary(self):
@@ -216,6 +366,14 @@ class TestRequestSummary(unittest.TestCase):
         summary = utils.request_summary(request)
         self.assertEqual('GET /path (127.0.0.1)', summary)
 
+    def test_redacted(self):
+        # Resume tokens are not included in the summary.
+        request = mock.Mock(
+            method='GET', uri='/ws?resume=secret&flag=1',
+            remote_ip='127.0.0.1')
+        summary = utils.request_summary(request)
+        self.assertEqual('GET /ws?resume=REDACTED&flag=1 (127.0.0.1)', summary)
+
 
 class TestWrapWriteMessage(unittest.TestCase):
 
@@ -263,6 +421,19 @@ class TestWrapWriteMessage(unittest.TestCase):
         self.assertEqual(snowman, json.loads(self.messages[0]))
 
 
+class TestWatchIOLoopLag(AsyncTestCase):
+
+    @gen_test
+    def test_lag(self):
+        # The IO loop lag is periodically recorded.
+        histogram = utils._ioloop_lag_histogram
+        count = histogram.count
+        utils.watch_ioloop_lag(self.io_loop, interval=0.01)
+        yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.05)
+        self.assertGreater(histogram.count, count + 1)
+        self.assertGreaterEqual(utils._ioloop_lag.value, 0)
+
+
 class TestWsToHttp(unittest.TestCase):
 
     def test_websocket(self):
@@ -17,6 +17,10 @@
 """Juju GUI server utility functions and classes."""
 
 import collections
+from email.utils import (
+    mktime_tz,
+    parsedate_tz,
+)
 import functools
 import logging
 import re
@@ -26,8 +30,32 @@ import weakref
 from tornado import (
     escape,
     httpclient,
+    httputil,
 )
 
+from guiserver import metrics
+
+
+# Find the environment UUID in a Juju API URL.
+_environment_uuid = re.compile(r'/environment/([^/]+)/api$').search
+# Match the beginning of a string representing a JSON object.
+_json_object_start = re.compile(r'\s*\{').match
+# Replace the values of the query arguments which must not be logged, like
+# session resume tokens.
+_redact_arguments = re.compile(r'([?&]resume=)[^&#]*').sub
+# The hop-by-hop headers only apply to a single connection, and must not be
+# forwarded by proxies (see RFC 7230 section 6.1).
+_HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade'])
+
+_ioloop_lag = metrics.gauge(
+    'ioloop_lag_seconds',
+    'How late the IO loop ran the last periodic lag check.')
+_ioloop_lag_histogram = metrics.histogram(
+    'ioloop_lag_check_seconds',
+    'How late the IO loop ran the periodic lag checks.')
+
 
 def add_future(io_loop, future, callback, *args):
     """Schedule a callback on the IO loop when the given Future is finished.
@@ -45,8 +73,26 @@ def clone_request(request, url, validate_cert=True):
     usually an instance of tornado.httpserver.HTTPRequest.
     """
     return httpclient.HTTPRequest(
-        url, body=request.body or None, headers=request.headers,
-        method=request.method, validate_cert=validate_cert)
+        url, body=request.body or None,
+        headers=end_to_end_headers(request.headers), method=request.method,
+        validate_cert=validate_cert)
+
+
+def end_to_end_headers(headers):
+    """Return a copy of the given headers without the hop-by-hop ones.
+
+    The headers listed in the Connection header are also hop-by-hop. The
+    returned value is an httputil.HTTPHeaders instance.
+    """
+    headers = httputil.HTTPHeaders(headers)
+    hop_by_hop = set(_HOP_BY_HOP_HEADERS)
+    for value in headers.get_list('Connection'):
+        hop_by_hop.update(name.strip().lower() for name in value.split(','))
+    result = httputil.HTTPHeaders()
+    for name, value in headers.get_all():
+        if name.lower() not in hop_by_hop:
+            result.add(name, value)
+    return result
 
 
 def get_headers(request, websocket_url):
@@ -62,6 +108,18 @@ def get_headers(request, websocket_url):
     return {'Origin': origin}
 
 
+def get_environment_uuid(apiurl):
+    """Return the environment UUID included in the given Juju API URL.
+
+    The apiurl argument is a URL like those returned by get_juju_api_url.
+    Return None if the URL does not include the environment UUID.
+    """
+    match = _environment_uuid(apiurl)
+    if match is None:
+        return None
+    return match.group(1)
+
+
 def get_juju_api_url(path, template, default):
     """Return the Juju WebSocket API fully qualified URL.
 
@@ -84,6 +142,39 @@ def get_juju_api_url(path, template, default):
         **match.groupdict())
 
 
+def is_not_modified(request, etag=None, last_modified=None):
+    """Return True if the browser copy of the response is still valid.
+
+    Receive the browser request (usually a tornado.httpserver.HTTPRequest)
+    and the ETag and Last-Modified validators of the response, if any.
+    As required by RFC 7232, If-Modified-Since is ignored if If-None-Match is
+    present, and entity tags are compared using the weak comparison.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        tags = [_strip_weak(tag) for tag in if_none_match.split(',')]
+        return '*' in tags or _strip_weak(etag) in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    since, modified = map(parsedate_tz, (if_modified_since, last_modified))
+    if since is None or modified is None:
+        return False
+    return mktime_tz(modified) <= mktime_tz(since)
+
+
+def _strip_weak(tag):
+    """Return the given entity tag without the weakness indicator."""
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        return tag[2:]
+    return tag
+
+
 def join_url(base_url, path, query):
     """Create and return an URL string joining the given parts.
 
@@ -114,9 +205,53 @@ def json_decode_dict(message):
     return data
 
 
+def message_requires_decoding(message, markers):
+    """Return True if the given raw JSON message must be fully decoded.
+
+    This is a cheap scan of the message string, used to avoid decoding the
+    messages that are just forwarded unchanged. The markers argument is a
+    sequence of strings (e.g. quoted request types like '"Deployer"'):
+    if any of them is included in the message, True is returned. True is also
+    returned if the message does not look like a JSON object, so that invalid
+    messages are still reported by the decoder. False positives are harmless:
+    they just cause the message to be decoded.
+    """
+    if _json_object_start(message) is None:
+        return True
+    for marker in markers:
+        if marker in message:
+            return True
+    return False
+
+
 def request_summary(request):
-    """Return a string representing a summary for the given request."""
-    return '{} {} ({})'.format(request.method, request.uri, request.remote_ip)
+    """Return a string representing a summary for the given request.
+
+    Secrets included in the query string, like resume tokens, are redacted.
+    """
+    uri = _redact_arguments(r'\1REDACTED', request.uri)
+    return '{} {} ({})'.format(request.method, uri, request.remote_ip)
+
+
+def watch_ioloop_lag(io_loop, interval=1):
+    """Periodically measure the IO loop lag.
+
+    A callback is scheduled every interval seconds: the delay between the
+    time the callback was scheduled for and the time it is actually run is
+    recorded in the ioloop_lag_seconds metrics. A high lag means that the
+    IO loop is blocked by long running operations.
+    """
+    def check(deadline):
+        lag = max(io_loop.time() - deadline, 0)
+        _ioloop_lag.set(lag)
+        _ioloop_lag_histogram.observe(lag)
+        schedule()
+
+    def schedule():
+        deadline = io_loop.time() + interval
+        io_loop.add_timeout(deadline, functools.partial(check, deadline))
+
+    schedule()
 
 
 def wrap_write_message(handler):
@@ -38,10 +38,12 @@ setup(
     keywords='juju gui server',
     packages=[
         PROJECT_NAME,
+        '{}.benchmarks'.format(PROJECT_NAME),
         '{}.bundles'.format(PROJECT_NAME),
         '{}.tests'.format(PROJECT_NAME),
         '{}.tests.bundles'.format(PROJECT_NAME),
     ],
+    package_data={PROJECT_NAME: ['static/*.svg']},
     scripts=['runserver.py'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -36,6 +36,7 @@ from utils import (
     _get_by_attr,
     cmd_log,
     get_api_address,
+    get_api_addresses,
     get_launchpad_release,
     get_port,
     get_release_file_path,
@@ -134,6 +135,19 @@ class TestGetApiAddress(unittest.TestCase):
         with self.agent_file(addresses) as (unit_dir, _):
             self.assertEqual(self.agent_address, get_api_address(unit_dir))
 
+    def test_all_addresses_in_env(self):
+        # All the API addresses listed in the environment can be retrieved.
+        addresses = '{} foo.example.com:42'.format(self.env_address)
+        with environ(JUJU_API_ADDRESSES=addresses):
+            self.assertEqual(
+                [self.env_address, 'foo.example.com:42'], get_api_addresses())
+
+    def test_all_addresses_in_agent_file(self):
+        # All the API addresses listed in the agent file can be retrieved.
+        addresses = [self.agent_address, 'foo.example.com:42']
+        with self.agent_file(addresses) as (unit_dir, _):
+            self.assertEqual(addresses, get_api_addresses(unit_dir))
+
     def test_missing_env_and_agent_file(self):
         # An IOError is raised if the agent configuration file is not found.
         with self.agent_file() as (unit_dir, machine_dir):
@@ -631,7 +645,9 @@ class TestStartGui(unittest.TestCase):
             su=(utils.su, su),
             run=(utils.run, run),
             render_to_file=(utils.render_to_file, render_to_file),
-            get_api_address=(utils.get_api_address, noop),
+            get_api_addresses=(
+                utils.get_api_addresses,
+                lambda: ['1.2.3.4:17070', '1.2.3.5:17070']),
         )
         # Apply the patches.
         for fn, fcns in self.utils_names.items():
@@ -659,8 +675,11 @@ class TestStartGui(unittest.TestCase):
         guiserver_conf = self.files['guiserver.conf']
         self.assertIn('description "GUIServer"', guiserver_conf)
         self.assertIn('--logging="info"', guiserver_conf)
-        # The get_api_address is noop'd in these tests so the addr is None.
-        self.assertIn('--apiurl="wss://None"', guiserver_conf)
+        # The first API address is used as the API URL, and all the addresses
+        # are passed to the server.
+        self.assertIn('--apiurl="wss://1.2.3.4:17070"', guiserver_conf)
+        self.assertIn(
+            '--apiaddresses="1.2.3.4:17070,1.2.3.5:17070"', guiserver_conf)
         self.assertIn('--apiversion="go"', guiserver_conf)
         self.assertIn(
             '--testsroot="{}/test/"'.format(JUJU_GUI_DIR), guiserver_conf)
@@ -678,6 +697,53 @@ class TestStartGui(unittest.TestCase):
         guiserver_conf = self.files['guiserver.conf']
         self.assertIn('--port=8000', guiserver_conf)
 
+    def test_write_builtin_server_startup_processes(self):
+        # The number of GUI server processes is passed to the server.
+        write_builtin_server_startup(self.ssl_cert_path)
+        self.assertIn('--processes=1', self.files['guiserver.conf'])
+        write_builtin_server_startup(self.ssl_cert_path, processes=8)
+        self.assertIn('--processes=8', self.files['guiserver.conf'])
+
+    def test_write_builtin_server_startup_proxy_pool(self):
+        # The juju-core HTTPS proxy connection settings are passed to the
+        # server.
+        write_builtin_server_startup(self.ssl_cert_path)
+        guiserver_conf = self.files['guiserver.conf']
+        self.assertIn('--proxymaxclients=20', guiserver_conf)
+        self.assertIn('--proxyconnecttimeout=20', guiserver_conf)
+        self.assertIn('--proxyrequesttimeout=20', guiserver_conf)
+        self.assertIn('--proxyqueuetimeout=10', guiserver_conf)
+        self.assertIn('--proxybreakerfailures=0', guiserver_conf)
+        self.assertNotIn('--proxykeepalive', guiserver_conf)
+        write_builtin_server_startup(
+            self.ssl_cert_path, proxy_max_clients=50, proxy_keep_alive=False,
+            proxy_connect_timeout=5, proxy_request_timeout=60,
+            proxy_queue_timeout=0, proxy_breaker_failures=5)
+        guiserver_conf = self.files['guiserver.conf']
+        self.assertIn('--proxymaxclients=50', guiserver_conf)
+        self.assertIn('--proxyconnecttimeout=5', guiserver_conf)
+        self.assertIn('--proxyrequesttimeout=60', guiserver_conf)
+        self.assertIn('--proxyqueuetimeout=0', guiserver_conf)
+        self.assertIn('--proxybreakerfailures=5', guiserver_conf)
+        self.assertIn('--proxykeepalive=false', guiserver_conf)
+
+    def test_write_builtin_server_startup_websocket_compression(self):
+        # WebSocket compression is only enabled if requested.
+        write_builtin_server_startup(self.ssl_cert_path)
+        guiserver_conf = self.files['guiserver.conf']
+        self.assertIn('--gzip', guiserver_conf)
+        self.assertNotIn('--wsdeflate', guiserver_conf)
+        write_builtin_server_startup(
+            self.ssl_cert_path, websocket_compression=True)
+        self.assertIn('--wsdeflate', self.files['guiserver.conf'])
+
+    def test_write_builtin_server_startup_api_reconnect(self):
+        # Reconnections to the Juju API are only enabled if requested.
+        write_builtin_server_startup(self.ssl_cert_path)
+        self.assertNotIn('--apireconnect', self.files['guiserver.conf'])
+        write_builtin_server_startup(self.ssl_cert_path, api_reconnect=3)
+        self.assertIn('--apireconnect=3', self.files['guiserver.conf'])
+
     def test_write_builtin_server_startup_sandbox_and_logging(self):
         # The upstart configuration file for the GUI server is correctly
         # generated when the GUI is in sandbox mode and when a customized log